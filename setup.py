@@ -14,6 +14,9 @@ extensions = [
               define_macros=define_macros),
     Extension('scilpy.tractanalysis.streamlines_metrics',
               ['src/scilpy/tractanalysis/streamlines_metrics.pyx'],
+              define_macros=define_macros),
+    Extension('scilpy.tracking.propagation_kernel',
+              ['src/scilpy/tracking/propagation_kernel.pyx'],
               define_macros=define_macros)]
 
 # This is the function that is executed
@@ -68,7 +68,6 @@ See our other scripts to help you achieve your goals:
 import argparse
 import itertools
 import logging
-import multiprocessing
 import os
 
 import coloredlogs
@@ -77,9 +76,7 @@ import nibabel as nib
 import numpy as np
 import scipy.ndimage as ndi
 
-from scilpy.connectivity.connectivity import \
-    compute_connectivity_matrices_from_hdf5, \
-    multi_proc_compute_connectivity_matrices_from_hdf5
+from scilpy.connectivity.connectivity import compute_connectivity_matrices
 from scilpy.image.labels import get_data_as_labels
 from scilpy.io.hdf5 import assert_header_compatible_hdf5
 from scilpy.io.image import get_data_as_mask
@@ -162,7 +159,6 @@ def check_inputs_outputs(parser, args):
         optional_output_matrices.extend([m[1] for m in args.metrics])
     if args.lesion_load is not None:
         optional_input_volumes.append(args.lesion_load[0])
-        optional_output_matrices.append(args.lesion_load[1])
     if args.similarity is not None:
         optional_output_matrices.append(args.similarity[1])
         # Note. Inputs in the --similarity folder are not checked yet!
@@ -190,24 +186,6 @@ def check_inputs_outputs(parser, args):
                          .format(m))
 
 
-def fill_matrix_and_save(measures_dict, labels_list, measure_keys, filenames):
-    matrix = np.zeros((len(labels_list), len(labels_list), len(measure_keys)))
-
-    # Run one loop on node. Fill all matrices at once.
-    for label_key, node_values in measures_dict.items():
-        in_label, out_label = label_key
-        for i, measure_key in enumerate(measure_keys):
-            in_pos = labels_list.index(in_label)
-            out_pos = labels_list.index(out_label)
-            matrix[in_pos, out_pos, i] = node_values[measure_key]
-            matrix[out_pos, in_pos, i] = node_values[measure_key]
-
-    for i, f in enumerate(filenames):
-        logging.info("Saving resulting {} in file {}"
-                     .format(measure_keys[i], f))
-        np.save(f, matrix[:, :, i])
-
-
 def main():
     parser = _build_arg_parser()
     args = parser.parse_args()
@@ -264,62 +242,21 @@ def main():
     if not args.no_self_connection:
         comb_list.extend(zip(labels_list, labels_list))
 
-    # Running everything!
+    # Running everything! Each connection is read once, and all matrices
+    # are filled at once.
     nbr_cpu = validate_nbr_processes(parser, args)
-    outputs = []
-    if nbr_cpu == 1:
-        for comb in comb_list:
-            outputs.append(compute_connectivity_matrices_from_hdf5(
-                args.in_hdf5, img_labels, comb[0], comb[1],
-                compute_volume, compute_streamline_count, compute_length,
-                similarity_directory, metrics_data, metrics_names,
-                lesion_data, args.include_dps, args.density_weighting,
-                args.min_lesion_vol))
-    else:
-        pool = multiprocessing.Pool(nbr_cpu)
-
-        # Dividing the process bundle by bundle
-        outputs = pool.map(
-            multi_proc_compute_connectivity_matrices_from_hdf5,
-            zip(itertools.repeat(args.in_hdf5),
-                itertools.repeat(img_labels),
-                comb_list,
-                itertools.repeat(compute_volume),
-                itertools.repeat(compute_streamline_count),
-                itertools.repeat(compute_length),
-                itertools.repeat(similarity_directory),
-                itertools.repeat(metrics_data),
-                itertools.repeat(metrics_names),
-                itertools.repeat(lesion_data),
-                itertools.repeat(args.include_dps),
-                itertools.repeat(args.density_weighting),
-                itertools.repeat(args.min_lesion_vol)
-                ))
-        pool.close()
-        pool.join()
-
-    # Removing None entries (combinaisons that do not exist)
-    outputs = [it for it in outputs if it is not None]
-    if len(outputs) == 0:
-        raise ValueError('No connection found at all! Matrices would be '
-                         'all-zeros. Exiting.')
-
-    measures_dict_list = [it[0] for it in outputs]
-    dps_keys = [it[1] for it in outputs]
-
-    # Verify that all bundles had the same dps_keys
-    if len(dps_keys) > 1 and not dps_keys[1:] == dps_keys[:-1]:
-        raise ValueError("DPS keys not consistant throughout the hdf5 "
-                         "connections. Verify your tractograms, or do not "
-                         "use --include_dps.")
-    dps_keys = dps_keys[0]
-
-    # Fusing the multiprocessing output into a single dictionary
-    measures_dict = {}
-    for node in measures_dict_list:
-        measures_dict.update(node)
-
-    # Filling out all the matrices (symmetric) in the order of labels_list
+    matrices, dps_keys = compute_connectivity_matrices(
+        args.in_hdf5, img_labels, labels_list, comb_list, nbr_cpu,
+        compute_volume=compute_volume,
+        compute_streamline_count=compute_streamline_count,
+        compute_length=compute_length,
+        similarity_directory=similarity_directory,
+        metrics_data=metrics_data, metrics_names=metrics_names,
+        lesion_data=lesion_data, include_dps=args.include_dps,
+        weighted=args.density_weighting,
+        min_lesion_vol=args.min_lesion_vol)
+
+    # Saving the matrices (symmetric, in the order of labels_list)
     keys = []
     filenames = []
     if compute_volume:
@@ -347,7 +284,9 @@ def main():
         keys.extend(dps_keys)
         filenames.extend([os.path.join(args.include_dps, "{}.npy".format(k))
                           for k in dps_keys])
-    fill_matrix_and_save(measures_dict, labels_list, keys, filenames)
+    for key, filename in zip(keys, filenames):
+        logging.info("Saving resulting {} in file {}".format(key, filename))
+        np.save(filename, matrices[key])
 
 
 if __name__ == "__main__":
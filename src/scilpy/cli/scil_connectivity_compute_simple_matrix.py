@@ -20,6 +20,10 @@ In the output figure, 4 matrices are shown, all using the streamline count:
 
 You may select which matrix to save to disk (as .npy) using options --binary or
 --percentage. Default ouput matrix is the raw count.
+
+With a high number of labels (ex, voxel-wise connectomes), use a .npz output:
+the matrix is then computed and saved as a scipy sparse matrix. You will
+probably want to use --hide_fig, as the figure needs the dense matrix.
 """
 
 import argparse
@@ -39,7 +43,7 @@ from scilpy.image.labels import get_data_as_labels
 from scilpy.io.streamlines import load_tractogram_with_reference
 from scilpy.io.utils import assert_inputs_exist, assert_outputs_exist, \
     add_verbose_arg, add_overwrite_arg, assert_headers_compatible, \
-    add_reference_arg
+    add_reference_arg, save_matrix_in_any_format
 from scilpy.version import version_string
 
 
@@ -53,7 +57,7 @@ def _build_arg_parser():
     p.add_argument('in_labels',
                    help='Input nifti volume.')
     p.add_argument('out_matrix',
-                   help="Out .npy file.")
+                   help="Out .npy file, or .npz for a sparse matrix.")
     p.add_argument('out_labels',
                    help="Out .txt file. Will show the ordered labels (i.e. "
                         "the columns and lines' tags).")
@@ -74,7 +78,7 @@ def _build_arg_parser():
                    help="If set, saves the figure to file. \nExtension can be "
                         "any format understood by matplotlib (ex, .png).")
 
-    g = p.add_argument_group("Output matrix (.npy) options")
+    g = p.add_argument_group("Output matrix options")
     g = g.add_mutually_exclusive_group()
     g.add_argument('--binary', action='store_true',
                    help="If set, saves the result as binary. Else, the "
@@ -128,8 +132,9 @@ def main():
 
     # Verifications
     tmp, ext = os.path.splitext(args.out_matrix)
-    if ext != '.npy':
-        p.error("out_matrix should have a .npy extension.")
+    if ext not in ['.npy', '.npz']:
+        p.error("out_matrix should have a .npy or .npz extension.")
+    use_sparse = ext == '.npz'
 
     assert_inputs_exist(p, [args.in_labels, args.in_tractogram],
                         args.reference)
@@ -146,11 +151,12 @@ def main():
     matrix, ordered_labels, _, _ = \
         compute_triu_connectivity_from_labels(
             in_sft, data_labels, keep_background=args.keep_background,
-            hide_labels=args.hide_labels)
+            hide_labels=args.hide_labels, sparse=use_sparse)
 
     # Save figure will all versions of the matrix.
     if (not args.hide_fig) or args.out_fig is not None:
-        prepare_figure_connectivity(matrix)
+        prepare_figure_connectivity(matrix.toarray() if use_sparse
+                                    else matrix)
 
         if args.out_fig is not None:
             plt.savefig(args.out_fig)
@@ -160,7 +166,7 @@ def main():
         matrix = matrix > 0
     elif args.percentage:
         matrix = matrix / matrix.sum() * 100
-    np.save(args.out_matrix, matrix)
+    save_matrix_in_any_format(args.out_matrix, matrix)
 
     # Save labels
     with open(args.out_labels, "w") as text_file:
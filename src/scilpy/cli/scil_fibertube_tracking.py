@@ -210,6 +210,10 @@ def _build_arg_parser():
     add_json_args(out_g)
     add_overwrite_arg(out_g)
     add_processes_arg(p)
+    p.add_argument('--use_shared_memory', action='store_true',
+                   help="With multiprocessing, share the fibertube data with "
+                        "the processes \nthrough shared memory instead of a "
+                        "temporary file on disk.")
     add_verbose_arg(p)
 
     return p
@@ -325,7 +329,8 @@ def main():
                       skip=args.skip,
                       verbose=args.verbose,
                       min_iter=1,
-                      append_last_point=args.keep_last_out_point)
+                      append_last_point=args.keep_last_out_point,
+                      use_shared_memory=args.use_shared_memory)
 
     start_time = time.time()
     logging.debug("Tracking...")
@@ -41,7 +41,8 @@ import argparse
 import logging
 
 from dipy.data import get_sphere
-from dipy.reconst.mcsd import MultiShellDeconvModel, multi_shell_fiber_response
+from dipy.reconst.mcsd import (MultiShellDeconvModel, SH_CONST,
+                               multi_shell_fiber_response)
 import nibabel as nib
 import numpy as np
 
@@ -203,19 +204,15 @@ def main():
                                          sh_order_max=args.sh_order)
 
     # Computing memsmt-CSD fit
-    memsmt_fit = fit_from_model(memsmt_model, data,
-                                mask=mask, nbr_processes=args.nbr_processes)
-
-    # memsmt_fit is a MultiVoxelFit.
-    #   - memsmt_fit.array_fit is a 3D np.ndarray, where value in each voxel is
-    #     a dipy.reconst.mcsd.MSDeconvFit object.
-    #   - When accessing memsmt_fit.all_shm_coeff, we get an array of shape
-    #     (x, y, z, n), where n is the number of fitted values.
-    shm_coeff = memsmt_fit.all_shm_coeff
+    # Only keeping the coefficients of the fits, of shape (x, y, z, n): the
+    # isotropic coefficients (CSF, GM) first, then the WM coefficients.
+    shm_coeff, _ = fit_from_model(memsmt_model, data, mask=mask,
+                                  nbr_processes=args.nbr_processes,
+                                  return_coeffs=True)
     shm_coeff = verify_failed_voxels_shm_coeff(shm_coeff)
 
-    vf = memsmt_fit.volume_fractions
-    vf = np.where(np.isnan(vf), 0, vf)
+    # As dipy's MSDeconvFit.volume_fractions.
+    vf = shm_coeff[..., :memsmt_model.response.iso + 1] / SH_CONST
 
     # Saving results
     if args.wm_out_fODF:
@@ -123,11 +123,11 @@ def main():
                                                 sh_order_max=sh_order)
 
     # Computing CSD fit
-    csd_fit = fit_from_model(csd_model, data,
-                             mask=mask, nbr_processes=args.nbr_processes)
+    shm_coeff, _ = fit_from_model(csd_model, data, mask=mask,
+                                  nbr_processes=args.nbr_processes,
+                                  return_coeffs=True)
 
     # Saving results
-    shm_coeff = csd_fit.shm_coeff
     shm_coeff = convert_sh_basis(shm_coeff, reg_sphere, mask=mask,
                                  input_basis='descoteaux07',
                                  output_basis=sh_basis,
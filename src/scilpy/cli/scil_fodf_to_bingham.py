@@ -86,8 +86,8 @@ def main():
     assert_outputs_exist(parser, args, args.out_bingham)
     assert_headers_compatible(parser, args.in_sh, args.mask)
 
+    # The SH are read by tiles during the fit.
     sh_im = nib.load(args.in_sh)
-    data = sh_im.get_fdata()
     mask = get_data_as_mask(nib.load(args.mask),
                             dtype=bool) if args.mask else None
 
@@ -97,7 +97,7 @@ def main():
 
     t0 = time.perf_counter()
     logging.info('Fitting Bingham functions.')
-    bingham = bingham_fit_sh(data, args.max_lobes,
+    bingham = bingham_fit_sh(sh_im, args.max_lobes,
                              abs_th=args.at, rel_th=args.rt,
                              min_sep_angle=args.min_sep_angle,
                              max_fit_angle=args.max_fit_angle,
@@ -42,6 +42,12 @@ implementations:
         to disable backward tracking. This option isn't available for CPU
         tracking.
 
+The OpenCL implementation can also run without a GPU, using an OpenCL CPU
+driver (ex, POCL) with `--use_gpu --device cpu`. Seeds are then tracked on
+all the CPU cores. With many devices of the chosen type, batches of seeds are
+sent to all of them (see --nbr_devices). Given a --seed, the streamlines do
+not depend on the device, the number of devices or the batch size.
+
 All the input nifti files must be in isotropic resolution.
 
 --------------------------------------------------------------------------------
@@ -86,6 +92,7 @@ DEFAULT_BATCH_SIZE = 10000
 DEFAULT_SH_INTERP = 'trilinear'
 DEFAULT_FWD_ONLY = False
 DEFAULT_GPU_SPHERE = 'repulsion724'
+DEFAULT_DEVICE = 'gpu'
 
 
 def _build_arg_parser():
@@ -125,6 +132,18 @@ def _build_arg_parser():
                        help='Approximate size of GPU batches (number\n'
                             'of streamlines to track in parallel).'
                             ' [{}]'.format(DEFAULT_BATCH_SIZE))
+    gpu_g.add_argument('--autotune_batch_size', action='store_true',
+                       default=None,
+                       help='Starting from --batch_size, increase the size '
+                            'of the batches\nof each device as long as it '
+                            'improves the tracking speed.')
+    gpu_g.add_argument('--device', default=None, choices=['gpu', 'cpu'],
+                       help='Type of OpenCL devices on which to run the '
+                            'tracking.\nUsing cpu requires an OpenCL CPU '
+                            'driver (ex, POCL). [{}]'.format(DEFAULT_DEVICE))
+    gpu_g.add_argument('--nbr_devices', default=None, type=int,
+                       help='Maximal number of OpenCL devices to use. '
+                            '[all devices]')
 
     out_g = add_out_options(p)
 
@@ -147,6 +166,10 @@ def main():
         batch_size = args.batch_size or DEFAULT_BATCH_SIZE
         sh_interp = args.sh_interp or DEFAULT_SH_INTERP
         forward_only = args.forward_only or DEFAULT_FWD_ONLY
+        autotune_batch_size = args.autotune_batch_size or False
+        device = args.device or DEFAULT_DEVICE
+        if args.nbr_devices is not None and args.nbr_devices < 1:
+            parser.error('--nbr_devices must be at least 1.')
         if args.algo != 'prob':
             parser.error('Algo `{}` not supported for GPU tracking. '
                          'Set --algo to `prob` for GPU tracking.'
@@ -161,6 +184,15 @@ def main():
         if args.forward_only is not None:
             parser.error('Invalid argument --forward_only. '
                          'Set --use_gpu to enable.')
+        if args.autotune_batch_size is not None:
+            parser.error('Invalid argument --autotune_batch_size. '
+                         'Set --use_gpu to enable.')
+        if args.device is not None:
+            parser.error('Invalid argument --device. '
+                         'Set --use_gpu to enable.')
+        if args.nbr_devices is not None:
+            parser.error('Invalid argument --nbr_devices. '
+                         'Set --use_gpu to enable.')
 
     assert_inputs_exist(parser, [args.in_odf, args.in_seed, args.in_mask])
     assert_outputs_exist(parser, args, args.out_tractogram)
@@ -276,7 +308,10 @@ def main():
             batch_size=batch_size,
             forward_only=forward_only,
             rng_seed=args.seed,
-            sphere=sphere)
+            sphere=sphere,
+            device_type=device,
+            nbr_devices=args.nbr_devices,
+            autotune_batch_size=autotune_batch_size)
 
     # save streamlines on-the-fly to file
     save_tractogram(streamlines_generator, tracts_format,
@@ -47,6 +47,7 @@ Reference:
 
 import argparse
 import logging
+import os
 import time
 
 import dipy.core.geometry as gm
@@ -73,6 +74,7 @@ from scilpy.tracking.utils import (add_mandatory_options_tracking,
                                    add_out_options, add_seeding_options,
                                    add_tracking_options,
                                    get_theta,
+                                   save_tractogram as save_tractogram_lazily,
                                    verify_streamline_length_options,
                                    verify_seed_options)
 from scilpy.version import version_string
@@ -161,6 +163,51 @@ def _build_arg_parser():
 
     m_g = p.add_argument_group('Memory options')
     add_processes_arg(m_g)
+    m_g.add_argument('--batch_size', type=int,
+                     help="If set, streamlines are propagated batch_size at "
+                          "the time, as \narrays, instead of one by one. "
+                          "Much faster, but not available \nwith RAP. "
+                          "Seeds are the same as in the default mode, but \n"
+                          "random samplings differ (probabilistic "
+                          "tracking). \nReproducible with a fixed "
+                          "--rng_seed.")
+    m_g.add_argument('--use_shared_memory', action='store_true',
+                     help="With multiprocessing, share the ODF data with "
+                          "the processes \nthrough shared memory instead of "
+                          "a temporary file on disk.")
+    m_g.add_argument('--precompute_sf', action='store_true',
+                     help="If set, the SF is computed on the sphere for all "
+                          "voxels before \ntracking, instead of at each "
+                          "step. Faster with --sh_interp nearest, or \n"
+                          "without --batch_size. The SF is kept in float32: "
+                          "memory \nusage is multiplied by about "
+                          "nb_directions / (2 * nb_coeffs).")
+    m_g.add_argument('--sf_cache_dir',
+                     help="If set, implies --precompute_sf. The SF is saved "
+                          "in this \ndirectory and memory-mapped rather than "
+                          "kept in memory. \nLater runs on the same ODF file "
+                          "(same path, header and \nmodification time) with "
+                          "the same sphere and basis reuse it.")
+    m_g.add_argument('--use_native_kernel', action='store_true',
+                     help="If set, streamlines are propagated by a compiled "
+                          "kernel instead \nof the Python loop. Same results, "
+                          "faster. Not available with \nRAP or with "
+                          "--batch_size.")
+    m_g.add_argument('--nbr_seeds_per_chunk', type=int,
+                     help="With multiprocessing, seeds are handed to the "
+                          "processes by chunks \nof nbr_seeds_per_chunk "
+                          "seeds, as soon as they are free. \nSmaller chunks "
+                          "balance the work better between processes. \n"
+                          "Results do not depend on this value. Default: "
+                          "about 8 \nchunks per process.")
+    m_g.add_argument('--chunk_size', type=int,
+                     help="If set, seeds are processed by chunks of "
+                          "chunk_size seeds, and \nstreamlines are written "
+                          "to disk as soon as their chunk is \nfinished: "
+                          "memory usage does not grow with the number of "
+                          "\nstreamlines. With multiprocessing, the order of "
+                          "the streamlines \nin the output depends on the "
+                          "processes.")
 
     add_out_options(p)
     add_verbose_arg(p)
@@ -190,6 +237,19 @@ def main():
         parser.error('No RAP method selected.')
     if not args.rap_method == "None" and args.rap_mask is None:
         parser.error('No RAP mask selected.')
+    if args.batch_size is not None:
+        if args.batch_size <= 0:
+            parser.error('Batch size must be > 0.')
+        if args.rap_mask is not None:
+            parser.error('Option --batch_size cannot be used with RAP.')
+    if args.use_native_kernel and (args.rap_mask is not None or
+                                   args.batch_size is not None):
+        parser.error('Option --use_native_kernel cannot be used with RAP or '
+                     'with --batch_size.')
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error('Chunk size must be > 0.')
+    if args.nbr_seeds_per_chunk is not None and args.nbr_seeds_per_chunk <= 0:
+        parser.error('Number of seeds per chunk must be > 0.')
 
     tracts_format = detect_format(args.out_tractogram)
     if tracts_format is not TrkFile:
@@ -272,11 +332,21 @@ def main():
     # in dipy.
     sh_basis, is_legacy = parse_sh_basis_arg(args)
 
+    # Identifying the ODF file in the SF cache without reading its data.
+    sf_cache_key = None
+    if args.sf_cache_dir:
+        stat = os.stat(args.in_odf)
+        sf_cache_key = '{}:{}:{}:{}'.format(
+            os.path.abspath(args.in_odf), stat.st_size, stat.st_mtime_ns,
+            odf_sh_img.header.binaryblock.hex())
+
     propagator = ODFPropagator(
         dataset, vox_step_size, args.rk_order, args.algo, sh_basis,
         args.sf_threshold, args.sf_threshold_init, theta, args.sphere,
         sub_sphere=args.sub_sphere,
-        space=our_space, origin=our_origin, is_legacy=is_legacy)
+        space=our_space, origin=our_origin, is_legacy=is_legacy,
+        precompute_sf=args.precompute_sf, sf_cache_dir=args.sf_cache_dir,
+        sf_cache_key=sf_cache_key)
 
     # ------- INSTANTIATING RAP OBJECT -------
     if args.rap_mask:
@@ -304,9 +374,25 @@ def main():
                       track_forward_only=args.forward_only,
                       skip=args.skip,
                       append_last_point=args.keep_last_out_point,
-                      rap=rap, verbose=args.verbose)
+                      rap=rap, batch_size=args.batch_size,
+                      use_shared_memory=args.use_shared_memory,
+                      nbr_seeds_per_chunk=args.nbr_seeds_per_chunk,
+                      use_native_kernel=args.use_native_kernel,
+                      verbose=args.verbose)
 
     start = time.time()
+    if args.chunk_size:
+        logging.info("Tracking and saving...")
+        # Streamlines are already filtered and compressed by the tracker.
+        # We tracked in vox, center, which is what is expected here.
+        save_tractogram_lazily(
+            tracker.track_generator(args.chunk_size), tracts_format,
+            mask_img, nbr_seeds, args.out_tractogram, 0, np.inf, None,
+            args.save_seeds, args.verbose)
+        logging.info("Tracked {} seeds in {:.2f} seconds."
+                     .format(nbr_seeds, time.time() - start))
+        return
+
     logging.info("Tracking...")
     streamlines, seeds = tracker.track()
 
@@ -8,20 +8,29 @@ This script correctly handles compressed streamlines.
 To get only a map of the endpoints, use option --endpoints_only. To get a
 separate map for the head and tail, see
 >> scil_bundle_compute_endpoints_map
+
+For very large tractograms (.trk or .tck), use --chunk_size: the tractogram is
+then never fully loaded, but read and processed by chunks of streamlines, in
+parallel with --processes.
 """
 
 import argparse
 import logging
+import os
 
+from dipy.io.utils import get_reference_info
 import numpy as np
 import nibabel as nib
 
 from scilpy.io.streamlines import load_tractogram_with_reference
-from scilpy.io.utils import (add_overwrite_arg, add_reference_arg,
-                             assert_inputs_exist, add_verbose_arg,
-                             assert_outputs_exist)
+from scilpy.io.utils import (add_overwrite_arg, add_processes_arg,
+                             add_reference_arg, assert_inputs_exist,
+                             add_verbose_arg, assert_outputs_exist,
+                             validate_nbr_processes)
 from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
 
+from scilpy.tractograms.lazy_tractogram_operations import \
+    lazy_compute_density_map
 from scilpy.tractograms.streamline_and_mask_operations import \
     get_endpoints_density_map
 from scilpy.version import version_string
@@ -49,6 +58,11 @@ def _build_arg_parser():
                    help='If set, will only use the endpoints.\n'
                         'To get a head and a tail maps, see '
                         'scil_bundle_compute_endpoints_map.')
+    p.add_argument('--chunk_size', type=int, metavar='NBR',
+                   help='If set, the tractogram is lazy-loaded and processed '
+                        'by chunks of NBR \nstreamlines (per process, ex: '
+                        '10000). Only for .trk and .tck files.')
+    add_processes_arg(p)
     add_reference_arg(p)
     add_verbose_arg(p)
     add_overwrite_arg(p)
@@ -70,18 +84,38 @@ def main():
                      'must be greater than 0 and smaller or equal to {}'
                      .format(args.binary, max_))
 
-    # Loading
-    sft = load_tractogram_with_reference(parser, args, args.in_tractogram)
-    sft.to_vox()
-    sft.to_corner()
-    transformation, dimensions, _, _ = sft.space_attributes
-
-    # Processing
-    if args.endpoints_only:
-        streamline_count = get_endpoints_density_map(sft)
+    nbr_cpu = validate_nbr_processes(parser, args)
+    if args.chunk_size is None and args.nbr_processes != 1:
+        parser.error('--processes can only be used with --chunk_size.')
+    elif args.chunk_size is not None:
+        _, ext = os.path.splitext(args.in_tractogram)
+        if ext not in ['.trk', '.tck']:
+            parser.error('--chunk_size can only be used with .trk or .tck '
+                         'files.')
+        if ext == '.tck' and args.reference is None:
+            parser.error('--reference is required with a .tck file.')
+        if args.chunk_size <= 0:
+            parser.error('--chunk_size must be greater than 0.')
+
+    # Loading and processing
+    if args.chunk_size is not None:
+        reference = args.reference or args.in_tractogram
+        transformation = get_reference_info(reference)[0]
+        streamline_count = lazy_compute_density_map(
+            args.in_tractogram, reference, args.chunk_size,
+            endpoints_only=args.endpoints_only, nbr_processes=nbr_cpu)
     else:
-        streamline_count = compute_tract_counts_map(sft.streamlines,
-                                                    dimensions)
+        sft = load_tractogram_with_reference(parser, args,
+                                             args.in_tractogram)
+        sft.to_vox()
+        sft.to_corner()
+        transformation, dimensions, _, _ = sft.space_attributes
+
+        if args.endpoints_only:
+            streamline_count = get_endpoints_density_map(sft)
+        else:
+            streamline_count = compute_tract_counts_map(sft.streamlines,
+                                                        dimensions)
 
     # Saving
     dtype_to_use = np.int32
@@ -22,6 +22,10 @@ connectivity matrix.
 
 By default, ignores the empty connections. To save them, use --save_empty.
 Note that data_per_point is never included.
+
+With --compression, the datasets are chunked and compressed: the file is
+smaller and scripts reading only part of a connection read less, at the cost
+of decompression (lzf is faster, gzip is smaller).
 """
 
 import argparse
@@ -64,6 +68,8 @@ def _build_arg_parser():
                    help='Include the data_per_streamline the metadata.')
     p.add_argument('--save_empty', action='store_true',
                    help='Save empty connections.')
+    p.add_argument('--compression', choices=['gzip', 'lzf'],
+                   help='Compress the datasets of the HDF5 file.')
 
     add_verbose_arg(p)
     add_overwrite_arg(p)
@@ -103,7 +109,8 @@ def main():
             group = hdf5_file.create_group(in_basename)
             dps = curr_sft.data_per_streamline if args.include_dps else {}
             construct_hdf5_group_from_streamlines(group, curr_sft.streamlines,
-                                                  dps=dps)
+                                                  dps=dps,
+                                                  compression=args.compression)
 
 
 if __name__ == "__main__":
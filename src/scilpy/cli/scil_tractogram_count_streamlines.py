@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Return the number of streamlines in a tractogram. Only support trk and tck in
-order to support the lazy loading from nibabel.
+Return the number of streamlines in a tractogram, without loading it.
+
+For trk, tck and trx files, the count written in the header is used. For the
+hdf5 files of scil_tractogram_segment_connections_from_labels, the streamlines
+of all connections are counted. The vtk, vtp, fib and dpy formats cannot be
+lazy-loaded: they are fully loaded.
 """
 
 import argparse
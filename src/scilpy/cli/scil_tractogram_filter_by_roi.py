@@ -63,6 +63,13 @@ Anisotropic data will affect each direction differently.
     When using --overwrite_distance, any filtering option with given criteria
 will have its DISTANCE value replaced.
 
+Voxel index
+-----------
+With --voxel_index, modes 'any' and 'all' use the voxels of the index instead
+of traversing the streamlines again for each ROI. Points lying exactly on a
+voxel face may then be assigned to another voxel, which can change the
+selection of these streamlines.
+
 Usage examples:
 ---------------
 - Filter out "bad streamlines" that have points out of the brain mask.
@@ -84,7 +91,6 @@ import glob
 import json
 import logging
 import os
-from copy import deepcopy
 
 import nibabel as nib
 import numpy as np
@@ -96,10 +102,12 @@ from scilpy.io.streamlines import (load_tractogram_with_reference,
                                    save_tractogram)
 from scilpy.io.utils import (add_json_args, add_overwrite_arg,
                              add_reference_arg, add_verbose_arg,
+                             add_voxel_index_arg,
                              assert_inputs_exist, assert_outputs_exist,
                              read_info_from_mb_bdo, assert_headers_compatible)
-from scilpy.segment.streamlines import (filter_cuboid, filter_ellipsoid,
-                                        filter_grid_roi)
+from scilpy.segment.streamlines import StreamlinesROIFilter
+from scilpy.tractograms.voxel_traversal_index import \
+    load_or_compute_voxel_traversal_index
 from scilpy.version import version_string
 
 MODES = ['any', 'all', 'either_end', 'both_ends']
@@ -163,6 +171,7 @@ def _build_arg_parser():
     p.add_argument('--save_rejected', metavar='FILENAME',
                    help='Save rejected streamlines to output tractogram.')
 
+    add_voxel_index_arg(p)
     add_json_args(p)
     add_reference_arg(p)
     add_verbose_arg(p)
@@ -374,15 +383,20 @@ def main():
         parser, args.drawn_roi, args.atlas_roi, args.bdo,
         args.x_plane, args.y_plane, args.z_plane, dim)
 
-    if args.save_rejected:
-        initial_sft = deepcopy(sft)
-
     # Processing
+    # Endpoints (and, with --voxel_index, the voxels traversed by the
+    # streamlines) are computed once and shared by all criteria. The output
+    # is only created at the end.
+    voxel_index = None
+    if args.voxel_index:
+        voxel_index = load_or_compute_voxel_traversal_index(
+            sft, args.voxel_index, overwrite=args.overwrite)
+    roi_filter = StreamlinesROIFilter(sft, voxel_index=voxel_index)
 
     o_dict = {'streamline_count_before_filtering': len(sft.streamlines)}
 
     atlas_roi_item = 0
-    total_kept_ids = np.arange(len(sft.streamlines))
+    total_kept = np.ones(len(sft.streamlines), dtype=bool)
     for i, roi_opt in enumerate(roi_opt_list):
         logging.info("Preparing filtering from option: {}".format(roi_opt))
 
@@ -424,8 +438,7 @@ def main():
                     img = nib.Nifti1Image(mask, img.affine)
                     img.to_filename(filename)
 
-            kept_ids, filtered_sft = filter_grid_roi(
-                sft, mask, mode, is_exclude, distance, return_sft=True)
+            kept = roi_filter.in_mask(mask, mode, is_exclude, distance)
 
         elif filter_type in ['x_plane', 'y_plane', 'z_plane']:
             # FILTERING FROM PLANE
@@ -438,8 +451,7 @@ def main():
             elif filter_type == 'z_plane':
                 mask[:, :, plane_id] = 1
 
-            kept_ids, filtered_sft = filter_grid_roi(
-                sft, mask, mode, is_exclude, distance, return_sft=True)
+            kept = roi_filter.in_mask(mask, mode, is_exclude, distance)
 
         else:  # filter_type == 'bdo':
             # FILTERING FROM BOUNDING BOX
@@ -449,37 +461,30 @@ def main():
                 radius += distance * sft.space_attributes[2]
 
             if geometry == 'Ellipsoid':
-                kept_ids, filtered_sft = filter_ellipsoid(
-                    sft, radius, center, mode, is_exclude)
+                kept = roi_filter.in_ellipsoid(radius, center, mode,
+                                               is_exclude)
             else:  # geometry == 'Cuboid':
-                kept_ids, filtered_sft = filter_cuboid(
-                    sft, radius, center, mode, is_exclude)
+                kept = roi_filter.in_cuboid(radius, center, mode, is_exclude)
 
+        total_kept &= kept
+        nb_kept = int(np.count_nonzero(total_kept))
         logging.info('The filtering options {} resulted in {} included '
-                     'streamlines'.format(roi_opt, len(filtered_sft)))
+                     'streamlines'.format(roi_opt, nb_kept))
 
-        sft = filtered_sft
-        if kept_ids.size == 0:
-            total_kept_ids = 0
-        else:
-            total_kept_ids = total_kept_ids[kept_ids]
-
-        o_dict['streamline_count_after_criteria{}'.format(i)] = \
-            len(sft.streamlines)
+        o_dict['streamline_count_after_criteria{}'.format(i)] = nb_kept
 
     # Streamline count after filtering
-    o_dict['streamline_count_final_filtering'] = len(sft.streamlines)
+    o_dict['streamline_count_final_filtering'] = \
+        int(np.count_nonzero(total_kept))
     if args.display_counts:
         print(json.dumps(o_dict, indent=args.indent))
 
-    save_tractogram(sft, args.out_tractogram, args.no_empty)
+    save_tractogram(sft[np.where(total_kept)[0]], args.out_tractogram,
+                    args.no_empty)
 
     if args.save_rejected:
-        rejected_ids = np.setdiff1d(np.arange(len(initial_sft.streamlines)),
-                                    total_kept_ids)
-
-        sft = initial_sft[rejected_ids]
-        save_tractogram(sft, args.save_rejected, args.no_empty)
+        save_tractogram(sft[np.where(~total_kept)[0]], args.save_rejected,
+                        args.no_empty)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Prints information on a loaded tractogram: number of streamlines, and
+Prints information on a tractogram: number of streamlines, and
 mean / min / max / std of
     - length in number of points
     - length in mm
     - step size.
+Also prints the histogram of the lengths in mm (number of streamlines in each
+bin of --bin_size mm, starting at 0) and the bounding box (in rasmm) of the
+streamlines.
 
-For trk files: also prints the data_per_point and data_per_streamline keys.
+For trk and trx files: also prints the data_per_point and data_per_streamline
+keys. For hdf5 files: prints the data_per_streamline keys.
+
+The tractogram is never fully loaded: it is read by chunks of --chunk_size
+streamlines, with a constant memory usage. Supports trk, tck, trx and the
+hdf5 files of scil_tractogram_segment_connections_from_labels (all
+connections together). The vtk, vtp, fib and dpy formats cannot be read by
+chunks: they are fully loaded.
 
 See also:
     - scil_header_print_info to see the header, affine, volume dimension.
@@ -18,14 +28,14 @@ import argparse
 import json
 import logging
 
-from dipy.tracking.streamlinespeed import length
-import numpy as np
+import os
 
-from scilpy.io.streamlines import load_tractogram_with_reference
 from scilpy.io.utils import (add_json_args,
                              add_reference_arg,
                              add_verbose_arg,
                              assert_inputs_exist)
+from scilpy.tractograms.lazy_tractogram_operations import (
+    lazy_data_keys, lazy_tractogram_statistics)
 from scilpy.version import version_string
 
 
@@ -36,6 +46,12 @@ def _build_arg_parser():
 
     p.add_argument('in_tractogram',
                    help='Tractogram file.')
+    p.add_argument('--chunk_size', type=int, default=10000, metavar='NBR',
+                   help='Number of streamlines loaded at once. '
+                        '[%(default)s]')
+    p.add_argument('--bin_size', type=float, default=10., metavar='MM',
+                   help='Size of the bins of the histogram of lengths, in mm.'
+                        ' [%(default)s]')
     add_reference_arg(p)
     add_verbose_arg(p)
     add_json_args(p)
@@ -50,34 +66,32 @@ def main():
 
     assert_inputs_exist(parser, args.in_tractogram, args.reference)
 
-    sft = load_tractogram_with_reference(parser, args, args.in_tractogram)
-
-    lengths = [len(s) for s in sft.streamlines]
-    lengths_mm = list(length(sft.streamlines))
-
-    sft.to_voxmm()
-    steps = [np.sqrt(np.sum(np.diff(s, axis=0) ** 2, axis=1))
-             for s in sft.streamlines]
-    steps = np.hstack(steps)
-
-    print(json.dumps(
-        {'number_streamlines': int(len(sft)),
-         'min_length_mm': float(np.min(lengths_mm)),
-         'mean_length_mm': float(np.mean(lengths_mm)),
-         'max_length_mm': float(np.max(lengths_mm)),
-         'std_length_mm': float(np.std(lengths_mm)),
-         'min_length_nb_points': float(np.min(lengths)),
-         'mean_length_nb_points': float(np.mean(lengths)),
-         'max_length_nb_points': float(np.max(lengths)),
-         'std_length_nb_points': float(np.std(lengths)),
-         'min_step_size': float(np.min(steps)),
-         'mean_step_size': float(np.mean(steps)),
-         'max_step_size': float(np.max(steps)),
-         'std_step_size': float(np.std(steps)),
-         'data_per_point_keys': list(sft.data_per_point.keys()),
-         'data_per_streamline_keys': list(sft.data_per_streamline.keys())
-         },
-        indent=args.indent, sort_keys=args.sort_keys))
+    _, ext = os.path.splitext(args.in_tractogram)
+    if ext not in ['.trk', '.trx', '.h5'] and args.reference is None:
+        parser.error('--reference is required for this file format '
+                     '{}.'.format(args.in_tractogram))
+    if args.chunk_size <= 0:
+        parser.error('--chunk_size must be a positive number.')
+    if args.bin_size <= 0:
+        parser.error('--bin_size must be a positive number.')
+
+    stats = lazy_tractogram_statistics(args.in_tractogram, args.reference,
+                                       chunk_size=args.chunk_size,
+                                       bin_size=args.bin_size)
+    dpp_keys, dps_keys = lazy_data_keys(args.in_tractogram)
+
+    info = {'number_streamlines': stats['number_streamlines']}
+    for name in ['length_mm', 'length_nb_points', 'step_size']:
+        for measure in ['min', 'mean', 'max', 'std']:
+            info['{}_{}'.format(measure, name)] = stats[name][measure]
+    info['length_mm_histogram'] = {
+        'bin_size_mm': args.bin_size,
+        'counts': stats['length_mm_histogram']}
+    info['bounding_box_rasmm'] = stats['bounding_box_rasmm']
+    info['data_per_point_keys'] = dpp_keys
+    info['data_per_streamline_keys'] = dps_keys
+
+    print(json.dumps(info, indent=args.indent, sort_keys=args.sort_keys))
 
 
 if __name__ == '__main__':
@@ -56,7 +56,9 @@ The output file is a hdf5 (.h5) where each bundle is a group with key
 'LABEL1_LABEL2' and each. The array_sequence format cannot be stored directly
 in a hdf5, so each group is composed of 'data', 'offsets' and 'lengths' from
 the array_sequence. The 'data' is stored in VOX/CORNER for simplicity and
-efficiency.
+efficiency. With --compression, these datasets are chunked and compressed
+(gzip or lzf), and a range of streamlines can be read without decompressing
+the whole connection.
 """
 
 import argparse
@@ -74,7 +76,8 @@ from scilpy.io.hdf5 import construct_hdf5_header
 from scilpy.io.streamlines import load_tractogram_with_reference
 from scilpy.io.utils import (add_bbox_arg, add_overwrite_arg,
                              add_processes_arg, add_verbose_arg,
-                             add_reference_arg, assert_inputs_exist,
+                             add_reference_arg, add_voxel_index_arg,
+                             assert_inputs_exist,
                              assert_outputs_exist,
                              assert_output_dirs_exist_and_empty,
                              validate_nbr_processes, assert_headers_compatible)
@@ -82,7 +85,8 @@ from scilpy.tractanalysis.connectivity_segmentation import (
     compute_connectivity,
     construct_hdf5_from_connectivity,
     extract_longest_segments_from_profile)
-from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
+from scilpy.tractograms.voxel_traversal_index import \
+    load_or_compute_voxel_traversal_index
 from scilpy.version import version_string
 
 
@@ -201,11 +205,17 @@ def _build_arg_parser():
                         'bundles later, using:\n'
                         'scil_tractogram_convert_hdf5_to_trk.')
 
+    s.add_argument('--compression', choices=['gzip', 'lzf'],
+                   help='Compress the datasets of the hdf5 (lzf is faster, '
+                        'gzip is smaller).\nConnections are then read by '
+                        'chunks.')
+
     p.add_argument('--out_labels_list', metavar='OUT_FILE',
                    help='Save the labels list as text file.\n'
                         'Needed for scil_connectivity_compute_matrices and '
                         'others.')
 
+    add_voxel_index_arg(p)
     add_reference_arg(p)
     add_bbox_arg(p)
     add_processes_arg(p)
@@ -284,10 +294,9 @@ def main():
     # Get the indices of the voxels traversed by each streamline
     logging.info('*** Computing voxels traversed by each streamline ***')
     time1 = time.time()
-    indices, points_to_idx = streamlines_to_voxel_coordinates(
-        sft.streamlines,
-        return_mapping=True
-    )
+    indices, points_to_idx = load_or_compute_voxel_traversal_index(
+        sft, args.voxel_index,
+        overwrite=args.overwrite).get_voxel_coordinates()
     time2 = time.time()
     logging.info('    Streamlines intersection took {} sec.'.format(
         round(time2 - time1, 2)))
@@ -296,7 +305,8 @@ def main():
     logging.info('*** Computing connectivity information ***')
     time1 = time.time()
     con_info = compute_connectivity(indices, data_labels, real_labels,
-                                    extract_longest_segments_from_profile)
+                                    extract_longest_segments_from_profile,
+                                    nbr_processes=nbr_cpu)
     time2 = time.time()
     logging.info('    Connectivity computation took {} sec.'.format(
         round(time2 - time1, 2)))
@@ -317,7 +327,7 @@ def main():
             remove_loops, args.loop_max_angle,
             remove_outliers, args.outlier_threshold,
             remove_curv_dev, args.curv_qb_distance,
-            nbr_cpu)
+            nbr_cpu, compression=args.compression)
     time2 = time.time()
     logging.info(
         '    Connections post-processing and saving took {} sec.'.format(
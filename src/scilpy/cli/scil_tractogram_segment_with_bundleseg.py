@@ -30,6 +30,11 @@ For CPU usage, it can be variable (advanced CPU vs. basic CPU):
     On a cluster: 8 CPU per subject and then it is better to parallelize across
     subjects.
 
+To segment the same tractogram(s) against several atlases or parameters, use
+--cache_dir: the QBx clustering of the whole-brain tractogram and its
+decomposition on disk are saved there (per tractogram content, thresholds and
+seed) and reused by the next runs, instead of being computed again.
+
 For RAM usage, it is recommanded to use this heuristic:
     (size of inputs tractogram (GB) * number of processes) < RAM (GB)
 This is important because many instances of data structures are initialized
@@ -115,6 +120,11 @@ def _build_arg_parser():
                          'pruning for all bundles \nin the configuration '
                          '[%(default)s]')
 
+    p.add_argument('--cache_dir', metavar='DIR',
+                   help='Directory where the clustering of the whole-brain '
+                        'tractogram is \nsaved and reused by the next runs '
+                        'on the same tractogram(s).\nCreated if needed.')
+
     p.add_argument('--seed', type=int, default=0,
                    help='Random number generator seed %(default)s.')
     p.add_argument('--inverse', action='store_true',
@@ -194,7 +204,8 @@ def main():
                           ignore_metadata=args.ignore_metadata)
 
     voting(args.in_tractograms, nbr_processes=args.nbr_processes,
-           seed=args.seed, reference=args.reference)
+           seed=args.seed, reference=args.reference,
+           cache_dir=args.cache_dir)
 
 
 if __name__ == '__main__':
@@ -122,6 +122,18 @@ def test_batch_size_without_gpu(script_runner, monkeypatch):
     assert not ret.success
 
 
+def test_device_without_gpu(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking', 'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking', 'seeding_mask.nii.gz')
+
+    ret = script_runner.run(['scil_tracking_local', in_fodf,
+                             in_mask, in_mask, 'device.trk',
+                             '--device', 'cpu', '--nt', '100'])
+
+    assert not ret.success
+
+
 def test_algo_with_gpu(script_runner, monkeypatch):
     monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
     in_fodf = os.path.join(SCILPY_HOME, 'tracking', 'fodf.nii.gz')
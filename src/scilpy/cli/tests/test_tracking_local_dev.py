@@ -4,6 +4,7 @@
 import os
 import tempfile
 import numpy as np
+from dipy.io.streamline import load_tractogram
 
 from scilpy import SCILPY_HOME
 from scilpy.io.fetcher import fetch_data, get_testing_files_dict
@@ -77,3 +78,97 @@ def test_execution_tracking_fodf_custom_seeds(script_runner, monkeypatch):
                              '--sub_sphere', '2',
                              '--rk_order', '4'])
     assert ret.success
+
+
+def test_execution_tracking_fodf_precompute_sf(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking',
+                           'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking',
+                           'seeding_mask.nii.gz')
+    ret = script_runner.run(['scil_tracking_local_dev', in_fodf,
+                             in_mask, in_mask, 'local_prob_sf.trk',
+                             '--nt', '10',
+                             '--compress', '0.1', '--sh_basis', 'descoteaux07',
+                             '--min_length', '20', '--max_length', '200',
+                             '--save_seeds', '--rng_seed', '0',
+                             '--sh_interp', 'nearest',
+                             '--sf_cache_dir', 'sf_cache'])
+    assert ret.success
+
+
+def test_execution_tracking_fodf_native_kernel(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking',
+                           'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking',
+                           'seeding_mask.nii.gz')
+    ret = script_runner.run(['scil_tracking_local_dev', in_fodf,
+                             in_mask, in_mask, 'local_prob_native.trk',
+                             '--nt', '10',
+                             '--compress', '0.1', '--sh_basis', 'descoteaux07',
+                             '--min_length', '20', '--max_length', '200',
+                             '--save_seeds', '--rng_seed', '0',
+                             '--processes', '2',
+                             '--use_native_kernel'])
+    assert ret.success
+
+
+def test_execution_tracking_fodf_batch(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking',
+                           'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking',
+                           'seeding_mask.nii.gz')
+    ret = script_runner.run(['scil_tracking_local_dev', in_fodf,
+                             in_mask, in_mask, 'local_det_batch.trk',
+                             '--nt', '10', '--algo', 'det',
+                             '--compress', '0.1', '--sh_basis', 'descoteaux07',
+                             '--min_length', '20', '--max_length', '200',
+                             '--save_seeds', '--rng_seed', '0',
+                             '--rk_order', '2', '--batch_size', '4'])
+    assert ret.success
+
+
+def test_execution_tracking_fodf_shared_memory(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking',
+                           'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking',
+                           'seeding_mask.nii.gz')
+    ret = script_runner.run(['scil_tracking_local_dev', in_fodf,
+                             in_mask, in_mask, 'local_prob_shared.trk',
+                             '--nt', '10',
+                             '--compress', '0.1', '--sh_basis', 'descoteaux07',
+                             '--min_length', '20', '--max_length', '200',
+                             '--save_seeds', '--rng_seed', '0',
+                             '--processes', '2', '--use_shared_memory'])
+    assert ret.success
+
+
+def test_execution_tracking_fodf_chunk_size(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking',
+                           'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking',
+                           'seeding_mask.nii.gz')
+    out_files = ['local_prob_not_chunked.trk', 'local_prob_chunked.trk']
+    for out_file, chunk_args in zip(out_files, [[], ['--chunk_size', '3']]):
+        ret = script_runner.run(['scil_tracking_local_dev', in_fodf,
+                                 in_mask, in_mask, out_file,
+                                 '--nt', '10', '--compress', '0.1',
+                                 '--sh_basis', 'descoteaux07',
+                                 '--min_length', '20', '--max_length', '200',
+                                 '--save_seeds', '--rng_seed', '0',
+                                 '-f'] + chunk_args)
+        assert ret.success
+
+    # Single process: same streamlines, in the same order.
+    sft, chunked_sft = [load_tractogram(out_file, 'same')
+                        for out_file in out_files]
+    assert len(chunked_sft) == len(sft)
+    for streamline, chunked_streamline in zip(sft.streamlines,
+                                              chunked_sft.streamlines):
+        assert np.allclose(chunked_streamline, streamline, atol=1e-3)
+    assert np.allclose(chunked_sft.data_per_streamline['seeds'],
+                       sft.data_per_streamline['seeds'])
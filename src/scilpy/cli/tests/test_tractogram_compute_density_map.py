@@ -32,3 +32,21 @@ def test_execution_tractometry(script_runner, monkeypatch):
     ret = script_runner.run(['scil_tractogram_compute_density_map',
                              in_bundle, 'IFGWM.nii.gz', '--binary'])
     assert ret.success
+
+
+def test_execution_chunks(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_bundle = os.path.join(SCILPY_HOME, 'tractometry', 'IFGWM.trk')
+    ret = script_runner.run(['scil_tractogram_compute_density_map',
+                             in_bundle, 'IFGWM_chunks.nii.gz',
+                             '--chunk_size', '100', '-f'])
+    assert ret.success
+
+
+def test_execution_processes_without_chunks(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_bundle = os.path.join(SCILPY_HOME, 'tractometry', 'IFGWM.trk')
+    ret = script_runner.run(['scil_tractogram_compute_density_map',
+                             in_bundle, 'IFGWM_processes.nii.gz',
+                             '--processes', '2', '-f'])
+    assert not ret.success
@@ -22,3 +22,11 @@ def test_execution_filtering(script_runner, monkeypatch):
     in_bundle = os.path.join(SCILPY_HOME, 'filtering', 'bundle_4.trk')
     ret = script_runner.run(['scil_tractogram_print_info', in_bundle])
     assert ret.success
+
+
+def test_execution_chunks(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_bundle = os.path.join(SCILPY_HOME, 'filtering', 'bundle_4.trk')
+    ret = script_runner.run(['scil_tractogram_print_info', in_bundle,
+                             '--chunk_size', '3', '--bin_size', '5'])
+    assert ret.success
@@ -67,3 +67,34 @@ def test_execution_bundles_metadata_multiple_format(script_runner, monkeypatch):
                             '--save_empty', '-v', 'WARNING',
                             '--out_dir', 'multiple/'])
     assert ret.success
+
+
+def test_execution_cache(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_tractogram = os.path.join(SCILPY_HOME, 'bundles',
+                                 'bundle_all_1mm.trk')
+    in_models = os.path.join(SCILPY_HOME, 'bundles', 'fibercup_atlas')
+    in_aff = os.path.join(SCILPY_HOME, 'bundles',
+                          'affine.txt')
+
+    tmp_config = {}
+    for i in range(1, 6):
+        tmp_config['bundle_{}.trk'.format(i)] = 4
+
+    with open('config.json', 'w') as outfile:
+        json.dump(tmp_config, outfile)
+
+    # The second run reuses the clustering of the first one.
+    for out_dir in ['cache_1/', 'cache_2/']:
+        ret = script_runner.run(['scil_tractogram_segment_with_bundleseg',
+                                 in_tractogram, 'config.json',
+                                 in_models,
+                                 in_aff, '--inverse',
+                                 '--processes', '1', '-v', 'WARNING',
+                                 '--cache_dir', 'qbx_cache',
+                                 '--out_dir', out_dir])
+        assert ret.success
+
+    with open('cache_1/results.json') as f1, \
+            open('cache_2/results.json') as f2:
+        assert json.load(f1) == json.load(f2)
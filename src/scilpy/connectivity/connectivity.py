@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+from contextlib import nullcontext
 import logging
+import multiprocessing
 import os
 import threading
 
@@ -11,6 +13,7 @@ import h5py
 import nibabel as nib
 import numpy as np
 from scipy.ndimage import map_coordinates
+from scipy.sparse import coo_matrix
 
 from scilpy.image.labels import get_data_as_labels
 from scilpy.io.hdf5 import reconstruct_streamlines_from_hdf5
@@ -20,6 +23,7 @@ from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
 from scilpy.tractograms.streamline_operations import \
     resample_streamlines_num_points
 from scilpy.utils.metrics_tools import compute_lesion_stats
+from scilpy.utils.shared_memory import SharedMemoryArray
 
 
 d = threading.local()
@@ -27,7 +31,7 @@ d = threading.local()
 
 def compute_triu_connectivity_from_labels(tractogram, data_labels,
                                           keep_background=False,
-                                          hide_labels=None):
+                                          hide_labels=None, sparse=False):
     """
     Compute a connectivity matrix.
 
@@ -45,18 +49,22 @@ def compute_triu_connectivity_from_labels(tractogram, data_labels,
     hide_labels: Optional[List[int]]
         If not None, streamlines ending in a voxel with a given label are
         ignored (i.e. matrix is set to 0 for that label).
+    sparse: bool
+        If True, the matrix is returned as a scipy.sparse.csr_matrix. Useful
+        with a high number of labels (ex, voxel-wise connectomes), where the
+        dense matrix would not fit in memory.
 
     Returns
     -------
-    matrix: np.ndarray
+    matrix: np.ndarray or scipy.sparse.csr_matrix
         With use_scilpy: shape (nb_labels + 1, nb_labels + 1)
         Else, shape (nb_labels, nb_labels)
     ordered_labels: List
         The list of labels. Name of each row / column.
-    start_labels: List
-        For each streamline, the label at starting point.
-    end_labels: List
-        For each streamline, the label at ending point.
+    start_labels: np.ndarray
+        For each streamline, the smallest of its two endpoint labels.
+    end_labels: np.ndarray
+        For each streamline, the biggest of its two endpoint labels.
     """
     if isinstance(tractogram, StatefulTractogram):
         # vox space, center origin: compatible with map_coordinates
@@ -71,53 +79,63 @@ def compute_triu_connectivity_from_labels(tractogram, data_labels,
         streamlines = nib.streamlines.ArraySequence(tractogram)
         streamlines = set_number_of_points(streamlines, 2)
 
-    ordered_labels = list(np.sort(np.unique(data_labels)))
-    assert ordered_labels[0] >= 0, "Only accepting positive labels, or 0."
-    nb_labels = len(ordered_labels)
+    unique_labels = np.unique(data_labels)
+    assert unique_labels[0] >= 0, "Only accepting positive labels, or 0."
+    nb_labels = len(unique_labels)
     logging.debug("Computing connectivity matrix for {} labels."
                   .format(nb_labels))
 
-    matrix = np.zeros((nb_labels, nb_labels), dtype=int)
     labels = map_coordinates(data_labels, streamlines._data.T, order=0,
                              mode='nearest')
-    start_labels = labels[0::2]
-    end_labels = labels[1::2]
 
     # sort each pair of labels for start to be smaller than end
-    start_labels, end_labels = zip(*[sorted(pair) for pair in
-                                     zip(start_labels, end_labels)])
-    ordered_labels = list(ordered_labels)
-    start_index = [ordered_labels.index(label) for label in start_labels]
-    end_index = [ordered_labels.index(label) for label in end_labels]
-    np.add.at(matrix, (start_index, end_index), 1)
-    assert matrix.sum() == len(streamlines)
+    start_labels = np.minimum(labels[0::2], labels[1::2])
+    end_labels = np.maximum(labels[0::2], labels[1::2])
+    start_index = np.searchsorted(unique_labels, start_labels)
+    end_index = np.searchsorted(unique_labels, end_labels)
+    ordered_labels = list(unique_labels)
 
     # Rejecting background
     if not keep_background and ordered_labels[0] == 0:
         logging.debug("Rejecting background.")
         ordered_labels = ordered_labels[1:]
-        matrix = matrix[1:, 1:]
+        nb_labels -= 1
+        in_background = start_index == 0
+        start_index = start_index[~in_background] - 1
+        end_index = end_index[~in_background] - 1
 
     # Hiding labels
     if hide_labels is not None:
+        hidden = np.zeros(len(start_index), dtype=bool)
         for label in hide_labels:
             if label not in ordered_labels:
                 logging.warning("Cannot hide label {} because it was not in "
                                 "the data.".format(label))
                 continue
             idx = ordered_labels.index(label)
-            nb_hidden = np.sum(matrix[idx, :]) + np.sum(matrix[:, idx]) - \
-                matrix[idx, idx]
+            in_label = np.logical_or(start_index == idx, end_index == idx)
+            nb_hidden = np.count_nonzero(in_label)
             if nb_hidden > 0:
                 logging.warning("{} streamlines had one or both endpoints "
                                 "in hidden label {} (line/column {})"
                                 .format(nb_hidden, label, idx))
-                matrix[idx, :] = 0
-                matrix[:, idx] = 0
+                hidden |= in_label
             else:
                 logging.info("No streamlines with endpoints in hidden label "
                              "{} (line/column {}) :)".format(label, idx))
             ordered_labels[idx] = ("Hidden label ({})".format(label))
+        start_index = start_index[~hidden]
+        end_index = end_index[~hidden]
+
+    if sparse:
+        # Duplicated entries are summed when converting to csr.
+        matrix = coo_matrix((np.ones(len(start_index), dtype=int),
+                             (start_index, end_index)),
+                            shape=(nb_labels, nb_labels)).tocsr()
+    else:
+        matrix = np.bincount(start_index * nb_labels + end_index,
+                             minlength=nb_labels * nb_labels)
+        matrix = matrix.reshape((nb_labels, nb_labels))
 
     return matrix, ordered_labels, start_labels, end_labels
 
@@ -135,16 +153,239 @@ def _load_node_nifti(directory, in_label, out_label, ref_img):
     return None
 
 
-def multi_proc_compute_connectivity_matrices_from_hdf5(args):
-    (hdf5_filename, labels_img, comb,
-     compute_volume, compute_streamline_count, compute_length,
-     similarity_directory, metrics_data, metrics_names, lesion_data,
-     include_dps, weighted, min_lesion_vol) = args
-    return compute_connectivity_matrices_from_hdf5(
-        hdf5_filename, labels_img, comb[0], comb[1],
-        compute_volume, compute_streamline_count, compute_length,
-        similarity_directory, metrics_data, metrics_names, lesion_data,
-        include_dps, weighted, min_lesion_vol)
+def _prepare_lesion_info(lesion_data):
+    """
+    Loads the lesion atlas once for all connections.
+
+    Returns
+    -------
+    lesion_info: Tuple
+        (lesion_labels, lesion_atlas, lesion_mask, voxel_sizes), where the
+        lesion_atlas is loaded as labels and lesion_mask is the lesion atlas
+        as uint8.
+    """
+    lesion_labels, lesion_img = lesion_data
+    voxel_sizes = lesion_img.header.get_zooms()[0:3]
+    lesion_img.set_filename('tmp.nii.gz')
+    lesion_atlas = get_data_as_labels(lesion_img)
+    return (lesion_labels, lesion_atlas, lesion_atlas.astype(np.uint8),
+            voxel_sizes)
+
+
+def _get_bounding_box(streamlines, dimensions):
+    """
+    Slices of the volume containing all voxels traversed by the streamlines
+    (vox space, corner origin), with a margin of one voxel.
+    """
+    # All the points of the data (maybe more than the streamlines'): the box
+    # can only be larger.
+    points = streamlines._data
+    low = np.maximum(np.floor(np.min(points, axis=0)).astype(int) - 1, 0)
+    high = np.minimum(np.floor(np.max(points, axis=0)).astype(int) + 2,
+                      dimensions)
+    return tuple(slice(lo, hi) for lo, hi in zip(low, high))
+
+
+def _compute_connection_measures(
+        hdf5_file, labels_img, in_label, out_label, dimensions, voxel_sizes,
+        compute_volume=True, compute_streamline_count=True,
+        compute_length=True, similarity_directory=None, metrics_data=None,
+        metrics_names=None, lesion_info=None, include_dps=False,
+        weighted=False, min_lesion_vol=0):
+    """
+    Computes all measures of one connection, reading its group once. The
+    density map is only computed in the bounding box of the streamlines, so
+    that the cost depends on the size of the connection, not on the size of
+    the volume (except for the similarity, which requires the whole map). See
+    compute_connectivity_matrices_from_hdf5 for the parameters.
+    """
+    measures_to_return = {}
+
+    # Getting the bundle from the hdf5
+    key = '{}_{}'.format(in_label, out_label)
+    if key not in hdf5_file:
+        logging.debug("Connection {} not found in the hdf5".format(key))
+        return None
+    streamlines = reconstruct_streamlines_from_hdf5(hdf5_file[key])
+    if len(streamlines) == 0:
+        logging.debug("Connection {} contained no streamline".format(key))
+        return None
+    logging.debug("Found {} streamlines for connection {}"
+                  .format(len(streamlines), key))
+
+    # Getting dps info from the hdf5
+    dps_keys = []
+    if include_dps:
+        for dps_key in hdf5_file[key].keys():
+            if dps_key not in ['data', 'offsets', 'lengths']:
+                if 'commit' in dps_key:
+                    dps_values = np.sum(hdf5_file[key][dps_key])
+                else:
+                    dps_values = np.average(hdf5_file[key][dps_key])
+                measures_to_return[dps_key] = dps_values
+                dps_keys.append(dps_key)
+
+    # If density is not required, do not compute it
+    # Only required for volume, similarity, any metrics and lesions
+    if (compute_volume or similarity_directory is not None or
+            len(metrics_data) > 0 or lesion_info is not None):
+        bbox = _get_bounding_box(streamlines, dimensions)
+        bbox_density = compute_tract_counts_map(
+            streamlines, [s.stop - s.start for s in bbox],
+            offset=[s.start for s in bbox])
+        # Traversed voxels, in the same (C) order as in the whole volume.
+        bbox_voxels = np.nonzero(bbox_density)
+        voxels = tuple(v + s.start for v, s in zip(bbox_voxels, bbox))
+
+    if compute_length:
+        # scil_tractogram_segment_connections_from_labels.py requires
+        # isotropic voxels
+        mean_length = np.average(length(streamlines)) * voxel_sizes[0]
+        measures_to_return['length_mm'] = mean_length
+
+    if compute_volume:
+        measures_to_return['volume_mm3'] = len(voxels[0]) * \
+            np.prod(voxel_sizes)
+
+    if compute_streamline_count:
+        measures_to_return['streamline_count'] = len(streamlines)
+
+    if similarity_directory is not None:
+        density_sim = _load_node_nifti(similarity_directory,
+                                       in_label, out_label, labels_img)
+        if density_sim is None:
+            ba_vox = 0
+        else:
+            density = np.zeros(dimensions, dtype=bbox_density.dtype)
+            density[bbox] = bbox_density
+            ba_vox = compute_bundle_adjacency_voxel(density, density_sim)
+
+        measures_to_return['similarity'] = ba_vox
+
+    for metric_data, metric_name in zip(metrics_data, metrics_names):
+        if weighted:
+            avg_value = np.average(metric_data[voxels],
+                                   weights=bbox_density[bbox_voxels])
+        else:
+            avg_value = np.average(metric_data[voxels])
+        measures_to_return[metric_name] = avg_value
+
+    if lesion_info is not None:
+        lesion_labels, lesion_atlas, lesion_mask, lesion_vox_sizes = \
+            lesion_info
+        tmp_dict = compute_lesion_stats(
+            bbox_density.astype(bool), lesion_atlas[bbox],
+            voxel_sizes=lesion_vox_sizes, single_label=True,
+            min_lesion_vol=min_lesion_vol,
+            precomputed_lesion_labels=lesion_labels)
+
+        tmp_ind = _streamlines_in_mask(list(streamlines), lesion_mask,
+                                       np.eye(3), [0, 0, 0])
+        streamlines_count = len(
+            np.where(tmp_ind == [0, 1][True])[0].tolist())
+
+        if tmp_dict:
+            measures_to_return['lesion_vol'] = tmp_dict['lesion_total_volume']
+            measures_to_return['lesion_count'] = tmp_dict['lesion_count']
+            measures_to_return['lesion_streamline_count'] = streamlines_count
+        else:
+            measures_to_return['lesion_vol'] = 0
+            measures_to_return['lesion_count'] = 0
+            measures_to_return['lesion_streamline_count'] = 0
+
+    return {(in_label, out_label): measures_to_return}, dps_keys
+
+
+def _init_connectivity_matrices_process(hdf5_filename, labels_img,
+                                        metrics_info, lesion_info, options):
+    """
+    Pool initializer: opens the hdf5 once per process and attaches to the
+    shared metrics and lesion volumes.
+    """
+    d.hdf5_file = h5py.File(hdf5_filename, 'r')
+    d.labels_img = labels_img
+    d.shared_metrics = [SharedMemoryArray.attach(info)
+                        for info in metrics_info]
+    d.lesion_info = None
+    if lesion_info is not None:
+        lesion_labels, atlas_info, mask_info, voxel_sizes = lesion_info
+        d.shared_lesion = [SharedMemoryArray.attach(atlas_info),
+                           SharedMemoryArray.attach(mask_info)]
+        d.lesion_info = (lesion_labels, d.shared_lesion[0].array,
+                         d.shared_lesion[1].array, voxel_sizes)
+    d.options = options
+
+
+def _compute_connectivity_matrices_in_process(comb):
+    _, dimensions, voxel_sizes, _ = get_reference_info(d.labels_img)
+    return _compute_connection_measures(
+        d.hdf5_file, d.labels_img, comb[0], comb[1], dimensions, voxel_sizes,
+        metrics_data=[m.array for m in d.shared_metrics],
+        lesion_info=d.lesion_info, **d.options)
+
+
+def compute_connectivity_matrices_from_hdf5_multiproc(
+        hdf5_filename, labels_img, comb_list, nbr_processes,
+        metrics_data=None, lesion_data=None, **kwargs):
+    """
+    Runs compute_connectivity_matrices_from_hdf5 on all pairs of labels,
+    with a pool of processes. The metrics and lesion volumes are copied once
+    in shared memory, each process opens the hdf5 once, and the pairs of
+    labels are sent to the processes by batches.
+
+    Parameters
+    ----------
+    hdf5_filename: str
+        Name of the hdf5 file containing the precomputed connections (bundles)
+    labels_img: nib.Nifti1Image
+        The labels image.
+    comb_list: list[Tuple]
+        The (in_label, out_label) pairs.
+    nbr_processes: int
+        Number of processes.
+    metrics_data: list[np.ndarray]
+        See compute_connectivity_matrices_from_hdf5.
+    lesion_data: Tuple[list, nib.Nifti1Image]
+        See compute_connectivity_matrices_from_hdf5.
+    kwargs: dict
+        The other options of compute_connectivity_matrices_from_hdf5.
+
+    Returns
+    -------
+    outputs: list
+        The output of compute_connectivity_matrices_from_hdf5 for each pair
+        of labels.
+    """
+    shared_arrays = []
+    try:
+        for metric_data in metrics_data or []:
+            shared_arrays.append(SharedMemoryArray.from_array(metric_data))
+        metrics_info = [m.get_info() for m in shared_arrays]
+
+        lesion_info = None
+        if lesion_data is not None:
+            lesion_labels, lesion_atlas, lesion_mask, voxel_sizes = \
+                _prepare_lesion_info(lesion_data)
+            shared_arrays.append(SharedMemoryArray.from_array(lesion_atlas))
+            shared_arrays.append(SharedMemoryArray.from_array(lesion_mask))
+            lesion_info = (lesion_labels, shared_arrays[-2].get_info(),
+                           shared_arrays[-1].get_info(), voxel_sizes)
+
+        # The pool is terminated on exit, even on errors, before the shared
+        # memory is unlinked.
+        chunksize = max(1, len(comb_list) // (4 * nbr_processes))
+        with multiprocessing.Pool(
+                nbr_processes,
+                initializer=_init_connectivity_matrices_process,
+                initargs=(hdf5_filename, labels_img, metrics_info,
+                          lesion_info, kwargs)) as pool:
+            outputs = pool.map(_compute_connectivity_matrices_in_process,
+                               comb_list, chunksize=chunksize)
+    finally:
+        for shared_array in shared_arrays:
+            shared_array.unlink()
+
+    return outputs
 
 
 def compute_connectivity_matrices_from_hdf5(
@@ -156,8 +397,9 @@ def compute_connectivity_matrices_from_hdf5(
     """
     Parameters
     ----------
-    hdf5_filename: str
-        Name of the hdf5 file containing the precomputed connections (bundles)
+    hdf5_filename: str or h5py.File
+        Name of the hdf5 file containing the precomputed connections
+        (bundles), or the opened file.
     labels_img: np.ndarray
         Data as labels
     in_label: str
@@ -208,95 +450,118 @@ def compute_connectivity_matrices_from_hdf5(
     if len(metrics_data) > 0:
         assert len(metrics_data) == len(metrics_names)
 
-    affine, dimensions, voxel_sizes, _ = get_reference_info(labels_img)
-
-    measures_to_return = {}
-
-    # Getting the bundle from the hdf5
-    with h5py.File(hdf5_filename, 'r') as hdf5_file:
-        key = '{}_{}'.format(in_label, out_label)
-        if key not in hdf5_file:
-            logging.debug("Connection {} not found in the hdf5".format(key))
-            return None
-        streamlines = reconstruct_streamlines_from_hdf5(hdf5_file[key])
-        if len(streamlines) == 0:
-            logging.debug("Connection {} contained no streamline".format(key))
-            return None
-        logging.debug("Found {} streamlines for connection {}"
-                      .format(len(streamlines), key))
-
-        # Getting dps info from the hdf5
-        dps_keys = []
-        if include_dps:
-            for dps_key in hdf5_file[key].keys():
-                if dps_key not in ['data', 'offsets', 'lengths']:
-                    if 'commit' in dps_key:
-                        dps_values = np.sum(hdf5_file[key][dps_key])
-                    else:
-                        dps_values = np.average(hdf5_file[key][dps_key])
-                    measures_to_return[dps_key] = dps_values
-                    dps_keys.append(dps_key)
-
-    # If density is not required, do not compute it
-    # Only required for volume, similarity and any metrics
-    if (compute_volume or similarity_directory is not None or
-            len(metrics_data) > 0):
-        density = compute_tract_counts_map(streamlines, dimensions)
-
-    if compute_length:
-        # scil_tractogram_segment_connections_from_labels.py requires
-        # isotropic voxels
-        mean_length = np.average(length(list(streamlines))) * voxel_sizes[0]
-        measures_to_return['length_mm'] = mean_length
-
-    if compute_volume:
-        measures_to_return['volume_mm3'] = np.count_nonzero(density) * \
-            np.prod(voxel_sizes)
-
-    if compute_streamline_count:
-        measures_to_return['streamline_count'] = len(streamlines)
-
-    if similarity_directory is not None:
-        density_sim = _load_node_nifti(similarity_directory,
-                                       in_label, out_label, labels_img)
-        if density_sim is None:
-            ba_vox = 0
-        else:
-            ba_vox = compute_bundle_adjacency_voxel(density, density_sim)
-
-        measures_to_return['similarity'] = ba_vox
-
-    for metric_data, metric_name in zip(metrics_data, metrics_names):
-        if weighted:
-            avg_value = np.average(metric_data, weights=density)
-        else:
-            avg_value = np.average(metric_data[density > 0])
-        measures_to_return[metric_name] = avg_value
-
+    _, dimensions, voxel_sizes, _ = get_reference_info(labels_img)
+    lesion_info = None
     if lesion_data is not None:
-        lesion_labels, lesion_img = lesion_data
-        voxel_sizes = lesion_img.header.get_zooms()[0:3]
-        lesion_img.set_filename('tmp.nii.gz')
-        lesion_atlas = get_data_as_labels(lesion_img)
-        tmp_dict = compute_lesion_stats(
-            density.astype(bool), lesion_atlas,
-            voxel_sizes=voxel_sizes, single_label=True,
-            min_lesion_vol=min_lesion_vol,
-            precomputed_lesion_labels=lesion_labels)
+        lesion_info = _prepare_lesion_info(lesion_data)
 
-        tmp_ind = _streamlines_in_mask(list(streamlines),
-                                       lesion_atlas.astype(np.uint8),
-                                       np.eye(3), [0, 0, 0])
-        streamlines_count = len(
-            np.where(tmp_ind == [0, 1][True])[0].tolist())
+    if isinstance(hdf5_filename, h5py.File):
+        hdf5_context = nullcontext(hdf5_filename)
+    else:
+        hdf5_context = h5py.File(hdf5_filename, 'r')
+    with hdf5_context as hdf5_file:
+        return _compute_connection_measures(
+            hdf5_file, labels_img, in_label, out_label, dimensions,
+            voxel_sizes, compute_volume, compute_streamline_count,
+            compute_length, similarity_directory, metrics_data,
+            metrics_names, lesion_info, include_dps, weighted,
+            min_lesion_vol)
+
+
+def compute_connectivity_matrices(
+        hdf5_filename, labels_img, labels_list, comb_list, nbr_processes=1,
+        compute_volume=True, compute_streamline_count=True,
+        compute_length=True, similarity_directory=None, metrics_data=None,
+        metrics_names=None, lesion_data=None, include_dps=False,
+        weighted=False, min_lesion_vol=0):
+    """
+    Computes all connectivity matrices in a single pass on the hdf5: each
+    connection (group) is read once and all its measures are computed
+    together. The hdf5 is opened once (per process), the lesions are loaded
+    once, and the density of each connection is only read where it has
+    streamlines.
 
-        if tmp_dict:
-            measures_to_return['lesion_vol'] = tmp_dict['lesion_total_volume']
-            measures_to_return['lesion_count'] = tmp_dict['lesion_count']
-            measures_to_return['lesion_streamline_count'] = streamlines_count
-        else:
-            measures_to_return['lesion_vol'] = 0
-            measures_to_return['lesion_count'] = 0
-            measures_to_return['lesion_streamline_count'] = 0
+    Parameters
+    ----------
+    hdf5_filename: str
+        Name of the hdf5 file containing the precomputed connections (bundles)
+    labels_img: nib.Nifti1Image
+        The labels image.
+    labels_list: list
+        The labels, in the order of the rows and columns of the matrices.
+    comb_list: list[Tuple]
+        The (in_label, out_label) pairs to compute.
+    nbr_processes: int
+        Number of processes.
+    Other parameters: see compute_connectivity_matrices_from_hdf5.
 
-    return {(in_label, out_label): measures_to_return}, dps_keys
+    Returns
+    -------
+    matrices: dict
+        For each measure (ex, 'volume_mm3', 'length_mm', 'streamline_count',
+        'similarity', metrics names, 'lesion_vol', 'lesion_count',
+        'lesion_streamline_count' and dps keys), the symmetric matrix of
+        shape (len(labels_list), len(labels_list)).
+    dps_keys: list[str]
+        The list of keys included from dps.
+    """
+    options = {'compute_volume': compute_volume,
+               'compute_streamline_count': compute_streamline_count,
+               'compute_length': compute_length,
+               'similarity_directory': similarity_directory,
+               'metrics_names': metrics_names,
+               'include_dps': include_dps,
+               'weighted': weighted,
+               'min_lesion_vol': min_lesion_vol}
+    metrics_data = metrics_data or []
+
+    if nbr_processes == 1:
+        _, dimensions, voxel_sizes, _ = get_reference_info(labels_img)
+        lesion_info = None
+        if lesion_data is not None:
+            lesion_info = _prepare_lesion_info(lesion_data)
+        with h5py.File(hdf5_filename, 'r') as hdf5_file:
+            outputs = [_compute_connection_measures(
+                hdf5_file, labels_img, comb[0], comb[1], dimensions,
+                voxel_sizes, metrics_data=metrics_data,
+                lesion_info=lesion_info, **options) for comb in comb_list]
+    else:
+        outputs = compute_connectivity_matrices_from_hdf5_multiproc(
+            hdf5_filename, labels_img, comb_list, nbr_processes,
+            metrics_data=metrics_data, lesion_data=lesion_data, **options)
+
+    # Removing None entries (combinaisons that do not exist)
+    outputs = [it for it in outputs if it is not None]
+    if len(outputs) == 0:
+        raise ValueError('No connection found at all! Matrices would be '
+                         'all-zeros. Exiting.')
+
+    # Verify that all bundles had the same dps_keys
+    dps_keys = [it[1] for it in outputs]
+    if len(dps_keys) > 1 and not dps_keys[1:] == dps_keys[:-1]:
+        raise ValueError("DPS keys not consistant throughout the hdf5 "
+                         "connections. Verify your tractograms, or do not "
+                         "use --include_dps.")
+    dps_keys = dps_keys[0]
+
+    # Filling all the (symmetric) matrices at once, as sparse (row, col,
+    # value) lists of the connections.
+    labels_pos = {label: i for i, label in enumerate(labels_list)}
+    rows = []
+    cols = []
+    values = {}
+    for node, _ in outputs:
+        for (in_label, out_label), measures in node.items():
+            rows.append(labels_pos[in_label])
+            cols.append(labels_pos[out_label])
+            for measure_key, value in measures.items():
+                values.setdefault(measure_key, []).append(value)
+
+    matrices = {}
+    for measure_key, measure_values in values.items():
+        matrix = np.zeros((len(labels_list), len(labels_list)))
+        matrix[rows, cols] = measure_values
+        matrix[cols, rows] = measure_values
+        matrices[measure_key] = matrix
+
+    return matrices, dps_keys
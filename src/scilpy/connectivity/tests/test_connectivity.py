@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import h5py
+import nibabel as nib
+from nibabel.streamlines import ArraySequence
 import numpy as np
 
 from scilpy.connectivity.connectivity import \
-    compute_triu_connectivity_from_labels
+    compute_connectivity_matrices, compute_triu_connectivity_from_labels
+from scilpy.io.hdf5 import construct_hdf5_group_from_streamlines
 
 
 def test_compute_triu_connectivity_from_labels():
@@ -38,6 +42,72 @@ def test_compute_triu_connectivity_from_labels():
     assert np.array_equal(output, expected_out)
 
 
+def test_compute_triu_connectivity_from_labels_sparse():
+    labels = np.zeros((3, 3, 3), dtype=int)
+    labels[0] = 2
+    labels[2] = 5
+    labels[1, 1] = 7
+    # Labels (2, 5), (5, 2), (0, 5), (7, 2), (0, 0) and (5, 5).
+    tractogram = [np.asarray([[0., 0., 0.], [2., 0., 0.]]),
+                  np.asarray([[2., 1., 1.], [0., 2., 2.]]),
+                  np.asarray([[1., 0., 0.], [2., 2., 2.]]),
+                  np.asarray([[1., 1., 2.], [0., 1., 1.]]),
+                  np.asarray([[1., 0., 0.], [1., 2., 2.]]),
+                  np.asarray([[2., 0., 0.], [2., 2., 2.]])]
+
+    dense, ordered_labels, start_labels, end_labels = \
+        compute_triu_connectivity_from_labels(tractogram, labels)
+    sparse, _, _, _ = compute_triu_connectivity_from_labels(
+        tractogram, labels, sparse=True)
+    assert ordered_labels == [2, 5, 7]
+    assert np.array_equal(start_labels, [2, 2, 0, 2, 0, 5])
+    assert np.array_equal(end_labels, [5, 5, 5, 7, 0, 5])
+    assert np.array_equal(dense, [[0, 2, 1], [0, 1, 0], [0, 0, 0]])
+    assert np.array_equal(sparse.toarray(), dense)
+
+    dense, ordered_labels, _, _ = compute_triu_connectivity_from_labels(
+        tractogram, labels, keep_background=True, hide_labels=[7])
+    sparse, _, _, _ = compute_triu_connectivity_from_labels(
+        tractogram, labels, keep_background=True, hide_labels=[7],
+        sparse=True)
+    assert ordered_labels == [0, 2, 5, 'Hidden label (7)']
+    expected = np.zeros((4, 4))
+    expected[0, 0] = 1
+    expected[0, 2] = 1
+    expected[1, 2] = 2
+    expected[2, 2] = 1
+    assert np.array_equal(dense, expected)
+    assert np.array_equal(sparse.toarray(), expected)
+
+
 def test_compute_connectivity_matrices_from_hdf5():
     # ToDo. We will have to create a test hdf5.
     pass
+
+
+def test_compute_connectivity_matrices(tmp_path):
+    # Two connections, in vox space, corner origin.
+    labels_img = nib.Nifti1Image(np.zeros((5, 5, 5), dtype=np.int16),
+                                 np.eye(4))
+    connections = {
+        '1_2': [np.array([[0.5, 0.5, 0.5], [3.5, 0.5, 0.5]]),
+                np.array([[0.5, 0.5, 0.5], [0.5, 2.5, 0.5]])],
+        '2_2': [np.array([[1.5, 1.5, 1.5], [1.5, 1.5, 3.5]])]}
+    hdf5_filename = str(tmp_path / 'connections.h5')
+    with h5py.File(hdf5_filename, 'w') as hdf5_file:
+        for key, streamlines in connections.items():
+            construct_hdf5_group_from_streamlines(
+                hdf5_file.create_group(key), ArraySequence(streamlines))
+
+    metric = np.zeros((5, 5, 5))
+    metric[:, 0, 0] = 1
+    matrices, dps_keys = compute_connectivity_matrices(
+        hdf5_filename, labels_img, [1, 2], [(1, 2), (2, 2), (1, 1)],
+        metrics_data=[metric], metrics_names=['metric'])
+
+    assert dps_keys == []
+    assert np.array_equal(matrices['streamline_count'], [[0, 2], [2, 1]])
+    assert np.array_equal(matrices['length_mm'], [[0, 2.5], [2.5, 2]])
+    assert np.array_equal(matrices['volume_mm3'], [[0, 6], [6, 3]])
+    # 4 voxels on the x axis out of 6 voxels.
+    assert np.allclose(matrices['metric'], [[0, 4 / 6], [4 / 6, 0]])
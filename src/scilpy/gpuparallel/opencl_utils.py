@@ -3,6 +3,7 @@ import numpy as np
 import logging
 import inspect
 import os
+import time
 import scilpy
 
 from dipy.utils.optpkg import optional_package
@@ -14,7 +15,38 @@ def cl_device_type(device_type_str):
         return cl.device_type.CPU
     if device_type_str == 'gpu':
         return cl.device_type.GPU
-    return -1
+    # Not returning -1: all bits set, it would match any device.
+    raise ValueError("Device type should be 'cpu' or 'gpu', got {}."
+                     .format(device_type_str))
+
+
+def get_cl_devices(device_type='gpu'):
+    """
+    Get all the OpenCL devices of a given type, on all platforms.
+
+    Parameters
+    ----------
+    device_type: string
+        One of 'cpu', 'gpu'. OpenCL on the cpu requires a cpu driver, ex
+        POCL.
+
+    Returns
+    -------
+    devices: list of cl.Device
+        The devices, in the order of the platforms.
+    """
+    if not have_opencl:
+        raise RuntimeError('pyopencl is not installed. '
+                           'Cannot list OpenCL devices.')
+
+    devices = []
+    for p in cl.get_platforms():
+        for d in p.get_devices():
+            # The type is a bitfield.
+            if d.get_info(cl.device_info.TYPE) & \
+                    cl_device_type(device_type):
+                devices.append(d)
+    return devices
 
 
 class CLManager(object):
@@ -36,8 +68,11 @@ class CLManager(object):
         The CLKernel containing the OpenCL program to manage.
     device_type: string
         The device onto which to run the program. One of 'cpu', 'gpu'.
+    device: cl.Device, optional
+        The device onto which to run the program (ex, one of the devices
+        returned by get_cl_devices). If set, device_type is ignored.
     """
-    def __init__(self, cl_kernel, device_type='gpu'):
+    def __init__(self, cl_kernel, device_type='gpu', device=None):
         if not have_opencl:
             raise RuntimeError('pyopencl is not installed. '
                                'Cannot create CLManager instance.')
@@ -54,20 +89,15 @@ class CLManager(object):
         self.outputs_mapping = {}
 
         # Find the best device for running GPU tasks
-        platforms = cl.get_platforms()
-        best_device = None
-        for p in platforms:
-            devices = p.get_devices()
-            for d in devices:
-                d_type = d.get_info(cl.device_info.TYPE)
-                if d_type == cl_device_type(device_type)\
-                   and best_device is None:
-                    best_device = d  # take the first device of right type
-
-        if best_device is None:
-            raise ValueError('No device of type {} found'.format(device_type))
-
-        self.context = cl.Context(devices=[best_device])
+        if device is None:
+            devices = get_cl_devices(device_type)
+            if len(devices) == 0:
+                raise ValueError('No device of type {} found'
+                                 .format(device_type))
+            device = devices[0]  # take the first device of right type
+        self.device = device
+
+        self.context = cl.Context(devices=[device])
         self.queue = cl.CommandQueue(self.context)
         program = cl.Program(self.context, cl_kernel.code_string).build()
         self.kernel = cl.Kernel(program, cl_kernel.entry_point)
@@ -241,6 +271,71 @@ class CLManager(object):
         return outputs
 
 
+class BatchSizeTuner(object):
+    """
+    Finds a good number of work items per call to a kernel (batch size) for
+    a device: the batch size is doubled as long as the throughput (items per
+    second) increases by at least `min_gain`, then kept at the best value.
+
+    Parameters
+    ----------
+    initial_batch_size: int
+        The first batch size to try.
+    max_batch_size: int
+        The maximal batch size, ex, allowed by the device's memory.
+    min_gain: float, optional
+        Minimal relative increase of throughput to keep doubling the batch
+        size.
+    """
+    def __init__(self, initial_batch_size, max_batch_size, min_gain=0.1):
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_size = max(1, min(initial_batch_size,
+                                     self.max_batch_size))
+        self.min_gain = min_gain
+        self.is_tuned = self.batch_size == self.max_batch_size
+
+        self._best_batch_size = self.batch_size
+        self._best_throughput = 0.
+        self._start = None
+
+    def start(self):
+        """
+        Starts timing a batch.
+        """
+        self._start = time.perf_counter()
+
+    def stop(self, nb_items):
+        """
+        Stops timing a batch and updates the batch size.
+
+        Parameters
+        ----------
+        nb_items: int
+            Number of items in the batch. Partial batches (ex, the last one)
+            are not used for tuning.
+        """
+        duration = time.perf_counter() - self._start
+        if self.is_tuned or nb_items < self.batch_size or duration <= 0:
+            return
+
+        throughput = nb_items / duration
+        if throughput >= self._best_throughput * (1. + self.min_gain):
+            self._best_throughput = throughput
+            self._best_batch_size = self.batch_size
+            if self.batch_size == self.max_batch_size:
+                self.is_tuned = True
+            else:
+                self.batch_size = min(2 * self.batch_size,
+                                      self.max_batch_size)
+        else:
+            self.batch_size = self._best_batch_size
+            self.is_tuned = True
+
+        if self.is_tuned:
+            logging.info('Batch size set to {} ({:.0f} items/s).'.format(
+                self.batch_size, self._best_throughput))
+
+
 class CLKernel(object):
     """
     Wrapper for OpenCL kernel/program code.
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+import pytest
+
+from scilpy.gpuparallel.opencl_utils import BatchSizeTuner, cl_device_type
+
+
+def _run_batches(tuner, durations):
+    # Fakes the duration of each batch of the tuner.
+    for duration in durations:
+        with mock.patch('time.perf_counter', return_value=0.):
+            tuner.start()
+        with mock.patch('time.perf_counter', return_value=duration):
+            tuner.stop(tuner.batch_size)
+
+
+def test_batch_size_tuner():
+    tuner = BatchSizeTuner(100, 1000)
+
+    # Twice the items in the same time: doubles.
+    _run_batches(tuner, [1., 1.])
+    assert tuner.batch_size == 400
+    assert not tuner.is_tuned
+
+    # Twice the items in twice the time: back to the best batch size.
+    _run_batches(tuner, [2.])
+    assert tuner.batch_size == 200
+    assert tuner.is_tuned
+
+    # Tuned: no more changes.
+    _run_batches(tuner, [0.1])
+    assert tuner.batch_size == 200
+
+
+def test_batch_size_tuner_max():
+    tuner = BatchSizeTuner(100, 300)
+    _run_batches(tuner, [1., 1.])
+    assert tuner.batch_size == 300
+    _run_batches(tuner, [1.])
+    assert tuner.batch_size == 300
+    assert tuner.is_tuned
+
+    tuner = BatchSizeTuner(500, 300)
+    assert tuner.batch_size == 300
+    assert tuner.is_tuned
+
+
+def test_cl_device_type():
+    with pytest.raises(ValueError):
+        cl_device_type('tpu')
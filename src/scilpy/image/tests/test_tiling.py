@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from scilpy.image.tiling import get_tile_shape, process_by_tiles
+from scilpy.image.utils import get_spatial_blocks
+
+
+def _sum_and_concatenate(data, data_3d, factor):
+    return (np.sum(data, axis=1) * factor,
+            np.concatenate((data, data_3d[:, None]), axis=1))
+
+
+def _raise_error(data):
+    raise ValueError('Error in a tile.')
+
+
+def _get_data():
+    rng = np.random.default_rng(0)
+    data = rng.random((7, 6, 9, 4))
+    data_3d = rng.random((7, 6, 9))
+    mask = rng.random((7, 6, 9)) > 0.3
+
+    expected_sum = np.where(mask, np.sum(data, axis=-1) * 2, 0)
+    expected_concatenated = np.where(
+        mask[..., None], np.concatenate((data, data_3d[..., None]), axis=-1),
+        0)
+    return data, data_3d, mask, expected_sum, expected_concatenated
+
+
+def test_get_spatial_blocks():
+    blocks = get_spatial_blocks((7, 6, 9), (4, 6, 2))
+    assert len(blocks) == 2 * 1 * 5
+    assert blocks[0] == (slice(0, 4), slice(0, 6), slice(0, 2))
+    assert blocks[1] == (slice(4, 7), slice(0, 6), slice(0, 2))
+
+    covered = np.zeros((7, 6, 9), dtype=int)
+    for block in blocks:
+        covered[block] += 1
+    assert np.all(covered == 1)
+
+    assert get_tile_shape((7, 6, 9), 4, nbr_processes=2) == (7, 6, 2)
+
+
+def test_process_by_tiles():
+    data, data_3d, mask, expected_sum, expected_concatenated = _get_data()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The images on disk are read by tiles.
+        filename = os.path.join(tmp_dir, 'data.nii')
+        nib.save(nib.Nifti1Image(data, np.eye(4)), filename)
+        img = nib.load(filename)
+
+        for nbr_processes in [1, 2]:
+            for inputs in [[img, data_3d],
+                           [data, nib.Nifti1Image(data_3d, np.eye(4))]]:
+                out_sum, out_concatenated = process_by_tiles(
+                    _sum_and_concatenate, inputs, [(), (5,)], mask=mask,
+                    func_args=(2,), tile_shape=(4, 4, 2),
+                    nbr_processes=nbr_processes)
+                assert np.allclose(out_sum, expected_sum)
+                assert np.allclose(out_concatenated, expected_concatenated)
+
+            # Written by tiles in the output files.
+            out_filenames = [os.path.join(tmp_dir, 'sum.nii'),
+                             os.path.join(tmp_dir, 'concatenated.nii')]
+            process_by_tiles(_sum_and_concatenate, [img, data_3d],
+                             [(), (5,)], [np.float32, np.float64],
+                             mask=mask, func_args=(2,),
+                             nbr_processes=nbr_processes,
+                             out_filenames=out_filenames)
+            out_sum = nib.load(out_filenames[0])
+            assert out_sum.get_data_dtype() == np.float32
+            assert np.allclose(out_sum.get_fdata(), expected_sum)
+            assert np.allclose(nib.load(out_filenames[1]).get_fdata(),
+                               expected_concatenated)
+
+
+def test_process_by_tiles_error():
+    data, _, _, _, _ = _get_data()
+    for nbr_processes in [1, 2]:
+        with pytest.raises(ValueError):
+            process_by_tiles(_raise_error, [data], [()],
+                             nbr_processes=nbr_processes)
+    # The workers are terminated.
+    assert len(multiprocessing.active_children()) == 0
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from dipy.io.stateful_tractogram import Origin, Space
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+
+from scilpy.image.volume_space_management import (DataVolume,
+                                                  FibertubeDataVolume,
+                                                  FTODFDataVolume)
+from scilpy.tests.streamlines import get_random_walk_sft
+
+
+def _get_coords():
+    # Points inside the volume, on the borders and out of bound.
+    rng = np.random.default_rng(1234)
+    coords = rng.uniform(-1, 6, size=(50, 3))
+    coords[0] = [0, 0, 0]
+    coords[1] = [3.5, 4.5, 5.5]
+    coords[2] = [-0.5, 2.999, 1]
+    return coords
+
+
+def test_get_value_at_coordinates():
+    rng = np.random.default_rng(0)
+    data = rng.random((4, 5, 6, 3))
+    voxres = np.asarray([1., 2., 0.5])
+    coords = _get_coords()
+
+    for interpolation in ['nearest', 'trilinear']:
+        volume = DataVolume(data, voxres, interpolation)
+        for space in [Space.VOX, Space.VOXMM]:
+            for origin in [Origin('center'), Origin('corner')]:
+                values = volume.get_value_at_coordinates(coords, space,
+                                                         origin)
+                expected = [volume.get_value_at_coordinate(*c, space,
+                                                           origin)
+                            for c in coords]
+                assert_allclose(values, expected)
+
+
+def test_get_value_at_coordinates_3d():
+    rng = np.random.default_rng(0)
+    data = rng.random((4, 5, 6))
+    volume = DataVolume(data, [1, 1, 1], 'trilinear')
+    coords = _get_coords()
+
+    values = volume.get_value_at_coordinates(coords, Space.VOX,
+                                             Origin('center'))
+    expected = [volume.get_value_at_coordinate(*c, Space.VOX,
+                                               Origin('center'))
+                for c in coords]
+    assert values.shape == (len(coords),)
+    assert_allclose(values, expected)
+
+
+def test_get_value_at_coordinates_float32():
+    rng = np.random.default_rng(0)
+    data = rng.random((4, 5, 6, 3))
+    coords = _get_coords()
+
+    volume64 = DataVolume(data, [1, 1, 1], 'trilinear')
+    volume32 = DataVolume(data.astype(np.float32), [1, 1, 1], 'trilinear')
+    values = volume32.get_value_at_coordinates(coords, Space.VOX,
+                                               Origin('center'))
+    expected = volume64.get_value_at_coordinates(coords, Space.VOX,
+                                                 Origin('center'))
+    assert values.dtype == np.float32
+    assert_allclose(values, expected, atol=1e-5)
+
+    # The non-vectorized version also works with float32 data.
+    value = volume32.get_value_at_coordinate(*coords[1], Space.VOX,
+                                             Origin('center'))
+    assert_allclose(value, expected[1], atol=1e-5)
+
+
+def test_are_coordinates_in_bound():
+    volume = DataVolume(np.zeros((4, 5, 6)), [1., 2., 0.5], 'nearest')
+    coords = _get_coords()
+
+    for space in [Space.VOX, Space.VOXMM]:
+        for origin in [Origin('center'), Origin('corner')]:
+            in_bound = volume.are_coordinates_in_bound(coords, space, origin)
+            expected = [volume.is_coordinate_in_bound(*c, space, origin)
+                        for c in coords]
+            assert_array_equal(in_bound, expected)
+
+
+def test_get_value_at_indices():
+    rng = np.random.default_rng(0)
+    data = rng.random((4, 5, 6, 3))
+    volume = DataVolume(data, [1, 1, 1], 'nearest')
+    idx = np.asarray([[0, 0, 0], [3, 4, 5], [-1, 2, 7], [1, 2, 3]])
+
+    values = volume.get_value_at_indices(idx)
+    expected = [volume.get_value_at_idx(*i) for i in idx]
+    assert_array_equal(values, expected)
+    assert_array_equal(volume.are_indices_in_bound(idx),
+                       [volume.is_idx_in_bound(*i) for i in idx])
+
+
+def test_voxmm_to_idx_array():
+    volume = DataVolume(np.zeros((4, 5, 6)), [1., 2., 0.5], 'nearest')
+    coords = _get_coords()
+
+    assert_allclose(volume.voxmm_to_vox_array(coords),
+                    [volume.voxmm_to_vox(*c) for c in coords])
+    for origin in [Origin('center'), Origin('corner')]:
+        assert_array_equal(volume.voxmm_to_idx_array(coords, origin),
+                           [volume.voxmm_to_idx(*c, origin) for c in coords])
+        assert_array_equal(volume.vox_to_idx_array(coords, origin),
+                           [volume.vox_to_idx(*c, origin) for c in coords])
+
+
+def _get_fibertube_volumes(volume_class, **kwargs):
+    # Two identical volumes, with the same random generator seed, so that the
+    # sampled intersection volumes are the same.
+    sft = get_random_walk_sft(nb_streamlines=5, min_nb_points=3)
+    diameters = np.full(len(sft), 0.5)
+    return [volume_class(sft.streamlines, diameters, sft, 0.5,
+                         np.random.default_rng(0), **kwargs)
+            for _ in range(2)]
+
+
+def test_fibertube_get_value_at_coordinates():
+    coords = _get_coords()[:10]
+
+    volume, scalar_volume = _get_fibertube_volumes(FibertubeDataVolume)
+    values = volume.get_value_at_coordinates(coords, Space.VOXMM,
+                                             Origin('center'))
+    assert len(values) == len(coords)
+    for (directions, volumes), c in zip(values, coords):
+        expected = scalar_volume.get_value_at_coordinate(
+            *c, Space.VOXMM, Origin('center'))
+        assert_allclose(directions, expected[0])
+        assert_allclose(volumes, expected[1])
+
+    volume, scalar_volume = _get_fibertube_volumes(
+        FTODFDataVolume, sh_basis='descoteaux07', sh_order=4)
+    values = volume.get_value_at_indices(coords.astype(int))
+    expected = [scalar_volume.get_value_at_coordinate(
+        *i, Space.VOX, Origin('center'))
+        for i in np.clip(coords.astype(int), 0, 19)]
+    assert values.shape == (len(coords), 15)
+    assert_allclose(values, expected)
+
+    with pytest.raises(ValueError):
+        volume.get_value_at_coordinates(coords, Space.VOX, Origin('corner'))
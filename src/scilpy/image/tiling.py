@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import threading
+
+import nibabel as nib
+import numpy as np
+
+from scilpy.image.utils import get_spatial_blocks
+from scilpy.utils.shared_memory import SharedMemoryArray
+
+# Approximate memory (in MB) of the input data of a tile, in float64.
+TILE_MEMORY = 256
+
+# State of the worker processes (see _init_tiles_process).
+d = threading.local()
+
+
+def get_tile_shape(shape, nb_values_per_voxel, nbr_processes=1,
+                   tile_memory=TILE_MEMORY):
+    """
+    Computes the default shape of the tiles of a volume: slabs of
+    consecutive slices along the last axis (contiguous on disk in a NIfTI
+    image) whose input data takes about tile_memory MB, with at least 4
+    tiles per process when possible.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Spatial shape of the volume (X, Y, Z).
+    nb_values_per_voxel : int
+        Number of values per voxel in all the inputs.
+    nbr_processes : int, optional
+        Number of processes sharing the tiles.
+    tile_memory : float, optional
+        Memory (MB) of the input data of a tile, in float64.
+
+    Returns
+    -------
+    tile_shape : tuple of int
+    """
+    slice_memory = shape[0] * shape[1] * nb_values_per_voxel * 8 / 1024 ** 2
+    nb_slices = int(tile_memory // max(slice_memory, 1e-9))
+    if nbr_processes > 1:
+        nb_slices = min(nb_slices, -(-shape[2] // (4 * nbr_processes)))
+    return shape[0], shape[1], int(np.clip(nb_slices, 1, shape[2]))
+
+
+def _is_on_disk(data):
+    return isinstance(data, nib.spatialimages.SpatialImage) and \
+        nib.is_proxy(data.dataobj) and data.get_filename() is not None
+
+
+def _get_source_info(data):
+    """
+    How the processes access an input: images saved on disk are read by
+    tiles from the file, the other inputs are copied in shared memory.
+    Returns the information and the shared array (or None).
+    """
+    if _is_on_disk(data):
+        return ('file', data.get_filename()), None
+
+    if isinstance(data, nib.spatialimages.SpatialImage):
+        data = data.get_fdata()
+    shared = SharedMemoryArray.from_array(np.asarray(data))
+    return ('shared', shared.get_info()), shared
+
+
+def _open_source(info):
+    kind, value = info
+    if kind == 'file':
+        return nib.load(value).dataobj
+    if kind == 'shared':
+        d.shared_arrays.append(SharedMemoryArray.attach(value))
+        return d.shared_arrays[-1].array
+    return value
+
+
+def _read_tile(source, tile):
+    if nib.is_proxy(source):
+        # As get_fdata.
+        return np.asarray(source[tile], dtype=np.float64)
+    return source[tile]
+
+
+def create_nifti_memmap(filename, shape, dtype, affine, header=None):
+    """
+    Creates an uncompressed NIfTI image filled with zeros, and maps its data
+    in memory: the data can be written by parts without ever being entirely
+    in memory.
+
+    Parameters
+    ----------
+    filename : str
+        Output filename. Must be an uncompressed NIfTI (.nii).
+    shape : tuple of int
+        Shape of the data.
+    dtype : np.dtype or str
+        Type of the data.
+    affine : np.ndarray
+        Affine of the image.
+    header : nib.Nifti1Header, optional
+        Header from which to copy the other information (ex, units).
+
+    Returns
+    -------
+    data : np.memmap
+        The data of the image, in Fortran order (as stored in the file).
+    """
+    offset = _create_nifti_file(filename, shape, dtype, affine, header)
+    return _open_nifti_memmap(filename, offset, shape, dtype)
+
+
+def _create_nifti_file(filename, shape, dtype, affine, header=None):
+    """
+    Writes the header of an uncompressed NIfTI image and fills its data with
+    zeros (without writing them, the file is extended). Returns the offset
+    of the data in the file.
+    """
+    if not filename.endswith('.nii'):
+        raise ValueError('Only uncompressed NIfTI images (.nii) can be '
+                         'written by tiles. Got {}.'.format(filename))
+
+    header = nib.Nifti1Header() if header is None else header.copy()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_slope_inter(1, 0)
+    header['vox_offset'] = header.single_vox_offset
+    offset = int(header['vox_offset'])
+
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.truncate(offset + nbytes)
+    return offset
+
+
+def _open_nifti_memmap(filename, offset, shape, dtype):
+    return np.memmap(filename, dtype=np.dtype(dtype), mode='r+',
+                     offset=offset, shape=tuple(shape), order='F')
+
+
+def _init_tiles_process(tiles, sources_info, mask_info, outputs_info, func,
+                        func_args):
+    """
+    Pool initializer (also used without a pool): opens the inputs and the
+    outputs once per process.
+    """
+    d.shared_arrays = []
+    d.tiles = tiles
+    d.sources = [_open_source(info) for info in sources_info]
+    d.mask = None if mask_info is None else _open_source(mask_info)
+    d.outputs = []
+    for info in outputs_info:
+        if info[0] == 'memmap':
+            d.outputs.append(_open_nifti_memmap(*info[1]))
+        else:
+            d.outputs.append(_open_source(info))
+    d.func = func
+    d.func_args = func_args
+
+
+def _close_tiles_process():
+    for output in d.outputs:
+        if isinstance(output, np.memmap):
+            output.flush()
+    for shared_array in d.shared_arrays:
+        shared_array.close()
+    d.__dict__.clear()
+
+
+def _process_tile(tile_id):
+    """
+    Processes the voxels of a tile (inside the mask) and writes the results
+    in the outputs. Returns the number of processed voxels.
+    """
+    tile = d.tiles[tile_id]
+    if d.mask is None:
+        mask = np.ones([s.stop - s.start for s in tile], dtype=bool)
+    else:
+        mask = np.asarray(d.mask[tile], dtype=bool)
+    if not np.any(mask):
+        return 0
+
+    voxels = [_read_tile(source, tile)[mask] for source in d.sources]
+    results = d.func(*voxels, *d.func_args)
+    if not isinstance(results, tuple):
+        results = (results,)
+    for output, result in zip(d.outputs, results):
+        output[tile][mask] = result
+    return len(voxels[0])
+
+
+def process_by_tiles(func, inputs, out_shapes, out_dtypes=np.float64,
+                     mask=None, func_args=(), tile_shape=None,
+                     nbr_processes=1, out_filenames=None, affine=None):
+    """
+    Applies a voxel-wise function to volumes, tile by tile. Only the tiles
+    being processed are in memory: images saved on disk are read by tiles
+    (through img.dataobj) and, if out_filenames are given, the results are
+    written by tiles in the output files. With many processes, the tiles are
+    sent to the processes as they become available and the other inputs and
+    the outputs are in shared memory.
+
+    Reading compressed images (.nii.gz) by tiles is slow unless the
+    indexed_gzip package is installed: prefer uncompressed images.
+
+    Parameters
+    ----------
+    func : callable
+        Function applied on the voxels of each tile (must be picklable, ex,
+        defined at the module level, when nbr_processes > 1). Called as
+        func(*voxels, *func_args), where voxels contains, for each input, the
+        data of the voxels of the tile inside the mask, of shape
+        (N, ...). Returns one array of shape (N,) + out_shape per output (as
+        a tuple if there are many outputs).
+    inputs : list of nib.Nifti1Image or np.ndarray
+        Input volumes, of shape (X, Y, Z, ...). Images are read as with
+        get_fdata (in float64).
+    out_shapes : list of tuple of int
+        Shape of the values of each output, for one voxel (ex, (nb_coeffs,)
+        or () for a 3D output).
+    out_dtypes : np.dtype or list of np.dtype, optional
+        Type of each output.
+    mask : np.ndarray, optional
+        Mask of shape (X, Y, Z). Only the voxels in the mask are processed;
+        the others are 0 in the outputs. Default: all voxels.
+    func_args : tuple, optional
+        Other arguments of func, common to all tiles.
+    tile_shape : tuple of int, optional
+        Spatial shape of the tiles. Default: see get_tile_shape.
+    nbr_processes : int, optional
+        Number of processes.
+    out_filenames : list of str, optional
+        If given, the outputs are written by tiles in these uncompressed
+        NIfTI files (see create_nifti_memmap) instead of being kept in
+        memory.
+    affine : np.ndarray, optional
+        Affine of the output files. Default: the affine of the first image in
+        the inputs.
+
+    Returns
+    -------
+    outputs : list of np.ndarray
+        The outputs, of shape (X, Y, Z) + out_shape. If out_filenames are
+        given, the data of the files (as memmaps).
+    """
+    shape = inputs[0].shape[0:3]
+    for data in list(inputs[1:]) + ([] if mask is None else [mask]):
+        if data.shape[0:3] != shape:
+            raise ValueError('All inputs must have the same spatial shape. '
+                             'Got {} and {}.'.format(shape, data.shape[0:3]))
+    if isinstance(out_dtypes, (list, tuple)):
+        out_dtypes = [np.dtype(dtype) for dtype in out_dtypes]
+    else:
+        out_dtypes = [np.dtype(out_dtypes)] * len(out_shapes)
+
+    if tile_shape is None:
+        nb_values = sum(int(np.prod(data.shape[3:])) for data in inputs)
+        tile_shape = get_tile_shape(shape, nb_values, nbr_processes)
+    tiles = get_spatial_blocks(shape, tile_shape)
+
+    if out_filenames is not None:
+        if affine is None:
+            affine = next(data.affine for data in inputs
+                          if isinstance(data, nib.spatialimages.SpatialImage))
+        files_info = []
+        for filename, out_shape, dtype in zip(out_filenames, out_shapes,
+                                              out_dtypes):
+            out_shape = shape + tuple(out_shape)
+            offset = _create_nifti_file(filename, out_shape, dtype, affine)
+            files_info.append(('memmap', (filename, offset, out_shape,
+                                          dtype)))
+
+    # Separating the case nbr_processes=1 to help get good coverage metrics
+    # (codecov does not deal well with multiprocessing)
+    if nbr_processes == 1:
+        sources_info = []
+        for data in inputs:
+            if _is_on_disk(data):
+                sources_info.append(('file', data.get_filename()))
+            elif isinstance(data, nib.spatialimages.SpatialImage):
+                sources_info.append(('array', data.get_fdata()))
+            else:
+                sources_info.append(('array', data))
+        if out_filenames is None:
+            outputs = [np.zeros(shape + tuple(out_shape), dtype=dtype)
+                       for out_shape, dtype in zip(out_shapes, out_dtypes)]
+            outputs_info = [('array', output) for output in outputs]
+        else:
+            outputs_info = files_info
+        mask_info = None if mask is None else ('array', mask)
+
+        _init_tiles_process(tiles, sources_info, mask_info, outputs_info,
+                            func, func_args)
+        try:
+            if out_filenames is not None:
+                outputs = d.outputs
+            for tile_id in range(len(tiles)):
+                _process_tile(tile_id)
+                logging.debug('Processed tile {}/{}.'
+                              .format(tile_id + 1, len(tiles)))
+        finally:
+            _close_tiles_process()
+        return outputs
+
+    shared_arrays = []
+    try:
+        sources_info = []
+        for data in inputs:
+            info, shared = _get_source_info(data)
+            sources_info.append(info)
+            if shared is not None:
+                shared_arrays.append(shared)
+
+        mask_info = None
+        if mask is not None:
+            shared_arrays.append(SharedMemoryArray.from_array(
+                np.asarray(mask, dtype=bool)))
+            mask_info = ('shared', shared_arrays[-1].get_info())
+
+        if out_filenames is None:
+            shared_outputs = [SharedMemoryArray(shape + tuple(out_shape),
+                                                dtype)
+                              for out_shape, dtype in zip(out_shapes,
+                                                          out_dtypes)]
+            shared_arrays.extend(shared_outputs)
+            outputs_info = [('shared', output.get_info())
+                            for output in shared_outputs]
+        else:
+            outputs_info = files_info
+
+        # The pool is terminated on exit, even on errors, before the shared
+        # memory is unlinked.
+        with multiprocessing.Pool(
+                nbr_processes, initializer=_init_tiles_process,
+                initargs=(tiles, sources_info, mask_info, outputs_info, func,
+                          func_args)) as pool:
+            for i, _ in enumerate(pool.imap_unordered(_process_tile,
+                                                      range(len(tiles)))):
+                logging.debug('Processed tile {}/{}.'
+                              .format(i + 1, len(tiles)))
+
+        if out_filenames is None:
+            outputs = [output.array.copy() for output in shared_outputs]
+        else:
+            outputs = [_open_nifti_memmap(*info[1]) for info in outputs_info]
+    finally:
+        for shared_array in shared_arrays:
+            shared_array.unlink()
+
+    return outputs
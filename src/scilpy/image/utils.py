@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import itertools
 import logging
 
 from dipy.segment.mask import bounding_box
@@ -55,6 +56,30 @@ def volume_iterator(img, blocksize=1, start=0, end=0):
             yield list(range(stop, end)), img.dataobj[..., stop:end]
 
 
+def get_spatial_blocks(shape, block_shape):
+    """Splits a volume into spatial blocks.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Spatial shape of the volume (X, Y, Z).
+    block_shape : tuple of int
+        Shape of the blocks. The blocks at the end of each axis can be
+        smaller.
+
+    Returns
+    -------
+    blocks : list of tuple of slice
+        The slices of each block, ordered along the last axis first (for a
+        NIfTI image, blocks of consecutive slices are close on disk).
+    """
+    ranges = [range(0, dim, size) for dim, size in zip(shape, block_shape)]
+    return [tuple(slice(start, min(start + size, dim))
+                  for start, size, dim in zip(starts[::-1], block_shape,
+                                              shape))
+            for starts in itertools.product(*ranges[::-1])]
+
+
 def extract_affine(input_files):
     """Extract the affine from a list of nifti files.
 
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import itertools
+
 import numpy as np
 
 from numba_kdtree import KDTree
@@ -26,7 +28,9 @@ class DataVolume(object):
         Parameters
         ----------
         data: np.array
-            The data, ex, loaded from nibabel img.get_fdata().
+            The data, ex, loaded from nibabel img.get_fdata(). Float32 data
+            (ex, img.get_fdata(dtype=np.float32)) is supported, and halves
+            the memory usage; values are then interpolated as float32.
         voxres: np.array(3,)
             The pixel resolution, ex, using img.header.get_zooms()[:3].
         interpolation: str or None
@@ -76,6 +80,30 @@ class DataVolume(object):
         i, j, k = self._clip_idx_to_bound(i, j, k)
         return self.data[i][j][k]
 
+    def get_value_at_indices(self, idx):
+        """
+        Vectorized version of get_value_at_idx: get the voxel values at N
+        indices at once. If an index is out of bound, the nearest voxel value
+        is taken.
+
+        Parameters
+        ----------
+        idx: ndarray (N, 3)
+            Voxel indices along each axis.
+
+        Return
+        ------
+        values: ndarray (N, self.dim[-1]) or (N,)
+            The values at each index. If the last dimension is of length 1,
+            return an array of shape (N,).
+        """
+        idx = np.asarray(idx).reshape((-1, 3)).astype(np.intp)
+        idx = np.clip(idx, 0, np.asarray(self.dim[0:3]) - 1)
+        result = self.data[idx[:, 0], idx[:, 1], idx[:, 2]]
+        if result.shape[-1] == 1:
+            return result[:, 0]
+        return result
+
     def get_value_at_coordinate(self, x, y, z, space, origin):
         """
         Get the voxel value at coordinates x, y, z, in the dataset.
@@ -105,6 +133,39 @@ class DataVolume(object):
             raise NotImplementedError("We have not prepared the DataVolume to "
                                       "work in RASMM space yet.")
 
+    def get_value_at_coordinates(self, coords, space, origin):
+        """
+        Vectorized version of get_value_at_coordinate: get the values at N
+        coordinates at once. Coordinates must be in the given space and
+        origin.
+
+        If the coordinates are out of bound, the nearest voxel value is taken.
+
+        Parameters
+        ----------
+        coords: ndarray (N, 3)
+            Coordinates along each axis.
+        space: dipy Space
+            'vox' or 'voxmm'.
+        origin: dipy Origin
+            'corner' or 'center'.
+
+        Return
+        ------
+        values: ndarray (N, self.dim[-1]) or (N,)
+            The values evaluated at each coordinate. If the last dimension is
+            of length 1, return an array of shape (N,).
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        if space == Space.VOX:
+            return self._vox_to_values(coords, origin)
+        elif space == Space.VOXMM:
+            return self._vox_to_values(self.voxmm_to_vox_array(coords),
+                                       origin)
+        else:
+            raise NotImplementedError("We have not prepared the DataVolume to "
+                                      "work in RASMM space yet.")
+
     def is_idx_in_bound(self, i, j, k):
         """
         Test if voxel is in dataset range.
@@ -149,6 +210,52 @@ class DataVolume(object):
             raise NotImplementedError("We have not prepared the DataVolume to "
                                       "work in RASMM space yet.")
 
+    def are_coordinates_in_bound(self, coords, space, origin):
+        """
+        Vectorized version of is_coordinate_in_bound.
+
+        Parameters
+        ----------
+        coords: ndarray (N, 3)
+            Coordinates along each axis.
+        space: dipy Space
+            'vox' or 'voxmm'.
+        origin: dipy Origin
+            'corner' or 'center'.
+
+        Return
+        ------
+        out: ndarray (N,) of bools
+            True if voxel is in dataset range, False otherwise.
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        if space == Space.VOX:
+            return self.are_indices_in_bound(
+                self.vox_to_idx_array(coords, origin))
+        elif space == Space.VOXMM:
+            return self.are_indices_in_bound(
+                self.voxmm_to_idx_array(coords, origin))
+        else:
+            raise NotImplementedError("We have not prepared the DataVolume to "
+                                      "work in RASMM space yet.")
+
+    def are_indices_in_bound(self, idx):
+        """
+        Vectorized version of is_idx_in_bound.
+
+        Parameters
+        ----------
+        idx: ndarray (N, 3)
+            Voxel indices along each axis.
+
+        Return
+        ------
+        out: ndarray (N,) of bools
+            True if voxel is in dataset range, False otherwise.
+        """
+        idx = np.asarray(idx).reshape((-1, 3))
+        return np.all((idx >= 0) & (idx < np.asarray(self.dim[0:3])), axis=1)
+
     def _clip_idx_to_bound(self, i, j, k):
         """
         Returns i, j, k if the index is valid inside the bounding box. Else,
@@ -220,6 +327,31 @@ class DataVolume(object):
         else:
             raise ValueError("Origin must be 'center' or 'corner'.")
 
+    @staticmethod
+    def vox_to_idx_array(coords, origin):
+        """
+        Vectorized version of vox_to_idx.
+
+        Parameters
+        ----------
+        coords: ndarray (N, 3)
+            Position coordinates in voxel space.
+        origin: Dipy Space
+            'center' or 'corner'.
+
+        Return
+        ------
+        idx: ndarray (N, 3)
+            3D indices of the voxels, as floats (like in vox_to_idx).
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        if origin == Origin('corner'):
+            return np.floor(coords)
+        elif origin == Origin('center'):
+            return np.floor(coords + 0.5)
+        else:
+            raise ValueError("Origin must be 'center' or 'corner'.")
+
     def _vox_to_value(self, x, y, z, origin):
         """
         Get the voxel value at voxel position x, y, z (vox) in the dataset.
@@ -246,7 +378,14 @@ class DataVolume(object):
             # Interpolation: Using dipy's pyx methods. The doc can be found in
             # the file dipy.core.interpolation.pxd. Dipy works with origin
             # center.
-            # Note. Data is expected to be double (float64), can't use float32.
+            # Note. Dipy expects writeable double (float64) data. Else (ex,
+            # float32 data), using our vectorized version rather than
+            # converting the whole volume.
+            if self.data.dtype != np.float64 or \
+                    not self.data.flags.writeable:
+                coord = np.array([[x, y, z]], dtype=np.float64)
+                return np.squeeze(self._vox_to_values(coord, origin)[0])
+
             coord = np.array((x, y, z), dtype=np.float64)
             if origin == Origin('corner'):
                 coord -= 0.5
@@ -269,6 +408,90 @@ class DataVolume(object):
             raise Exception("No interpolation method was given, cannot run "
                             "this method..")
 
+    def _vox_to_values(self, coords, origin):
+        """
+        Vectorized version of _vox_to_value, for an array of coordinates
+        (N, 3). Reproduces dipy's nearest neighbour and trilinear
+        interpolation without a Python call per point. Values are computed
+        as float32 if the data is float32, else as float64.
+
+        Parameters
+        ----------
+        coords: ndarray (N, 3)
+            Position coordinates (vox).
+        origin: dipy Space
+            'center' or 'corner'.
+
+        Return
+        ------
+        values: ndarray (N, self.dims[-1]) or (N,)
+            Interpolated values. If the last dimension is of length 1, return
+            an array of shape (N,).
+        """
+        if self.interpolation is None:
+            raise Exception("No interpolation method was given, cannot run "
+                            "this method..")
+
+        # Checking if out of bound. Only points out of bound are clipped, as
+        # in _clip_vox_to_bound.
+        eps = float(1e-8)
+        dim = np.asarray(self.dim[0:3], dtype=np.float64)
+        if origin == Origin('corner'):
+            clipped = np.clip(coords, 0, dim - eps)
+        elif origin == Origin('center'):
+            clipped = np.clip(coords, -0.5, dim - 0.5 - eps)
+        else:
+            raise ValueError("Origin should be 'center' or 'corner'.")
+        in_bound = self.are_indices_in_bound(
+            self.vox_to_idx_array(coords, origin))
+        coords = np.where(in_bound[:, None], coords, clipped)
+
+        # Dipy works with origin center.
+        if origin == Origin('corner'):
+            coords = coords - 0.5
+
+        if self.interpolation == 'nearest':
+            # Same as dipy: round(point), not floor.
+            idx = np.round(coords).astype(np.intp)
+            result = self.data[idx[:, 0], idx[:, 1], idx[:, 2]]
+        else:
+            # Trilinear. Same as dipy's trilinear_interpolate4d: on the
+            # borders, the neighbour outside the volume is replaced by the
+            # voxel itself.
+            dtype = np.float32 if self.data.dtype == np.float32 \
+                else np.float64
+            flr = np.floor(coords).astype(np.intp)
+            rem = (coords - flr).astype(dtype)
+            idx0 = flr + (flr == -1)
+            idx1 = flr + (flr != np.asarray(self.dim[0:3]) - 1)
+
+            # The 8 neighbours: (N, 8) indices and weights along each axis,
+            # in the order of itertools.product((0, 1), repeat=3).
+            corners = np.asarray(list(itertools.product((0, 1), repeat=3)))
+            indices = np.stack((idx0, idx1), axis=1)
+            weights = np.stack((1 - rem, rem), axis=1)
+            i = indices[:, corners[:, 0], 0]
+            j = indices[:, corners[:, 1], 1]
+            k = indices[:, corners[:, 2], 2]
+            w = (weights[:, corners[:, 0], 0] * weights[:, corners[:, 1], 1] *
+                 weights[:, corners[:, 2], 2])
+
+            # One gather for all neighbours, then the weighted sum for all
+            # points as a batch of (1, 8) x (8, C) products. In float32,
+            # summing the neighbours in order instead, as the native
+            # propagation kernel does, to get the same values.
+            values = self.data[i, j, k].astype(dtype, copy=False)
+            if dtype == np.float32:
+                result = w[:, 0, None] * values[:, 0]
+                for n in range(1, len(corners)):
+                    result += w[:, n, None] * values[:, n]
+            else:
+                result = np.matmul(w[:, None, :], values)[:, 0]
+
+        if result.shape[-1] == 1:
+            return result[:, 0]
+        return result
+
     def _is_vox_in_bound(self, x, y, z, origin):
         """
         Test if voxel is in dataset range.
@@ -306,6 +529,24 @@ class DataVolume(object):
         """
         return self.vox_to_idx(*self.voxmm_to_vox(x, y, z), origin)
 
+    def voxmm_to_idx_array(self, coords, origin):
+        """
+        Vectorized version of voxmm_to_idx.
+
+        Parameters
+        ----------
+        coords: ndarray (N, 3)
+            Position coordinates (mm).
+        origin: dipy Space
+            'center' or 'corner'.
+
+        Return
+        ------
+        idx: ndarray (N, 3)
+            3D indices of the voxels, as floats (like in vox_to_idx).
+        """
+        return self.vox_to_idx_array(self.voxmm_to_vox_array(coords), origin)
+
     def voxmm_to_vox(self, x, y, z):
         """
         Get voxel space coordinates at position x, y, z (mm).
@@ -328,6 +569,23 @@ class DataVolume(object):
                 y / self.voxres[1],
                 z / self.voxres[2]]
 
+    def voxmm_to_vox_array(self, coords):
+        """
+        Vectorized version of voxmm_to_vox.
+
+        Parameters
+        ----------
+        coords: ndarray (N, 3)
+            Position coordinates (mm).
+
+        Return
+        ------
+        coords: ndarray (N, 3)
+            Voxel space coordinates.
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        return coords / np.asarray(self.voxres, dtype=np.float64)
+
     def _voxmm_to_value(self, x, y, z, origin):
         """
         Get the voxel value at voxel position x, y, z (mm) in the dataset.
@@ -446,6 +704,27 @@ class FibertubeDataVolume(DataVolume):
             raise NotImplementedError("We have not prepared the DataVolume "
                                       "to work in RASMM space yet.")
 
+    def get_value_at_indices(self, idx):
+        # Voxel indices are the voxel centers in vox space.
+        idx = np.asarray(idx).reshape((-1, 3)).astype(np.intp)
+        idx = np.clip(idx, 0, np.asarray(self.dim[0:3]) - 1)
+        return self.get_value_at_coordinates(idx, Space.VOX, Origin.NIFTI)
+
+    def get_value_at_coordinates(self, coords, space, origin):
+        # Not vectorized: loops on get_value_at_coordinate. Values are
+        # stacked in an array when they are vectors (ex, SH coefficients) and
+        # returned as a list otherwise (ex, tuples of directions and volumes).
+        FibertubeDataVolume._validate_origin(origin)
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        values = [self.get_value_at_coordinate(x, y, z, space, origin)
+                  for x, y, z in coords]
+        if self.nb_coeffs == 0:
+            return values
+        values = np.asarray(values).reshape((len(coords), -1))
+        if values.shape[-1] == 1:
+            return values[:, 0]
+        return values
+
     def is_idx_in_bound(self, i, j, k):
         return super().is_idx_in_bound(i, j, k)
 
@@ -453,6 +732,10 @@ class FibertubeDataVolume(DataVolume):
         FibertubeDataVolume._validate_origin(origin)
         return super().is_coordinate_in_bound(x, y, z, space, origin)
 
+    def are_coordinates_in_bound(self, coords, space, origin):
+        FibertubeDataVolume._validate_origin(origin)
+        return super().are_coordinates_in_bound(coords, space, origin)
+
     @staticmethod
     def vox_to_idx(x, y, z, origin):
         FibertubeDataVolume._validate_origin(origin)
@@ -8,6 +8,9 @@ import numpy as np
 
 from scilpy.io.streamlines import reconstruct_streamlines
 
+# Number of rows (points or streamlines) per chunk of compressed datasets.
+HDF5_CHUNK_LEN = 65536
+
 
 def reconstruct_sft_from_hdf5(hdf5_handle, group_keys, space=Space.VOX,
                               origin=Origin.TRACKVIS, load_dps=False,
@@ -173,7 +176,7 @@ def assert_header_compatible_hdf5(hdf5_handle, ref):
                       ' {}'.format(name))
 
 
-def reconstruct_streamlines_from_hdf5(hdf5_group):
+def reconstruct_streamlines_from_hdf5(hdf5_group, indices=None):
     """
     Function to reconstruct streamlines from hdf5, mainly to facilitate
     decomposition into thousands of connections and decrease I/O usage.
@@ -182,24 +185,32 @@ def reconstruct_streamlines_from_hdf5(hdf5_group):
     ----------
     hdf5_group: h5py.group
         Handle to the hdf5 group. Ex: hdf5_file[bundle_key].
+    indices: slice or list of int, optional
+        The streamlines to reconstruct. Only the needed part of the group is
+        read, ex, with a slice(start, end). Default: all streamlines.
 
     Returns
     -------
-    streamlines : list of np.ndarray
-        List of streamlines.
+    streamlines : ArraySequence
+        The streamlines.
     """
     if 'data' not in hdf5_group:
         raise ValueError("Expecting data in bundle's group.")
 
-    data = np.array(hdf5_group['data']).flatten()
-    offsets = np.array(hdf5_group['offsets'])
-    lengths = np.array(hdf5_group['lengths'])
+    # The data is only read where needed.
+    offsets = hdf5_group['offsets']
+    lengths = hdf5_group['lengths']
+    if isinstance(indices, slice):
+        offsets = offsets[indices]
+        lengths = lengths[indices]
+        indices = None
 
-    return reconstruct_streamlines(data, offsets, lengths)
+    return reconstruct_streamlines(hdf5_group['data'], offsets, lengths,
+                                   indices=indices)
 
 
 def construct_hdf5_from_sft(hdf5_handle, sfts, groups_keys='streamlines',
-                            save_dps=False, save_dpp=False):
+                            save_dps=False, save_dpp=False, compression=None):
     """
     Create a hdf5 from a SFT.
 
@@ -214,6 +225,8 @@ def construct_hdf5_from_sft(hdf5_handle, sfts, groups_keys='streamlines',
         If True, save the DPS keys to hdf5.
     save_dpp: bool
         If True, save the DPP keys to hdf5.
+    compression: str or None
+        One of 'gzip', 'lzf'. See construct_hdf5_group_from_streamlines.
     """
     if isinstance(sfts, StatefulTractogram):
         sfts = [sfts]
@@ -233,7 +246,8 @@ def construct_hdf5_from_sft(hdf5_handle, sfts, groups_keys='streamlines',
         construct_hdf5_group_from_streamlines(
             group, sft.streamlines,
             sft.data_per_streamline if save_dps else None,
-            sft.data_per_point if save_dpp else None)
+            sft.data_per_point if save_dpp else None,
+            compression=compression)
 
 
 def construct_hdf5_header(hdf5_handle, ref_sft):
@@ -246,7 +260,8 @@ def construct_hdf5_header(hdf5_handle, ref_sft):
 
 
 def construct_hdf5_group_from_streamlines(hdf5_group, streamlines,
-                                          dps=None, dpp=None):
+                                          dps=None, dpp=None,
+                                          compression=None):
     """
     Create a hdf5 group from streamlines.
 
@@ -260,18 +275,31 @@ def construct_hdf5_group_from_streamlines(hdf5_group, streamlines,
         The data_per_streamline
     dpp: dict or None
         The data_per_point
+    compression: str or None
+        One of 'gzip', 'lzf'. If set, the datasets are chunked and
+        compressed, and reading a range of streamlines only decompresses the
+        chunks it covers. Default: contiguous, uncompressed datasets.
     """
-    hdf5_group.create_dataset('data', data=streamlines.get_data(),
-                              dtype=np.float32)
-    hdf5_group.create_dataset('offsets', data=streamlines.copy()._offsets,
-                              dtype=np.int64)
-    hdf5_group.create_dataset('lengths', data=streamlines.copy()._lengths,
-                              dtype=np.int32)
+    lengths = np.asarray(streamlines._lengths)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+
+    # Streamlines already stored one after the other (ex, loaded from a
+    # file) are saved without a copy.
+    if len(streamlines._data) == np.sum(lengths) and \
+            np.array_equal(streamlines._offsets, offsets):
+        data = streamlines._data
+    else:
+        data = streamlines.get_data()
+
+    _create_dataset(hdf5_group, 'data', data, np.float32, compression)
+    _create_dataset(hdf5_group, 'offsets', offsets, np.int64, compression)
+    _create_dataset(hdf5_group, 'lengths', lengths, np.int32, compression)
     if dps is not None:
         for dps_key, dps_value in dps.items():
             if dps_key not in ['data', 'offsets', 'lengths']:
-                hdf5_group.create_dataset(dps_key, data=dps_value,
-                                          dtype=np.float32)
+                _create_dataset(hdf5_group, dps_key, dps_value, np.float32,
+                                compression)
             else:
                 raise ValueError("Please do not use data_per_streamline keys "
                                  "'data', 'offsets' or 'lengths', this "
@@ -280,3 +308,20 @@ def construct_hdf5_group_from_streamlines(hdf5_group, streamlines,
     if dpp is not None:
         raise NotImplementedError(
             "NOT IMPLEMENTED: Cannot save data_per_point in the hdf5 yet.")
+
+
+def _create_dataset(hdf5_group, key, data, dtype, compression=None):
+    """
+    Create a dataset, chunked along its first axis if compressed.
+    """
+    data = np.asarray(data)
+    if compression is None or data.ndim == 0 or len(data) == 0:
+        return hdf5_group.create_dataset(key, data=data, dtype=dtype)
+
+    if compression not in ['gzip', 'lzf']:
+        raise ValueError("Unknown hdf5 compression {}. Choices are gzip "
+                         "and lzf.".format(compression))
+    chunks = (min(len(data), HDF5_CHUNK_LEN),) + data.shape[1:]
+    return hdf5_group.create_dataset(key, data=data, dtype=dtype,
+                                     chunks=chunks, compression=compression,
+                                     shuffle=True)
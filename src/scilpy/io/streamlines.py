@@ -270,34 +270,44 @@ def load_dpp_files_as_dpp(parser, dpp_files, sft, keys=None, overwrite=False):
 
 
 def streamlines_to_memmap(input_streamlines,
-                          strs_dtype='float32'):
+                          strs_dtype='float32', out_dir=None):
     """
     Function to decompose on disk the array_sequence into its components.
     Parameters
     ----------
     input_streamlines : ArraySequence
         All streamlines of the tractogram to segment.
+    strs_dtype : str
+        Data type of the points.
+    out_dir : str, optional
+        Existing directory where to write the memmaps, which are then kept.
+        Default: a temporary directory.
     Returns
     -------
     tmp_obj : tuple
-        Temporary directory and tuple of filenames for the data, offsets
-        and lengths.
+        Temporary directory (None if out_dir is given) and tuple of filenames
+        for the data, offsets and lengths.
     """
-    tmp_dir = tempfile.TemporaryDirectory()
-    data_filename = os.path.join(tmp_dir.name, 'data.dat')
+    if out_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        out_dir = tmp_dir.name
+    else:
+        tmp_dir = None
+    data_filename = os.path.join(out_dir, 'data.dat')
     data = np.memmap(data_filename, dtype=strs_dtype, mode='w+',
                      shape=input_streamlines._data.shape)
     data[:] = input_streamlines._data[:]
 
-    offsets_filename = os.path.join(tmp_dir.name, 'offsets.dat')
+    offsets_filename = os.path.join(out_dir, 'offsets.dat')
     offsets = np.memmap(offsets_filename, dtype='int64', mode='w+',
                         shape=input_streamlines._offsets.shape)
     offsets[:] = input_streamlines._offsets[:]
 
-    lengths_filename = os.path.join(tmp_dir.name, 'lengths.dat')
+    lengths_filename = os.path.join(out_dir, 'lengths.dat')
     lengths = np.memmap(lengths_filename, dtype='int32', mode='w+',
                         shape=input_streamlines._lengths.shape)
     lengths[:] = input_streamlines._lengths[:]
+    del data, offsets, lengths
 
     return tmp_dir, (data_filename, offsets_filename, lengths_filename)
 
@@ -317,8 +327,8 @@ def reconstruct_streamlines_from_memmap(memmap_filenames, indices=None,
 
     Returns
     -------
-    streamlines : list of np.ndarray
-        List of streamlines.
+    streamlines : ArraySequence
+        The streamlines.
     """
 
     data = np.memmap(memmap_filenames[0],  dtype=strs_dtype, mode='r')
@@ -328,15 +338,31 @@ def reconstruct_streamlines_from_memmap(memmap_filenames, indices=None,
     return reconstruct_streamlines(data, offsets, lengths, indices=indices)
 
 
+def _read_points(data, start, end):
+    """
+    Reads the points start to end of data, of shape (N, 3) or flattened.
+    """
+    if data.ndim == 1:
+        return np.array(data[3 * start:3 * end]).reshape((-1, 3))
+    return np.array(data[start:end])
+
+
 def reconstruct_streamlines(data, offsets, lengths, indices=None):
     """
     Function to reconstruct streamlines from its data, offsets and lengths
     (from the nibabel tractogram object).
 
+    The ArraySequence is built directly from the offsets and lengths: the
+    points of runs of streamlines that are contiguous in data are read with a
+    single slice. Other streamlines are gathered with a single fancy index
+    from arrays and memmaps, or read one contiguous run at a time from other
+    datasets (ex, h5py).
+
     Parameters
     ----------
     data : np.ndarray
-        Nx3 array representing all points of the streamlines.
+        Nx3 (or flattened 3Nx1) array representing all points of the
+        streamlines. Can be a memmap or a h5py dataset.
     offsets : np.ndarray
         Nx1 array representing the cumsum of length array.
     lengths : np.ndarray
@@ -346,19 +372,44 @@ def reconstruct_streamlines(data, offsets, lengths, indices=None):
 
     Returns
     -------
-    streamlines : list of np.ndarray
-        List of streamlines.
+    streamlines : ArraySequence
+        The streamlines.
     """
-
-    if data.ndim == 2:
-        data = np.array(data).flatten()
-
-    if indices is None:
-        indices = np.arange(len(offsets))
-
-    streamlines = []
-    for i in indices:
-        streamline = data[offsets[i]*3:offsets[i]*3 + lengths[i]*3]
-        streamlines.append(streamline.reshape((lengths[i], 3)))
-
-    return ArraySequence(streamlines)
+    offsets = np.asarray(offsets, dtype=np.intp)
+    lengths = np.asarray(lengths, dtype=np.intp)
+    if indices is not None:
+        indices = np.asarray(indices, dtype=np.intp)
+        offsets = offsets[indices]
+        lengths = lengths[indices]
+
+    streamlines = ArraySequence()
+    if len(offsets) == 0:
+        return streamlines
+
+    if isinstance(data, np.ndarray) and data.ndim == 1:
+        data = data.reshape((-1, 3))
+
+    new_offsets = np.zeros(len(lengths), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=new_offsets[1:])
+
+    # Streamlines following each other in data can be read at once.
+    is_contiguous = offsets[1:] == offsets[:-1] + lengths[:-1]
+    if isinstance(data, np.ndarray) and not np.all(is_contiguous):
+        # Memmaps are only read where indexed.
+        point_indices = np.repeat(offsets - new_offsets, lengths)
+        point_indices += np.arange(len(point_indices))
+        points = np.asarray(data)[point_indices]
+    else:
+        # Other datasets (ex, h5py) are read one contiguous run of
+        # streamlines at a time, to avoid reading the gaps between them.
+        run_starts = np.concatenate(([0], np.flatnonzero(~is_contiguous) + 1))
+        run_ends = np.append(run_starts[1:], len(offsets))
+        points = [_read_points(data, offsets[s],
+                               offsets[e - 1] + lengths[e - 1])
+                  for s, e in zip(run_starts, run_ends)]
+        points = points[0] if len(points) == 1 else np.concatenate(points)
+
+    streamlines._data = points
+    streamlines._offsets = new_offsets
+    streamlines._lengths = lengths
+    return streamlines
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+
+import h5py
+import nibabel as nib
+import numpy as np
+from dipy.io.stateful_tractogram import StatefulTractogram, Space, Origin
+
+from scilpy.io.hdf5 import (construct_hdf5_from_sft,
+                            reconstruct_streamlines_from_hdf5)
+
+
+def _get_sft():
+    rng = np.random.default_rng(0)
+    ref = nib.Nifti1Image(np.zeros((10, 10, 10)), affine=np.eye(4))
+    streamlines = [rng.uniform(0, 10, (n, 3)).astype(np.float32)
+                   for n in [3, 1, 7, 2, 4]]
+    return StatefulTractogram(
+        streamlines, ref, space=Space.VOX, origin=Origin('corner'),
+        data_per_streamline={'weight': rng.random(5)})
+
+
+def _assert_same(streamlines, expected):
+    assert len(streamlines) == len(expected)
+    for s, e in zip(streamlines, expected):
+        assert np.array_equal(s, e)
+
+
+def test_hdf5_round_trip(tmp_path):
+    sft = _get_sft()
+    for compression in [None, 'gzip', 'lzf']:
+        filename = os.path.join(tmp_path, '{}.h5'.format(compression))
+        with h5py.File(filename, 'w') as f:
+            construct_hdf5_from_sft(f, [sft, sft[1:2]], ['a', 'b'],
+                                    save_dps=True, compression=compression)
+
+        with h5py.File(filename, 'r') as f:
+            for key in ['data', 'offsets', 'lengths', 'weight']:
+                assert f['a'][key].compression == compression
+            assert np.allclose(f['a']['weight'],
+                               sft.data_per_streamline['weight'])
+            _assert_same(reconstruct_streamlines_from_hdf5(f['a']),
+                         sft.streamlines)
+            _assert_same(reconstruct_streamlines_from_hdf5(f['b']),
+                         sft[1:2].streamlines)
+
+
+def test_reconstruct_streamlines_from_hdf5_indices(tmp_path):
+    sft = _get_sft()
+    for compression in [None, 'gzip']:
+        filename = os.path.join(tmp_path, '{}.h5'.format(compression))
+        with h5py.File(filename, 'w') as f:
+            construct_hdf5_from_sft(f, sft, 'a', compression=compression)
+
+        with h5py.File(filename, 'r') as f:
+            for indices in [slice(1, 4), slice(3, None), [0, 2, 4], [3, 1],
+                            [2], []]:
+                streamlines = reconstruct_streamlines_from_hdf5(f['a'],
+                                                                indices)
+                if isinstance(indices, slice):
+                    expected = sft.streamlines[indices]
+                else:
+                    expected = [sft.streamlines[i] for i in indices]
+                _assert_same(streamlines, expected)
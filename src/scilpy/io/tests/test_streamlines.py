@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import h5py
+import numpy as np
+from nibabel.streamlines.array_sequence import ArraySequence
+
+from scilpy.io.streamlines import (reconstruct_streamlines,
+                                   reconstruct_streamlines_from_memmap,
+                                   streamlines_to_memmap)
+
+
+def _reconstruct_streamlines_one_by_one(data, offsets, lengths,
+                                        indices=None):
+    # The previous version, with one slice per streamline.
+    if data.ndim == 2:
+        data = np.array(data).flatten()
+
+    if indices is None:
+        indices = np.arange(len(offsets))
+
+    streamlines = []
+    for i in indices:
+        streamline = data[offsets[i]*3:offsets[i]*3 + lengths[i]*3]
+        streamlines.append(streamline.reshape((lengths[i], 3)))
+
+    return ArraySequence(streamlines)
+
+
+def _assert_same(streamlines, expected):
+    assert isinstance(streamlines, ArraySequence)
+    assert len(streamlines) == len(expected)
+    for s, e in zip(streamlines, expected):
+        assert np.array_equal(s, e)
+
+
+def _get_streamlines(lengths):
+    rng = np.random.default_rng(0)
+    return ArraySequence([rng.random((n, 3)).astype(np.float32)
+                          for n in lengths])
+
+
+def test_reconstruct_streamlines():
+    for lengths in [[], [5], [3, 1, 7, 2, 4]]:
+        streamlines = _get_streamlines(lengths)
+        data = streamlines.get_data()
+        offsets = streamlines._offsets
+        nb = len(lengths)
+
+        # All, a contiguous run, non-contiguous, in any order, repeated.
+        all_indices = [None, np.arange(nb)]
+        if nb > 1:
+            all_indices += [[1, 2, 3], [0, 2, 4], [4, 0, 3], [2, 2], []]
+        for indices in all_indices:
+            expected = _reconstruct_streamlines_one_by_one(
+                data, offsets, lengths, indices)
+            _assert_same(reconstruct_streamlines(data, offsets, lengths,
+                                                 indices), expected)
+            # Flattened data.
+            _assert_same(reconstruct_streamlines(data.ravel(), offsets,
+                                                 lengths, indices), expected)
+
+
+def test_reconstruct_streamlines_h5py():
+    streamlines = _get_streamlines([3, 1, 7, 2, 4])
+    tmp_dir = tempfile.TemporaryDirectory()
+    with h5py.File(os.path.join(tmp_dir.name, 'data.h5'), 'w') as f:
+        for shape in [(-1, 3), (-1,)]:
+            data = f.create_dataset(
+                str(len(shape)), data=streamlines.get_data().reshape(shape))
+            for indices in [None, [1, 2, 3], [0, 2, 4], [4, 0, 3], [2, 2]]:
+                expected = _reconstruct_streamlines_one_by_one(
+                    streamlines.get_data(), streamlines._offsets,
+                    streamlines._lengths, indices)
+                _assert_same(reconstruct_streamlines(
+                    data, streamlines._offsets, streamlines._lengths,
+                    indices), expected)
+    tmp_dir.cleanup()
+
+
+def test_reconstruct_streamlines_reads_only_runs():
+    class _Dataset:
+        # Records the slices read.
+        def __init__(self, data):
+            self.data = data
+            self.ndim = data.ndim
+            self.slices = []
+
+        def __getitem__(self, key):
+            self.slices.append((key.start, key.stop))
+            return self.data[key]
+
+    streamlines = _get_streamlines([3, 1, 7, 2, 4])
+    data = _Dataset(streamlines.get_data())
+    reconstruct_streamlines(data, streamlines._offsets, streamlines._lengths,
+                            [0, 1, 4, 2])
+    # Streamlines 0 and 1 are contiguous. The gap is never read.
+    assert data.slices == [(0, 4), (13, 17), (4, 11)]
+
+
+def test_reconstruct_streamlines_from_memmap():
+    streamlines = _get_streamlines([3, 1, 7, 2, 4])
+    tmp_dir, filenames = streamlines_to_memmap(streamlines)
+    for indices in [None, [0, 2, 4], [3, 1]]:
+        expected = _reconstruct_streamlines_one_by_one(
+            streamlines.get_data(), streamlines._offsets,
+            streamlines._lengths, indices)
+        _assert_same(reconstruct_streamlines_from_memmap(filenames, indices),
+                     expected)
+    tmp_dir.cleanup()
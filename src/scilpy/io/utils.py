@@ -16,6 +16,7 @@ from dipy.data import SPHERE_FILES
 from dipy.io.stateful_tractogram import Space, Origin
 from dipy.io.utils import is_header_compatible
 from scipy.io import loadmat
+import scipy.sparse
 import six
 
 from scilpy.gradients.bvec_bval_tools import DEFAULT_B0_THRESHOLD
@@ -308,6 +309,17 @@ def add_bbox_arg(parser):
                              'streamlines).')
 
 
+def add_voxel_index_arg(parser):
+    parser.add_argument('--voxel_index', metavar='FILE',
+                        help='Cache (.npz) of the voxels traversed by the '
+                             'streamlines. If it exists and was \ncomputed '
+                             'from this tractogram, it is loaded. Else, it is '
+                             'computed and \nsaved, to be shared with the '
+                             'next scripts using this tractogram. \nA file '
+                             'computed from another tractogram is only '
+                             'replaced with -f.')
+
+
 def add_vtk_legacy_arg(parser):
     parser.add_argument('--legacy_vtk_format', action='store_true',
                         help='Save the VTK file in the legacy format.')
@@ -1023,12 +1035,33 @@ def read_info_from_mb_bdo(filename):
     return geometry, radius, center
 
 
-def load_matrix_in_any_format(filepath):
+def load_matrix_in_any_format(filepath, keep_sparse=False):
+    """
+    Load a matrix from a .txt, .npy, .npz (scipy.sparse) or .mat
+    (antsRegistration) file.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the matrix.
+    keep_sparse: bool
+        If True, matrices saved as .npz are returned as a scipy.sparse matrix.
+        Else, they are converted to a dense np.ndarray.
+
+    Returns
+    -------
+    data: np.ndarray or scipy.sparse matrix
+        The loaded matrix.
+    """
     _, ext = os.path.splitext(filepath)
     if ext == '.txt':
         data = np.loadtxt(filepath)
     elif ext == '.npy':
         data = np.load(filepath)
+    elif ext == '.npz':
+        data = scipy.sparse.load_npz(filepath)
+        if not keep_sparse:
+            data = data.toarray()
     elif ext == '.mat':
         # .mat are actually dictionnary. This function support .mat from
         # antsRegistration that encode a 4x4 transformation matrix.
@@ -1053,7 +1086,25 @@ def load_matrix_in_any_format(filepath):
 
 
 def save_matrix_in_any_format(filepath, output_data):
+    """
+    Save a matrix as .txt, .npy or .npz (scipy.sparse). Without extension,
+    it is saved as .npy. Sparse matrices are converted to dense arrays,
+    except for .npz. Dense arrays saved as .npz are converted to sparse.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the output matrix.
+    output_data: np.ndarray or scipy.sparse matrix
+        The matrix to save. Must be 2D if saved as .npz.
+    """
     _, ext = os.path.splitext(filepath)
+    if ext == '.npz':
+        scipy.sparse.save_npz(filepath, scipy.sparse.csr_matrix(output_data))
+        return
+
+    if scipy.sparse.issparse(output_data):
+        output_data = output_data.toarray()
     if ext == '.txt':
         np.savetxt(filepath, output_data)
     elif ext == '.npy':
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import itertools
 import multiprocessing
 
 from math import cos, radians
@@ -9,6 +8,7 @@ import numpy as np
 
 from dipy.direction import peak_directions
 from dipy.reconst.shm import sh_to_sf_matrix
+from scilpy.image.tiling import process_by_tiles
 from scilpy.reconst.utils import get_sh_order_and_fullness
 
 
@@ -145,8 +145,8 @@ def bingham_fit_sh(sh, max_lobes=5, abs_th=0.,
 
     Parameters
     ----------
-    sh: ndarray (X, Y, Z, ncoeffs)
-        SH coefficients array.
+    sh: ndarray (X, Y, Z, ncoeffs) or nib.Nifti1Image
+        SH coefficients array. An image saved on disk is read by tiles.
     max_lobes: unsigned int, optional
         Maximum number of lobes to fit per voxel.
     abs_th: float, optional
@@ -170,7 +170,6 @@ def bingham_fit_sh(sh, max_lobes=5, abs_th=0.,
         Bingham functions array.
     """
     order, full_basis = get_sh_order_and_fullness(sh.shape[-1])
-    shape = sh.shape
 
     sphere = get_sphere(name='symmetric724').subdivide(n=2)
     B_mat = sh_to_sf_matrix(sphere, order,
@@ -183,46 +182,20 @@ def bingham_fit_sh(sh, max_lobes=5, abs_th=0.,
         or nbr_processes > multiprocessing.cpu_count() \
         else nbr_processes
 
-    if mask is not None:
-        sh = sh[mask]
-    else:
-        sh = sh.reshape((-1, shape[-1]))
-
-    sh = np.array_split(sh, nbr_processes)
-    pool = multiprocessing.Pool(nbr_processes)
-    out = pool.map(_bingham_fit_sh_chunk, zip(sh, itertools.repeat(B_mat),
-                                              itertools.repeat(sphere),
-                                              itertools.repeat(abs_th),
-                                              itertools.repeat(min_sep_angle),
-                                              itertools.repeat(rel_th),
-                                              itertools.repeat(max_lobes),
-                                              itertools.repeat(max_fit_angle)))
-    pool.close()
-    pool.join()
-
-    out = np.concatenate(out, axis=0)
-    if mask is not None:
-        bingham = np.zeros(shape[:3] + (max_lobes, NB_PARAMS))
-        bingham[mask] = out
-        return bingham
-
-    out = out.reshape(shape[:3] + (max_lobes, NB_PARAMS))
-    return out
+    bingham = process_by_tiles(_bingham_fit_sh_chunk, [sh],
+                               [(max_lobes, NB_PARAMS)], mask=mask,
+                               func_args=(B_mat, sphere, abs_th,
+                                          min_sep_angle, rel_th, max_lobes,
+                                          max_fit_angle),
+                               nbr_processes=nbr_processes)[0]
+    return bingham
 
 
-def _bingham_fit_sh_chunk(args):
+def _bingham_fit_sh_chunk(sh_chunk, B_mat, sphere, abs_th, min_sep_angle,
+                          rel_th, max_lobes, max_angle):
     """
     Fit Bingham functions on a (N, ncoeffs) chunk taken from a SH field.
     """
-    sh_chunk = args[0]
-    B_mat = args[1]
-    sphere = args[2]
-    abs_th = args[3]
-    min_sep_angle = args[4]
-    rel_th = args[5]
-    max_lobes = args[6]
-    max_angle = args[7]
-
     out = np.zeros((len(sh_chunk), max_lobes, NB_PARAMS))
     for i, sh in enumerate(sh_chunk):
         odf = sh.dot(B_mat)
@@ -359,9 +332,10 @@ def compute_fiber_density(bingham, m=50, mask=None, nbr_processes=None):
 
     Parameters
     ----------
-    bingham: Array
+    bingham: Array or nib.Nifti1Image
         Volume of shape (X, Y, Z, N_LOBES, NB_PARAMS) containing
         the Bingham distributions parameters. Note, NB_PARAMS is usually 7.
+        An image saved on disk is read by tiles.
     m: unsigned int, optional
         Number of steps along theta axis for the integration. The number of
         steps along the phi axis is 2*m.
@@ -376,8 +350,6 @@ def compute_fiber_density(bingham, m=50, mask=None, nbr_processes=None):
     res: ndarray (X, Y, Z, max_lobes)
         FD per lobe for each voxel.
     """
-    shape = bingham.shape
-
     phi = np.linspace(0, 2 * np.pi, 2 * m, endpoint=False)  # [0, 2pi[
     theta = np.linspace(0, np.pi, m)  # [0, pi]
     coords = np.array([[p, t] for p in phi for t in theta]).T
@@ -390,50 +362,28 @@ def compute_fiber_density(bingham, m=50, mask=None, nbr_processes=None):
         or nbr_processes > multiprocessing.cpu_count() \
         else nbr_processes
 
-    if mask is not None:
-        bingham = bingham[mask]
-
-    bingham = bingham.reshape((-1, np.prod(shape[-2:])))
-    bingham = np.array_split(bingham, nbr_processes)
-    pool = multiprocessing.Pool(nbr_processes)
-    res = pool.map(_compute_fiber_density_chunk,
-                   zip(bingham,
-                       itertools.repeat(coords),
-                       itertools.repeat(dphi),
-                       itertools.repeat(dtheta)))
-    pool.close()
-    pool.join()
-
-    res = np.concatenate(res, axis=0)
-    nbr_lobes = shape[-2]
-
-    if mask is not None:
-        fd = np.zeros(shape[:3] + (nbr_lobes,))
-        fd[mask] = res
-        return fd
-
-    res = np.reshape(np.array(res), shape[:3] + (nbr_lobes,))
-    return res
+    fd = process_by_tiles(_compute_fiber_density_chunk, [bingham],
+                          [(bingham.shape[-2],)], mask=mask,
+                          func_args=(coords, dphi, dtheta),
+                          nbr_processes=nbr_processes)[0]
+    return fd
 
 
-def _compute_fiber_density_chunk(args):
+def _compute_fiber_density_chunk(binghams_chunk, coords, dphi, dtheta):
     """
-    Compute fiber density for a chunk taken from a Bingham volume.
+    Compute fiber density for a chunk taken from a Bingham volume, of shape
+    (N, N_LOBES, NB_PARAMS).
     """
-    binghams_chunk = args[0]
-    coords = args[1]
-    dphi = args[2]
-    dtheta = args[3]
     theta = coords[1]
     u = np.array([np.cos(coords[0]) * np.sin(coords[1]),
                   np.sin(coords[0]) * np.sin(coords[1]),
                   np.cos(coords[1])]).T
 
-    nbr_lobes = binghams_chunk.shape[1] // NB_PARAMS
+    nbr_lobes = binghams_chunk.shape[1]
     out = np.zeros((len(binghams_chunk), nbr_lobes))
     for i, binghams in enumerate(binghams_chunk):
         for lobe_i in range(nbr_lobes):
-            params = binghams[lobe_i * NB_PARAMS:(lobe_i + 1) * NB_PARAMS]
+            params = binghams[lobe_i]
             lobe = BinghamDistribution(params[0], params[1:4], params[4:7])
             if lobe.f0 > 0:
                 fd = np.sum(lobe.evaluate(u) * np.sin(theta) * dtheta * dphi)
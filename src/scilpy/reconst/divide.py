@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
-import itertools
 import multiprocessing
 import numpy as np
 from scipy.optimize import curve_fit
 from scipy.special import erf
 
+from scilpy.image.tiling import process_by_tiles
+
 
 def _get_bounds():
     """Define the lower (lb) and upper (ub) boundaries of the fitting
@@ -262,18 +263,6 @@ def gamma_fit2metrics(params):
     return microFA, MK_I, MK_A, MK_T
 
 
-def _fit_gamma_parallel(args):
-    # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
-    (data, gtab_infos, fit_iters, random_iters,
-     do_weight_bvals, do_weight_pa, do_multiple_s0, chunk_id) = args
-
-    sub_fit_array = _fit_gamma_loop(data, gtab_infos, fit_iters,
-                                    random_iters, do_weight_bvals,
-                                    do_weight_pa, do_multiple_s0)
-
-    return chunk_id, sub_fit_array
-
-
 def _fit_gamma_loop(data, gtab_infos, fit_iters, random_iters,
                     do_weight_bvals, do_weight_pa, do_multiple_s0):
     """
@@ -297,9 +286,10 @@ def fit_gamma(data, gtab_infos, mask=None, fit_iters=1, random_iters=50,
 
     Parameters
     ----------
-    data : np.ndarray (4d)
+    data : np.ndarray (4d) or nib.Nifti1Image
         Diffusion data, powder averaged. Obtained as output of the function
-        `reconst.b_tensor_utils.generate_powder_averaged_data`.
+        `reconst.b_tensor_utils.generate_powder_averaged_data`. An image
+        saved on disk is read by tiles.
     gtab_infos : np.ndarray
         Contains information about the gtab, such as the unique bvals, the
         encoding types, the number of directions and the acquisition index.
@@ -328,48 +318,14 @@ def fit_gamma(data, gtab_infos, mask=None, fit_iters=1, random_iters=50,
     fit_array : np.ndarray
         Array containing the fit
     """
-    data_shape = data.shape
-    if mask is None:
-        mask = np.sum(data, axis=3).astype(bool)
-
     nbr_processes = multiprocessing.cpu_count() if nbr_processes is None \
         or nbr_processes <= 0 else nbr_processes
 
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    data = data[mask].reshape((np.count_nonzero(mask), data_shape[3]))
-
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        tmp_fit_array = _fit_gamma_loop(data, gtab_infos, fit_iters,
-                                        random_iters, do_weight_bvals,
-                                        do_weight_pa, do_multiple_s0)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        chunks = np.array_split(data, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_fit_gamma_parallel,
-                           zip(chunks,
-                               itertools.repeat(gtab_infos),
-                               itertools.repeat(fit_iters),
-                               itertools.repeat(random_iters),
-                               itertools.repeat(do_weight_bvals),
-                               itertools.repeat(do_weight_pa),
-                               itertools.repeat(do_multiple_s0),
-                               np.arange(len(chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunks together.
-        chunk_len = np.cumsum([0] + [len(c) for c in chunks])
-        tmp_fit_array = np.zeros((np.count_nonzero(mask), 4))
-        for chunk_id, fit in results:
-            tmp_fit_array[chunk_len[chunk_id]:chunk_len[chunk_id + 1]] = fit
-
-    # Bring back to the original shape
-    fit_array = np.zeros((data_shape[0:3]) + (4,))
-    fit_array[mask] = tmp_fit_array
+    # Empty voxels (ex, outside the mask) are not fitted.
+    fit_array = process_by_tiles(_fit_gamma_loop, [data], [(4,)], mask=mask,
+                                 func_args=(gtab_infos, fit_iters,
+                                            random_iters, do_weight_bvals,
+                                            do_weight_pa, do_multiple_s0),
+                                 nbr_processes=nbr_processes)[0]
 
     return fit_array
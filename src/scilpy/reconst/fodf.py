@@ -9,6 +9,7 @@ from dipy.reconst.mcsd import MSDeconvFit
 from dipy.reconst.multi_voxel import MultiVoxelFit
 from dipy.reconst.shm import sh_to_sf_matrix
 
+from scilpy.image.tiling import process_by_tiles
 from scilpy.reconst.utils import find_order_from_nb_coeff
 
 from dipy.utils.optpkg import optional_package
@@ -138,6 +139,12 @@ def get_ventricles_max_fodf(data, fa, md, zoom, sh_basis,
         return np.mean(list_of_max), out_mask
 
 
+def _get_nb_coeffs(model):
+    # Columns of the fitted basis: for multi-tissue models, the isotropic
+    # coefficients followed by the SH coefficients.
+    return model.B_dwi.shape[1]
+
+
 def _fit_from_model_parallel(args):
     (model, data, chunk_id) = args
     sub_fit_array = _fit_from_model_loop(data, model)
@@ -157,12 +164,36 @@ def _fit_from_model_loop(data, model):
             try:
                 tmp_fit_array[i] = model.fit(data[i])
             except cvx.error.SolverError:
-                coeff = np.full((len(model.n)), np.NaN)
+                coeff = np.full(_get_nb_coeffs(model), np.nan)
                 tmp_fit_array[i] = MSDeconvFit(model, coeff, None)
     return tmp_fit_array
 
 
-def fit_from_model(model, data, mask=None, nbr_processes=None):
+def _fit_coeffs_from_model_tile(data, model):
+    """
+    Fits each voxel of a tile (2D data, of shape [N, X]) separately and only
+    keeps the coefficients of the fits. See fit_from_model.
+    """
+    coeffs = np.zeros((data.shape[0], _get_nb_coeffs(model)), dtype=np.float32)
+    failed = np.zeros(data.shape[0], dtype=bool)
+    for i in range(data.shape[0]):
+        if data[i].any():
+            try:
+                fit = model.fit(data[i])
+            except cvx.error.SolverError:
+                failed[i] = True
+                continue
+            # Multi-tissue fits: the isotropic coefficients come first.
+            if isinstance(fit, MSDeconvFit):
+                coeffs[i] = fit.all_shm_coeff
+            else:
+                coeffs[i] = fit.shm_coeff
+    coeffs[failed] = np.nan
+    return coeffs, failed
+
+
+def fit_from_model(model, data, mask=None, nbr_processes=None,
+                   return_coeffs=False):
     """Fit the model to data. Can use parallel processing.
 
     Parameters
@@ -178,14 +209,25 @@ def fit_from_model(model, data, mask=None, nbr_processes=None):
     nbr_processes : int, optional
         The number of subprocesses to use.
         Default: multiprocessing.cpu_count()
+    return_coeffs : bool, optional
+        If True, only the coefficients of the fits are kept, in a float32
+        array, instead of an array of fit objects. Much lighter in memory and
+        between the processes for whole-brain data. The data is then fitted
+        by tiles (see scilpy.image.tiling.process_by_tiles).
 
     Returns
     -------
     fit_array : MultiVoxelFit
-        Dipy's MultiVoxelFit, containing the fit.
+        If not return_coeffs. Dipy's MultiVoxelFit, containing the fit.
         It contains an array of fits. Any attributes of its individuals fits
         (of class given by 'model.fit') can be accessed through the
         MultiVoxelFit to get all fits at once.
+    coeffs : np.ndarray (4d)
+        If return_coeffs. The coefficients of the fits (float32), i.e. their
+        all_shm_coeff for multi-tissue fits (isotropic coefficients first),
+        else their shm_coeff. NaN where the fit failed, 0 outside the mask.
+    failed : np.ndarray (3d)
+        If return_coeffs. Mask of the voxels where the solver failed.
     """
     data_shape = data.shape
     if mask is None:
@@ -198,6 +240,13 @@ def fit_from_model(model, data, mask=None, nbr_processes=None):
         if nbr_processes is None or nbr_processes <= 0 \
         else nbr_processes
 
+    if return_coeffs:
+        coeffs, failed = process_by_tiles(
+            _fit_coeffs_from_model_tile, [data],
+            [(_get_nb_coeffs(model),), ()], [np.float32, bool], mask=mask,
+            func_args=(model,), nbr_processes=nbr_processes)
+        return coeffs, failed
+
     # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
     # 1D time series voxels. Then separate it in chunks of len(nbr_processes).
     data = data[mask].reshape((np.count_nonzero(mask), data_shape[3]))
@@ -1,20 +1,26 @@
 # -*- coding: utf-8 -*-
-import itertools
+import functools
 import logging
 import multiprocessing
 import numpy as np
 
 from dipy.core.sphere import Sphere
-from dipy.direction.peaks import peak_directions
-from dipy.reconst.odf import gfa
 from dipy.reconst.shm import (sh_to_sf_matrix, order_from_ncoef, sf_to_sh,
                               sph_harm_ind_list)
+from threadpoolctl import ThreadpoolController
 
 from scilpy.gradients.bvec_bval_tools import (identify_shells,
                                               is_normalized_bvecs,
                                               normalize_bvecs,
                                               DEFAULT_B0_THRESHOLD)
 from scilpy.dwi.operations import compute_dwi_attenuation
+from scilpy.image.tiling import process_by_tiles
+from scilpy.reconst.utils import (get_peaks_by_blocks, get_sphere_adjacency,
+                                  get_sphere_antipodes, get_sphere_neighbours)
+
+# Number of voxels per block in sh_matmul_by_blocks. A block of SF on a
+# sphere of 724 directions (float32) takes ~12 MB.
+SH_BLOCK_SIZE = 4096
 
 
 def verify_data_vs_sh_order(data, sh_order):
@@ -181,16 +187,65 @@ def compute_rish(sh, mask=None, full_basis=False):
     return rish, orders
 
 
-def _peaks_from_sh_parallel(args):
-    (shm_coeff, B, sphere, relative_peak_threshold,
-     absolute_threshold, min_separation_angle,
-     npeaks, normalize_peaks, chunk_id, is_symmetric) = args
+@functools.lru_cache(maxsize=None)
+def _get_threadpool_controller():
+    # Finding the loaded BLAS libraries is slow: done once.
+    return ThreadpoolController()
+
 
-    peak_dirs, peak_values, peak_indices = _peaks_from_sh_loop(
-        shm_coeff, B, sphere, relative_peak_threshold,
-        absolute_threshold, min_separation_angle, npeaks,
-        normalize_peaks, is_symmetric)
-    return chunk_id, peak_dirs, peak_values, peak_indices
+def sh_matmul_by_blocks(data, matrix, dtype='float32', nbr_threads=None,
+                        block_size=SH_BLOCK_SIZE):
+    """
+    Computes the product of ravelled voxels with a matrix (ex, SH to SF with
+    the matrix of sh_to_sf_matrix), by blocks of voxels: a single BLAS call
+    per block, without a copy of all the data in the computation dtype.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Ravelled data. Shape [N, X] where N is the number of voxels.
+    matrix : np.ndarray
+        Matrix of shape [X, Y].
+    dtype : str
+        Datatype used for the computation and for the output array.
+        Default: `float32`
+    nbr_threads : int, optional
+        Number of threads used by BLAS. Default: all (BLAS' default).
+    block_size : int, optional
+        Number of voxels per block.
+
+    Returns
+    -------
+    out : np.ndarray
+        The product, of shape [N, Y].
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=dtype)
+    out = np.empty((len(data), matrix.shape[1]), dtype=dtype)
+    with _get_threadpool_controller().limit(limits=nbr_threads,
+                                            user_api='blas'):
+        for start in range(0, len(data), block_size):
+            end = start + block_size
+            np.dot(np.asarray(data[start:end], dtype=dtype), matrix,
+                   out=out[start:end])
+    return out
+
+
+def _peaks_from_sh_tile(shm_coeff, use_default_mask, *args):
+    """
+    Runs _peaks_from_sh_loop on the voxels of a tile. With the default mask,
+    the voxels whose coefficients sum to 0 are left to 0.
+    """
+    if not use_default_mask:
+        return _peaks_from_sh_loop(shm_coeff, *args)
+
+    in_mask = np.sum(shm_coeff, axis=1).astype(bool)
+    npeaks = args[5]
+    peak_dirs = np.zeros((len(shm_coeff), npeaks, 3))
+    peak_values = np.zeros((len(shm_coeff), npeaks))
+    peak_indices = np.zeros((len(shm_coeff), npeaks))
+    (peak_dirs[in_mask], peak_values[in_mask],
+     peak_indices[in_mask]) = _peaks_from_sh_loop(shm_coeff[in_mask], *args)
+    return peak_dirs, peak_values, peak_indices
 
 
 def _peaks_from_sh_loop(shm_coeff, B, sphere, relative_peak_threshold,
@@ -207,26 +262,42 @@ def _peaks_from_sh_loop(shm_coeff, B, sphere, relative_peak_threshold,
     peak_indices = np.zeros((data_shape, npeaks), dtype='int')
     peak_indices.fill(-1)
 
-    for idx in range(len(shm_coeff)):
-        if shm_coeff[idx].any():
-            odf = np.dot(shm_coeff[idx], B)
-            odf[odf < absolute_threshold] = 0.
-
-            dirs, peaks, ind = peak_directions(odf, sphere,
-                                               relative_peak_threshold=relative_peak_threshold,
-                                               min_separation_angle=min_separation_angle,
-                                               is_symmetric=is_symmetric)
-
-            if peaks.shape[0] != 0:
-                n = min(npeaks, peaks.shape[0])
-
-                peak_dirs[idx][:n] = dirs[:n]
-                peak_indices[idx][:n] = ind[:n]
-                peak_values[idx][:n] = peaks[:n]
-
-                if normalize_peaks:
-                    peak_values[idx][:n] /= peaks[0]
-                    peak_dirs[idx] *= peak_values[idx][:, None]
+    adjacency = get_sphere_adjacency(sphere)
+    neighbours = get_sphere_neighbours(
+        sphere, np.deg2rad(min_separation_angle), is_symmetric)
+    if is_symmetric:
+        # Antipodal vertices have the same value, up to rounding errors which
+        # depend on how the SF is computed. Peaks are always reported on the
+        # vertex of the pair with the smallest index.
+        antipodes = get_sphere_antipodes(sphere)
+        vertex_ids = np.arange(len(sphere.vertices))
+        canonical_ids = np.where(antipodes > -1,
+                                 np.minimum(vertex_ids, antipodes), vertex_ids)
+    for start in range(0, len(shm_coeff), SH_BLOCK_SIZE):
+        block = shm_coeff[start:start + SH_BLOCK_SIZE]
+        has_sh = np.flatnonzero(block.any(axis=1))
+        odfs = sh_matmul_by_blocks(block[has_sh], B, dtype=np.float64,
+                                   nbr_threads=1)
+        odfs[odfs < absolute_threshold] = 0.
+
+        values, indices = get_peaks_by_blocks(
+            odfs, sphere, relative_peak_threshold=relative_peak_threshold,
+            min_separation_angle=min_separation_angle, npeaks=npeaks,
+            is_symmetric=is_symmetric, adjacency=adjacency,
+            neighbours=neighbours)
+        if is_symmetric:
+            indices = np.where(indices > -1, canonical_ids[indices], -1)
+        dirs = sphere.vertices[indices]
+        dirs[indices < 0] = 0.
+
+        if normalize_peaks:
+            has_peak = indices[:, 0] > -1
+            values[has_peak] /= values[has_peak, 0:1]
+            dirs[has_peak] *= values[has_peak, :, None]
+
+        peak_dirs[start + has_sh] = dirs
+        peak_values[start + has_sh] = values
+        peak_indices[start + has_sh] = indices
     return peak_dirs, peak_values, peak_indices
 
 
@@ -239,8 +310,9 @@ def peaks_from_sh(shm_coeff, sphere, mask=None, relative_peak_threshold=0.5,
 
     Parameters
     ----------
-    shm_coeff : np.ndarray
-        Spherical harmonic coefficients
+    shm_coeff : np.ndarray or nib.Nifti1Image
+        Spherical harmonic coefficients. An image saved on disk is read by
+        tiles.
     sphere : Sphere
         The Sphere providing discrete directions for evaluation.
     mask : np.ndarray, optional
@@ -280,7 +352,10 @@ def peaks_from_sh(shm_coeff, sphere, mask=None, relative_peak_threshold=0.5,
         If True, SH coefficients are expressed using a full basis.
         Default: False
     is_symmetric: bool, optional
-        If False, antipodal sphere directions are considered distinct.
+        If False, antipodal sphere directions are considered distinct. If
+        True, each peak is reported on the vertex of smallest index of its
+        antipodal pair (dipy's peak_directions returns either one, depending
+        on rounding errors).
         Default: True
 
     Returns
@@ -294,117 +369,15 @@ def peaks_from_sh(shm_coeff, sphere, mask=None, relative_peak_threshold=0.5,
                            basis_type=sh_basis_type,
                            full_basis=full_basis, legacy=is_legacy)
 
-    data_shape = shm_coeff.shape
-    if mask is None:
-        mask = np.sum(shm_coeff, axis=3).astype(bool)
-
     nbr_processes = multiprocessing.cpu_count() if nbr_processes is None \
         or nbr_processes <= 0 else nbr_processes
 
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        (tmp_peak_dirs_array, tmp_peak_values_array,
-         tmp_peak_indices_array) = _peaks_from_sh_loop(
-            shm_coeff, B, sphere, relative_peak_threshold,
-            absolute_threshold, min_separation_angle, npeaks,
-            normalize_peaks, is_symmetric)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        chunks = np.array_split(shm_coeff, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_peaks_from_sh_parallel,
-                           zip(chunks,
-                               itertools.repeat(B),
-                               itertools.repeat(sphere),
-                               itertools.repeat(relative_peak_threshold),
-                               itertools.repeat(absolute_threshold),
-                               itertools.repeat(min_separation_angle),
-                               itertools.repeat(npeaks),
-                               itertools.repeat(normalize_peaks),
-                               np.arange(len(chunks)),
-                               itertools.repeat(is_symmetric)))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together..
-        chunk_len = np.cumsum([0] + [len(c) for c in chunks])
-
-        # tmp arrays are necessary to avoid inserting data in returned variable
-        # rather than the original array
-        tmp_peak_dirs_array = np.zeros((np.count_nonzero(mask), npeaks, 3))
-        tmp_peak_values_array = np.zeros((np.count_nonzero(mask), npeaks))
-        tmp_peak_indices_array = np.zeros((np.count_nonzero(mask), npeaks))
-        for i, peak_dirs, peak_values, peak_indices in results:
-            tmp_peak_dirs_array[chunk_len[i]:chunk_len[i+1], :, :] = peak_dirs
-            tmp_peak_values_array[chunk_len[i]:chunk_len[i+1], :] = peak_values
-            tmp_peak_indices_array[chunk_len[i]:chunk_len[i+1], :] = peak_indices
-
-    # Bring back to the original shape
-    peak_dirs_array = np.zeros(data_shape[0:3] + (npeaks, 3))
-    peak_values_array = np.zeros(data_shape[0:3] + (npeaks,))
-    peak_indices_array = np.zeros(data_shape[0:3] + (npeaks,))
-    peak_dirs_array[mask] = tmp_peak_dirs_array
-    peak_values_array[mask] = tmp_peak_values_array
-    peak_indices_array[mask] = tmp_peak_indices_array
-
-    return peak_dirs_array, peak_values_array, peak_indices_array
-
-
-def _maps_from_sh_parallel(args):
-    (shm_coeff, peak_values, peak_indices, B, sphere,
-     gfa_thr, chunk_id) = args
-
-    res = _maps_from_sh_loop(shm_coeff, peak_values, peak_indices, B,
-                             sphere, gfa_thr)
-    return chunk_id, *res
-
-
-def _maps_from_sh_loop(shm_coeff, peak_values, peak_indices, B, sphere,
-                       gfa_thr):
-    """
-    Loops on 2D (ravelled) data and fits each voxel separately.
-    For a more complete description of parameters, see maps_from_sh.
-    """
-    # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
-    data_shape = shm_coeff.shape[0]
-    nufo_map = np.zeros(data_shape)
-    afd_max = np.zeros(data_shape)
-    afd_sum = np.zeros(data_shape)
-    rgb_map = np.zeros((data_shape, 3))
-    gfa_map = np.zeros(data_shape)
-    qa_map = np.zeros((data_shape, peak_values.shape[1]))
-
-    max_odf = 0
-    global_max = -np.inf
-    for idx in range(len(shm_coeff)):
-        if shm_coeff[idx].any():
-            odf = np.dot(shm_coeff[idx], B)
-            odf = odf.clip(min=0)
-            sum_odf = np.sum(odf)
-            max_odf = np.maximum(max_odf, sum_odf)
-            if sum_odf > 0:
-                rgb_map[idx] = np.dot(np.abs(sphere.vertices).T, odf)
-                rgb_map[idx] /= np.linalg.norm(rgb_map[idx])
-                rgb_map[idx] *= sum_odf
-            gfa_map[idx] = gfa(odf)
-            if gfa_map[idx] < gfa_thr:
-                global_max = max(global_max, odf.max())
-            elif np.sum(peak_indices[idx] > -1):
-                nufo_map[idx] = np.sum(peak_indices[idx] > -1)
-                afd_max[idx] = peak_values[idx].max()
-                afd_sum[idx] = np.sqrt(np.dot(shm_coeff[idx], shm_coeff[idx]))
-                qa_map = peak_values[idx] - odf.min()
-                global_max = max(global_max, peak_values[idx][0])
-
-    return (nufo_map, afd_max, afd_sum, rgb_map,
-            gfa_map, qa_map, max_odf, global_max)
+    return tuple(process_by_tiles(
+        _peaks_from_sh_tile, [shm_coeff], [(npeaks, 3), (npeaks,), (npeaks,)],
+        mask=mask, func_args=(mask is None, B, sphere, relative_peak_threshold,
+                              absolute_threshold, min_separation_angle,
+                              npeaks, normalize_peaks, is_symmetric),
+        nbr_processes=nbr_processes))
 
 
 def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
@@ -412,6 +385,9 @@ def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
                  nbr_processes=None):
     """Computes maps from given SH coefficients and peaks
 
+    All maps of a block of voxels are derived at once from the SF of the
+    block (see sh_matmul_by_blocks).
+
     Parameters
     ----------
     shm_coeff : np.ndarray
@@ -434,8 +410,8 @@ def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
         `descoteaux07` or `tournier07`.
         Default: `descoteaux07`
     nbr_processes: int, optional
-        The number of subprocesses to use.
-        Default: multiprocessing.cpu_count()
+        The number of threads used for the matrix products.
+        Default: all (BLAS' default).
 
     Returns
     -------
@@ -450,68 +426,78 @@ def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
 
-    nbr_processes = multiprocessing.cpu_count() \
-        if nbr_processes is None or nbr_processes < 0 \
+    nbr_processes = None if nbr_processes is None or nbr_processes <= 0 \
         else nbr_processes
 
     npeaks = peak_values.shape[3]
+    nb_voxels = np.count_nonzero(mask)
 
     # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
     # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-    peak_values = peak_values[mask].reshape((np.count_nonzero(mask), npeaks))
-    peak_indices = peak_indices[mask].reshape((np.count_nonzero(mask), npeaks))
-
-    if nbr_processes == 1:
-        (tmp_nufo_map_array, tmp_afd_max_array, tmp_afd_sum_array,
-         tmp_rgb_map_array, tmp_gfa_map_array, tmp_qa_map_array,
-         all_time_max_odf, all_time_global_max) = _maps_from_sh_loop(
-            shm_coeff, peak_values, peak_indices,
-            B, sphere, gfa_thr)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        shm_coeff_chunks = np.array_split(shm_coeff, nbr_processes)
-        peak_values_chunks = np.array_split(peak_values, nbr_processes)
-        peak_indices_chunks = np.array_split(peak_indices, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_maps_from_sh_parallel,
-                           zip(shm_coeff_chunks,
-                               peak_values_chunks,
-                               peak_indices_chunks,
-                               itertools.repeat(B),
-                               itertools.repeat(sphere),
-                               itertools.repeat(gfa_thr),
-                               np.arange(len(shm_coeff_chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together.
-        chunk_len = np.cumsum([0] + [len(c) for c in shm_coeff_chunks])
-
-        # tmp arrays are necessary to avoid inserting data in returned variable
-        # rather than the original array
-        tmp_nufo_map_array = np.zeros((np.count_nonzero(mask)))
-        tmp_afd_max_array = np.zeros((np.count_nonzero(mask)))
-        tmp_afd_sum_array = np.zeros((np.count_nonzero(mask)))
-        tmp_rgb_map_array = np.zeros((np.count_nonzero(mask), 3))
-        tmp_gfa_map_array = np.zeros((np.count_nonzero(mask)))
-        tmp_qa_map_array = np.zeros((np.count_nonzero(mask), npeaks))
-
-        all_time_max_odf = -np.inf
-        all_time_global_max = -np.inf
-        for (i, nufo_map, afd_max, afd_sum, rgb_map,
-             gfa_map, qa_map, max_odf, global_max) in results:
-            all_time_max_odf = max(all_time_global_max, max_odf)
-            all_time_global_max = max(all_time_global_max, global_max)
-
-            tmp_nufo_map_array[chunk_len[i]:chunk_len[i+1]] = nufo_map
-            tmp_afd_max_array[chunk_len[i]:chunk_len[i+1]] = afd_max
-            tmp_afd_sum_array[chunk_len[i]:chunk_len[i+1]] = afd_sum
-            tmp_rgb_map_array[chunk_len[i]:chunk_len[i+1], :] = rgb_map
-            tmp_gfa_map_array[chunk_len[i]:chunk_len[i+1]] = gfa_map
-            tmp_qa_map_array[chunk_len[i]:chunk_len[i+1], :] = qa_map
+    shm_coeff = shm_coeff[mask]
+    peak_values = peak_values[mask]
+    peak_indices = peak_indices[mask]
+
+    nufo_map = np.zeros(nb_voxels)
+    afd_max = np.zeros(nb_voxels)
+    afd_sum = np.zeros(nb_voxels)
+    rgb_map = np.zeros((nb_voxels, 3))
+    gfa_map = np.zeros(nb_voxels)
+    qa_map = np.zeros((nb_voxels, npeaks))
+
+    abs_vertices = np.abs(sphere.vertices)
+    max_odf = 0
+    global_max = -np.inf
+    for start in range(0, nb_voxels, SH_BLOCK_SIZE):
+        block = slice(start, start + SH_BLOCK_SIZE)
+        sh = shm_coeff[block]
+        odfs = sh_matmul_by_blocks(sh, B, dtype=np.float64,
+                                   nbr_threads=nbr_processes)
+        np.clip(odfs, 0, None, out=odfs)
+
+        # Voxels without coefficients are skipped.
+        has_sh = sh.any(axis=1)
+        sum_odf = np.sum(odfs, axis=1)
+        if np.any(has_sh):
+            max_odf = max(max_odf, np.max(sum_odf[has_sh]))
+
+        has_odf = np.logical_and(has_sh, sum_odf > 0)
+        rgb = np.dot(odfs, abs_vertices)[has_odf]
+        rgb *= (sum_odf[has_odf] / np.linalg.norm(rgb, axis=1))[:, None]
+        rgb_map[block][has_odf] = rgb
+
+        # GFA, as dipy's gfa(), with fewer temporary arrays.
+        nb_dirs = odfs.shape[1]
+        centered = odfs - (sum_odf / nb_dirs)[:, None]
+        numerator = nb_dirs * np.einsum('ij,ij->i', centered, centered)
+        denominator = (nb_dirs - 1) * np.einsum('ij,ij->i', odfs, odfs)
+        del centered
+        block_gfa = np.full(len(odfs), np.nan)
+        np.sqrt(numerator / denominator, out=block_gfa,
+                where=denominator > 0)
+        gfa_map[block][has_sh] = block_gfa[has_sh]
+
+        # Low GFA voxels (ex, ventricles) only contribute to the global max.
+        is_low_gfa = np.logical_and(has_sh, block_gfa < gfa_thr)
+        if np.any(is_low_gfa):
+            global_max = max(global_max,
+                             np.max(np.max(odfs, axis=1)[is_low_gfa]))
+
+        is_peak = peak_indices[block] > -1
+        nb_peaks = np.count_nonzero(is_peak, axis=1)
+        is_fiber = has_sh & ~(block_gfa < gfa_thr) & (nb_peaks > 0)
+        if not np.any(is_fiber):
+            continue
+
+        nufo_map[block][is_fiber] = nb_peaks[is_fiber]
+        afd_max[block][is_fiber] = np.max(peak_values[block][is_fiber],
+                                          axis=1)
+        afd_sum[block][is_fiber] = np.linalg.norm(sh[is_fiber], axis=1)
+        is_peak[~is_fiber] = False
+        qa = peak_values[block] - np.min(odfs, axis=1)[:, None]
+        qa_map[block][is_peak] = qa[is_peak]
+        global_max = max(global_max,
+                         np.max(peak_values[block][is_fiber, 0]))
 
     # Bring back to the original shape
     nufo_map_array = np.zeros(data_shape[0:3])
@@ -521,16 +507,16 @@ def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
     gfa_map_array = np.zeros(data_shape[0:3])
     qa_map_array = np.zeros(data_shape[0:3] + (npeaks,))
 
-    nufo_map_array[mask] = tmp_nufo_map_array
-    afd_max_array[mask] = tmp_afd_max_array
-    afd_sum_array[mask] = tmp_afd_sum_array
-    rgb_map_array[mask] = tmp_rgb_map_array
-    gfa_map_array[mask] = tmp_gfa_map_array
-    qa_map_array[mask] = tmp_qa_map_array
+    nufo_map_array[mask] = nufo_map
+    afd_max_array[mask] = afd_max
+    afd_sum_array[mask] = afd_sum
+    rgb_map_array[mask] = rgb_map
+    gfa_map_array[mask] = gfa_map
+    qa_map_array[mask] = qa_map
 
-    rgb_map_array /= all_time_max_odf
+    rgb_map_array /= max_odf
     rgb_map_array *= 255
-    qa_map_array /= all_time_global_max
+    qa_map_array /= global_max
 
     afd_unique = np.unique(afd_max_array)
     if np.array_equal(np.array([0, 1]), afd_unique) \
@@ -541,30 +527,10 @@ def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
             rgb_map_array, gfa_map_array, qa_map_array)
 
 
-def _convert_sh_basis_parallel(args):
-    (sh, B_in, invB_out, chunk_id) = args
-    sh = _convert_sh_basis_loop(sh, B_in, invB_out)
-
-    return chunk_id, sh
-
-
-def _convert_sh_basis_loop(sh, B_in, invB_out):
-    """
-    Loops on 2D (ravelled) data and fits each voxel separately.
-    For a more complete description of parameters, see convert_sh_basis.
-    """
-    # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
-    for idx in range(sh.shape[0]):
-        if sh[idx].any():
-            sf = np.dot(sh[idx], B_in)
-            sh[idx] = np.dot(sf, invB_out)
-    return sh
-
-
 def convert_sh_basis(shm_coeff, sphere, mask=None,
                      input_basis='descoteaux07', output_basis='tournier07',
                      is_input_legacy=True, is_output_legacy=False,
-                     nbr_processes=None):
+                     nbr_processes=None, dtype="float32"):
     """Converts spherical harmonic coefficients between two bases
 
     Parameters
@@ -595,8 +561,11 @@ def convert_sh_basis(shm_coeff, sphere, mask=None,
         ``descoteaux07`` implementations.
         Default: False
     nbr_processes: int, optional
-        The number of subprocesses to use.
-        Default: multiprocessing.cpu_count()
+        The number of threads used for the matrix products.
+        Default: all (BLAS' default).
+    dtype : str
+        Datatype to use for computation and output array.
+        Either `float32` or `float64`. Default: `float32`
 
     Returns
     -------
@@ -615,74 +584,27 @@ def convert_sh_basis(shm_coeff, sphere, mask=None,
     _, invB_out = sh_to_sf_matrix(sphere=sphere, sh_order=sh_order,
                                   basis_type=output_basis,
                                   legacy=is_output_legacy)
+    # SH -> SF -> SH, as a single (small) matrix.
+    conversion_matrix = np.dot(B_in, invB_out)
 
     data_shape = shm_coeff.shape
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
 
-    nbr_processes = multiprocessing.cpu_count() \
-        if nbr_processes is None or nbr_processes < 0 else nbr_processes
-
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        tmp_shm_coeff_array = _convert_sh_basis_loop(shm_coeff, B_in, invB_out)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        shm_coeff_chunks = np.array_split(shm_coeff, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_convert_sh_basis_parallel,
-                           zip(shm_coeff_chunks,
-                               itertools.repeat(B_in),
-                               itertools.repeat(invB_out),
-                               np.arange(len(shm_coeff_chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together.
-        chunk_len = np.cumsum([0] + [len(c) for c in shm_coeff_chunks])
-        tmp_shm_coeff_array = np.zeros((np.count_nonzero(mask), data_shape[3]))
-        for i, new_shm_coeff in results:
-            tmp_shm_coeff_array[chunk_len[i]:chunk_len[i+1], :] = new_shm_coeff
+    nbr_processes = None if nbr_processes is None or nbr_processes <= 0 \
+        else nbr_processes
 
-    # Bring back to the original shape
-    shm_coeff_array = np.zeros(data_shape)
-    shm_coeff_array[mask] = tmp_shm_coeff_array
+    shm_coeff_array = np.zeros(data_shape, dtype=dtype)
+    shm_coeff_array[mask] = sh_matmul_by_blocks(
+        shm_coeff[mask], conversion_matrix, dtype=dtype,
+        nbr_threads=nbr_processes)
 
     return shm_coeff_array
 
 
-def _convert_sh_to_sf_parallel(args):
-    (sh, B_in, new_output_dim, chunk_id) = args
-    sf = _convert_sh_to_sf_loop(sh, new_output_dim, B_in)
-    return chunk_id, sf
-
-
-def _convert_sh_to_sf_loop(sh, new_output_dim, B_in):
-    """
-    Loops on 2D data and fits each voxel separately.
-    See convert_sh_to_sf for more information.
-    """
-    # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
-    sf = np.zeros((sh.shape[0], new_output_dim), dtype=np.float32)
-
-    for idx in range(sh.shape[0]):
-        if sh[idx].any():
-            sf[idx] = np.dot(sh[idx], B_in)
-
-    return sf
-
-
 def convert_sh_to_sf(shm_coeff, sphere, mask=None, dtype="float32",
                      input_basis='descoteaux07', input_full_basis=False,
-                     is_input_legacy=True,
-                     nbr_processes=multiprocessing.cpu_count()):
+                     is_input_legacy=True, nbr_processes=None):
     """Converts spherical harmonic coefficients to an SF sphere
 
     Parameters
@@ -707,8 +629,8 @@ def convert_sh_to_sf(shm_coeff, sphere, mask=None, dtype="float32",
     is_input_legacy : bool, optional
         Whether the input basis is in its legacy form.
     nbr_processes: int, optional
-        The number of subprocesses to use.
-        Default: multiprocessing.cpu_count()
+        The number of threads used for the matrix products.
+        Default: all (BLAS' default).
 
     Returns
     -------
@@ -723,46 +645,17 @@ def convert_sh_to_sf(shm_coeff, sphere, mask=None, dtype="float32",
     B_in, _ = sh_to_sf_matrix(sphere, sh_order, basis_type=input_basis,
                               full_basis=input_full_basis,
                               legacy=is_input_legacy)
-    B_in = B_in.astype(dtype)
 
     data_shape = shm_coeff.shape
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
 
-    output_dim = len(sphere.vertices)
-    new_shape = data_shape[:3] + (output_dim,)
-
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        tmp_sf_array = _convert_sh_to_sf_loop(shm_coeff, output_dim, B_in)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        shm_coeff_chunks = np.array_split(shm_coeff, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_convert_sh_to_sf_parallel,
-                           zip(shm_coeff_chunks,
-                               itertools.repeat(B_in),
-                               itertools.repeat(output_dim),
-                               np.arange(len(shm_coeff_chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together.
-        chunk_len = np.cumsum([0] + [len(c) for c in shm_coeff_chunks])
-        tmp_sf_array = np.zeros((np.count_nonzero(mask), new_shape[3]),
-                                dtype=dtype)
-        for i, new_sf in results:
-            tmp_sf_array[chunk_len[i]:chunk_len[i + 1], :] = new_sf
+    nbr_processes = None if nbr_processes is None or nbr_processes <= 0 \
+        else nbr_processes
 
-    # Bring back to the original shape
-    sf_array = np.zeros(new_shape, dtype=dtype)
-    sf_array[mask] = tmp_sf_array
+    sf_array = np.zeros(data_shape[:3] + (len(sphere.vertices),),
+                        dtype=dtype)
+    sf_array[mask] = sh_matmul_by_blocks(shm_coeff[mask], B_in, dtype=dtype,
+                                         nbr_threads=nbr_processes)
 
     return sf_array
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 import numpy as np
+from dipy.core.gradients import gradient_table
 from dipy.data import get_sphere
+from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
+from dipy.reconst.mcsd import (MultiShellDeconvModel,
+                               multi_shell_fiber_response)
 from dipy.reconst.shm import sh_to_sf_matrix
+from dipy.sims.voxel import multi_tensor
 
-from scilpy.reconst.fodf import get_ventricles_max_fodf
+from scilpy.reconst.fodf import fit_from_model, get_ventricles_max_fodf
 from scilpy.reconst.utils import find_order_from_nb_coeff
 from scilpy.tests.arrays import fodf_3x3_order8_descoteaux07
 
@@ -90,8 +95,45 @@ def test_get_ventricles_max_fodf_mask():
 
 
 def test_fit_from_model():
-    # toDO
-    pass
+    rng = np.random.default_rng(0)
+    bvals = np.concatenate(([0, 0], np.full(30, 1000), np.full(30, 2000)))
+    bvecs = rng.normal(size=(62, 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1, keepdims=True)
+    gtab = gradient_table(bvals, bvecs=bvecs)
+
+    # Two crossing fibers with random angles, and empty voxels.
+    evals = np.array([[0.0015, 0.0003, 0.0003], [0.0015, 0.0003, 0.0003]])
+    data = np.zeros((4, 3, 2, 62))
+    for idx in np.ndindex(3, 3, 2):
+        data[idx], _ = multi_tensor(gtab, evals, S0=100,
+                                    angles=rng.uniform(0, 180, (2, 2)),
+                                    fractions=[50, 50], snr=30, rng=rng)
+    mask = np.ones((4, 3, 2), dtype=bool)
+    mask[0, 0, 0] = False
+
+    csd_model = ConstrainedSphericalDeconvModel(
+        gtab, (evals[0], 100.), sh_order_max=4)
+    response = multi_shell_fiber_response(
+        4, [0, 1000, 2000], np.array([[0.0015, 0.0003, 0.0003, 100.]] * 2),
+        np.array([[0.0008, 0.0008, 0.0008, 100.]] * 2),
+        np.array([[0.003, 0.003, 0.003, 100.]] * 2))
+    msmt_model = MultiShellDeconvModel(gtab, response, sh_order_max=4)
+
+    for model, attr in [(csd_model, 'shm_coeff'),
+                        (msmt_model, 'all_shm_coeff')]:
+        fit = fit_from_model(model, data, mask=mask.copy(), nbr_processes=1)
+        expected = getattr(fit, attr)
+        for nbr_processes in [1, 2]:
+            coeffs, failed = fit_from_model(model, data, mask=mask.copy(),
+                                            nbr_processes=nbr_processes,
+                                            return_coeffs=True)
+            assert coeffs.dtype == np.float32
+            assert coeffs.shape == expected.shape
+            assert not np.any(failed)
+            assert np.allclose(coeffs, expected, rtol=1e-4, atol=1e-4)
+            # Outside the mask or empty.
+            assert not np.any(coeffs[0, 0, 0])
+            assert not np.any(coeffs[3])
 
 
 def test_verify_failed_voxels_shm_coeff():
@@ -1,4 +1,15 @@
 # -*- coding: utf-8 -*-
+import numpy as np
+from dipy.data import get_sphere
+from dipy.direction.peaks import peak_directions
+from dipy.reconst.odf import gfa
+from dipy.reconst.shm import sh_to_sf
+
+from scilpy.reconst.sh import (convert_sh_basis, convert_sh_to_sf,
+                               maps_from_sh, peaks_from_sh,
+                               sh_matmul_by_blocks)
+from scilpy.reconst.utils import get_sphere_antipodes
+from scilpy.tests.arrays import fodf_3x3_order8_descoteaux07
 
 
 def test_verify_data_vs_sh_order():
@@ -17,20 +28,101 @@ def test_compute_rish():
 
 
 def test_peaks_from_sh():
-    # toDO
-    pass
+    sphere = get_sphere(name='repulsion724')
+    fodf = fodf_3x3_order8_descoteaux07
+    peak_dirs, peak_values, peak_indices = peaks_from_sh(
+        fodf, sphere, relative_peak_threshold=0.3, npeaks=3,
+        normalize_peaks=True, nbr_processes=1)
+    assert peak_dirs.shape == (3, 3, 1, 3, 3)
+
+    # Same as dipy's peak_directions, voxel per voxel, except that the peaks
+    # are always on the vertex of smallest index of their antipodal pair.
+    antipodes = get_sphere_antipodes(sphere)
+    odfs = sh_to_sf(fodf, sphere, sh_order_max=6).clip(min=0)
+    nb_flipped = 0
+    for idx in np.ndindex(fodf.shape[0:3]):
+        if not np.any(fodf[idx]):
+            continue
+        dirs, values, indices = peak_directions(odfs[idx], sphere,
+                                                relative_peak_threshold=0.3)
+        n = min(3, len(values))
+        expected_indices = np.minimum(indices[:n], antipodes[indices[:n]])
+        nb_flipped += np.sum(expected_indices != indices[:n])
+        assert np.array_equal(peak_indices[idx][:n], expected_indices)
+        assert np.all(peak_indices[idx][n:] == -1)
+        assert np.allclose(peak_values[idx][:n], values[:n] / values[0])
+        assert np.allclose(peak_dirs[idx][:n],
+                           sphere.vertices[expected_indices] *
+                           peak_values[idx][:n, None])
+    assert nb_flipped > 0
 
 
 def test_maps_from_sh():
-    # toDO
-    pass
+    sphere = get_sphere(name='repulsion724')
+    fodf = fodf_3x3_order8_descoteaux07
+    _, peak_values, peak_indices = peaks_from_sh(fodf, sphere,
+                                                 relative_peak_threshold=0.3,
+                                                 nbr_processes=1)
+    nufo, afd_max, afd_sum, rgb, gfa_map, qa = maps_from_sh(
+        fodf, peak_values, peak_indices, sphere, nbr_processes=1)
+
+    # Expected values, voxel per voxel.
+    odfs = sh_to_sf(fodf, sphere, sh_order_max=6).clip(min=0)
+    for idx in np.ndindex(fodf.shape[0:3]):
+        if not np.any(fodf[idx]):
+            # Empty voxels are skipped.
+            assert nufo[idx] == 0 and gfa_map[idx] == 0
+            continue
+
+        is_peak = peak_indices[idx] > -1
+        assert nufo[idx] == np.count_nonzero(is_peak)
+        assert np.isclose(afd_max[idx], np.max(peak_values[idx]))
+        assert np.isclose(afd_sum[idx], np.linalg.norm(fodf[idx]))
+        assert np.isclose(gfa_map[idx], gfa(odfs[idx]))
+        expected_rgb = np.dot(np.abs(sphere.vertices).T, odfs[idx])
+        assert np.allclose(rgb[idx] / np.linalg.norm(rgb[idx]),
+                           expected_rgb / np.linalg.norm(expected_rgb))
+        expected_qa = peak_values[idx][is_peak] - np.min(odfs[idx])
+        assert np.allclose(qa[idx][is_peak], expected_qa / np.max(
+            peak_values[..., 0]))
+        assert np.all(qa[idx][~is_peak] == 0)
+
+
+def test_sh_matmul_by_blocks():
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(100, 15))
+    matrix = rng.normal(size=(15, 30))
+    out = sh_matmul_by_blocks(data, matrix, dtype='float64', block_size=7)
+    assert out.dtype == np.float64
+    assert np.allclose(out, np.dot(data, matrix))
 
 
 def test_convert_sh_basis():
-    # toDO
-    pass
+    sphere = get_sphere(name='repulsion724')
+    fodf = fodf_3x3_order8_descoteaux07
+    new_fodf = convert_sh_basis(fodf, sphere, input_basis='descoteaux07',
+                                output_basis='tournier07',
+                                is_input_legacy=True, is_output_legacy=False)
+
+    # Same SF in the new basis.
+    expected_sf = sh_to_sf(fodf, sphere, sh_order_max=6,
+                           basis_type='descoteaux07', legacy=True)
+    sf = sh_to_sf(new_fodf, sphere, sh_order_max=6,
+                  basis_type='tournier07', legacy=False)
+    assert np.allclose(sf, expected_sf, atol=1e-5)
 
 
 def test_convert_sh_to_sf():
-    # toDO
-    pass
+    sphere = get_sphere(name='repulsion100')
+    fodf = fodf_3x3_order8_descoteaux07
+    mask = np.ones(fodf.shape[0:3], dtype=bool)
+    mask[0, 0, 0] = False
+
+    expected_sf = sh_to_sf(fodf, sphere, sh_order_max=6,
+                           basis_type='descoteaux07', legacy=True)
+    expected_sf[0, 0, 0] = 0
+    for dtype in ['float32', 'float64']:
+        sf = convert_sh_to_sf(fodf, sphere, mask=mask, dtype=dtype,
+                              nbr_processes=1)
+        assert sf.dtype == dtype
+        assert np.allclose(sf, expected_sf, atol=1e-5)
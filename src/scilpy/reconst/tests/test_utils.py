@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+import numpy as np
+from dipy.core.sphere import Sphere
+from dipy.data import get_sphere
+from dipy.direction.peaks import peak_directions
+
+from scilpy.reconst.utils import (get_peaks_by_blocks, get_sphere_adjacency,
+                                  get_sphere_antipodes)
 
 
 def test_get_sh_order_and_fullness():
@@ -19,3 +26,48 @@ def test_get_maximas():
 def test_get_sphere_neighbours():
     # toDO
     pass
+
+
+def test_get_sphere_adjacency():
+    sphere = get_sphere(name='repulsion100')
+    adjacency = get_sphere_adjacency(sphere)
+    assert adjacency.shape[0] == len(sphere.vertices)
+    for i, j in sphere.edges:
+        assert j in adjacency[i] and i in adjacency[j]
+
+
+def test_get_sphere_antipodes():
+    sphere = get_sphere(name='repulsion100')
+    antipodes = get_sphere_antipodes(sphere)
+    assert np.allclose(sphere.vertices[antipodes], -sphere.vertices)
+    assert np.array_equal(antipodes[antipodes], np.arange(100))
+
+    half = Sphere(xyz=sphere.vertices[sphere.vertices[:, 2] > 0])
+    assert np.all(get_sphere_antipodes(half) == -1)
+
+
+def test_get_peaks_by_blocks():
+    sphere = get_sphere(name='repulsion724')
+    rng = np.random.default_rng(0)
+
+    # Random sums of a few lobes, with ties (zeros) and a constant ODF.
+    directions = sphere.vertices[rng.integers(0, 724, (50, 4))]
+    weights = rng.uniform(0, 1, (50, 4, 1))
+    odfs = np.sum(weights * np.dot(directions, sphere.vertices.T) ** 8,
+                  axis=1)
+    odfs[odfs < 0.1] = 0
+    odfs[10] = 1
+
+    for is_symmetric in [True, False]:
+        for threshold in [0, 0.1, 0.5]:
+            values, indices = get_peaks_by_blocks(
+                odfs, sphere, relative_peak_threshold=threshold,
+                min_separation_angle=20, npeaks=3, is_symmetric=is_symmetric)
+            for odf, odf_values, odf_indices in zip(odfs, values, indices):
+                _, expected_values, expected_indices = peak_directions(
+                    odf, sphere, relative_peak_threshold=threshold,
+                    min_separation_angle=20, is_symmetric=is_symmetric)
+                n = min(3, len(expected_indices))
+                assert np.array_equal(odf_indices[:n], expected_indices[:n])
+                assert np.all(odf_indices[n:] == -1)
+                assert np.array_equal(odf_values[:n], expected_values[:n])
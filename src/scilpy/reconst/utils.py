@@ -36,7 +36,7 @@ def get_maximas(data, sphere, b_matrix, threshold, absolute_threshold,
         spherical_func, sphere, threshold, min_separation_angle)
 
 
-def get_sphere_neighbours(sphere, max_angle):
+def get_sphere_neighbours(sphere, max_angle, is_symmetric=False):
     """
     Get a matrix of neighbours for each direction on the sphere, within
     the min_separation_angle.
@@ -44,6 +44,9 @@ def get_sphere_neighbours(sphere, max_angle):
     min_separation_angle: float
         Maximum angle in radians defining the neighbourhood
         of each direction.
+    is_symmetric: bool, optional
+        If True, the antipodal directions of the neighbours are also
+        neighbours.
 
     Return
     ------
@@ -55,5 +58,202 @@ def get_sphere_neighbours(sphere, max_angle):
     zs = sphere.vertices[:, 2]
     scalar_prods = (np.outer(xs, xs) + np.outer(ys, ys) +
                     np.outer(zs, zs))
+    if is_symmetric:
+        scalar_prods = np.abs(scalar_prods)
     neighbours = scalar_prods >= np.cos(max_angle)
     return neighbours
+
+
+def get_sphere_adjacency(sphere):
+    """
+    Get the table of the adjacent vertices of each vertex on the sphere's
+    mesh (sphere.edges), as used to find local maxima.
+
+    Return
+    ------
+    adjacency: ndarray
+        Array of shape (nb_vertices, max_nb_adjacent). Vertices with less
+        adjacent vertices are padded with (duplicates of) their first one.
+    """
+    edges = np.concatenate((sphere.edges, sphere.edges[:, ::-1]))
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    nb_vertices = len(sphere.vertices)
+    counts = np.bincount(edges[:, 0], minlength=nb_vertices)
+    if np.any(counts == 0):
+        raise ValueError('All vertices of the sphere must be on an edge.')
+
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    positions = np.arange(np.max(counts))
+    positions = np.where(positions < counts[:, None], positions, 0)
+    return edges[starts[:, None] + positions, 1]
+
+
+def get_sphere_antipodes(sphere):
+    """
+    Get the antipodal vertex of each vertex on the sphere.
+
+    Return
+    ------
+    antipodes: ndarray
+        Index of the vertex opposite to each vertex, or -1 if the sphere has
+        no such vertex.
+    """
+    vertices = sphere.vertices
+    antipodes = np.argmin(np.dot(vertices, vertices.T), axis=1)
+    is_antipode = np.all(np.isclose(vertices[antipodes], -vertices), axis=1)
+    antipodes[~is_antipode] = -1
+    return antipodes
+
+
+def _get_local_maxima(odfs, adjacency, odf_ids=None, vertex_ids=None):
+    """
+    Finds the local maxima of ODFs: the vertices larger or equal to all their
+    adjacent vertices, and larger than at least one. If odf_ids and
+    vertex_ids are given, only these vertices are verified.
+    Returns the odf_ids and vertex_ids of the maxima.
+    """
+    if odf_ids is None:
+        # On all vertices. np.take is much faster than fancy indexing on the
+        # columns.
+        max_adjacent = np.take(odfs, adjacency[:, 0], axis=1)
+        min_adjacent = max_adjacent.copy()
+        adjacent = np.empty_like(max_adjacent)
+        for i in range(1, adjacency.shape[1]):
+            np.take(odfs, adjacency[:, i], axis=1, out=adjacent)
+            np.maximum(max_adjacent, adjacent, out=max_adjacent)
+            np.minimum(min_adjacent, adjacent, out=min_adjacent)
+        return np.nonzero((odfs >= max_adjacent) & (odfs > min_adjacent))
+
+    # One adjacent vertex at a time (reductions on the short axis of a
+    # (nb_vertices, nb_adjacent) array are slow).
+    flat_odfs = odfs.ravel()
+    values = flat_odfs[odf_ids * odfs.shape[1] + vertex_ids]
+    is_larger_or_equal = np.ones(len(values), dtype=bool)
+    is_larger = np.zeros(len(values), dtype=bool)
+    for adjacent_ids in adjacency[vertex_ids].T:
+        adjacent = flat_odfs[odf_ids * odfs.shape[1] + adjacent_ids]
+        is_larger_or_equal &= values >= adjacent
+        is_larger |= values > adjacent
+    is_maximum = is_larger_or_equal & is_larger
+    return odf_ids[is_maximum], vertex_ids[is_maximum]
+
+
+def get_peaks_by_blocks(odfs, sphere, relative_peak_threshold=0.5,
+                        min_separation_angle=25, npeaks=5, is_symmetric=True,
+                        adjacency=None, neighbours=None):
+    """
+    Finds the peaks of many ODFs at once. Equivalent to calling dipy's
+    peak_directions on each ODF (and keeping the npeaks first ones), but
+    vectorized over the voxels.
+
+    Parameters
+    ----------
+    odfs: np.ndarray
+        ODFs of shape (N, nb_vertices).
+    sphere: Sphere
+        The sphere on which the ODFs are sampled.
+    relative_peak_threshold: float, optional
+        Only return peaks greater than ``relative_peak_threshold * m`` where m
+        is the largest peak (with the ODF's minimum, if positive, removed).
+    min_separation_angle: float in [0, 90], optional
+        The minimum angle (in degrees) between peaks. If two peaks are too
+        close only the larger of the two is returned.
+    npeaks: int, optional
+        Maximum number of peaks returned per ODF.
+    is_symmetric: bool, optional
+        If False, antipodal sphere directions are considered distinct.
+    adjacency: np.ndarray, optional
+        The result of get_sphere_adjacency(sphere), if already computed.
+    neighbours: np.ndarray, optional
+        The result of get_sphere_neighbours(sphere, min_separation_angle,
+        is_symmetric) (with the angle in radians), if already computed.
+
+    Return
+    ------
+    peak_values: np.ndarray
+        Values of the peaks, of shape (N, npeaks), sorted in descending order.
+        Padded with 0.
+    peak_indices: np.ndarray
+        Index of the vertex of each peak, of shape (N, npeaks). Padded with
+        -1.
+    """
+    if adjacency is None:
+        adjacency = get_sphere_adjacency(sphere)
+    if neighbours is None:
+        neighbours = get_sphere_neighbours(
+            sphere, np.deg2rad(min_separation_angle), is_symmetric)
+    # dipy keeps peaks separated by strictly more than the angle: the
+    # vertices exactly at the angle are the same up to rounding errors.
+
+    nb_odfs = len(odfs)
+    peak_values = np.zeros((nb_odfs, npeaks))
+    peak_indices = np.full((nb_odfs, npeaks), -1, dtype=int)
+
+    # 1. Local maxima. When the largest maximum is the ODF's maximum (i.e.
+    # almost always), only the vertices above the relative threshold can be
+    # kept: the others are not verified. The ODFs where it is not the case
+    # are verified entirely.
+    odfs = np.ascontiguousarray(odfs)
+    odf_max = np.max(odfs, axis=1)
+    odf_min = np.maximum(np.min(odfs, axis=1), 0)
+    if 0 < relative_peak_threshold <= 1:
+        odf_ids, vertex_ids = np.nonzero(
+            odfs - odf_min[:, None] >=
+            relative_peak_threshold * (odf_max - odf_min)[:, None])
+        odf_ids, vertex_ids = _get_local_maxima(odfs, adjacency,
+                                                odf_ids, vertex_ids)
+        is_verified = np.zeros(nb_odfs, dtype=bool)
+        is_verified[odf_ids[odfs[odf_ids, vertex_ids] ==
+                            odf_max[odf_ids]]] = True
+        others = np.flatnonzero(~is_verified)
+    else:
+        odf_ids = vertex_ids = np.zeros(0, dtype=int)
+        others = np.arange(nb_odfs)
+    if len(others) > 0:
+        other_odf_ids, other_vertex_ids = _get_local_maxima(odfs[others],
+                                                            adjacency)
+        odf_ids = np.concatenate((odf_ids, others[other_odf_ids]))
+        vertex_ids = np.concatenate((vertex_ids, other_vertex_ids))
+    values = odfs[odf_ids, vertex_ids]
+
+    # 2. Sorting the maxima of each ODF in descending order (ties in the
+    # order of the vertices).
+    order = np.lexsort((-values, odf_ids))
+    odf_ids, vertex_ids, values = \
+        odf_ids[order], vertex_ids[order], values[order]
+    nb_maxima = np.bincount(odf_ids, minlength=nb_odfs)
+    if len(values) == 0:
+        return peak_values, peak_indices
+    firsts = np.concatenate(([0], np.cumsum(nb_maxima)[:-1]))
+    ranks = np.arange(len(odf_ids)) - firsts[odf_ids]
+
+    max_nb = np.max(nb_maxima)
+    candidates = np.zeros((nb_odfs, max_nb), dtype=int)
+    candidates_values = np.full((nb_odfs, max_nb), -np.inf)
+    candidates[odf_ids, ranks] = vertex_ids
+    candidates_values[odf_ids, ranks] = values
+
+    # 3. Relative threshold, on the values minus the ODF's minimum (if
+    # positive). A single maximum is always kept, unless negative.
+    values_norm = candidates_values - odf_min[:, None]
+    is_valid = values_norm >= relative_peak_threshold * values_norm[:, 0:1]
+    is_valid[nb_maxima == 1, 0] = True
+    is_valid[candidates_values[:, 0] < 0] = False
+
+    # 4. Removing the maxima too close to a larger peak.
+    is_peak = np.zeros_like(is_valid)
+    is_peak[:, 0] = is_valid[:, 0]
+    for i in range(1, max_nb):
+        is_close = neighbours[candidates[:, :i], candidates[:, i:i + 1]]
+        is_peak[:, i] = is_valid[:, i] & \
+            ~np.any(is_peak[:, :i] & is_close, axis=1)
+
+    # 5. Keeping the npeaks first ones.
+    positions = np.cumsum(is_peak, axis=1) - 1
+    is_peak &= positions < npeaks
+    rows, columns = np.nonzero(is_peak)
+    peak_values[rows, positions[rows, columns]] = \
+        candidates_values[rows, columns]
+    peak_indices[rows, positions[rows, columns]] = candidates[rows, columns]
+
+    return peak_values, peak_indices
@@ -12,10 +12,11 @@ from scipy.ndimage import (map_coordinates, generate_binary_structure,
 
 import numpy as np
 
+from scilpy.io.streamlines import reconstruct_streamlines
 from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
 
 
-def streamlines_in_mask(sft, target_mask, all_in=False):
+def streamlines_in_mask(sft, target_mask, all_in=False, voxel_index=None):
     """
     Parameters
     ----------
@@ -23,33 +24,53 @@ def streamlines_in_mask(sft, target_mask, all_in=False):
         StatefulTractogram containing the streamlines to segment.
     target_mask : numpy.ndarray
         Binary mask in which the streamlines should pass.
+    all_in: bool
+        If true, streamlines must be entirely in the mask.
+    voxel_index: VoxelTraversalIndex, optional
+        The voxel traversal index of the sft. If given, the streamlines are
+        not traversed again. Note that the index's traversal may assign
+        points lying exactly on voxel faces to other voxels than dipy's
+        traversal, used otherwise: the results can then differ.
     Returns
     -------
     ids : list
         Ids of the streamlines passing through the mask.
     """
+    if voxel_index is not None:
+        return np.flatnonzero(voxel_index.streamlines_in_mask(
+            target_mask, all_in=all_in)).tolist()
+
     sft.to_vox()
     sft.to_corner()
+    return np.flatnonzero(_streamlines_in_mask_vox_corner(
+        sft.streamlines, target_mask, all_in)).tolist()
+
+
+def _streamlines_in_mask_vox_corner(streamlines, target_mask, all_in):
+    """
+    Same as streamlines_in_mask, for streamlines in vox space, corner origin.
+    Returns a boolean array of shape (nb_streamlines,).
+    """
     # Copy-Paste from Dipy to get indices
     if all_in:
         target_mask = np.array(target_mask, dtype=bool, copy=True)
         target_mask = np.invert(target_mask)
-        tractogram_mask = compute_tract_counts_map(sft.streamlines,
+        tractogram_mask = compute_tract_counts_map(streamlines,
                                                    target_mask.shape)
         tractogram_mask[tractogram_mask > 0] = 1
         tmp_mask = tractogram_mask.astype(
             np.uint8)*target_mask.astype(np.uint8)
-        streamlines_case = _streamlines_in_mask(list(sft.streamlines),
+        streamlines_case = _streamlines_in_mask(list(streamlines),
                                                 tmp_mask,
                                                 np.eye(3), [0, 0, 0])
 
-        return np.where(streamlines_case == [0, 1][False])[0].tolist()
+        return streamlines_case == [0, 1][False]
     else:
         target_mask = np.array(target_mask, dtype=np.uint8, copy=True)
-        streamlines_case = _streamlines_in_mask(list(sft.streamlines),
+        streamlines_case = _streamlines_in_mask(list(streamlines),
                                                 target_mask,
                                                 np.eye(3), [0, 0, 0])
-        return np.where(streamlines_case == [0, 1][True])[0].tolist()
+        return streamlines_case == [0, 1][True]
 
 
 def filter_grid_roi_both(sft, mask_1, mask_2):
@@ -106,7 +127,8 @@ def filter_grid_roi_both(sft, mask_1, mask_2):
 
 
 def filter_grid_roi(sft, mask, filter_type, is_exclude, filter_distance=0,
-                    return_sft=False, return_rejected_sft=False):
+                    return_sft=False, return_rejected_sft=False,
+                    voxel_index=None):
     """
     Parameters
     ----------
@@ -126,6 +148,9 @@ def filter_grid_roi(sft, mask, filter_type, is_exclude, filter_distance=0,
     return_rejected_sft: bool
         If true, also returns a StatefulTractogram of the rejected streamlines.
         (Only if return_sft also true).
+    voxel_index: VoxelTraversalIndex, optional
+        The voxel traversal index of the sft, used with 'any' and 'all'. See
+        streamlines_in_mask for the differences on voxel faces.
 
     Returns
     -------
@@ -153,7 +178,8 @@ def filter_grid_roi(sft, mask, filter_type, is_exclude, filter_distance=0,
     line_based_indices = []
     if filter_type in ['any', 'all']:
         line_based_indices = streamlines_in_mask(sft, mask,
-                                                 all_in=filter_type == 'all')
+                                                 all_in=filter_type == 'all',
+                                                 voxel_index=voxel_index)
     else:
         sft.to_vox()
         sft.to_corner()
@@ -199,30 +225,13 @@ def filter_grid_roi(sft, mask, filter_type, is_exclude, filter_distance=0,
     return line_based_indices
 
 
-def pre_filtering_for_geometrical_shape(sft, size, center, filter_type,
-                                        is_in_vox):
+def _get_geometrical_shape_bounding_mask(space_attributes, size, center,
+                                         is_in_vox):
     """
-    Parameters
-    ----------
-    sft : StatefulTractogram
-        Tractogram containing the streamlines to segment.
-    size : numpy.ndarray (3)
-        Size in mm, x/y/z of the ROI.
-    center: numpy.ndarray (3)
-        Center x/y/z of the ROI.
-    filter_type: str
-        One of the 4 following choices, 'any', 'all', 'either_end', 'both_ends'.
-    is_in_vox: bool
-        Value to indicate if the ROI is in voxel space.
-
-    Returns
-    -------
-    ids : list
-        Ids of the streamlines passing through the mask.
-    sft: StatefulTractogram
-        Filtered sft
+    Returns a mask of the bounding box (in voxel space) around a geometrical
+    shape (ellipsoid or cuboid), with a margin of a voxel.
     """
-    transfo, dim, _, _ = sft.space_attributes
+    transfo, dim, _, _ = space_attributes
     inv_transfo = np.linalg.inv(transfo)
 
     # Create relevant info about the ellipsoid in vox/world space
@@ -246,6 +255,35 @@ def pre_filtering_for_geometrical_shape(sft, size, center, filter_type,
     min_z, max_z = int(max(min_corner[2], 0)), int(min(max_corner[2], dim[2]))
 
     pre_mask[min_x:max_x, min_y:max_y, min_z:max_z] = 1
+    return pre_mask
+
+
+def pre_filtering_for_geometrical_shape(sft, size, center, filter_type,
+                                        is_in_vox):
+    """
+    Parameters
+    ----------
+    sft : StatefulTractogram
+        Tractogram containing the streamlines to segment.
+    size : numpy.ndarray (3)
+        Size in mm, x/y/z of the ROI.
+    center: numpy.ndarray (3)
+        Center x/y/z of the ROI.
+    filter_type: str
+        One of the 4 following choices, 'any', 'all', 'either_end',
+        'both_ends'.
+    is_in_vox: bool
+        Value to indicate if the ROI is in voxel space.
+
+    Returns
+    -------
+    ids : list
+        Ids of the streamlines passing through the mask.
+    sft: StatefulTractogram
+        Filtered sft
+    """
+    pre_mask = _get_geometrical_shape_bounding_mask(
+        sft.space_attributes, size, center, is_in_vox)
 
     return filter_grid_roi(sft, pre_mask, filter_type, is_exclude=False,
                            return_sft=True)
@@ -312,7 +350,7 @@ def filter_ellipsoid(sft, ellipsoid_radius, ellipsoid_center,
                 ((line - ellipsoid_center) / ellipsoid_radius) ** 2,
                 axis=1)
             if filter_type == 'any' \
-                    and np.argwhere(points_in_ellipsoid <= 1).any():
+                    and np.any(points_in_ellipsoid <= 1):
                 # If at least one point was in the ellipsoid
                 selected_by_ellipsoid.append(pre_filtered_indices[i])
             elif filter_type == 'all' \
@@ -412,7 +450,7 @@ def filter_cuboid(sft, cuboid_radius, cuboid_center,
             points_in_cuboid = np.sum(np.where(points_in_cuboid <= 1, 1, 0),
                                       axis=1)
             if filter_type == 'any' \
-                    and np.argwhere(points_in_cuboid == 3).any():
+                    and np.any(points_in_cuboid == 3):
                 # If at least one point was in the cuboid in x/y/z
                 selected_by_cuboid.append(pre_filtered_indices[i])
             elif filter_type == 'all' \
@@ -459,3 +497,223 @@ def filter_cuboid(sft, cuboid_radius, cuboid_center,
         data_per_point=data_per_point)
 
     return line_based_indices, new_sft
+
+
+def _points_in_ellipsoid(points, radius, center):
+    return np.sum(((points - center) / radius) ** 2, axis=-1) <= 1
+
+
+def _points_in_cuboid(points, radius, center):
+    return np.all(np.abs(points - center) / radius <= 1, axis=-1)
+
+
+class StreamlinesROIFilter(object):
+    """
+    Filters a tractogram with any number of ROIs. The streamlines in each
+    space and their endpoints are computed once, and each ROI is then
+    evaluated as a boolean mask over the streamlines. Masks can be combined
+    (ex, with np.logical_and) and the filtered tractogram only created at the
+    end.
+
+    Results are the same as with filter_grid_roi, filter_ellipsoid and
+    filter_cuboid (given the same voxel_index, if any).
+    """
+    def __init__(self, sft, voxel_index=None):
+        """
+        Parameters
+        ----------
+        sft: StatefulTractogram
+            The tractogram to filter. It is not modified.
+        voxel_index: VoxelTraversalIndex, optional
+            The voxel traversal index of the tractogram, used with 'any' and
+            'all'. If not given, the streamlines are traversed again for each
+            ROI. See streamlines_in_mask for the differences on voxel faces.
+        """
+        self.nb_streamlines = len(sft)
+        self.space_attributes = sft.space_attributes
+        self.dimensions = np.asarray(sft.dimensions, dtype=int)
+
+        # Working on a copy of the streamlines (without metadata), so that
+        # the sft is not moved between spaces.
+        sft = StatefulTractogram.from_sft(reconstruct_streamlines(
+            sft.streamlines._data, sft.streamlines._offsets,
+            sft.streamlines._lengths), sft)
+
+        # rasmm, center: for bounding boxes (see filter_ellipsoid).
+        sft.to_rasmm()
+        sft.to_center()
+        self.streamlines = reconstruct_streamlines(
+            sft.streamlines._data, sft.streamlines._offsets,
+            sft.streamlines._lengths)
+
+        # vox, corner: for voxel traversal and endpoints (filter_grid_roi).
+        sft.to_vox()
+        sft.to_corner()
+        self.vox_streamlines = sft.streamlines
+
+        self.endpoints = None
+        self.voxel_index = voxel_index
+
+    def _compute_endpoints(self):
+        if self.endpoints is None:
+            data = self.vox_streamlines._data
+            offsets = self.vox_streamlines._offsets
+            lengths = self.vox_streamlines._lengths
+            self.endpoints = (data[offsets].astype(np.int16).T,
+                              data[offsets + lengths - 1].astype(np.int16).T)
+
+    def in_mask(self, mask, filter_type, is_exclude=False,
+                filter_distance=0):
+        """
+        Evaluates a mask ROI (see filter_grid_roi).
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Binary mask in which the streamlines should pass.
+        filter_type: str
+            One of the 4 following choices:
+                'any', 'all', 'either_end', 'both_ends'
+        is_exclude: bool
+            Value to indicate if the ROI is an AND (false) or a NOT (true).
+        filter_distance: int
+            The number of passes for dilation.
+
+        Returns
+        -------
+        selected: np.ndarray
+            Boolean array of shape (nb_streamlines,).
+        """
+        if self.nb_streamlines == 0:
+            return np.zeros(0, dtype=bool)
+
+        if filter_distance != 0:
+            bin_struct = generate_binary_structure(3, 2)
+            mask = binary_dilation(mask, bin_struct,
+                                   iterations=filter_distance)
+        mask = np.asarray(mask).astype(bool)
+
+        if filter_type in ['any', 'all']:
+            if self.voxel_index is None:
+                selected = _streamlines_in_mask_vox_corner(
+                    self.vox_streamlines, mask, filter_type == 'all')
+            else:
+                selected = self.voxel_index.streamlines_in_mask(
+                    mask, all_in=filter_type == 'all')
+        else:
+            self._compute_endpoints()
+            mask = mask.astype(np.uint8)
+            in_mask_1 = map_coordinates(mask, self.endpoints[0], order=0,
+                                        mode='nearest').astype(bool)
+            in_mask_2 = map_coordinates(mask, self.endpoints[1], order=0,
+                                        mode='nearest').astype(bool)
+            # Both endpoints need to be in the mask (AND)
+            if filter_type == 'both_ends':
+                selected = in_mask_1 & in_mask_2
+            # Only one endpoint need to be in the mask (OR)
+            else:
+                selected = in_mask_1 | in_mask_2
+
+        # If the 'exclude' option is used, the selection is inverted
+        if is_exclude:
+            return ~selected
+        return selected
+
+    def _in_geometrical_shape(self, size, center, filter_type, is_exclude,
+                              is_in_vox, points_in_shape):
+        if self.nb_streamlines == 0:
+            return np.zeros(0, dtype=bool)
+
+        pre_mask = _get_geometrical_shape_bounding_mask(
+            self.space_attributes, size, center, is_in_vox)
+        pre_filtered_indices = np.where(self.in_mask(pre_mask,
+                                                     filter_type))[0]
+
+        if is_in_vox:
+            center = np.asarray(apply_affine(self.space_attributes[0],
+                                             center), dtype=float)
+        size = np.asarray(size, dtype=float)
+        center = np.asarray(center, dtype=float)
+
+        selected = np.zeros(self.nb_streamlines, dtype=bool)
+        streamlines = self.streamlines[pre_filtered_indices]
+        if filter_type in ['any', 'all']:
+            res = self.space_attributes[2]
+            for i, line in zip(pre_filtered_indices, streamlines):
+                # Resample to 1/10 of the voxel size
+                nb_points = max(int(length(line) / np.average(res) * 10), 2)
+                line = set_number_of_points(line, nb_points)
+                in_shape = points_in_shape(line, size, center)
+                if filter_type == 'any':
+                    selected[i] = np.any(in_shape)
+                else:
+                    selected[i] = np.all(in_shape)
+        else:
+            offsets = streamlines._offsets
+            in_shape_1 = points_in_shape(streamlines._data[offsets],
+                                         size, center)
+            in_shape_2 = points_in_shape(
+                streamlines._data[offsets + streamlines._lengths - 1],
+                size, center)
+            if filter_type == 'both_ends':
+                selected[pre_filtered_indices] = in_shape_1 & in_shape_2
+            else:
+                selected[pre_filtered_indices] = in_shape_1 | in_shape_2
+
+        if is_exclude:
+            return ~selected
+        return selected
+
+    def in_ellipsoid(self, ellipsoid_radius, ellipsoid_center, filter_type,
+                     is_exclude, is_in_vox=False):
+        """
+        Evaluates an ellipsoid ROI (see filter_ellipsoid).
+
+        Parameters
+        ----------
+        ellipsoid_radius : numpy.ndarray (3)
+            Size in mm, x/y/z of the ellipsoid.
+        ellipsoid_center: numpy.ndarray (3)
+            Center x/y/z of the ellipsoid.
+        filter_type: str
+            One of the 4 following choices, 'any', 'all', 'either_end',
+            'both_ends'.
+        is_exclude: bool
+            Value to indicate if the ROI is an AND (false) or a NOT (true).
+        is_in_vox: bool
+            Value to indicate if the ROI is in voxel space.
+
+        Returns
+        -------
+        selected: np.ndarray
+            Boolean array of shape (nb_streamlines,).
+        """
+        return self._in_geometrical_shape(
+            ellipsoid_radius, ellipsoid_center, filter_type, is_exclude,
+            is_in_vox, _points_in_ellipsoid)
+
+    def in_cuboid(self, cuboid_radius, cuboid_center, filter_type,
+                  is_exclude):
+        """
+        Evaluates a cuboid ROI (see filter_cuboid).
+
+        Parameters
+        ----------
+        cuboid_radius : numpy.ndarray (3)
+            Size in mm, x/y/z of the cuboid.
+        cuboid_center: numpy.ndarray (3)
+            Center x/y/z of the cuboid.
+        filter_type: str
+            One of the 4 following choices, 'any', 'all', 'either_end',
+            'both_ends'.
+        is_exclude: bool
+            Value to indicate if the ROI is an AND (false) or a NOT (true).
+
+        Returns
+        -------
+        selected: np.ndarray
+            Boolean array of shape (nb_streamlines,).
+        """
+        return self._in_geometrical_shape(
+            cuboid_radius, cuboid_center, filter_type, is_exclude, False,
+            _points_in_cuboid)
@@ -0,0 +1,64 @@
+import numpy as np
+
+from dipy.io.stateful_tractogram import Space, StatefulTractogram
+from numpy.testing import assert_array_equal
+
+from scilpy.segment.streamlines import (StreamlinesROIFilter,
+                                        filter_cuboid, filter_ellipsoid,
+                                        filter_grid_roi)
+from scilpy.tests.streamlines import get_random_walk_sft
+
+
+def test_streamlines_roi_filter():
+    sft = get_random_walk_sft(200)
+    initial_streamlines = sft.streamlines.copy()
+    roi_filter = StreamlinesROIFilter(sft)
+
+    # The sft is left untouched.
+    assert sft.space == Space.VOX
+    assert_array_equal(sft.streamlines.get_data(),
+                       initial_streamlines.get_data())
+
+    radius, center = np.array([6., 4., 8.]), np.array([20., 22., 18.])
+    mask = np.zeros((20, 20, 20), dtype=np.uint8)
+    mask[8:12, 6:14, 9:11] = 1
+    for filter_type in ['any', 'all', 'either_end', 'both_ends']:
+        for is_exclude in [False, True]:
+            for distance in [0, 1]:
+                ids = filter_grid_roi(sft, mask, filter_type, is_exclude,
+                                      filter_distance=distance)
+                kept = roi_filter.in_mask(mask, filter_type, is_exclude,
+                                          filter_distance=distance)
+                assert_array_equal(np.flatnonzero(kept), np.sort(ids))
+
+            ids, _ = filter_ellipsoid(sft, radius, center,
+                                      filter_type, is_exclude)
+            kept = roi_filter.in_ellipsoid(radius, center,
+                                           filter_type, is_exclude)
+            assert_array_equal(np.flatnonzero(kept), np.sort(ids))
+
+            ids, _ = filter_cuboid(sft, radius, center,
+                                   filter_type, is_exclude)
+            kept = roi_filter.in_cuboid(radius, center,
+                                        filter_type, is_exclude)
+            assert_array_equal(np.flatnonzero(kept), np.sort(ids))
+
+
+def test_streamlines_roi_filter_face_aligned():
+    # Integer coordinates in vox space, corner origin: all points are on the
+    # voxels' faces.
+    sft = get_random_walk_sft(200, clip_range=(1, 18))
+    sft.to_corner()
+    sft = StatefulTractogram.from_sft(
+        [np.round(s) for s in sft.streamlines], sft)
+    roi_filter = StreamlinesROIFilter(sft)
+
+    mask = np.zeros((20, 20, 20), dtype=np.uint8)
+    mask[8:12, 6:14, 9:11] = 1
+    for filter_type in ['any', 'all']:
+        for distance in [0, 1, 4]:
+            ids = filter_grid_roi(sft, mask, filter_type, False,
+                                  filter_distance=distance)
+            kept = roi_filter.in_mask(mask, filter_type,
+                                      filter_distance=distance)
+            assert_array_equal(np.flatnonzero(kept), np.sort(ids))
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import gc
+import hashlib
 from itertools import product, repeat
 import json
 import logging
 from multiprocessing import Manager
 import multiprocessing
 import os
+import shutil
+import tempfile
 from time import time
 import warnings
 
@@ -249,7 +252,7 @@ class VotingScheme(object):
             json.dump(results_dict, outfile)
 
     def __call__(self, input_tractograms_path, nbr_processes=1, seed=None,
-                 reference=None):
+                 reference=None, cache_dir=None):
         """
         Entry point function that generate the 'stack' of commands for
         dispatching and launch them using multiprocessing.
@@ -262,61 +265,105 @@ class VotingScheme(object):
             Number of processes used for the parallel bundle recognition.
         seed : int
             Seed for the RandomState.
+        reference : str
+            Reference file for the header. Default: the first tractogram.
+        cache_dir : str, optional
+            Directory where the QBx clustering and the memmaps of the
+            whole-brain tractogram are kept, to be reused by the next runs on
+            the same tractogram(s) (ex, with other atlases or parameters).
+            The clustering is only cached when a seed is given.
         """
         # Load the subject tractogram
         load_timer = time()
         reference = input_tractograms_path[0] if reference is None else reference
 
-        wb_streamlines = ArraySequence()
-        for in_tractogram in input_tractograms_path:
-            wb_streamlines.extend(
-                nib.streamlines.load(in_tractogram).streamlines)
-        len_wb_streamlines = len(wb_streamlines)
+        thresholds = [45, 35, 25, TCT]
+        rng = np.random.RandomState(seed)
 
-        logger.debug(f'Tractogram {input_tractograms_path} with '
-                     f'{len_wb_streamlines} streamlines '
-                     f'is loaded in {get_duration(load_timer)} seconds')
+        memmap_filenames = None
+        clustering = None
+        if cache_dir is not None:
+            cache_dir = os.path.join(
+                cache_dir, _get_tractograms_hash(input_tractograms_path))
+            memmap_filenames = _load_cached_memmap(cache_dir)
+            if seed is not None:
+                clustering = _load_cached_qbx(cache_dir, thresholds, seed)
+
+        wb_streamlines = None
+        if memmap_filenames is None or clustering is None:
+            wb_streamlines = ArraySequence()
+            for in_tractogram in input_tractograms_path:
+                wb_streamlines.extend(
+                    nib.streamlines.load(in_tractogram).streamlines)
+            len_wb_streamlines = len(wb_streamlines)
+
+            logger.debug(f'Tractogram {input_tractograms_path} with '
+                         f'{len_wb_streamlines} streamlines '
+                         f'is loaded in {get_duration(load_timer)} seconds')
+        else:
+            len_wb_streamlines = len(np.memmap(memmap_filenames[2],
+                                               dtype='int32', mode='r'))
 
         total_timer = time()
         # Each type of bundle is processed separately
         model_bundles_dict, bundle_names, bundle_count = \
             self._load_bundles_dictionary()
 
-        thresholds = [45, 35, 25, TCT]
-        rng = np.random.RandomState(seed)
-        cluster_timer = time()
-        with warnings.catch_warnings(record=True) as _:
-            cluster_map = qbx_and_merge(wb_streamlines,
-                                        thresholds,
-                                        nb_pts=12, rng=rng,
-                                        verbose=False)
-
-        clusters_indices = []
-        for cluster in cluster_map.clusters:
-            clusters_indices.append(cluster.indices)
-        centroids = ArraySequence(cluster_map.centroids)
-        clusters_indices = ArraySequence(clusters_indices)
-        clusters_indices._data = clusters_indices._data.astype(np.uint32)
-
-        logger.info(f'QBx with seed {seed} at {TCT}mm took '
-                    f'{get_duration(cluster_timer)}sec. gave '
-                    f'{len(cluster_map.centroids)} centroids')
-
-        tmp_dir, tmp_memmap_filenames = streamlines_to_memmap(wb_streamlines,
-                                                              'float16')
+        cluster_map = None
+        if clustering is None:
+            cluster_timer = time()
+            with warnings.catch_warnings(record=True) as _:
+                cluster_map = qbx_and_merge(wb_streamlines,
+                                            thresholds,
+                                            nb_pts=12, rng=rng,
+                                            verbose=False)
+
+            clusters_indices = []
+            for cluster in cluster_map.clusters:
+                clusters_indices.append(cluster.indices)
+            centroids = ArraySequence(cluster_map.centroids)
+            clusters_indices = ArraySequence(clusters_indices)
+            clusters_indices._data = clusters_indices._data.astype(np.uint32)
+
+            logger.info(f'QBx with seed {seed} at {TCT}mm took '
+                        f'{get_duration(cluster_timer)}sec. gave '
+                        f'{len(cluster_map.centroids)} centroids')
+
+            if cache_dir is not None and seed is not None:
+                _save_cached_qbx(cache_dir, thresholds, seed,
+                                 clusters_indices, centroids, rng)
+        else:
+            clusters_indices, centroids, rng_state = clustering
+            # The random state is as after the clustering, so that the
+            # recognition gives the same results.
+            rng.set_state(rng_state)
+            logger.info(f'QBx with seed {seed} at {TCT}mm loaded from '
+                        f'{cache_dir} with {len(centroids)} centroids')
+
+        tmp_dir = None
+        if memmap_filenames is None:
+            if cache_dir is None:
+                tmp_dir, memmap_filenames = streamlines_to_memmap(
+                    wb_streamlines, 'float16')
+            else:
+                memmap_filenames = _save_cached_memmap(cache_dir,
+                                                       wb_streamlines)
 
         # Memory cleanup (before multiprocessing)
-        cluster_map.refdata = None
-        for ref in gc.get_referrers(cluster_map) + \
-                gc.get_referrers(wb_streamlines):
-            if isinstance(ref, ArraySequence):
-                del ref._data
-            del ref
-        del wb_streamlines, cluster_map
-        gc.collect()
+        if wb_streamlines is not None:
+            referents = []
+            if cluster_map is not None:
+                cluster_map.refdata = None
+                referents = gc.get_referrers(cluster_map)
+            for ref in referents + gc.get_referrers(wb_streamlines):
+                if isinstance(ref, ArraySequence):
+                    del ref._data
+                del ref
+            del wb_streamlines, cluster_map
+            gc.collect()
         # End of memory cleanup
 
-        bsg = BundleSeg(tmp_memmap_filenames, self.transformation,
+        bsg = BundleSeg(memmap_filenames, self.transformation,
                         clusters_indices, centroids, rng=rng)
 
         # Update all BundleSeg initialisation into a single dictionnary
@@ -367,7 +414,8 @@ class VotingScheme(object):
                                       bundles_wise_vote,
                                       bundles_wise_score,
                                       minimum_vote, ext)
-        tmp_dir.cleanup()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
         saved_bundles = [f for f in os.listdir(self.output_directory)
                          if os.path.splitext(f)[1] in ['.trk', '.tck']]
         logger.info(f'Saving of {len(saved_bundles)} files in '
@@ -375,6 +423,122 @@ class VotingScheme(object):
                     f'{get_duration(save_timer)} sec.')
 
 
+def _get_tractograms_hash(filenames):
+    """
+    Hash of the content of the tractogram files (in order), identifying the
+    whole-brain tractogram in the cache.
+    """
+    signature = hashlib.blake2b(digest_size=16)
+    for filename in filenames:
+        signature.update(str(os.path.getsize(filename)).encode())
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 24), b''):
+                signature.update(block)
+    return signature.hexdigest()
+
+
+def _get_qbx_cache_filename(cache_dir, thresholds, seed):
+    thresholds = '_'.join(str(thr) for thr in thresholds)
+    return os.path.join(cache_dir,
+                        f'qbx_thr_{thresholds}_seed_{seed}.npz')
+
+
+def _load_cached_qbx(cache_dir, thresholds, seed):
+    """
+    Loads the QBx clustering of the whole-brain tractogram, if cached.
+
+    Returns
+    -------
+    clustering : tuple or None
+        The clusters' indices (ArraySequence), the centroids (ArraySequence,
+        float16) and the state of the RandomState after the clustering.
+    """
+    filename = _get_qbx_cache_filename(cache_dir, thresholds, seed)
+    if not os.path.isfile(filename):
+        return None
+
+    with np.load(filename) as data:
+        clusters_indices = ArraySequence()
+        clusters_indices._data = data['indices']
+        clusters_indices._lengths = data['indices_lengths']
+        clusters_indices._offsets = _get_offsets(clusters_indices._lengths)
+        centroids = ArraySequence()
+        centroids._data = data['centroids']
+        centroids._lengths = data['centroids_lengths']
+        centroids._offsets = _get_offsets(centroids._lengths)
+        rng_state = ('MT19937', data['rng_keys'], int(data['rng_pos']),
+                     int(data['rng_has_gauss']),
+                     float(data['rng_cached_gaussian']))
+    return clusters_indices, centroids, rng_state
+
+
+def _save_cached_qbx(cache_dir, thresholds, seed, clusters_indices,
+                     centroids, rng):
+    """
+    Saves the QBx clustering (with float16 centroids) and the state of the
+    RandomState after the clustering.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    _, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = \
+        rng.get_state()
+
+    # Written under another name first: runs sharing the cache never read
+    # an incomplete file.
+    filename = _get_qbx_cache_filename(cache_dir, thresholds, seed)
+    fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, indices=clusters_indices.get_data(),
+                 indices_lengths=clusters_indices._lengths,
+                 centroids=centroids.get_data().astype(np.float16),
+                 centroids_lengths=centroids._lengths,
+                 rng_keys=rng_keys, rng_pos=rng_pos,
+                 rng_has_gauss=rng_has_gauss,
+                 rng_cached_gaussian=rng_cached_gaussian)
+    os.replace(tmp_filename, filename)
+
+
+def _get_offsets(lengths):
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    return offsets
+
+
+def _get_memmap_filenames(memmap_dir):
+    return tuple(os.path.join(memmap_dir, name)
+                 for name in ['data.dat', 'offsets.dat', 'lengths.dat'])
+
+
+def _load_cached_memmap(cache_dir):
+    """
+    Returns the filenames of the cached memmaps of the whole-brain
+    tractogram, or None if they are not cached.
+    """
+    memmap_filenames = _get_memmap_filenames(os.path.join(cache_dir,
+                                                          'memmap'))
+    if all(os.path.isfile(filename) for filename in memmap_filenames):
+        return memmap_filenames
+    return None
+
+
+def _save_cached_memmap(cache_dir, streamlines):
+    """
+    Decomposes the whole-brain tractogram (float16) into memmaps in the
+    cache, as streamlines_to_memmap.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    memmap_dir = os.path.join(cache_dir, 'memmap')
+
+    # Written in another directory first, renamed once complete.
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    streamlines_to_memmap(streamlines, 'float16', out_dir=tmp_dir)
+    try:
+        os.rename(tmp_dir, memmap_dir)
+    except OSError:
+        # Already saved by another run.
+        shutil.rmtree(tmp_dir)
+    return _get_memmap_filenames(memmap_dir)
+
+
 def single_recognize_parallel(args):
     """Wrapper function to multiprocess recobundles execution."""
     rbx = args[0]
@@ -1,4 +1,30 @@
+import nibabel as nib
 import numpy as np
+from dipy.io.stateful_tractogram import Space, StatefulTractogram
+
+
+def get_random_walk_sft(nb_streamlines=100, affine=None, space=Space.VOX,
+                        clip_range=(0, 19), min_nb_points=2, rng_seed=0):
+    """
+    Tractogram of random walks (min_nb_points to 29 points, steps of about
+    1), starting around the center of a 20x20x20 reference. Points are
+    clipped to clip_range (if not None), given in space, origin center.
+    Default affine: voxels of 2mm.
+    """
+    rng = np.random.default_rng(rng_seed)
+    if affine is None:
+        affine = np.diag([2., 2., 2., 1.])
+    reference = nib.Nifti1Image(np.zeros((20, 20, 20), dtype=np.uint8),
+                                affine)
+    streamlines = [np.cumsum(rng.normal(0, 1, (rng.integers(min_nb_points,
+                                                            30), 3)),
+                             axis=0) + rng.uniform(5, 15, 3)
+                   for _ in range(nb_streamlines)]
+    if clip_range is not None:
+        streamlines = [np.clip(s, *clip_range) for s in streamlines]
+    streamlines = [s.astype(np.float32) for s in streamlines]
+    return StatefulTractogram(streamlines, reference, space)
+
 
 orig_strl_additional_exit_point = np.array([[79.61719,  77.53906,   6.65625],
                                             [78.76172,  77.984375,   6.90625],
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from dipy.data import get_sphere
+from dipy.io.stateful_tractogram import Origin, Space
+from dipy.reconst.shm import sf_to_sh
+
+from scilpy.image.volume_space_management import DataVolume
+from scilpy.tracking.propagator import ODFPropagator
+from scilpy.tracking.seed import SeedGenerator
+from scilpy.tracking.tracker import Tracker
+
+
+def get_tracking_data():
+    """
+    Small random fODF volume (order 6, descoteaux07 basis, 8x9x7), with its
+    tracking mask and seeding mask.
+    """
+    rng = np.random.default_rng(0)
+    shape = (8, 9, 7)
+    sf = rng.random(shape + (100,)) ** 4
+    sh = sf_to_sh(sf, get_sphere(name='repulsion100'), sh_order_max=6,
+                  basis_type='descoteaux07')
+    mask = np.zeros(shape)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    seeds = np.zeros(shape)
+    seeds[3:5, 3:5, 3:5] = 1
+    return sh, mask, seeds
+
+
+def get_tracker(algo='det', rk_order=1, interpolation='trilinear',
+                space=Space.VOX, origin=Origin('center'), nbr_seeds=16,
+                precompute_sf=False, sf_cache_dir=None, sf_cache_key=None,
+                sh=None, n_repeats=1, **tracker_args):
+    """
+    ODF Tracker on the data of get_tracking_data. The other arguments are
+    given to the Tracker. With space=Space.VOXMM, the voxels are 2mm.
+    """
+    data, mask, seeds = get_tracking_data()
+    if sh is not None:
+        data = sh
+    voxres = np.array([1., 1., 1.]) if space == Space.VOX else \
+        np.array([2., 2., 2.])
+
+    propagator = ODFPropagator(
+        DataVolume(data, voxres, interpolation), 0.5, rk_order, algo,
+        'descoteaux07', 0.1, 0.5, np.deg2rad(45), dipy_sphere='repulsion100',
+        space=space, origin=origin, precompute_sf=precompute_sf,
+        sf_cache_dir=sf_cache_dir, sf_cache_key=sf_cache_key)
+    seed_generator = SeedGenerator(seeds, voxres, space=space, origin=origin,
+                                   n_repeats=n_repeats)
+    tracker_args.setdefault('compression_th', None)
+    return Tracker(propagator, DataVolume(mask, voxres, 'nearest'),
+                   seed_generator, nbr_seeds, 2, 40, 1, **tracker_args)
+
+
+def assert_same_streamlines(streamlines, other_streamlines):
+    assert len(streamlines) == len(other_streamlines)
+    for streamline, other in zip(streamlines, other_streamlines):
+        assert len(streamline) == len(other)
+        assert np.allclose(streamline, other, atol=1e-5)
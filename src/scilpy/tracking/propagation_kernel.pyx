@@ -0,0 +1,559 @@
+# encoding: utf-8
+# cython: profile=False, language_level=3
+
+"""
+Compiled version of the one-by-one propagation loop of the Tracker with the
+ODFPropagator (Tracker._propagate_line, ODFPropagator.propagate and the
+stopping criteria). The loop runs without the GIL, so that streamlines can
+also be propagated from several threads.
+
+Each operation is done in the same order as in the Python code (dipy's
+trilinear interpolation, or DataVolume's for a float32 precomputed SF,
+projection on the sphere, cumulative sums, random draws), so that streamlines
+are the same as with the Python path for a given random generator. The
+projection on the sphere is done by sh_to_sf in both paths.
+"""
+
+cimport cython
+import numpy as np
+cimport numpy as cnp
+
+from cpython.pycapsule cimport PyCapsule_GetPointer
+from libc.math cimport floor, rint
+from libc.stdlib cimport free, malloc
+from numpy.random cimport bitgen_t
+
+from dipy.core.interpolation cimport trilinear_interpolate4d_c
+from dipy.io.stateful_tractogram import Origin, Space
+
+
+cdef struct Volume:
+    # A DataVolume, as understood by the kernel.
+    double *voxres
+    cnp.npy_intp *dim
+    bint nearest
+
+
+cdef inline bint _is_vox_in_bound(cnp.npy_intp *dim, double x, double y,
+                                  double z, bint is_corner) noexcept nogil:
+    # Same as DataVolume._is_vox_in_bound.
+    if not is_corner:
+        x = x + 0.5
+        y = y + 0.5
+        z = z + 0.5
+    return (0 <= floor(x) < dim[0] and
+            0 <= floor(y) < dim[1] and
+            0 <= floor(z) < dim[2])
+
+
+@cython.cdivision(True)
+cdef bint _to_dipy_point(Volume *vol, double *pos, bint is_voxmm,
+                         bint is_corner, double *point) noexcept nogil:
+    """
+    Converts pos to vox space, origin center (as used by dipy), clipped to
+    the volume. Returns whether pos was in bound.
+    """
+    cdef double eps = 1e-8
+    cdef double low
+    cdef cnp.npy_intp c
+    cdef bint in_bound
+
+    for c in range(3):
+        point[c] = pos[c]
+        if is_voxmm:
+            point[c] = point[c] / vol.voxres[c]
+
+    # Same as DataVolume._clip_vox_to_bound.
+    in_bound = _is_vox_in_bound(vol.dim, point[0], point[1], point[2],
+                                is_corner)
+    if not in_bound:
+        low = 0 if is_corner else -0.5
+        for c in range(3):
+            point[c] = max(low, min(vol.dim[c] + low - eps, point[c]))
+
+    # Dipy works with origin center.
+    if is_corner:
+        for c in range(3):
+            point[c] = point[c] - 0.5
+    return in_bound
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bint _get_value(double[:, :, :, :] data, Volume *vol, double *pos,
+                     bint is_voxmm, bint is_corner,
+                     double *out) noexcept nogil:
+    """
+    Same as DataVolume.get_value_at_coordinate, for vox or voxmm space.
+    Writes the values in out and returns whether pos was in bound.
+    """
+    cdef double point[3]
+    cdef cnp.npy_intp i, j, k, c
+    cdef bint in_bound
+
+    in_bound = _to_dipy_point(vol, pos, is_voxmm, is_corner, point)
+    if vol.nearest:
+        # Rounding half to even, like dipy's nearestneighbor_interpolate.
+        i = <cnp.npy_intp>rint(point[0])
+        j = <cnp.npy_intp>rint(point[1])
+        k = <cnp.npy_intp>rint(point[2])
+        for c in range(data.shape[3]):
+            out[c] = data[i, j, k, c]
+    else:
+        trilinear_interpolate4d_c(data, point, out)
+    return in_bound
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bint _get_value_float(float[:, :, :, :] data, Volume *vol, double *pos,
+                           bint is_voxmm, bint is_corner,
+                           double *out) noexcept nogil:
+    """
+    Same as _get_value, for float32 data, computed in float32 as in
+    DataVolume._vox_to_values.
+    """
+    cdef double point[3]
+    cdef float rem[3]
+    cdef float weights[8]
+    cdef cnp.npy_intp idx[2][3]
+    cdef cnp.npy_intp flr, n, c
+    cdef float value
+    cdef bint in_bound
+
+    in_bound = _to_dipy_point(vol, pos, is_voxmm, is_corner, point)
+    if vol.nearest:
+        for c in range(data.shape[3]):
+            out[c] = data[<cnp.npy_intp>rint(point[0]),
+                          <cnp.npy_intp>rint(point[1]),
+                          <cnp.npy_intp>rint(point[2]), c]
+        return in_bound
+
+    # On the borders, the neighbour outside the volume is replaced by the
+    # voxel itself.
+    for c in range(3):
+        flr = <cnp.npy_intp>floor(point[c])
+        rem[c] = <float>(point[c] - flr)
+        idx[0][c] = flr + (flr == -1)
+        idx[1][c] = flr + (flr != vol.dim[c] - 1)
+
+    # Neighbours in the order of itertools.product((0, 1), repeat=3).
+    for n in range(8):
+        weights[n] = ((rem[0] if n >> 2 else <float>1 - rem[0]) *
+                      (rem[1] if (n >> 1) & 1 else <float>1 - rem[1]))
+        weights[n] = weights[n] * (rem[2] if n & 1 else <float>1 - rem[2])
+    for c in range(data.shape[3]):
+        value = weights[0] * data[idx[0][0], idx[0][1], idx[0][2], c]
+        for n in range(1, 8):
+            value = value + weights[n] * data[idx[n >> 2][0],
+                                              idx[(n >> 1) & 1][1],
+                                              idx[n & 1][2], c]
+        out[c] = value
+    return in_bound
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _sh_to_sf(double[:, ::1] B, double *sh,
+                           double *sf) noexcept nogil:
+    """
+    Projection of the SH on the sphere, summed coefficient by coefficient.
+    """
+    cdef cnp.npy_intp i, c
+
+    for i in range(B.shape[1]):
+        sf[i] = 0
+    for c in range(B.shape[0]):
+        for i in range(B.shape[1]):
+            sf[i] = sf[i] + B[c, i] * sh[c]
+
+
+def sh_to_sf(double[:, ::1] B, double[::1] sh):
+    """
+    Projects the SH on the sphere: same as np.dot(B.T, sh), but always
+    summed in the same order, so that the Python path of the ODFPropagator
+    gives the same results as the native kernel.
+
+    Parameters
+    ----------
+    B: ndarray (nb_coeffs, nb_dirs)
+        The SH to SF matrix, float64 and C-contiguous.
+    sh: ndarray (nb_coeffs,)
+        The SH coefficients, float64.
+
+    Return
+    ------
+    sf: ndarray (nb_dirs,)
+        The spherical function.
+    """
+    cdef double[::1] sf_view
+
+    if sh.shape[0] != B.shape[0]:
+        raise ValueError("The SH should have {} coefficients."
+                         .format(B.shape[0]))
+    sf = np.zeros(B.shape[1], dtype=np.float64)
+    sf_view = sf
+    _sh_to_sf(B, &sh[0], &sf_view[0])
+    return sf
+
+
+cdef class ODFPropagationKernel:
+    """
+    Propagates streamlines one by one with the parameters of an
+    ODFPropagator and the stopping criteria of a Tracker.
+
+    The kernel keeps references to the data of the propagator and of the
+    mask: it must be created again if the data is reset (ex, in a new
+    process). It does not hold any state between calls, and can thus be used
+    by several threads at once, each with its own random generator.
+    """
+    cdef:
+        double[:, :, :, :] data
+        float[:, :, :, :] sf_data
+        double[:, :, :, :] mask_data
+        Volume vol
+        Volume mask_vol
+        double voxres[3]
+        double mask_voxres[3]
+        cnp.npy_intp dim[3]
+        cnp.npy_intp mask_dim[3]
+        bint is_voxmm
+        bint is_corner
+
+        bint precompute_sf
+        double[:, ::1] B
+        double[:, ::1] vertices
+        cnp.npy_intp nb_coeffs
+        cnp.npy_intp nb_dirs
+        # Neighbours as sparse rows: the neighbours of direction i are
+        # neighbours[offsets[i]:offsets[i + 1]], in increasing order.
+        cnp.npy_intp[::1] cone
+        cnp.npy_intp[::1] cone_offsets
+        cnp.npy_intp[::1] maxima
+        cnp.npy_intp[::1] maxima_offsets
+
+        bint is_det
+        int rk_order
+        double step_size
+        double sf_threshold
+
+        cnp.npy_intp max_nbr_pts
+        double max_invalid_dirs
+        bint append_last_point
+
+    def __init__(self, propagator, mask, max_nbr_pts, max_invalid_dirs,
+                 append_last_point):
+        """
+        Parameters
+        ----------
+        propagator: ODFPropagator
+            The propagator. Its data and the mask's data must be writeable
+            float64 arrays (as expected by dipy's interpolation, used in the
+            Python path), except the precomputed SF, in float32.
+        mask: DataVolume
+            Tracking mask.
+        max_nbr_pts: int
+            Maximum number of points for streamlines.
+        max_invalid_dirs: int
+            Number of consecutives invalid directions allowed during tracking.
+        append_last_point: bool
+            Whether to add the last point (once out of the tracking mask) to
+            the streamline or not.
+        """
+        if propagator.space not in [Space.VOX, Space.VOXMM]:
+            raise NotImplementedError("The native kernel only works in vox "
+                                      "or voxmm space.")
+        if propagator.origin not in [Origin('center'), Origin('corner')]:
+            raise ValueError("Origin should be 'center' or 'corner'.")
+        self.is_voxmm = propagator.space == Space.VOXMM
+        self.is_corner = propagator.origin == Origin('corner')
+
+        self.precompute_sf = propagator.precompute_sf
+        if self.precompute_sf:
+            self.sf_data = self._check_data(propagator.datavolume, np.float32)
+        else:
+            self.data = self._check_data(propagator.datavolume)
+        self.mask_data = self._check_data(mask)
+        if mask.data.shape[3] != 1:
+            raise ValueError("The tracking mask should be 3D.")
+        for c in range(3):
+            self.voxres[c] = propagator.datavolume.voxres[c]
+            self.mask_voxres[c] = mask.voxres[c]
+            self.dim[c] = propagator.datavolume.data.shape[c]
+            self.mask_dim[c] = mask.data.shape[c]
+        self.vol.voxres = self.voxres
+        self.vol.dim = self.dim
+        self.vol.nearest = propagator.datavolume.interpolation == 'nearest'
+        self.mask_vol.voxres = self.mask_voxres
+        self.mask_vol.dim = self.mask_dim
+        self.mask_vol.nearest = mask.interpolation == 'nearest'
+
+        self.B = np.ascontiguousarray(propagator.B, dtype=np.float64)
+        self.vertices = np.ascontiguousarray(propagator.sphere.vertices,
+                                             dtype=np.float64)
+        self.nb_coeffs = propagator.datavolume.data.shape[3]
+        self.nb_dirs = len(propagator.sphere.vertices)
+        self.cone, self.cone_offsets = self._to_sparse_rows(
+            propagator.tracking_neighbours)
+        self.maxima, self.maxima_offsets = self._to_sparse_rows(
+            propagator.maxima_neighbours)
+
+        self.is_det = propagator.algo == 'det'
+        self.rk_order = propagator.rk_order
+        self.step_size = propagator.step_size
+        self.sf_threshold = propagator.sf_threshold
+
+        self.max_nbr_pts = max_nbr_pts
+        self.max_invalid_dirs = max_invalid_dirs
+        self.append_last_point = append_last_point
+
+    @staticmethod
+    def _check_data(datavolume, dtype=np.float64):
+        if datavolume.interpolation not in ['nearest', 'trilinear']:
+            raise ValueError("The native kernel requires an interpolation "
+                             "method ('nearest' or 'trilinear').")
+        if datavolume.data.dtype != dtype or \
+                not datavolume.data.flags.writeable:
+            raise ValueError("The native kernel requires writeable {} "
+                             "data.".format(np.dtype(dtype).name))
+        return datavolume.data
+
+    @staticmethod
+    def _to_sparse_rows(neighbours):
+        rows, cols = np.nonzero(neighbours)
+        offsets = np.zeros(len(neighbours) + 1, dtype=np.intp)
+        offsets[1:] = np.cumsum(np.bincount(rows, minlength=len(neighbours)))
+        return cols.astype(np.intp), offsets
+
+    def propagate_line(self, double[:, ::1] line, cnp.npy_intp nb_pts,
+                       v_in, random_generator):
+        """
+        Same as Tracker._propagate_line: propagates the line from its last
+        point until a stopping criterion is met.
+
+        Parameters
+        ----------
+        line: ndarray (max_nbr_pts, 3)
+            Float64 buffer containing the beginning of the line. New points
+            are written after it.
+        nb_pts: int
+            Number of points already in the line.
+        v_in: TrackingDirection
+            The previous direction of the streamline.
+        random_generator: numpy Generator
+            The streamline's random generator (used with algo 'prob').
+
+        Returns
+        -------
+        nb_pts: int
+            The new number of points in the line.
+        """
+        cdef double dir_in[3]
+        cdef cnp.npy_intp dir_in_index, c
+        cdef bitgen_t *rng
+        cdef double *buffers
+
+        if line.shape[0] < self.max_nbr_pts or line.shape[1] != 3:
+            raise ValueError("Line buffer should be of shape "
+                             "(max_nbr_pts, 3).")
+        if nb_pts < 1:
+            raise ValueError("Line should contain at least one point.")
+
+        dir_in_index = v_in.index
+        for c in range(3):
+            dir_in[c] = v_in[c]
+
+        capsule = random_generator.bit_generator.capsule
+        rng = <bitgen_t *>PyCapsule_GetPointer(capsule, "BitGenerator")
+
+        # Working buffers, one per call to be usable by several threads.
+        buffers = <double *>malloc(
+            (self.nb_coeffs + 2 * self.nb_dirs) * sizeof(double))
+        if buffers == NULL:
+            raise MemoryError()
+        try:
+            with random_generator.bit_generator.lock, nogil:
+                nb_pts = self._propagate_line(&line[0, 0], nb_pts, dir_in,
+                                              dir_in_index, rng, buffers)
+        finally:
+            free(buffers)
+        return nb_pts
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef cnp.npy_intp _propagate_line(self, double *line, cnp.npy_intp nb_pts,
+                                      double *dir_in,
+                                      cnp.npy_intp dir_in_index,
+                                      bitgen_t *rng,
+                                      double *buffers) noexcept nogil:
+        # Same as Tracker._propagate_line.
+        cdef double new_pos[3]
+        cdef double mask_value
+        cdef cnp.npy_intp c
+        cdef double invalid_direction_count = 0
+        cdef bint propagation_can_continue = True
+        cdef bint is_direction_valid
+
+        while nb_pts < self.max_nbr_pts and propagation_can_continue:
+            is_direction_valid = self._propagate(
+                &line[3 * (nb_pts - 1)], dir_in, &dir_in_index, new_pos, rng,
+                buffers)
+
+            if is_direction_valid:
+                invalid_direction_count = 0
+            else:
+                invalid_direction_count += 1
+                if invalid_direction_count > self.max_invalid_dirs:
+                    break
+
+            # Same as Tracker._verify_stopping_criteria.
+            propagation_can_continue = _get_value(
+                self.mask_data, &self.mask_vol, new_pos, self.is_voxmm,
+                self.is_corner, &mask_value)
+            if propagation_can_continue and mask_value <= 0:
+                propagation_can_continue = False
+
+            if propagation_can_continue or self.append_last_point:
+                for c in range(3):
+                    line[3 * nb_pts + c] = new_pos[c]
+                nb_pts += 1
+
+        return nb_pts
+
+    cdef bint _propagate(self, double *pos, double *dir_in,
+                         cnp.npy_intp *dir_in_index, double *new_pos,
+                         bitgen_t *rng, double *buffers) noexcept nogil:
+        # Same as AbstractPropagator.propagate. The new direction replaces
+        # dir_in.
+        cdef double dir1[3]
+        cdef double dir2[3]
+        cdef double dir3[3]
+        cdef double dir4[3]
+        cdef double sub_pos[3]
+        cdef cnp.npy_intp idx1, idx2, idx3, idx4
+        cdef cnp.npy_intp c
+        cdef bint is_direction_valid
+
+        is_direction_valid = self._sample_next_direction_or_go_straight(
+            pos, dir_in, dir_in_index[0], dir1, &idx1, rng, buffers)
+
+        if self.rk_order == 2:
+            for c in range(3):
+                sub_pos[c] = pos[c] + 0.5 * self.step_size * dir1[c]
+            self._sample_next_direction_or_go_straight(
+                sub_pos, dir1, idx1, dir_in, dir_in_index, rng, buffers)
+        elif self.rk_order == 4:
+            for c in range(3):
+                sub_pos[c] = pos[c] + 0.5 * self.step_size * dir1[c]
+            self._sample_next_direction_or_go_straight(
+                sub_pos, dir1, idx1, dir2, &idx2, rng, buffers)
+            for c in range(3):
+                sub_pos[c] = pos[c] + 0.5 * self.step_size * dir2[c]
+            self._sample_next_direction_or_go_straight(
+                sub_pos, dir2, idx2, dir3, &idx3, rng, buffers)
+            for c in range(3):
+                sub_pos[c] = pos[c] + self.step_size * dir3[c]
+            self._sample_next_direction_or_go_straight(
+                sub_pos, dir3, idx3, dir4, &idx4, rng, buffers)
+            for c in range(3):
+                dir_in[c] = (dir1[c] + 2 * dir2[c] + 2 * dir3[c] +
+                             dir4[c]) / 6
+            dir_in_index[0] = idx1
+        else:
+            for c in range(3):
+                dir_in[c] = dir1[c]
+            dir_in_index[0] = idx1
+
+        for c in range(3):
+            new_pos[c] = pos[c] + self.step_size * dir_in[c]
+        return is_direction_valid
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef bint _sample_next_direction_or_go_straight(
+            self, double *pos, double *v_in, cnp.npy_intp v_in_index,
+            double *v_out, cnp.npy_intp *v_out_index, bitgen_t *rng,
+            double *buffers) noexcept nogil:
+        # Same as AbstractPropagator._sample_next_direction_or_go_straight
+        # and ODFPropagator._sample_next_direction.
+        cdef double *sf = buffers
+        cdef double *cdf = buffers + self.nb_dirs
+        cdef double *coeffs = buffers + 2 * self.nb_dirs
+        cdef cnp.npy_intp n, i, c, start, end, chosen = -1
+        cdef double total, r, cosinus, new_cosinus, neighbours_max
+
+        self._get_sf(pos, sf, coeffs)
+        for i in range(self.nb_dirs):
+            if sf[i] < self.sf_threshold:
+                sf[i] = 0
+
+        start = self.cone_offsets[v_in_index]
+        end = self.cone_offsets[v_in_index + 1]
+        if self.is_det:
+            # Maxima in the cone. Choosing the one the most aligned with v_in.
+            cosinus = 0
+            for n in range(start, end):
+                i = self.cone[n]
+                if not sf[i] > 0:
+                    continue
+                neighbours_max = sf[self.maxima[self.maxima_offsets[i]]]
+                for c in range(self.maxima_offsets[i] + 1,
+                               self.maxima_offsets[i + 1]):
+                    if sf[self.maxima[c]] > neighbours_max:
+                        neighbours_max = sf[self.maxima[c]]
+                if sf[i] != neighbours_max:
+                    continue
+                new_cosinus = (v_in[0] * self.vertices[i, 0] +
+                               v_in[1] * self.vertices[i, 1] +
+                               v_in[2] * self.vertices[i, 2])
+                if new_cosinus > cosinus:
+                    cosinus = new_cosinus
+                    chosen = i
+        else:
+            # Sampling from the SF in the cone (same as sample_distribution).
+            total = 0
+            for n in range(start, end):
+                total = total + sf[self.cone[n]]
+                cdf[n - start] = total
+            if total > 0:
+                r = rng.next_double(rng.state) * total
+                n = 0
+                while n < end - start - 1 and cdf[n] < r:
+                    n += 1
+                chosen = self.cone[start + n]
+
+        if chosen < 0:
+            for c in range(3):
+                v_out[c] = v_in[c]
+            v_out_index[0] = v_in_index
+            return False
+
+        for c in range(3):
+            v_out[c] = self.vertices[chosen, c]
+        v_out_index[0] = chosen
+        return True
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void _get_sf(self, double *pos, double *sf,
+                      double *coeffs) noexcept nogil:
+        # Same as ODFPropagator._get_sf.
+        cdef cnp.npy_intp i
+        cdef double sf_max
+
+        if self.precompute_sf:
+            _get_value_float(self.sf_data, &self.vol, pos, self.is_voxmm,
+                             self.is_corner, sf)
+        else:
+            _get_value(self.data, &self.vol, pos, self.is_voxmm,
+                       self.is_corner, coeffs)
+            _sh_to_sf(self.B, coeffs, sf)
+
+        sf_max = sf[0]
+        for i in range(1, self.nb_dirs):
+            if sf[i] > sf_max:
+                sf_max = sf[i]
+        if sf_max > 0:
+            for i in range(self.nb_dirs):
+                sf[i] = sf[i] / sf_max
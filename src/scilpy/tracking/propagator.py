@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from enum import Enum
+import hashlib
 import logging
+import os
 
 import numpy as np
 
@@ -10,8 +12,12 @@ from dipy.reconst.shm import sh_to_sf_matrix
 
 from scilpy.reconst.utils import (get_sphere_neighbours,
                                   get_sh_order_and_fullness)
-from scilpy.tracking.utils import sample_distribution, TrackingDirection
-from scilpy.image.volume_space_management import FibertubeDataVolume
+from scilpy.tracking.propagation_kernel import sh_to_sf
+from scilpy.tracking.utils import (sample_distribution,
+                                   sample_distribution_batch,
+                                   TrackingDirection)
+from scilpy.image.volume_space_management import (DataVolume,
+                                                  FibertubeDataVolume)
 
 
 class PropagationStatus(Enum):
@@ -234,6 +240,148 @@ class AbstractPropagator(object):
 
         return new_pos, new_dir, is_direction_valid
 
+    def prepare_forward_batch(self, seeding_pos, random_generator):
+        """
+        Vectorized version of prepare_forward, used by the batched tracking
+        mode of the Tracker: prepares N streamlines at once.
+
+        Directions are represented as a pair of arrays (vectors, indices)
+        rather than as a list of TrackingDirection.
+
+        Parameters
+        ----------
+        seeding_pos: ndarray (N, 3)
+            The seeding positions. Important, positions must be in the same
+            space and origin as self.space, self.origin!
+        random_generator: numpy Generator
+            Shared by all streamlines of the batch.
+
+        Returns
+        -------
+        v_in: ndarray (N, 3)
+            The "fake" previous direction at first step.
+        v_in_idx: ndarray (N,)
+            Index of v_in on the sphere, if any.
+        is_valid: ndarray (N,)
+            False where no good tracking direction can be set at the seeding
+            position.
+        """
+        # To be defined by child classes supporting batched tracking.
+        raise NotImplementedError
+
+    def prepare_backward_batch(self, first_steps, forward_dirs):
+        """
+        Vectorized version of prepare_backward.
+
+        Parameters
+        ----------
+        first_steps: ndarray (N, 3)
+            For each streamline, the seed minus the second point of the
+            forward line, or NaN if the forward line contains only the seed.
+        forward_dirs: ndarray (N, 3)
+            v_in chosen at the forward step.
+
+        Returns
+        -------
+        v_in: ndarray (N, 3)
+            Last directions of the (reversed) streamlines.
+        v_in_idx: ndarray (N,)
+            Index of v_in on the sphere, if any.
+        """
+        raise NotImplementedError
+
+    def propagate_batch(self, pos, v_in, v_in_idx, random_generator):
+        """
+        Vectorized version of propagate: computes the next position and
+        direction of N streamlines at once using Runge-Kutta integration. If
+        no valid tracking direction is available, v_in is chosen.
+
+        Parameters
+        ----------
+        pos: ndarray (N, 3)
+            Current positions.
+        v_in: ndarray (N, 3)
+            Previous tracking directions.
+        v_in_idx: ndarray (N,)
+            Indices of the previous tracking directions, if any.
+        random_generator: numpy Generator
+            Shared by all streamlines of the batch.
+
+        Return
+        ------
+        new_pos: ndarray (N, 3)
+            The new segment positions, expressed in propagator's space and
+            origin.
+        new_dir: ndarray (N, 3)
+            The new segment directions.
+        new_dir_idx: ndarray (N,)
+            Indices of the new segment directions.
+        is_direction_valid: ndarray (N,)
+            True where new_dir is valid.
+        """
+        if self.rk_order == 1:
+            is_direction_valid, new_dir, new_dir_idx = \
+                self._sample_next_direction_or_go_straight_batch(
+                    pos, v_in, v_in_idx, random_generator)
+
+        elif self.rk_order == 2:
+            is_direction_valid, dir1, idx1 = \
+                self._sample_next_direction_or_go_straight_batch(
+                    pos, v_in, v_in_idx, random_generator)
+            _, new_dir, new_dir_idx = \
+                self._sample_next_direction_or_go_straight_batch(
+                    pos + 0.5 * self.step_size * dir1, dir1, idx1,
+                    random_generator)
+        else:
+            # case self.rk_order == 4
+            is_direction_valid, dir1, idx1 = \
+                self._sample_next_direction_or_go_straight_batch(
+                    pos, v_in, v_in_idx, random_generator)
+            _, dir2, idx2 = self._sample_next_direction_or_go_straight_batch(
+                pos + 0.5 * self.step_size * dir1, dir1, idx1,
+                random_generator)
+            _, dir3, idx3 = self._sample_next_direction_or_go_straight_batch(
+                pos + 0.5 * self.step_size * dir2, dir2, idx2,
+                random_generator)
+            _, dir4, _ = self._sample_next_direction_or_go_straight_batch(
+                pos + self.step_size * dir3, dir3, idx3, random_generator)
+
+            new_dir = (dir1 + 2 * dir2 + 2 * dir3 + dir4) / 6
+            new_dir_idx = idx1
+
+        new_pos = pos + self.step_size * new_dir
+
+        return new_pos, new_dir, new_dir_idx, is_direction_valid
+
+    def _sample_next_direction_or_go_straight_batch(self, pos, v_in, v_in_idx,
+                                                    random_generator):
+        """
+        Vectorized version of _sample_next_direction_or_go_straight.
+        """
+        v_out, v_out_idx, is_direction_valid = \
+            self._sample_next_direction_batch(pos, v_in, v_in_idx,
+                                              random_generator)
+        v_out = np.where(is_direction_valid[:, None], v_out, v_in)
+        v_out_idx = np.where(is_direction_valid, v_out_idx, v_in_idx)
+        return is_direction_valid, v_out, v_out_idx
+
+    def _sample_next_direction_batch(self, pos, v_in, v_in_idx,
+                                     random_generator):
+        """
+        Vectorized version of _sample_next_direction.
+
+        Return
+        ------
+        v_out: ndarray (N, 3)
+            The chosen directions. Undefined where no valid direction is
+            found.
+        v_out_idx: ndarray (N,)
+            Indices of the chosen directions.
+        is_direction_valid: ndarray (N,)
+            False where no valid direction is found.
+        """
+        raise NotImplementedError
+
     def _sample_next_direction(self, pos, v_in):
         """
         Chooses a next tracking direction from all possible directions offered
@@ -314,6 +462,20 @@ class PropagatorOnSphere(AbstractPropagator):
         #  exactly equal to last_dir or to backward_dir.
         return TrackingDirection(self.sphere.vertices[ind], ind)
 
+    def prepare_backward_batch(self, first_steps, forward_dirs):
+        """
+        Vectorized version of prepare_backward. See
+        AbstractPropagator.prepare_backward_batch for the parameters.
+        """
+        has_step = ~np.isnan(first_steps[:, 0])
+        backward_dirs = np.where(has_step[:, None], first_steps,
+                                 -np.asarray(forward_dirs))
+
+        # Same as sphere.find_closest, for all directions at once.
+        inds = np.argmax(np.dot(backward_dirs, self.sphere.vertices.T),
+                         axis=1)
+        return self.sphere.vertices[inds], inds
+
 
 class ODFPropagator(PropagatorOnSphere):
     """
@@ -325,7 +487,8 @@ class ODFPropagator(PropagatorOnSphere):
                  sub_sphere=0,
                  min_separation_angle=np.pi / 16.,
                  space=Space('vox'), origin=Origin('center'),
-                 is_legacy=True):
+                 is_legacy=True, precompute_sf=False, sf_cache_dir=None,
+                 sf_cache_key=None):
         """
 
         Parameters
@@ -369,6 +532,28 @@ class ODFPropagator(PropagatorOnSphere):
             choice implies the less data modification.
         is_legacy : bool, optional
             Whether or not the SH basis is in its legacy form.
+        precompute_sf: bool, optional
+            If True, the SF is computed on the tracking sphere for all voxels
+            at initialization, and is interpolated directly during tracking
+            instead of interpolating the SH and projecting it on the sphere
+            at each step. Interpolation being linear, the result is the same,
+            up to the float32 precision of the SF. Memory usage is multiplied
+            by about nb_directions / (2 * nb_coeffs).
+            Mostly useful with nearest interpolation, or when propagating
+            streamlines one by one. With trilinear interpolation in the
+            batched mode, interpolating all directions is slower than
+            projecting the SH of the whole batch at once.
+        sf_cache_dir: str, optional
+            If set, precompute_sf is implied and the precomputed SF volume is
+            saved in this directory, in a file identified by a hash of
+            sf_cache_key, of the data shape and of the projection matrix, and
+            memory-mapped. Later runs with the same key, sphere and basis
+            reuse it.
+        sf_cache_key: str, optional
+            Required with sf_cache_dir. Identifies the SH data (ex, its file
+            name, header and modification time). The data itself is not
+            hashed: it is the caller's role to change the key when the data
+            changes.
         """
         super().__init__(datavolume, step_size, rk_order, dipy_sphere,
                          sub_sphere, space, origin)
@@ -402,9 +587,89 @@ class ODFPropagator(PropagatorOnSphere):
             get_sh_order_and_fullness(self.datavolume.nb_coeffs)
         self.basis = basis
         self.is_legacy = is_legacy
-        self.B = sh_to_sf_matrix(self.sphere, sh_order, self.basis,
-                                 smooth=0.006, return_inv=False,
-                                 full_basis=full_basis, legacy=self.is_legacy)
+        self.B = np.ascontiguousarray(
+            sh_to_sf_matrix(self.sphere, sh_order, self.basis, smooth=0.006,
+                            return_inv=False, full_basis=full_basis,
+                            legacy=self.is_legacy), dtype=np.float64)
+
+        # For batched deterministic tracking: maxima neighbours as a table of
+        # indices (nb_dirs, max_nb_neighbours), padded with the direction's
+        # own index.
+        rows, cols = np.nonzero(self.maxima_neighbours)
+        counts = np.bincount(rows, minlength=len(self.sphere.vertices))
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        self.maxima_neighbours_table = np.repeat(
+            np.arange(len(self.sphere.vertices))[:, None],
+            np.max(counts), axis=1)
+        self.maxima_neighbours_table[rows, np.arange(len(rows)) -
+                                     starts[rows]] = cols
+
+        # Replacing the SH by the SF, if asked.
+        if sf_cache_dir is not None and sf_cache_key is None:
+            raise ValueError("sf_cache_dir requires a sf_cache_key.")
+        self.precompute_sf = precompute_sf or sf_cache_dir is not None
+        if self.precompute_sf:
+            sf = self._compute_sf_volume(self.datavolume.data, sf_cache_dir,
+                                         sf_cache_key)
+            self.datavolume = DataVolume(sf, self.datavolume.voxres,
+                                         self.datavolume.interpolation)
+
+    def _compute_sf_volume(self, sh, cache_dir=None, cache_key=None):
+        """
+        Computes the SF on self.sphere for every voxel, slice by slice, as
+        float32.
+
+        Parameters
+        ----------
+        sh: ndarray (X, Y, Z, nb_coeffs)
+            The SH data.
+        cache_dir: str or None
+            If set, the SF volume is saved in this directory (or loaded from
+            it if it already exists) and memory-mapped.
+        cache_key: str or None
+            Identifies the SH data in the cache. Required with cache_dir.
+
+        Return
+        ------
+        sf: ndarray (X, Y, Z, len(self.sphere.vertices))
+            The SF volume. A np.memmap if cache_dir is set, opened in
+            copy-on-write mode: the file is never modified.
+        """
+        B = self.B
+        shape = sh.shape[:3] + (B.shape[1],)
+
+        if cache_dir is None:
+            sf = np.zeros(shape, dtype=np.float32)
+            for i in range(shape[0]):
+                sf[i] = np.dot(sh[i], B)
+            return sf
+
+        # Identifying the file by the key, the shape and the sphere, basis
+        # and order. Hashing the data itself would read it all on each run.
+        md5 = hashlib.md5(B.tobytes())
+        md5.update(str(sh.shape).encode())
+        md5.update(cache_key.encode())
+        filename = os.path.join(cache_dir,
+                                'sf_{}.npy'.format(md5.hexdigest()))
+
+        if os.path.isfile(filename):
+            logging.info("Loading precomputed SF from {}.".format(filename))
+        else:
+            logging.info("Saving precomputed SF to {}.".format(filename))
+            os.makedirs(cache_dir, exist_ok=True)
+            # Writing in a temporary file first: an interrupted run (or
+            # another run writing the same file) never leaves a partial file.
+            tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+            sf = np.lib.format.open_memmap(tmp_filename, mode='w+',
+                                           dtype=np.float32, shape=shape)
+            for i in range(shape[0]):
+                sf[i] = np.dot(sh[i], B)
+            sf.flush()
+            del sf
+            os.replace(tmp_filename, filename)
+
+        # Dipy's interpolation requires writeable data: using copy-on-write.
+        return np.load(filename, mmap_mode='c')
 
     def _get_sf(self, pos):
         """
@@ -423,15 +688,100 @@ class ODFPropagator(PropagatorOnSphere):
             its maximum amplitude.
         """
         # Interpolation:
-        sh = self.datavolume.get_value_at_coordinate(
-            *pos, space=self.space, origin=self.origin)
-        sf = np.dot(self.B.T, sh).reshape((-1, 1))
+        if self.precompute_sf:
+            # Copying: with nearest interpolation, we get a view of the data.
+            sf = np.array(self.datavolume.get_value_at_coordinate(
+                *pos, space=self.space, origin=self.origin),
+                dtype=np.float64).reshape((-1, 1))
+        else:
+            sh = self.datavolume.get_value_at_coordinate(
+                *pos, space=self.space, origin=self.origin)
+            # Summed in the same order as in the native kernel.
+            sf = sh_to_sf(self.B, np.ascontiguousarray(sh, dtype=np.float64))
+            sf = sf.reshape((-1, 1))
 
         sf_max = np.max(sf)
         if sf_max > 0:
             sf /= sf_max
         return sf
 
+    def _get_sf_batch(self, pos):
+        """
+        Vectorized version of _get_sf.
+
+        Parameters
+        ----------
+        pos: ndarray (N, 3)
+            Positions in the trackable dataset.
+
+        Return
+        ------
+        sf: ndarray (N, len(self.sphere.vertices))
+            Spherical functions evaluated at pos, each normalized by its
+            maximum amplitude.
+        """
+        values = self.datavolume.get_value_at_coordinates(
+            pos, space=self.space, origin=self.origin)
+        if self.precompute_sf:
+            sf = np.asarray(values, dtype=np.float64)
+        else:
+            sf = np.dot(values.reshape((len(pos), -1)), self.B)
+
+        sf_max = np.max(sf, axis=1)
+        positive = sf_max > 0
+        sf[positive] /= sf_max[positive, None]
+        return sf
+
+    def prepare_forward_batch(self, seeding_pos, random_generator):
+        """
+        Vectorized version of prepare_forward. See
+        AbstractPropagator.prepare_forward_batch for the parameters.
+        """
+        sf = self._get_sf_batch(seeding_pos)
+        sf[sf < self.sf_threshold_init] = 0
+
+        inds = sample_distribution_batch(sf, random_generator)
+        is_valid = inds >= 0
+        inds[~is_valid] = 0
+        return self.sphere.vertices[inds], inds, is_valid
+
+    def _sample_next_direction_batch(self, pos, v_in, v_in_idx,
+                                     random_generator):
+        """
+        Vectorized version of _sample_next_direction. See
+        AbstractPropagator._sample_next_direction_batch for the returned
+        values.
+        """
+        sf = self._get_sf_batch(pos)
+        sf[sf < self.sf_threshold] = 0
+
+        # Directions in the cone theta around v_in.
+        in_cone = self.tracking_neighbours[v_in_idx]
+
+        if self.algo == 'prob':
+            sf[~in_cone] = 0
+            inds = sample_distribution_batch(sf, random_generator)
+            is_valid = inds >= 0
+        elif self.algo == 'det':
+            # A direction is a maximum if its SF value is the biggest of its
+            # neighbourhood. Choosing the maximum the most aligned with v_in.
+            neighbours_max = sf.copy()
+            for k in range(self.maxima_neighbours_table.shape[1]):
+                np.maximum(neighbours_max,
+                           sf[:, self.maxima_neighbours_table[:, k]],
+                           out=neighbours_max)
+            is_maximum = (sf > 0) & (sf == neighbours_max) & in_cone
+
+            cosinus = np.dot(v_in, self.sphere.vertices.T)
+            cosinus[~is_maximum] = 0
+            inds = np.argmax(cosinus, axis=1)
+            is_valid = cosinus[np.arange(len(inds)), inds] > 0
+        else:
+            raise ValueError("Tracking choice must be one of 'det' or 'prob'.")
+
+        inds[~is_valid] = 0
+        return self.sphere.vertices[inds], inds, is_valid
+
     def prepare_forward(self, seeding_pos, random_generator):
         """
         Prepare information necessary at the first point of the
@@ -256,8 +256,9 @@ class SeedGenerator:
         # (by producing rand numbers without using them) until reaching this
         # process (i.e this chunk)'s set of random numbers. Producing only
         # 100000 at the time to prevent RAM overuse.
-        # (Multiplying by 3 for x,y,z)
-        random_numbers_to_skip = numbers_to_skip * 3
+        # (Multiplying by 3 for x,y,z. Repeated seeds share their position.)
+        random_numbers_to_skip = \
+            int(np.ceil(numbers_to_skip / self.n_repeats)) * 3
         # toDo: see if 100000 is ok, and if we can create something not
         #  hard-coded
         while random_numbers_to_skip > 100000:
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dipy.io.stateful_tractogram import Origin, Space
+
+from scilpy.tests.tracking import get_tracker
+from scilpy.tracking.propagation_kernel import ODFPropagationKernel
+
+
+def _get_tracker(algo, rk_order, interpolation, precompute_sf, space,
+                 origin, use_native_kernel):
+    return get_tracker(algo, rk_order, interpolation, space, origin,
+                       precompute_sf=precompute_sf,
+                       use_native_kernel=use_native_kernel)
+
+
+def test_native_kernel_same_as_python():
+    for algo, rk_order, interpolation, precompute_sf, space, origin in [
+            ('det', 1, 'trilinear', False, Space.VOX, Origin('center')),
+            ('det', 4, 'nearest', True, Space.VOXMM, Origin('corner')),
+            ('prob', 1, 'nearest', False, Space.VOXMM, Origin('center')),
+            ('prob', 2, 'trilinear', True, Space.VOX, Origin('corner'))]:
+        lines, _ = _get_tracker(algo, rk_order, interpolation,
+                                precompute_sf, space, origin, False).track()
+        native_lines, _ = _get_tracker(algo, rk_order, interpolation,
+                                       precompute_sf, space, origin,
+                                       True).track()
+
+        assert len(lines) == len(native_lines)
+        assert np.any([len(line) > 2 for line in lines])
+        for line, native_line in zip(lines, native_lines):
+            assert np.array_equal(line, native_line)
+
+
+def test_native_kernel_threads():
+    tracker = _get_tracker('prob', 1, 'trilinear', False, Space.VOX,
+                           Origin('center'), True)
+    kernel = ODFPropagationKernel(tracker.propagator, tracker.mask,
+                                  tracker.max_nbr_pts,
+                                  tracker.max_invalid_dirs,
+                                  tracker.append_last_point)
+    seed = (4., 4., 4.)
+
+    def _track(rng_seed):
+        rng = np.random.default_rng(rng_seed)
+        line = np.zeros((tracker.max_nbr_pts, 3))
+        line[0] = seed
+        v_in = tracker.propagator.prepare_forward(seed, rng)
+        nb_pts = kernel.propagate_line(line, 1, v_in, rng)
+        return line[:nb_pts]
+
+    expected = [_track(i) for i in range(8)]
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(_track, range(8)))
+    for line, expected_line in zip(results, expected):
+        assert np.array_equal(line, expected_line)
@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pytest
+
+from scilpy.tests.tracking import get_tracker
+from scilpy.tracking.utils import TrackingDirection
 
 
 def test_class_propagator():
@@ -8,3 +15,50 @@ def test_class_propagator():
     intented for developping and testing new parameters.
     """
     pass
+
+
+def test_propagate_batch():
+    # Deterministic tracking: propagate_batch must give the same step, and
+    # the same direction index, as propagate.
+    rng = np.random.default_rng(0)
+    pos = rng.uniform(1, 6, (200, 3))
+    inds = rng.integers(0, 100, 200)
+    for rk_order in [1, 2, 4]:
+        for interpolation in ['trilinear', 'nearest']:
+            propagator = get_tracker('det', rk_order, interpolation).propagator
+            vertices = propagator.sphere.vertices
+            new_pos, new_dirs, new_inds, is_valid = \
+                propagator.propagate_batch(pos, vertices[inds], inds, rng)
+
+            for i in range(len(pos)):
+                expected_pos, expected_dir, expected_valid = \
+                    propagator.propagate(
+                        [pos[i]], TrackingDirection(vertices[inds[i]],
+                                                    inds[i]))
+                assert np.allclose(new_pos[i], expected_pos)
+                assert np.allclose(new_dirs[i], expected_dir)
+                assert new_inds[i] == expected_dir.index
+                assert is_valid[i] == expected_valid
+
+
+def test_precompute_sf(tmp_path):
+    propagator = get_tracker().propagator
+    expected = np.dot(propagator.datavolume.data, propagator.B)
+
+    sf = get_tracker(precompute_sf=True).propagator.datavolume.data
+    assert sf.dtype == np.float32
+    assert np.allclose(sf, expected, rtol=1e-5, atol=1e-6)
+
+    # Cached: same values, saved once, then loaded.
+    for _ in range(2):
+        cached = get_tracker(sf_cache_dir=str(tmp_path),
+                             sf_cache_key='sh').propagator.datavolume.data
+        assert isinstance(cached, np.memmap)
+        assert np.array_equal(cached, sf)
+        assert len(os.listdir(tmp_path)) == 1
+
+    # The key identifies the data.
+    get_tracker(sf_cache_dir=str(tmp_path), sf_cache_key='other_sh')
+    assert len(os.listdir(tmp_path)) == 2
+    with pytest.raises(ValueError):
+        get_tracker(sf_cache_dir=str(tmp_path))
@@ -43,3 +43,25 @@ def test_seed_generation():
     assert np.array_equal(np.floor(seeds[0]), [1, 1, 1])
     assert np.array_equal(np.floor(seeds[3]), [4, 3, 2])
 
+
+def test_seed_generation_skip():
+    # Chunks start on a multiple of n_repeats. Skipping seeds must give the
+    # same seeds as generating them all from the start.
+    mask = np.zeros((5, 5, 5))
+    mask[1:4, 1:3, 2:4] = 1
+    for n_repeats in [1, 3]:
+        generator = SeedGenerator(mask, voxres=[1, 1, 1], space=Space('vox'),
+                                  origin=Origin('corner'),
+                                  n_repeats=n_repeats)
+        rng_generator, shuffled_indices = generator.init_generator(
+            rng_seed=1, numbers_to_skip=0)
+        expected = [generator.get_next_pos(rng_generator, shuffled_indices, i)
+                    for i in range(12)]
+
+        for skip in range(0, 12, n_repeats):
+            rng_generator, shuffled_indices = generator.init_generator(
+                rng_seed=1, numbers_to_skip=skip)
+            seeds = [generator.get_next_pos(rng_generator, shuffled_indices,
+                                            i)
+                     for i in range(skip, 12)]
+            assert np.allclose(seeds, expected[skip:])
@@ -1,4 +1,10 @@
 # -*- coding: utf-8 -*-
+import numpy as np
+
+from scilpy.tests.tracking import assert_same_streamlines, get_tracker
+from scilpy.tracking import propagator
+from scilpy.tracking.utils import (sample_distribution,
+                                   sample_distribution_batch)
 
 
 def test_class_tracker():
@@ -8,3 +14,87 @@ def test_class_tracker():
     intented for developping and testing new parameters.
     """
     pass
+
+
+class _FixedGenerator(object):
+    """Replaces the random generators: always draws the same value."""
+    def random(self, size=None):
+        return 0.4 if size is None else np.full(size, 0.4)
+
+
+def _use_fixed_sampling(monkeypatch):
+    # The batched mode uses one random generator per batch instead of one
+    # per streamline: with random samplings, streamlines differ from the
+    # one-by-one mode.
+    monkeypatch.setattr(propagator, 'sample_distribution',
+                        lambda dist, _: sample_distribution(
+                            dist, _FixedGenerator()))
+    monkeypatch.setattr(propagator, 'sample_distribution_batch',
+                        lambda dists, _: sample_distribution_batch(
+                            dists, _FixedGenerator()))
+
+
+def test_batched_tracking(monkeypatch):
+    _use_fixed_sampling(monkeypatch)
+    for algo, rk_order, interpolation in [('det', 1, 'trilinear'),
+                                          ('det', 2, 'trilinear'),
+                                          ('det', 4, 'nearest'),
+                                          ('det', 4, 'trilinear'),
+                                          ('prob', 1, 'nearest')]:
+        streamlines, seeds = get_tracker(algo, rk_order, interpolation,
+                                         save_seeds=True).track()
+        batched_streamlines, batched_seeds = get_tracker(
+            algo, rk_order, interpolation, save_seeds=True,
+            batch_size=5).track()
+
+        assert np.any([len(s) > 2 for s in streamlines])
+        assert_same_streamlines(batched_streamlines, streamlines)
+        assert np.allclose(batched_seeds, seeds)
+
+
+def test_tracking_shared_memory():
+    streamlines, seeds = get_tracker('prob', save_seeds=True).track()
+    for use_shared_memory in [False, True]:
+        for batch_size in [None, 5]:
+            if batch_size is None:
+                expected = streamlines
+            else:
+                expected, _ = get_tracker('prob',
+                                          batch_size=batch_size).track()
+
+            new_streamlines, new_seeds = get_tracker(
+                'prob', nbr_processes=2, use_shared_memory=use_shared_memory,
+                batch_size=batch_size, save_seeds=True).track()
+            assert_same_streamlines(new_streamlines, expected)
+            assert np.allclose(new_seeds, seeds)
+
+
+def test_tracking_chunks():
+    # Chunks skip the seeds of the previous chunks. They must give the same
+    # seeds and streamlines as the static path, with repeated seeds too.
+    for n_repeats in [1, 3]:
+        streamlines, seeds = get_tracker(
+            'prob', n_repeats=n_repeats, save_seeds=True).track()
+        for nbr_seeds_per_chunk in [1, 4, 7]:
+            tracker = get_tracker('prob', n_repeats=n_repeats,
+                                  nbr_processes=2, save_seeds=True,
+                                  nbr_seeds_per_chunk=nbr_seeds_per_chunk)
+            new_streamlines, new_seeds = tracker.track()
+            assert_same_streamlines(new_streamlines, streamlines)
+            assert np.allclose(new_seeds, seeds)
+
+
+def test_track_generator():
+    streamlines, seeds = get_tracker('prob', save_seeds=True).track()
+    for nbr_processes in [1, 2]:
+        items = list(get_tracker(
+            'prob', nbr_processes=nbr_processes,
+            save_seeds=True).track_generator(nbr_seeds_per_chunk=3))
+
+        # With multiprocessing, chunks are yielded in any order.
+        order = np.lexsort(np.asarray([seed for _, seed in items]).T)
+        expected_order = np.lexsort(np.asarray(seeds).T)
+        assert_same_streamlines([items[i][0] for i in order],
+                                [streamlines[i] for i in expected_order])
+        assert np.allclose([items[i][1] for i in order],
+                           np.asarray(seeds)[expected_order])
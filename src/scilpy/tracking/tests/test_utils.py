@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+from dipy.io.streamline import load_tractogram
+from nibabel.streamlines import TckFile, TrkFile
+
+from scilpy.tests.tracking import assert_same_streamlines, get_tracker
+from scilpy.tracking.utils import save_tractogram
+
+
+def test_save_tractogram():
+    tracker = get_tracker('prob', save_seeds=True)
+    streamlines, seeds = tracker.track()
+    ref_img = nib.Nifti1Image(np.zeros((8, 9, 7), dtype=np.uint8),
+                              np.diag([2., 2., 2., 1.]))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for tracts_format, extension in [(TrkFile, 'trk'), (TckFile, 'tck')]:
+            filenames = []
+            # A list, a one-shot iterator and the tracker's generator: all
+            # streamlines are saved once.
+            for i, items in enumerate([
+                    list(zip(streamlines, seeds)),
+                    iter(list(zip(streamlines, seeds))),
+                    tracker.track_generator(nbr_seeds_per_chunk=3)]):
+                filenames.append(os.path.join(
+                    tmp_dir, 'tractogram_{}.{}'.format(i, extension)))
+                save_tractogram(items, tracts_format, ref_img, len(seeds),
+                                filenames[-1], 0, np.inf, None,
+                                extension == 'trk', False)
+
+            for filename in filenames:
+                sft = load_tractogram(filename, ref_img)
+                sft.to_vox()
+                sft.to_center()
+                assert_same_streamlines(sft.streamlines, streamlines)
+                if extension == 'trk':
+                    assert np.allclose(sft.data_per_streamline['seeds'],
+                                       seeds)
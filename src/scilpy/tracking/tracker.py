@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import nullcontext
 import itertools
 import logging
@@ -6,6 +8,7 @@ import multiprocessing
 import os
 import sys
 from tempfile import TemporaryDirectory
+import time
 import traceback
 from typing import Union
 from tqdm import tqdm
@@ -17,10 +20,15 @@ from dipy.reconst.shm import sh_to_sf_matrix
 from dipy.tracking.streamlinespeed import compress_streamlines
 
 from scilpy.image.volume_space_management import DataVolume
-from scilpy.tracking.propagator import AbstractPropagator, PropagationStatus
+from scilpy.tracking.propagation_kernel import ODFPropagationKernel
+from scilpy.tracking.propagator import (AbstractPropagator, ODFPropagator,
+                                        PropagationStatus)
 from scilpy.reconst.utils import find_order_from_nb_coeff
 from scilpy.tracking.seed import SeedGenerator
-from scilpy.gpuparallel.opencl_utils import CLKernel, CLManager, have_opencl
+from scilpy.gpuparallel.opencl_utils import (BatchSizeTuner, CLKernel,
+                                             CLManager, get_cl_devices,
+                                             have_opencl)
+from scilpy.utils.shared_memory import SharedMemoryArray
 
 # For the multi-processing:
 # Dictionary. Will contain all parameters necessary for a sub-process
@@ -35,7 +43,9 @@ class Tracker(object):
                  nbr_processes=1, save_seeds=False,
                  mmap_mode: Union[str, None] = None, rng_seed=1234,
                  track_forward_only=False, skip=0, verbose=False,
-                 min_iter=100, append_last_point=True, rap=None):
+                 min_iter=100, append_last_point=True, rap=None,
+                 batch_size=None, use_shared_memory=False,
+                 nbr_seeds_per_chunk=None, use_native_kernel=False):
         """
         Parameters
         ----------
@@ -66,6 +76,9 @@ class Tracker(object):
         mmap_mode: str
             Memory-mapping mode. One of {None, 'r+', 'c'}. This value is passed
             to np.load() when loading the raw tracking data from a subprocess.
+            Ignored if use_shared_memory, or if the data is already
+            memory-mapped from a .npy file (it is then reloaded in
+            copy-on-write mode).
         rng_seed: int
             The random "seed" for the random generator.
         track_forward_only: bool
@@ -89,6 +102,32 @@ class Tracker(object):
             added.
         rap: RAP object
             Intantiated RAP object.
+        batch_size: int or None
+            If set, use the batched tracking mode: streamlines are propagated
+            batch_size at the time, as arrays, instead of one by one. Requires
+            a propagator implementing the batch methods (ex, ODFPropagator)
+            and cannot be used with RAP. Seeds are the same as in the
+            one-by-one mode, but one random generator is used per batch: with
+            random samplings (ex, probabilistic tracking), streamlines differ
+            from the one-by-one mode. Reproducible for a given rng_seed.
+        use_shared_memory: bool
+            With multiprocessing, share the tracking data with the
+            sub-processes through shared memory instead of saving it to a
+            temporary file reloaded by each sub-process.
+        nbr_seeds_per_chunk: int or None
+            With multiprocessing, seeds are split into chunks of (about)
+            nbr_seeds_per_chunk seeds, handed to the sub-processes as soon as
+            they are free. Smaller chunks balance the work better between
+            processes. With a SeedGenerator, results do not depend on this
+            value, nor on the number of processes. Default: about 8 chunks
+            per process.
+        use_native_kernel: bool
+            If set, streamlines are propagated with the compiled kernel
+            (scilpy.tracking.propagation_kernel) instead of the Python
+            propagation loop. Results are the same. Requires an ODFPropagator
+            working in vox or voxmm space, writeable float64 data and mask
+            with an interpolation method, and cannot be used with RAP or with
+            batch_size.
         """
         self.propagator = propagator
         self.rap = rap
@@ -105,6 +144,10 @@ class Tracker(object):
         self.track_forward_only = track_forward_only
         self.append_last_point = append_last_point
         self.skip = skip
+        self.batch_size = batch_size
+        self.use_shared_memory = use_shared_memory
+        self.nbr_seeds_per_chunk = nbr_seeds_per_chunk
+        self.use_native_kernel = use_native_kernel
 
         self.origin = self.propagator.origin
         self.space = self.propagator.space
@@ -127,6 +170,29 @@ class Tracker(object):
                             "None.".format(self.mmap_mode))
             self.mmap_mode = None
 
+        if self.nbr_seeds_per_chunk is not None and \
+                self.nbr_seeds_per_chunk <= 0:
+            raise ValueError("Number of seeds per chunk must be > 0.")
+
+        if self.batch_size is not None:
+            if self.batch_size <= 0:
+                raise ValueError("Batch size must be > 0.")
+            if self.rap is not None:
+                raise ValueError("Batched tracking cannot be used with RAP.")
+            if not isinstance(self.propagator, ODFPropagator):
+                raise NotImplementedError(
+                    "Batched tracking is only available with the "
+                    "ODFPropagator.")
+
+        if self.use_native_kernel:
+            if self.rap is not None or self.batch_size is not None:
+                raise ValueError("The native kernel cannot be used with RAP "
+                                 "or with batched tracking.")
+            if not isinstance(self.propagator, ODFPropagator):
+                raise NotImplementedError(
+                    "The native kernel is only available with the "
+                    "ODFPropagator.")
+
         self.nbr_processes = self._set_nbr_processes(nbr_processes)
 
         self.printing_frequency = 1000
@@ -149,26 +215,163 @@ class Tracker(object):
             chunk_id = 0
             lines, seeds = self._get_streamlines(chunk_id)
         else:
-            # Each process will use get_streamlines_at_seeds
-            chunk_ids = np.arange(self.nbr_processes)
-            with TemporaryDirectory() as tmpdir:
-                # Lock for logging
-                lock = multiprocessing.Manager().Lock()
-                zipped_chunks = zip(chunk_ids, [lock] * self.nbr_processes)
-
-                pool = self._prepare_multiprocessing_pool(tmpdir)
-
-                lines_per_process, seeds_per_process = zip(*pool.map(
-                    self._get_streamlines_sub, zipped_chunks))
-                pool.close()
-                # Make sure all worker processes have exited before leaving
-                # context manager.
-                pool.join()
-                lines = [line for line in itertools.chain(*lines_per_process)]
-                seeds = [seed for seed in itertools.chain(*seeds_per_process)]
+            # Chunks finish in any order. Sorting them back to get the same
+            # output as with a single process.
+            lines_per_chunk = {}
+            seeds_per_chunk = {}
+            for chunk_id, chunk_lines, chunk_seeds in self._track_chunks(
+                    self.nbr_seeds_per_chunk):
+                lines_per_chunk[chunk_id] = chunk_lines
+                seeds_per_chunk[chunk_id] = chunk_seeds
+            chunk_ids = sorted(lines_per_chunk.keys())
+            lines = [line for line in itertools.chain(
+                *[lines_per_chunk[i] for i in chunk_ids])]
+            seeds = [seed for seed in itertools.chain(
+                *[seeds_per_chunk[i] for i in chunk_ids])]
 
         return lines, seeds
 
+    def track_generator(self, nbr_seeds_per_chunk=None):
+        """
+        Streaming version of track: seeds are split into chunks of
+        approximately nbr_seeds_per_chunk seeds, and the streamlines of each
+        chunk are yielded as soon as the chunk is finished (in any order with
+        multiprocessing). Memory usage thus depends on the chunk size rather
+        than on the total number of streamlines, and the output can be fed
+        directly to a lazy writer such as
+        scilpy.tracking.utils.save_tractogram.
+
+        Streamlines are the same as with track(), but their order may differ.
+
+        Parameters
+        ----------
+        nbr_seeds_per_chunk: int
+            Approximate number of seeds per chunk. Default:
+            self.nbr_seeds_per_chunk.
+
+        Yields
+        ------
+        streamline: numpy.array
+            A streamline, represented as an array of positions.
+        seed: numpy.array or None
+            The seeding position of the streamline, if self.save_seeds.
+        """
+        if nbr_seeds_per_chunk is None:
+            nbr_seeds_per_chunk = self.nbr_seeds_per_chunk
+
+        for _, lines, seeds in self._track_chunks(nbr_seeds_per_chunk):
+            yield from self._zip_streamlines_and_seeds(lines, seeds)
+
+    def _track_chunks(self, nbr_seeds_per_chunk):
+        """
+        Tracks all seeds, by chunks of seeds. With multiprocessing, chunks
+        are handed to the processes on demand, as soon as they are free: a
+        process tracking long streamlines in a dense region does not delay
+        the others. The time taken by each chunk is logged (debug level).
+
+        Parameters
+        ----------
+        nbr_seeds_per_chunk: int or None
+            Approximate number of seeds per chunk. See
+            self._get_nbr_seeds_per_chunk.
+
+        Yields
+        ------
+        chunk_id: int
+            The chunk's ID, in order of completion.
+        streamlines: list
+            The chunk's successful streamlines.
+        seeds: list
+            The chunk's seeds, if self.save_seeds. Else, an empty list.
+        """
+        nbr_seeds_per_chunk = self._get_nbr_seeds_per_chunk(
+            nbr_seeds_per_chunk)
+        nbr_chunks = int(np.ceil(self.nbr_seeds / nbr_seeds_per_chunk))
+        params = ((chunk_id, None, nbr_seeds_per_chunk, False)
+                  for chunk_id in range(nbr_chunks))
+        logging.info("Tracking {} chunks of up to {} seeds."
+                     .format(nbr_chunks, nbr_seeds_per_chunk))
+
+        # Progress is shown per chunk rather than per process.
+        p = None
+        if self.verbose:
+            p = tqdm(total=self.nbr_seeds, leave=False)
+
+        chunk_times = []
+        with TemporaryDirectory() as tmpdir:
+            if self.nbr_processes < 2:
+                pool, shared_data = None, None
+                results = map(self._get_streamlines_timed, params)
+            else:
+                pool, shared_data = self._prepare_multiprocessing_pool(tmpdir)
+                results = pool.imap_unordered(self._get_streamlines_sub,
+                                              params)
+            try:
+                for chunk_id, lines, seeds, duration in results:
+                    chunk_size = self._get_chunk(chunk_id,
+                                                 nbr_seeds_per_chunk)[1]
+                    chunk_times.append(duration)
+                    logging.debug("Chunk #{} ({} seeds): {} streamlines in "
+                                  "{:.2f} seconds.".format(
+                                      chunk_id, chunk_size, len(lines),
+                                      duration))
+                    if p is not None:
+                        p.update(chunk_size)
+                    yield chunk_id, lines, seeds
+                if pool is not None:
+                    pool.close()
+                    # Make sure all worker processes have exited before
+                    # leaving context manager.
+                    pool.join()
+            finally:
+                # On failure, or if the consumer stops iterating early:
+                # stopping the workers and releasing the shared memory.
+                if pool is not None:
+                    pool.terminate()
+                if shared_data is not None:
+                    shared_data.unlink()
+                if p is not None:
+                    p.close()
+
+        if len(chunk_times) > 0:
+            logging.info("Time per chunk: mean {:.2f}s, min {:.2f}s, max "
+                         "{:.2f}s.".format(np.mean(chunk_times),
+                                           np.min(chunk_times),
+                                           np.max(chunk_times)))
+
+    def _get_nbr_seeds_per_chunk(self, nbr_seeds_per_chunk=None):
+        """
+        Get the number of seeds per chunk, rounded up so that chunks start on
+        a new batch (in batched mode) and on a new seed position (when
+        seeds are repeated). This way, results do not depend on the chunks.
+
+        Parameters
+        ----------
+        nbr_seeds_per_chunk: int or None
+            Approximate number of seeds per chunk. If None, uses about 8
+            chunks per process.
+
+        Returns
+        -------
+        nbr_seeds_per_chunk: int
+        """
+        if nbr_seeds_per_chunk is None:
+            nbr_seeds_per_chunk = int(np.ceil(
+                self.nbr_seeds / (8 * self.nbr_processes)))
+        nbr_seeds_per_chunk = max(1, nbr_seeds_per_chunk)
+
+        multiple = np.lcm(self.batch_size or 1,
+                          getattr(self.seed_generator, 'n_repeats', 1))
+        return int(np.ceil(nbr_seeds_per_chunk / multiple) * multiple)
+
+    def _zip_streamlines_and_seeds(self, streamlines, seeds):
+        """
+        Yields (streamline, seed) pairs. Seed is None if not self.save_seeds.
+        """
+        if not self.save_seeds:
+            seeds = [None] * len(streamlines)
+        return zip(streamlines, seeds)
+
     def _set_nbr_processes(self, nbr_processes):
         """
         If user did not define the number of processes, define it automatically
@@ -199,11 +402,15 @@ class Tracker(object):
         ------
         tmpdir: str
             Path where to save temporarily the data. This will allow clearing
-            the data from memory. We will fetch it back later.
+            the data from memory. We will fetch it back later. Unused if
+            self.use_shared_memory.
 
         Returns
         -------
         pool: The multiprocessing pool.
+        shared_data: SharedMemoryArray or None
+            The shared memory holding the data, if self.use_shared_memory.
+            The caller is responsible for unlinking it once the pool is done.
         """
         # Using pool with a class method will serialize all parameters
         # in the class, which can be heavy, but it is what we would be
@@ -211,22 +418,43 @@ class Tracker(object):
         # Be careful however, parameter changes inside the method will
         # not be kept.
 
-        # Saving data. We will reload it in each process.
-        data_file_name = os.path.join(tmpdir, 'data.npy')
-        np.save(data_file_name, self.propagator.datavolume.data)
+        if self.use_shared_memory:
+            # Copying data to shared memory. Each process will attach to it.
+            shared_data = SharedMemoryArray.from_array(
+                np.asarray(self.propagator.datavolume.data))
+            init_args = {'shared_data_info': shared_data.get_info()}
+        elif isinstance(self.propagator.datavolume.data, np.memmap) and \
+                str(self.propagator.datavolume.data.filename).endswith(
+                    '.npy'):
+            # Data is already a file on disk (ex, precomputed SF). Each
+            # process will memory-map it, in copy-on-write mode to never
+            # modify it.
+            shared_data = None
+            init_args = {
+                'data_file_name': self.propagator.datavolume.data.filename,
+                'mmap_mode': 'c'}
+        else:
+            # Saving data. We will reload it in each process.
+            shared_data = None
+            data_file_name = os.path.join(tmpdir, 'data.npy')
+            np.save(data_file_name, self.propagator.datavolume.data)
+            init_args = {'data_file_name': data_file_name,
+                         'mmap_mode': self.mmap_mode}
 
         # Clear data from memory
         self.propagator.reset_data(new_data=None)
 
-        pool = multiprocessing.Pool(
-            self.nbr_processes,
-            initializer=self._send_multiprocess_args_to_global,
-            initargs=({
-                'data_file_name': data_file_name,
-                'mmap_mode': self.mmap_mode
-            },))
+        try:
+            pool = multiprocessing.Pool(
+                self.nbr_processes,
+                initializer=self._send_multiprocess_args_to_global,
+                initargs=(init_args,))
+        except BaseException:
+            if shared_data is not None:
+                shared_data.unlink()
+            raise
 
-        return pool
+        return pool, shared_data
 
     @staticmethod
     def _send_multiprocess_args_to_global(init_args):
@@ -240,60 +468,117 @@ class Tracker(object):
 
     def _get_streamlines_sub(self, params):
         """
-        multiprocessing.pool.map input function. Calls the main tracking
+        multiprocessing.pool input function. Calls the main tracking
         method (_get_streamlines) with correct initialization arguments
         (taken from the global variable multiprocess_init_args).
 
         Parameters
         ----------
-        params: Tuple[chunk_id, Lock]
-            chunk_id: int, this processes's id.
-            Lock: the multiprocessing lock.
+        params: Tuple[chunk_id, Lock, nbr_seeds_per_chunk, verbose]
+            See _get_streamlines_timed.
 
         Return
         -------
-        lines: list
-            List of list of 3D positions (streamlines).
+        See _get_streamlines_timed.
         """
-        chunk_id, lock = params
         global multiprocess_init_args
 
         self._reload_data_for_new_process(multiprocess_init_args)
         try:
-            streamlines, seeds = self._get_streamlines(chunk_id, lock)
-            return streamlines, seeds
+            return self._get_streamlines_timed(params)
         except Exception as e:
             logging.error("Operation _get_streamlines_sub() failed.")
             traceback.print_exception(*sys.exc_info(), file=sys.stderr)
             raise e
 
+    def _get_streamlines_timed(self, params):
+        """
+        Calls _get_streamlines and measures its duration.
+
+        Parameters
+        ----------
+        params: Tuple[chunk_id, Lock, nbr_seeds_per_chunk, verbose]
+            chunk_id: int, this chunk's id.
+            Lock: the multiprocessing lock, or None.
+            nbr_seeds_per_chunk: int, the number of seeds per chunk.
+            verbose: bool, whether to display this chunk's progression.
+
+        Return
+        -------
+        chunk_id: int
+            This chunk's id.
+        streamlines: list
+            List of list of 3D positions (streamlines).
+        seeds: list
+            The seeds of each streamline, if self.save_seeds.
+        duration: float
+            The time taken to track this chunk, in seconds.
+        """
+        chunk_id = params[0]
+        start = time.time()
+        streamlines, seeds = self._get_streamlines(*params)
+        return chunk_id, streamlines, seeds, time.time() - start
+
     def _reload_data_for_new_process(self, init_args):
         """
         Once process is started, load back data.
 
         Params
         ------
-        init_args: Iterable
-            Args necessary to reset data. In current implementation: a tuple;
-            (file where the data is saved, mmap_mode).
+        init_args: dict
+            Args necessary to reset data. In current implementation, either
+            the file where the data is saved and the mmap_mode, or the
+            information to attach to the shared memory.
+        """
+        if 'shared_data_info' in init_args:
+            # Attaching once per process. Keeping a reference to the shared
+            # memory for as long as the process lives.
+            if 'shared_data' not in init_args:
+                init_args['shared_data'] = SharedMemoryArray.attach(
+                    init_args['shared_data_info'])
+            self.propagator.reset_data(init_args['shared_data'].array)
+        else:
+            self.propagator.reset_data(np.load(
+                init_args['data_file_name'], mmap_mode=init_args['mmap_mode']))
+
+    def _get_chunk(self, chunk_id, nbr_seeds_per_chunk):
+        """
+        Get the range of seeds of a chunk: chunks all have
+        nbr_seeds_per_chunk seeds, except the last one, which gets the
+        remaining seeds.
+
+        Returns
+        -------
+        first_seed_of_chunk: int
+            Number of the first seed, including the skipped seeds.
+        chunk_size: int
+            Number of seeds in the chunk.
         """
-        self.propagator.reset_data(np.load(
-            init_args['data_file_name'], mmap_mode=init_args['mmap_mode']))
+        first_seed_of_chunk = chunk_id * nbr_seeds_per_chunk
+        chunk_size = min(nbr_seeds_per_chunk,
+                         self.nbr_seeds - first_seed_of_chunk)
+        return first_seed_of_chunk + self.skip, chunk_size
 
-    def _get_streamlines(self, chunk_id, lock=None):
+    def _get_streamlines(self, chunk_id, lock=None, nbr_seeds_per_chunk=None,
+                         verbose=None):
         """
-        Tracks the n streamlines associates with current process (identified by
-        chunk_id). The number n is the total number of seeds / the number of
-        processes. If asked by user, may compress the streamlines and save the
-        seeds.
+        Tracks the n streamlines associates with current chunk (identified by
+        chunk_id), where n is the number of seeds per chunk. By default, there
+        is only one chunk. If asked by user, may compress the streamlines and
+        save the seeds.
 
         Parameters
         ----------
         chunk_id: int
-            This process ID.
+            This chunk's ID.
         lock: Lock
             The multiprocessing lock for verbose printing (optional with
             single processing).
+        nbr_seeds_per_chunk: int
+            Number of seeds per chunk. Default: all seeds.
+        verbose: bool
+            Whether to display this chunk's progression. Default:
+            self.verbose.
 
         Returns
         -------
@@ -303,22 +588,38 @@ class Tracker(object):
             The list of seeds for each streamline, if self.save_seeds. Else, an
             empty list.
         """
+        if nbr_seeds_per_chunk is None:
+            nbr_seeds_per_chunk = self.nbr_seeds
+        if verbose is None:
+            verbose = self.verbose
+
+        if self.batch_size is not None:
+            return self._get_streamlines_batched(chunk_id, lock,
+                                                 nbr_seeds_per_chunk, verbose)
+
         streamlines = []
         seeds = []
 
+        # Created here rather than at initialization: it must refer to the
+        # data reloaded in this process.
+        kernel = None
+        if self.use_native_kernel:
+            kernel = ODFPropagationKernel(self.propagator, self.mask,
+                                          self.max_nbr_pts,
+                                          self.max_invalid_dirs,
+                                          self.append_last_point)
+
         # Initialize the random number generator to cover multiprocessing,
         # skip, which voxel to seed and the subvoxel random position
-        chunk_size = int(self.nbr_seeds / self.nbr_processes)
-        first_seed_of_chunk = chunk_id * chunk_size + self.skip
+        first_seed_of_chunk, chunk_size = self._get_chunk(
+            chunk_id, nbr_seeds_per_chunk)
         random_generator, indices = self.seed_generator.init_generator(
             self.rng_seed, first_seed_of_chunk)
-        if chunk_id == self.nbr_processes - 1:
-            chunk_size += self.nbr_seeds % self.nbr_processes
 
         # Getting streamlines
         tqdm_text = "#" + "{}".format(chunk_id).zfill(3)
 
-        if self.verbose:
+        if verbose:
             if lock is None:
                 lock = nullcontext()
             with lock:
@@ -334,30 +635,23 @@ class Tracker(object):
             # based on the (real) seed position. However, in the case where we
             # like to have exactly the same seed more than once, this will lead
             # to exactly the same line, even in probabilistic tracking.
-            # Changing to seed position + seed number.
-            # Then in the case of multiprocessing, adding also a fraction based
-            # on current process ID.
-            eps = s + chunk_id / (self.nbr_processes + 1)
+            # Changing to seed position + seed number. The seed number does
+            # not depend on the chunk: results are the same whatever the
+            # chunks and the number of processes.
+            eps = first_seed_of_chunk - self.skip + s
             line_generator = np.random.default_rng(
                 np.abs(hash((seed + (eps, eps, eps), self.rng_seed))))
 
             # Forward and backward tracking
-            line = self._get_line_both_directions(seed, line_generator)
+            if kernel is not None:
+                line = self._get_line_both_directions_native(
+                    seed, line_generator, kernel)
+            else:
+                line = self._get_line_both_directions(seed, line_generator)
 
             if line is not None:
-                streamline = np.array(line, dtype='float32')
-
-                if self.compression_th is not None:
-                    # Compressing. Threshold is in mm. Verifying space.
-                    if self.space == Space.VOX:
-                        # Equivalent of sft.to_voxmm:
-                        streamline *= self.seed_generator.voxres
-                        compress_streamlines(streamline, self.compression_th)
-                        # Equivalent of sft.to_vox:
-                        streamline /= self.seed_generator.voxres
-                    else:
-                        compress_streamlines(streamline, self.compression_th)
-
+                streamline = self._compress_streamline(
+                    np.array(line, dtype='float32'))
                 streamlines.append(streamline)
 
                 if self.save_seeds:
@@ -367,15 +661,220 @@ class Tracker(object):
             # Will verify manually, lower.
             # Fixed choice of value rather than a percentage of the chunk
             # size because our tracker is quite slow.
-            if self.verbose and (s + 1) % self.min_iter == 0:
+            if verbose and (s + 1) % self.min_iter == 0:
                 with lock:
                     p.update(self.min_iter)
 
-        if self.verbose:
+        if verbose:
+            with lock:
+                p.close()
+        return streamlines, seeds
+
+    def _get_streamlines_batched(self, chunk_id, lock, nbr_seeds_per_chunk,
+                                 verbose):
+        """
+        Batched version of _get_streamlines: tracks the n streamlines
+        associated with current process (identified by chunk_id),
+        self.batch_size at the time. All streamlines of a batch are advanced
+        together, one step per iteration, as arrays. Streamlines are retired
+        from the batch as soon as they meet a stopping criterion.
+
+        Seeds are the same as in the one-by-one mode, but one random generator
+        is used per batch (instead of one per streamline).
+
+        Parameters and returned values are as in _get_streamlines.
+        """
+        streamlines = []
+        seeds = []
+
+        first_seed_of_chunk, chunk_size = self._get_chunk(
+            chunk_id, nbr_seeds_per_chunk)
+        random_generator, indices = self.seed_generator.init_generator(
+            self.rng_seed, first_seed_of_chunk)
+
+        tqdm_text = "#" + "{}".format(chunk_id).zfill(3)
+        if verbose:
+            if lock is None:
+                lock = nullcontext()
+            with lock:
+                p = tqdm(total=chunk_size, desc=tqdm_text, position=chunk_id+1,
+                         leave=False)
+
+        for start in range(0, chunk_size, self.batch_size):
+            n = min(self.batch_size, chunk_size - start)
+            first_seed_of_batch = first_seed_of_chunk + start
+            # Same seeds as in the one-by-one mode.
+            batch_seeds = np.asarray(
+                [self.seed_generator.get_next_pos(random_generator, indices,
+                                                  first_seed_of_batch + s)
+                 for s in range(n)], dtype=np.float64).reshape((n, 3))
+
+            # One generator per batch, depending on the position of the batch
+            # rather than on the chunk, for reproducibility. Chunks always
+            # start on a new batch (see _get_nbr_seeds_per_chunk).
+            line_generator = np.random.default_rng(
+                np.abs(hash((first_seed_of_batch, self.rng_seed))))
+
+            lines = self._get_lines_both_directions_batch(batch_seeds,
+                                                          line_generator)
+            for line, seed in zip(lines, batch_seeds):
+                if line is not None:
+                    streamlines.append(self._compress_streamline(line))
+                    if self.save_seeds:
+                        seeds.append(np.asarray(seed, dtype='float32'))
+
+            if verbose:
+                with lock:
+                    p.update(n)
+
+        if verbose:
             with lock:
                 p.close()
         return streamlines, seeds
 
+    def _compress_streamline(self, streamline):
+        """
+        Compresses the streamline (in-place) if self.compression_th is set.
+        """
+        if self.compression_th is not None:
+            # Compressing. Threshold is in mm. Verifying space.
+            if self.space == Space.VOX:
+                # Equivalent of sft.to_voxmm:
+                streamline *= self.seed_generator.voxres
+                compress_streamlines(streamline, self.compression_th)
+                # Equivalent of sft.to_vox:
+                streamline /= self.seed_generator.voxres
+            else:
+                compress_streamlines(streamline, self.compression_th)
+        return streamline
+
+    def _get_lines_both_directions_batch(self, seeding_pos, line_generator):
+        """
+        Batched version of _get_line_both_directions.
+
+        Parameters
+        ----------
+        seeding_pos : ndarray (N, 3)
+            The seed positions.
+        line_generator: numpy Generator
+            Random generator shared by all streamlines of the batch.
+
+        Returns
+        -------
+        lines: list
+            The generated streamlines (ndarrays of float32), or None where
+            the streamline was rejected.
+        """
+        nb_lines = len(seeding_pos)
+
+        # Forward
+        forward_dirs, forward_idx, is_valid = \
+            self.propagator.prepare_forward_batch(seeding_pos, line_generator)
+        forward, nb_forward = self._propagate_lines_batch(
+            seeding_pos, forward_dirs, forward_idx, is_valid,
+            np.zeros(nb_lines, dtype=int), line_generator)
+
+        # Backward
+        if not self.track_forward_only:
+            # Equivalent of line[-1] - line[-2] on the reversed line.
+            first_steps = np.full((nb_lines, 3), np.nan)
+            has_step = nb_forward > 1
+            first_steps[has_step] = seeding_pos[has_step] - \
+                forward[has_step, 1]
+            backward_dirs, backward_idx = \
+                self.propagator.prepare_backward_batch(first_steps,
+                                                       forward_dirs)
+            backward, nb_backward = self._propagate_lines_batch(
+                seeding_pos, backward_dirs, backward_idx, is_valid,
+                nb_forward - 1, line_generator)
+
+        lines = [None] * nb_lines
+        for i in np.flatnonzero(is_valid):
+            if self.track_forward_only:
+                line = forward[i, :nb_forward[i]]
+            else:
+                line = np.concatenate((forward[i, :nb_forward[i]][::-1],
+                                       backward[i, 1:nb_backward[i]]))
+
+            # Clean streamline
+            if self.min_nbr_pts <= len(line) <= self.max_nbr_pts:
+                lines[i] = line.astype(np.float32)
+        return lines
+
+    def _propagate_lines_batch(self, seeding_pos, dirs, dirs_idx, is_valid,
+                               nb_previous_pts, line_generator):
+        """
+        Batched version of _propagate_line: propagates N streamlines in one
+        direction, starting from their seed.
+
+        Parameters
+        ----------
+        seeding_pos: ndarray (N, 3)
+            The seed positions.
+        dirs: ndarray (N, 3)
+            Initial directions.
+        dirs_idx: ndarray (N,)
+            Indices of the initial directions on the propagator's sphere.
+        is_valid: ndarray (N,)
+            Streamlines to propagate. Others are left with their seed only.
+        nb_previous_pts: ndarray (N,)
+            Number of points already tracked in the other direction (excluding
+            the seed). Used to respect self.max_nbr_pts.
+        line_generator: numpy Generator
+            Random generator shared by all streamlines of the batch.
+
+        Returns
+        -------
+        lines: ndarray (N, self.max_nbr_pts, 3)
+            The propagated lines (float64, as in _propagate_line), starting
+            with their seed, padded with zeros.
+        nb_pts: ndarray (N,)
+            The number of points of each line.
+        """
+        nb_lines = len(seeding_pos)
+        lines = np.zeros((nb_lines, self.max_nbr_pts, 3))
+        lines[:, 0] = seeding_pos
+        nb_pts = np.ones(nb_lines, dtype=int)
+
+        pos = np.array(seeding_pos, dtype=np.float64)
+        dirs = np.array(dirs, dtype=np.float64)
+        dirs_idx = np.array(dirs_idx)
+        invalid_direction_count = np.zeros(nb_lines, dtype=int)
+        active = np.array(is_valid, dtype=bool)
+
+        while True:
+            active &= nb_previous_pts + nb_pts < self.max_nbr_pts
+            ids = np.flatnonzero(active)
+            if len(ids) == 0:
+                break
+
+            new_pos, new_dirs, new_dirs_idx, is_direction_valid = \
+                self.propagator.propagate_batch(pos[ids], dirs[ids],
+                                                dirs_idx[ids], line_generator)
+
+            # Verifying if direction is valid
+            invalid_direction_count[ids] = np.where(
+                is_direction_valid, 0, invalid_direction_count[ids] + 1)
+            is_broken = invalid_direction_count[ids] > self.max_invalid_dirs
+
+            can_continue = ~is_broken & \
+                self._verify_stopping_criteria_batch(new_pos)
+            if self.append_last_point:
+                is_appended = ~is_broken
+            else:
+                is_appended = can_continue
+
+            appended = ids[is_appended]
+            lines[appended, nb_pts[appended]] = new_pos[is_appended]
+            nb_pts[appended] += 1
+
+            pos[ids] = new_pos
+            dirs[ids] = new_dirs
+            dirs_idx[ids] = new_dirs_idx
+            active[ids] = can_continue
+
+        return lines, nb_pts
+
     def _get_line_both_directions(self, seeding_pos, line_generator):
         """
         Generate a streamline from an initial position following the tracking
@@ -414,6 +913,50 @@ class Tracker(object):
             return line
         return None
 
+    def _get_line_both_directions_native(self, seeding_pos, line_generator,
+                                         kernel):
+        """
+        Same as _get_line_both_directions, but the propagation is done by the
+        compiled kernel.
+
+        Parameters
+        ----------
+        seeding_pos : tuple
+            3D position, the seed position.
+        line_generator: numpy Generator
+            The streamline's random generator.
+        kernel: ODFPropagationKernel
+            The kernel, created for self.propagator and self.mask.
+
+        Returns
+        -------
+        line: ndarray (N, 3)
+            The generated streamline for seeding_pos.
+        """
+        line = np.zeros((self.max_nbr_pts, 3), dtype=np.float64)
+        line[0] = seeding_pos
+
+        # Forward
+        tracking_info = self.propagator.prepare_forward(seeding_pos,
+                                                        line_generator)
+        if tracking_info == PropagationStatus.ERROR:
+            # No good tracking direction can be found at seeding position.
+            return None
+        nb_pts = kernel.propagate_line(line, 1, tracking_info, line_generator)
+
+        # Backward
+        if not self.track_forward_only:
+            line[:nb_pts] = line[:nb_pts][::-1].copy()
+            tracking_info = self.propagator.prepare_backward(line[:nb_pts],
+                                                             tracking_info)
+            nb_pts = kernel.propagate_line(line, nb_pts, tracking_info,
+                                           line_generator)
+
+        # Clean streamline
+        if self.min_nbr_pts <= nb_pts <= self.max_nbr_pts:
+            return line[:nb_pts]
+        return None
+
     def _propagate_line(self, line, previous_dir):
         """
         Generate a streamline in forward or backward direction from an initial
@@ -496,6 +1039,26 @@ class Tracker(object):
 
         return True
 
+    def _verify_stopping_criteria_batch(self, last_pos):
+        """
+        Vectorized version of _verify_stopping_criteria.
+
+        Parameters
+        ----------
+        last_pos: ndarray (N, 3)
+            Last positions of N streamlines.
+
+        Returns
+        -------
+        can_continue: ndarray (N,)
+            False where the position is out of bound or out of the mask.
+        """
+        can_continue = self.mask.are_coordinates_in_bound(
+            last_pos, space=self.space, origin=self.origin)
+        can_continue[can_continue] = self.mask.get_value_at_coordinates(
+            last_pos[can_continue], space=self.space, origin=self.origin) > 0
+        return can_continue
+
 
 class GPUTacker():
     """
@@ -508,6 +1071,12 @@ class GPUTacker():
     interpolated using nearest neighbor interpolation. No backward tracking is
     performed.
 
+    The OpenCL kernel can also run on the CPU, given an OpenCL CPU driver (ex,
+    POCL). Seeds are split into batches, handed to all the available devices
+    of the chosen type as soon as they are free. Since the random values of
+    each seed do not depend on the batches, the streamlines do not depend on
+    the batch size nor on the number of devices.
+
     Parameters
     ----------
     sh : ndarray
@@ -528,18 +1097,29 @@ class GPUTacker():
     is_legacy : bool, optional
         Whether or not the SH basis is in its legacy form.
     batch_size : int, optional
-        Approximate size of GPU batches.
+        Size of GPU batches. If autotune_batch_size, initial size of the
+        batches.
     forward_only: bool, optional
         If True, only forward tracking is performed.
     rng_seed : int, optional
         Seed for random number generator.
     sphere : int, optional
         Sphere to use for the tracking.
+    device_type : str, optional
+        Type of OpenCL devices to use. One of 'gpu', 'cpu'.
+    nbr_devices : int, optional
+        Maximal number of devices to use. Default: all devices of type
+        device_type.
+    autotune_batch_size : bool, optional
+        If True, the batch size is adapted for each device, starting from
+        batch_size, to maximize the number of streamlines per second.
     """
     def __init__(self, sh, mask, seeds, step_size, max_nbr_pts,
                  theta=20.0, sf_threshold=0.1, sh_interp='trilinear',
                  sh_basis='descoteaux07', is_legacy=True, batch_size=100000,
-                 forward_only=False, rng_seed=None, sphere=None):
+                 forward_only=False, rng_seed=None, sphere=None,
+                 device_type='gpu', nbr_devices=None,
+                 autotune_batch_size=False):
         if not have_opencl:
             raise ImportError('pyopencl is not installed. In order to use'
                               'GPU tracker, you need to install it first.')
@@ -551,9 +1131,21 @@ class GPUTacker():
         self.mask = mask
 
         self.n_seeds = len(seeds)
-
-        self.seed_batches =\
-            np.array_split(seeds + 0.5, np.ceil(len(seeds)/batch_size))
+        self.seeds = seeds
+        self.batch_size = batch_size
+        self.autotune_batch_size = autotune_batch_size
+
+        if device_type not in ['cpu', 'gpu']:
+            raise ValueError('Invalid device type {}. Must be cpu or gpu'
+                             .format(device_type))
+        self.devices = get_cl_devices(device_type)
+        if len(self.devices) == 0:
+            raise ValueError('No OpenCL device of type {} found.'
+                             .format(device_type))
+        if nbr_devices is not None:
+            self.devices = self.devices[:nbr_devices]
+        logging.info('Tracking on {} OpenCL device(s): {}'.format(
+            len(self.devices), ', '.join([d.name for d in self.devices])))
 
         if sphere is None:
             self.sphere = get_sphere(name="repulsion724")
@@ -572,8 +1164,9 @@ class GPUTacker():
         self.is_legacy = is_legacy
         self.forward_only = forward_only
 
-        # Instantiate random number generator
-        self.rng = np.random.default_rng(rng_seed)
+        # The random number generator is instantiated for each iteration,
+        # so that iterating twice yields the same streamlines.
+        self.rng_seed = rng_seed
 
     def _get_max_amplitudes(self, B_mat):
         fodf_max = np.zeros(self.mask.shape,
@@ -586,10 +1179,10 @@ class GPUTacker():
     def __iter__(self):
         return self._track()
 
-    def _track(self):
+    def _get_cl_manager(self, device, B_mat, fodf_max):
         """
-        GPU streamlines generator yielding streamlines with corresponding
-        seed positions one by one.
+        Creates the CL program for a device, with its constant input
+        buffers.
         """
         # Convert theta to cos(theta)
         max_cos_theta = np.cos(np.deg2rad(self.theta))
@@ -614,19 +1207,13 @@ class GPUTacker():
                              'true' if self.sh_interp_nn else 'false')
 
         # Create CL program
-        cl_manager = CLManager(cl_kernel)
+        cl_manager = CLManager(cl_kernel, device=device)
 
         # Input buffers
         # Constant input buffers
         cl_manager.add_input_buffer('sh', self.sh)
         cl_manager.add_input_buffer('vertices', self.sphere.vertices)
-
-        sh_order = find_order_from_nb_coeff(self.sh)
-        B_mat = sh_to_sf_matrix(self.sphere, sh_order, self.sh_basis,
-                                return_inv=False, legacy=self.is_legacy)
         cl_manager.add_input_buffer('b_matrix', B_mat)
-
-        fodf_max = self._get_max_amplitudes(B_mat)
         cl_manager.add_input_buffer('max_amplitudes', fodf_max)
         cl_manager.add_input_buffer('mask', self.mask.astype(np.float32))
 
@@ -637,34 +1224,105 @@ class GPUTacker():
 
         cl_manager.add_output_buffer('out_strl')
         cl_manager.add_output_buffer('out_lengths')
+        return cl_manager
+
+    def _get_batch_size_tuner(self, device, static_size):
+        """
+        Get the batch size tuner of a device. The maximal batch size is
+        limited by the device's memory: the random values and the output
+        streamlines take 16 bytes per point.
+        """
+        bytes_per_seed = 4 * 3 * self.max_strl_points
+        max_batch_size = min(
+            device.max_mem_alloc_size // bytes_per_seed,
+            (device.global_mem_size - static_size) // 2 //
+            (bytes_per_seed + 4 * self.max_strl_points))
+        if not self.autotune_batch_size:
+            max_batch_size = min(max_batch_size, self.batch_size)
+        return BatchSizeTuner(self.batch_size, max_batch_size)
+
+    def _run_batch(self, cl_manager, seed_batch, rand_vals):
+        """
+        Tracks a batch of seeds on a device.
+        """
+        # Update buffers
+        cl_manager.update_input_buffer('seeds', seed_batch)
+        cl_manager.update_input_buffer('randvals', rand_vals)
+
+        # output streamlines buffer
+        cl_manager.update_output_buffer('out_strl',
+                                        (len(seed_batch),
+                                         self.max_strl_points, 3))
+        # output streamlines length buffer
+        cl_manager.update_output_buffer('out_lengths',
+                                        (len(seed_batch), 1))
+
+        # Run the kernel
+        return cl_manager.run((len(seed_batch), 1, 1))
 
-        # Generate streamlines in batches
-        for seed_batch in self.seed_batches:
-            # Generate random values for sf sampling
-            # TODO: Implement random number generator directly
-            #       on the GPU to generate values on-the-fly.
-            rand_vals = self.rng.uniform(0.0, 1.0,
-                                         (len(seed_batch),
-                                          self.max_strl_points))
-
-            # Update buffers
-            cl_manager.update_input_buffer('seeds', seed_batch)
-            cl_manager.update_input_buffer('randvals', rand_vals)
-
-            # output streamlines buffer
-            cl_manager.update_output_buffer('out_strl',
-                                            (len(seed_batch),
-                                             self.max_strl_points, 3))
-            # output streamlines length buffer
-            cl_manager.update_output_buffer('out_lengths',
-                                            (len(seed_batch), 1))
-
-            # Run the kernel
-            tracks, n_points = cl_manager.run((len(seed_batch), 1, 1))
-            n_points = n_points.flatten().astype(np.int16)
-            for (strl, seed, n_pts) in zip(tracks, seed_batch, n_points):
-                strl = strl[:n_pts]
-
-                # output is yielded so that we can use LazyTractogram.
-                # seed and strl with origin center (same as DIPY)
-                yield strl - 0.5, seed - 0.5
+    def _track(self):
+        """
+        GPU streamlines generator yielding streamlines with corresponding
+        seed positions one by one.
+        """
+        sh_order = find_order_from_nb_coeff(self.sh)
+        B_mat = sh_to_sf_matrix(self.sphere, sh_order, self.sh_basis,
+                                return_inv=False, legacy=self.is_legacy)
+        fodf_max = self._get_max_amplitudes(B_mat)
+        rng = np.random.default_rng(self.rng_seed)
+        static_size = 4 * (self.sh.size + B_mat.size + 2 * self.mask.size)
+
+        cl_managers = []
+        tuners = []
+        for device in self.devices:
+            cl_managers.append(self._get_cl_manager(device, B_mat,
+                                                    fodf_max))
+            tuners.append(self._get_batch_size_tuner(device, static_size))
+
+        # Batches are yielded in the order of the seeds. Limiting the number
+        # of batches waiting for an earlier one.
+        max_pending = 2 * len(cl_managers)
+        free_devices = list(range(len(cl_managers)))
+        running = {}
+        pending = deque()
+        next_seed = 0
+        with ThreadPoolExecutor(len(cl_managers)) as executor:
+            while next_seed < self.n_seeds or len(pending) > 0:
+                while len(free_devices) > 0 and len(pending) < max_pending \
+                        and next_seed < self.n_seeds:
+                    i = free_devices.pop(0)
+                    n = min(tuners[i].batch_size, self.n_seeds - next_seed)
+                    seed_batch = self.seeds[next_seed:next_seed + n] + 0.5
+                    next_seed += n
+
+                    # Generate random values for sf sampling, in the order of
+                    # the seeds: they do not depend on the batches.
+                    # TODO: Implement random number generator directly
+                    #       on the GPU to generate values on-the-fly.
+                    rand_vals = rng.uniform(0.0, 1.0,
+                                            (n, self.max_strl_points))
+
+                    tuners[i].start()
+                    future = executor.submit(self._run_batch, cl_managers[i],
+                                             seed_batch, rand_vals)
+                    running[future] = i
+                    pending.append((future, seed_batch))
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    tuners[i].stop(len(future.result()[1]))
+                    free_devices.append(i)
+
+                while len(pending) > 0 and pending[0][0].done():
+                    future, seed_batch = pending.popleft()
+                    tracks, n_points = future.result()
+                    n_points = n_points.flatten().astype(np.int16)
+                    for (strl, seed, n_pts) in zip(tracks, seed_batch,
+                                                   n_points):
+                        strl = strl[:n_pts]
+
+                        # output is yielded so that we can use
+                        # LazyTractogram. seed and strl with origin center
+                        # (same as DIPY)
+                        yield strl - 0.5, seed - 0.5
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import itertools
 import logging
 from typing import Iterable
 
@@ -189,7 +190,9 @@ def save_tractogram(
     Parameters
     ----------
     streamlines_generator : generator
-        Streamlines generator.
+        Streamlines generator, yielding (streamline, seed) tuples. Can be an
+        iterable or a one-shot iterator (ex, Tracker.track_generator()): it
+        is iterated only once.
     tracts_format : TrkFile or TckFile
         Tractogram format.
     ref_img : nibabel.Nifti1Image
@@ -244,8 +247,7 @@ def save_tractogram(
                     # origin `corner`. This is what is expected by
                     # LazyTractogram for .trk files (although this is not
                     # specified anywhere in the doc)
-                    strl += 0.5
-                    strl *= voxel_size  # in mm.
+                    strl = (strl + 0.5) * voxel_size  # in mm.
                 else:
                     # Streamlines are dumped in true world space with
                     # origin center as expected by .tck files.
@@ -254,7 +256,18 @@ def save_tractogram(
 
                 yield TractogramItem(strl, dps, {})
 
-    tractogram = LazyTractogram.from_data_func(tracks_generator_wrapper)
+    # The streamlines are only iterated once, even if streamlines_generator
+    # is a one-shot iterator (ex, Tracker.track_generator()). LazyTractogram
+    # calls the data function more than once, to peek at the first item: the
+    # first item is read here and yielded first at each call, followed by
+    # the items not consumed yet.
+    items = tracks_generator_wrapper()
+    first_items = list(itertools.islice(items, 1))
+
+    def get_items():
+        return itertools.chain(first_items, items)
+
+    tractogram = LazyTractogram.from_data_func(get_items)
     tractogram.affine_to_rasmm = ref_img.affine
 
     filetype = nib.streamlines.detect_format(out_tractogram)
@@ -449,3 +462,29 @@ def sample_distribution(dist, random_generator: np.random.Generator):
         return None
 
     return cdf.searchsorted(random_generator.random() * cdf[-1])
+
+
+def sample_distribution_batch(dists, random_generator: np.random.Generator):
+    """
+    Vectorized version of sample_distribution: samples one element in each
+    row of dists.
+
+    Parameters
+    ----------
+    dists: numpy.array (N, M)
+        The empirical distributions to sample from, one per row.
+    random_generator: numpy Generator
+
+    Return
+    ------
+    inds: numpy.array (N,)
+        The index of the sampled element for each row. -1 where the
+        distribution sums to 0.
+    """
+    cdf = dists.cumsum(axis=1)
+    r = random_generator.random(len(dists)) * cdf[:, -1]
+
+    # Equivalent to cdf.searchsorted(r) for each row.
+    inds = np.sum(cdf < r[:, None], axis=1)
+    inds[cdf[:, -1] == 0] = -1
+    return inds
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import itertools
 import logging
+import multiprocessing
 import os
 
 import numpy as np
@@ -9,7 +10,7 @@ from dipy.tracking.streamlinespeed import length
 from nibabel.streamlines import ArraySequence
 
 from scilpy.io.hdf5 import construct_hdf5_group_from_streamlines
-from scilpy.io.streamlines import save_tractogram
+from scilpy.io.streamlines import reconstruct_streamlines, save_tractogram
 from scilpy.tractanalysis.bundle_operations import remove_outliers_qb
 from scilpy.tractograms.streamline_and_mask_operations import \
     compute_streamline_segment
@@ -18,6 +19,10 @@ from scilpy.tractograms.streamline_operations import \
      remove_sharp_turns_qb,
      remove_streamlines_with_overlapping_points, filter_streamlines_by_length)
 
+# Number of streamlines segmented at once by
+# extract_longest_segments_from_profiles.
+SEGMENTATION_CHUNK_SIZE = 100000
+
 
 def extract_longest_segments_from_profile(strl_indices, atlas_data):
     """
@@ -87,7 +92,145 @@ def extract_longest_segments_from_profile(strl_indices, atlas_data):
              'end_index': end_idx}]
 
 
-def compute_connectivity(indices, atlas_data, real_labels, segmenting_func):
+def _first_in_each_streamline(flat_indices, strl_ids, nb_streamlines,
+                              last=False):
+    """
+    Among the flat_indices (sorted) of voxels of the streamlines strl_ids,
+    returns the first (or last) one of each streamline, or -1.
+    """
+    found = np.full(nb_streamlines, -1, dtype=np.intp)
+    if len(flat_indices) == 0:
+        return found
+    if last:
+        is_selected = np.append(strl_ids[1:] != strl_ids[:-1], True)
+    else:
+        is_selected = np.insert(strl_ids[1:] != strl_ids[:-1], 0, True)
+    found[strl_ids[is_selected]] = flat_indices[is_selected]
+    return found
+
+
+def _extract_longest_segments_from_chunk(strl_indices, lengths, atlas_data):
+    """
+    Same as extract_longest_segments_from_profile, for all the streamlines of
+    a chunk at once.
+
+    Parameters
+    ----------
+    strl_indices: np.ndarray (nb_voxels, 3)
+        The indices of all voxels traversed by the streamlines, one
+        streamline after the other.
+    lengths: np.ndarray
+        The number of voxels of each streamline.
+    atlas_data: np.ndarray
+        The loaded image containing the labels.
+
+    Returns
+    -------
+    segments_info: np.ndarray (nb_segmented, 5)
+        For each segmented streamline: its index in the chunk, the start
+        label, the start index, the end label and the end index.
+    """
+    nb_streamlines = len(lengths)
+    offsets = np.zeros(nb_streamlines, dtype=np.intp)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    strl_ids = np.repeat(np.arange(nb_streamlines), lengths)
+    positions = np.arange(len(strl_ids)) - offsets[strl_ids]
+
+    # Managing streamlines out of bound.
+    out_of_bound = np.any(strl_indices >= atlas_data.shape, axis=1)
+    is_valid = np.bincount(strl_ids[out_of_bound],
+                           minlength=nb_streamlines) == 0
+    strl_indices = np.where(out_of_bound[:, None], 0, strl_indices)
+    labels = atlas_data[tuple(strl_indices.T)]
+    labels[out_of_bound] = 0
+
+    # Start: the first voxel with a label. End: the last one. (Background
+    # and WM are label 0.)
+    in_labels = np.flatnonzero(labels > 0)
+    start = _first_in_each_streamline(in_labels, strl_ids[in_labels],
+                                      nb_streamlines)
+    end = _first_in_each_streamline(in_labels, strl_ids[in_labels],
+                                    nb_streamlines, last=True)
+    is_valid &= start >= 0
+    start_pos = np.where(start >= 0, start - offsets, 0)
+
+    # There must be a label 0 (WM) after the start, before the last voxel.
+    # Else, this is a weird streamline never leaving GM.
+    in_wm = np.flatnonzero((labels == 0) &
+                           (positions > start_pos[strl_ids]))
+    first_wm = _first_in_each_streamline(in_wm, strl_ids[in_wm],
+                                         nb_streamlines)
+    is_valid &= (first_wm >= 0) & (first_wm - offsets + 1 < lengths)
+
+    is_valid &= end - offsets > start_pos + 1
+
+    segmented = np.flatnonzero(is_valid)
+    return np.stack((segmented,
+                     labels[start[segmented]],
+                     start_pos[segmented],
+                     labels[end[segmented]],
+                     end[segmented] - offsets[segmented]), axis=-1)
+
+
+def _extract_longest_segments_from_chunk_parallel(args):
+    return _extract_longest_segments_from_chunk(*args)
+
+
+def extract_longest_segments_from_profiles(indices, atlas_data,
+                                           nbr_processes=1):
+    """
+    Same as extract_longest_segments_from_profile, but for all streamlines.
+    The labels of all voxels of a chunk of streamlines are read at once, and
+    the first and last labeled voxels are found without a loop on the
+    streamlines.
+
+    Parameters
+    ----------
+    indices: ArraySequence
+        The list of 3D indices [i, j, k] of all voxels traversed by all
+        streamlines. This is the output of the
+        streamlines_to_voxel_coordinates function.
+    atlas_data: np.ndarray
+        The loaded image containing the labels.
+    nbr_processes: int
+        Number of processes, each segmenting chunks of streamlines.
+
+    Returns
+    -------
+    segments_info: np.ndarray (nb_segmented, 5)
+        For each segmented streamline: its index, the start label, the start
+        index, the end label and the end index.
+    """
+    # Each chunk is a compact copy of the voxels of its streamlines.
+    def _chunks():
+        for start in range(0, len(indices), SEGMENTATION_CHUNK_SIZE):
+            end = min(start + SEGMENTATION_CHUNK_SIZE, len(indices))
+            chunk = reconstruct_streamlines(indices._data,
+                                            indices._offsets[start:end],
+                                            indices._lengths[start:end])
+            yield (np.reshape(chunk._data, (-1, 3)), chunk._lengths,
+                   atlas_data)
+
+    chunk_starts = range(0, len(indices), SEGMENTATION_CHUNK_SIZE)
+    if nbr_processes == 1:
+        results = [_extract_longest_segments_from_chunk(*args)
+                   for args in _chunks()]
+    else:
+        pool = multiprocessing.Pool(nbr_processes)
+        results = pool.map(_extract_longest_segments_from_chunk_parallel,
+                           _chunks())
+        pool.close()
+        pool.join()
+
+    for chunk_start, result in zip(chunk_starts, results):
+        result[:, 0] += chunk_start
+    if len(results) == 0:
+        return np.zeros((0, 5), dtype=int)
+    return np.concatenate(results)
+
+
+def compute_connectivity(indices, atlas_data, real_labels, segmenting_func,
+                         nbr_processes=1):
     """
     Segments a tractogram into "bundles", or "connections" between all pairs
     of labels.
@@ -104,7 +247,11 @@ def compute_connectivity(indices, atlas_data, real_labels, segmenting_func):
         The list of labels of interest in the image.
     segmenting_func: Callable
         The function used for segmentation.
-        Ex: extract_longest_segments_from_profile
+        Ex: extract_longest_segments_from_profile. With this one, all
+        streamlines are segmented at once, using
+        extract_longest_segments_from_profiles.
+    nbr_processes: int
+        Number of processes used with extract_longest_segments_from_profile.
 
     Returns
     -------
@@ -124,6 +271,17 @@ def compute_connectivity(indices, atlas_data, real_labels, segmenting_func):
     """
     connectivity = {k: {lab: [] for lab in real_labels} for k in real_labels}
 
+    if segmenting_func is extract_longest_segments_from_profile:
+        segments_info = extract_longest_segments_from_profiles(
+            indices, atlas_data, nbr_processes)
+        for strl_idx, start_label, start_idx, end_label, end_idx in \
+                segments_info.tolist():
+            connectivity[start_label][end_label].append(
+                {'strl_idx': strl_idx,
+                 'in_idx': start_idx,
+                 'out_idx': end_idx})
+        return connectivity
+
     # toDo. real_labels is not used in segmenting func!
     for strl_idx, strl_vox_indices in enumerate(indices):
         # Managing streamlines out of bound.
@@ -148,7 +306,7 @@ def construct_hdf5_from_connectivity(
         remove_loops, loop_max_angle,               # step 2
         remove_outliers, outlier_threshold,         # step 3
         remove_curv_dev, curv_qb_distance,          # step 4
-        nbr_cpu
+        nbr_cpu, compression=None
 ):
     """
     Parameters
@@ -189,6 +347,8 @@ def construct_hdf5_from_connectivity(
     curv_qb_distance: float
     nbr_cpu: int
         Number of cpu for steps allowing multiprocessing.
+    compression: str or None
+        Compression of the hdf5 datasets. One of 'gzip', 'lzf'.
     """
     sft.to_vox()
     sft.to_corner()
@@ -378,7 +538,7 @@ def construct_hdf5_from_connectivity(
         group = hdf5_file.create_group('{}_{}'.format(in_label, out_label))
         construct_hdf5_group_from_streamlines(
             group, current_sft.streamlines,
-            dps=current_sft.data_per_streamline)
+            dps=current_sft.data_per_streamline, compression=compression)
 
 
 def _save_intermediate(sft, saving_options, out_paths, in_label, out_label,
@@ -36,7 +36,10 @@ cdef inline void c_get_closest_edge(double p_x, double p_y, double p_z,
 @cython.wraparound(False)
 @cython.cdivision(True)
 # IMPORTANT: Streamlines should be in voxel space, aligned to corner.
-def compute_tract_counts_map(streamlines, vol_dims):
+# The map covers the voxels offset to offset + vol_dims of the volume: the
+# streamlines must be inside. Voxels are found with the same operations
+# whatever the offset.
+def compute_tract_counts_map(streamlines, vol_dims, offset=(0, 0, 0)):
     flags = np.seterr(divide="ignore", under="ignore")
 
     # Inspired from Dipy track_counts
@@ -80,9 +83,11 @@ def compute_tract_counts_map(streamlines, vol_dims):
     cdef np.npy_intp el_no, v
 
     cdef int vd[3]
+    cdef int off[3]
     cdef double vxs[3]
     for cno in range(3):
         vd[cno] = vol_dims[cno]
+        off[cno] = offset[cno]
     # x slice size (C array ordering)
     cdef np.npy_intp x_slice_size = vd[1] * vd[2]
 
@@ -147,9 +152,9 @@ def compute_tract_counts_map(streamlines, vol_dims):
                 # Find the coordinates of voxel containing current point, to
                 # tag it in the map
                 for cno in range(3):
-                    cur_voxel_coords[cno] = <int>floor(in_pt[cno] +
-                                                       0.5 * length_ratio *
-                                                       dir_vect[cno])
+                    cur_voxel_coords[cno] = <int>floor(
+                        in_pt[cno] + 0.5 * length_ratio * dir_vect[cno]) - \
+                        off[cno]
 
                 el_no = cur_voxel_coords[0] * x_slice_size + \
                         cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
@@ -173,8 +178,8 @@ def compute_tract_counts_map(streamlines, vol_dims):
 
         # Add last point
         for cno in range(3):
-            cur_voxel_coords[cno] = <int>floor(in_pt[cno] +
-                                               0.5 * (next_pt[cno] - in_pt[cno]))
+            cur_voxel_coords[cno] = <int>floor(
+                in_pt[cno] + 0.5 * (next_pt[cno] - in_pt[cno])) - off[cno]
 
         el_no = cur_voxel_coords[0] * x_slice_size + \
                 cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
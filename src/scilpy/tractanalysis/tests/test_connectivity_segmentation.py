@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from nibabel.streamlines import ArraySequence
+
+from scilpy.tractanalysis.connectivity_segmentation import (
+    compute_connectivity, extract_longest_segments_from_profile,
+    extract_longest_segments_from_profiles)
+
+
+def _get_atlas_and_indices():
+    # Labels 1 and 2 at both ends of the x axis, WM (0) in between.
+    atlas = np.zeros((6, 3, 3), dtype=int)
+    atlas[0] = 1
+    atlas[5] = 2
+    indices = ArraySequence([
+        np.array([[0, 1, 1], [1, 1, 1], [2, 1, 1], [5, 1, 1], [4, 1, 1]]),
+        np.array([[2, 1, 1], [0, 1, 1], [1, 1, 1], [5, 1, 1]]),
+        np.array([[1, 1, 1], [2, 1, 1]]),              # Never in GM.
+        np.array([[0, 1, 1], [0, 1, 1], [5, 1, 1], [1, 1, 1]]),  # WM last.
+        np.array([[0, 1, 1], [1, 1, 1], [8, 1, 1]]),   # Out of bound.
+        np.zeros((0, 3), dtype=int)])
+    return atlas, indices
+
+
+def test_extract_longest_segments_from_profiles():
+    atlas, indices = _get_atlas_and_indices()
+    segments_info = extract_longest_segments_from_profiles(indices, atlas)
+    assert np.array_equal(segments_info, [[0, 1, 0, 2, 3],
+                                          [1, 1, 1, 2, 3]])
+
+
+def test_compute_connectivity():
+    atlas, indices = _get_atlas_and_indices()
+    real_labels = np.array([1, 2])
+    connectivity = compute_connectivity(indices, atlas, real_labels,
+                                        extract_longest_segments_from_profile)
+
+    # Same as segmenting streamlines one by one.
+    expected = compute_connectivity(
+        indices, atlas, real_labels,
+        lambda *args: extract_longest_segments_from_profile(*args))
+    assert connectivity == expected
+    assert connectivity[1][2] == [{'strl_idx': 0, 'in_idx': 0, 'out_idx': 3},
+                                  {'strl_idx': 1, 'in_idx': 1, 'out_idx': 3}]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from dipy.io.stateful_tractogram import Space
+import numpy as np
+
+from scilpy.tests.streamlines import get_random_walk_sft
+from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
+
+
+def test_compute_tract_counts_map_offset():
+    sft = get_random_walk_sft(nb_streamlines=20, space=Space.VOX,
+                              clip_range=(5.5, 14.5))
+    # Most points on the voxels' faces.
+    streamlines = sft.streamlines.copy()
+    streamlines._data = np.round(streamlines._data * 2) / 2
+
+    density = compute_tract_counts_map(streamlines, sft.dimensions)
+    offset = [4, 5, 3]
+    dims = [12, 11, 13]
+    bbox_density = compute_tract_counts_map(streamlines, dims, offset=offset)
+
+    bbox = tuple(slice(o, o + d) for o, d in zip(offset, dims))
+    assert np.sum(bbox_density) == np.sum(density)
+    assert np.array_equal(bbox_density, density[bbox])
@@ -143,36 +143,28 @@ def project_map_to_streamlines(sft, map_volume, endpoints_only=False):
     else:
         dimension = 1
 
-    streamline_data = []
+    if len(sft.streamlines) == 0:
+        return []
+
+    # Querying all points at once.
     if endpoints_only:
-        for s in sft.streamlines:
-            p1_data = map_volume.get_value_at_coordinate(
-                s[0][0], s[0][1], s[0][2],
-                space=sft.space, origin=sft.origin)
-            p2_data = map_volume.get_value_at_coordinate(
-                s[-1][0], s[-1][1], s[-1][2],
-                space=sft.space, origin=sft.origin)
+        points = np.concatenate([[s[0], s[-1]] for s in sft.streamlines])
+    else:
+        points = sft.streamlines.get_data()
+    values = map_volume.get_value_at_coordinates(
+        points, space=sft.space, origin=sft.origin).reshape((-1, dimension))
 
+    streamline_data = []
+    if endpoints_only:
+        for i, s in enumerate(sft.streamlines):
             thisstreamline_data = np.ones((len(s), dimension)) * np.nan
 
-            thisstreamline_data[0] = p1_data
-            thisstreamline_data[-1] = p2_data
-            thisstreamline_data = np.asarray(thisstreamline_data)
-
-            streamline_data.append(
-                np.reshape(thisstreamline_data,
-                           (len(thisstreamline_data), dimension)))
+            thisstreamline_data[0] = values[2 * i]
+            thisstreamline_data[-1] = values[2 * i + 1]
+            streamline_data.append(thisstreamline_data)
     else:
-        # toDo: there is a double loop. Could be faster?
-        for s in sft.streamlines:
-            thisstreamline_data = []
-            for p in s:
-                thisstreamline_data.append(map_volume.get_value_at_coordinate(
-                    p[0], p[1], p[2], space=sft.space, origin=sft.origin))
-
-            streamline_data.append(
-                np.reshape(thisstreamline_data,
-                           (len(thisstreamline_data), dimension)))
+        offsets = np.cumsum([len(s) for s in sft.streamlines])[:-1]
+        streamline_data = np.split(values, offsets)
 
     return streamline_data
 
@@ -1,20 +1,43 @@
 # -*- coding: utf-8 -*-
+import collections
+import itertools
 import logging
+import multiprocessing
 import os
 
+import h5py
 import nibabel as nib
 import numpy as np
-from dipy.io.utils import is_header_compatible
-from nibabel.streamlines import LazyTractogram
+import trx.trx_file_memmap as tmm
+from dipy.io.dpy import Dpy
+from dipy.io.stateful_tractogram import Space, StatefulTractogram
+from dipy.io.utils import get_reference_info, is_header_compatible
+from dipy.io.vtk import load_vtk_streamlines
+from dipy.tracking.streamlinespeed import length
+from nibabel.affines import apply_affine
+from nibabel.streamlines import ArraySequence, LazyTractogram
+
+from scilpy.io.hdf5 import reconstruct_streamlines_from_hdf5
+from scilpy.io.streamlines import ichunk, reconstruct_streamlines
+from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
+
+# Formats that can only be read at once. They are still processed by chunks.
+FULLY_LOADED_FORMATS = ['.vtk', '.vtp', '.fib', '.dpy']
 
 
 def lazy_streamlines_count(in_tractogram_path):
-    """ Gets the number of streamlines as written in the tractogram header.
+    """ Gets the number of streamlines of a tractogram without loading it.
+
+    For .trk, .tck and .trx, the number written in the header is used (for a
+    .tck without count, the streamlines are counted while lazy-loading them).
+    For .h5 (as created by scil_tractogram_segment_connections_from_labels),
+    the streamlines of all groups are counted. Other formats (vtk, vtp, fib,
+    dpy) cannot be lazy-loaded: the file is fully loaded.
 
     Parameters
     ----------
     in_tractogram_path: str
-        Tractogram filepath, must be .trk or .tck.
+        Tractogram filepath.
 
     Return
     ------
@@ -22,16 +45,201 @@ def lazy_streamlines_count(in_tractogram_path):
         Number of streamlines present in the tractogram.
     """
     _, ext = os.path.splitext(in_tractogram_path)
-    if ext == '.trk':
-        key = 'nb_streamlines'
-    elif ext == '.tck':
-        key = 'count'
+    if ext in ['.trk', '.tck']:
+        key = 'nb_streamlines' if ext == '.trk' else 'count'
+        tractogram_file = nib.streamlines.load(in_tractogram_path,
+                                               lazy_load=True)
+        try:
+            return int(tractogram_file.header[key])
+        except (KeyError, ValueError):
+            logging.info('No streamline count in the header of {}. '
+                         'Counting them.'.format(in_tractogram_path))
+            return sum(1 for _ in tractogram_file.streamlines)
+    elif ext == '.trx':
+        trx = tmm.load(in_tractogram_path)
+        count = int(trx.header['NB_STREAMLINES'])
+        trx.close()
+        return count
+    elif ext == '.h5':
+        with h5py.File(in_tractogram_path, 'r') as hdf5_file:
+            return sum(len(hdf5_file[key]['lengths'])
+                       for key in _get_hdf5_streamlines_groups(hdf5_file))
+    elif ext in FULLY_LOADED_FORMATS:
+        return len(_load_full_streamlines(in_tractogram_path))
     else:
         raise IOError('{} is not supported for lazy loading'.format(ext))
 
-    tractogram_file = nib.streamlines.load(in_tractogram_path,
-                                           lazy_load=True)
-    return int(tractogram_file.header[key])
+
+def _get_hdf5_streamlines_groups(hdf5_file):
+    """
+    Keys of the groups of a hdf5 file containing streamlines.
+    """
+    return [key for key in hdf5_file.keys()
+            if isinstance(hdf5_file[key], h5py.Group) and
+            'data' in hdf5_file[key]]
+
+
+def _load_full_streamlines(in_tractogram_path):
+    """
+    Loads the streamlines (in rasmm) of the formats that cannot be lazy-loaded,
+    as done in dipy's load_tractogram.
+    """
+    _, ext = os.path.splitext(in_tractogram_path)
+    if ext == '.dpy':
+        dpy_obj = Dpy(in_tractogram_path, mode='r')
+        streamlines = list(dpy_obj.read_tracks())
+        dpy_obj.close()
+    else:
+        streamlines = load_vtk_streamlines(in_tractogram_path)
+    return ArraySequence(streamlines)
+
+
+def get_lazy_reference_info(in_tractogram_path, reference=None):
+    """
+    Gets the affine, dimensions and voxel sizes of a tractogram without
+    loading it.
+
+    Parameters
+    ----------
+    in_tractogram_path: str
+        Tractogram filepath.
+    reference: str, optional
+        Reference of the tractogram. Required for formats without a header
+        (.tck, .vtk, .vtp, .fib, .dpy). Ignored for the other formats.
+
+    Returns
+    -------
+    affine: np.ndarray
+        The voxel to rasmm affine.
+    dimensions: np.ndarray
+    voxel_sizes: np.ndarray
+    """
+    _, ext = os.path.splitext(in_tractogram_path)
+    if ext == '.h5':
+        with h5py.File(in_tractogram_path, 'r') as hdf5_file:
+            return (np.asarray(hdf5_file.attrs['affine']),
+                    np.asarray(hdf5_file.attrs['dimensions']),
+                    np.asarray(hdf5_file.attrs['voxel_sizes']))
+    elif ext in ['.trk', '.trx']:
+        reference = in_tractogram_path
+    elif reference is None:
+        raise ValueError('A reference is required for the format {}.'
+                         .format(ext))
+
+    affine, dimensions, voxel_sizes, _ = get_reference_info(reference)
+    return (np.asarray(affine, dtype=np.float64), np.asarray(dimensions),
+            np.asarray(voxel_sizes))
+
+
+def lazy_data_keys(in_tractogram_path):
+    """
+    Gets the data_per_point and data_per_streamline keys of a tractogram
+    without loading it. Formats without such data (.tck, .vtk, ...) have
+    none.
+
+    Parameters
+    ----------
+    in_tractogram_path: str
+        Tractogram filepath.
+
+    Returns
+    -------
+    dpp_keys: list[str]
+    dps_keys: list[str]
+    """
+    _, ext = os.path.splitext(in_tractogram_path)
+    if ext == '.trk':
+        tractogram = nib.streamlines.load(in_tractogram_path,
+                                          lazy_load=True).tractogram
+        return (list(tractogram.data_per_point.keys()),
+                list(tractogram.data_per_streamline.keys()))
+    elif ext == '.trx':
+        trx = tmm.load(in_tractogram_path)
+        keys = (list(trx.data_per_vertex.keys()),
+                list(trx.data_per_streamline.keys()))
+        trx.close()
+        return keys
+    elif ext == '.h5':
+        dps_keys = []
+        with h5py.File(in_tractogram_path, 'r') as hdf5_file:
+            for key in _get_hdf5_streamlines_groups(hdf5_file):
+                dps_keys += [k for k in hdf5_file[key].keys()
+                             if k not in ['data', 'offsets', 'lengths'] and
+                             k not in dps_keys]
+        return [], dps_keys
+    return [], []
+
+
+def lazy_streamlines_chunks(in_tractogram_path, chunk_size):
+    """
+    Yields the streamlines of a tractogram by chunks, in rasmm, as float32 (as
+    if loaded in a StatefulTractogram). Only one chunk is in memory at once.
+
+    Supports .trk and .tck (lazy-loaded with nibabel), .trx (memory-mapped)
+    and .h5 (all groups, one after the other, as saved by
+    scil_tractogram_segment_connections_from_labels). The .vtk, .vtp, .fib
+    and .dpy formats cannot be lazy-loaded: they are fully loaded first.
+
+    Parameters
+    ----------
+    in_tractogram_path: str
+        Tractogram filepath.
+    chunk_size: int
+        Number of streamlines per chunk.
+
+    Yields
+    ------
+    streamlines: ArraySequence
+        The streamlines of the chunk.
+    """
+    _, ext = os.path.splitext(in_tractogram_path)
+    if ext in ['.trk', '.tck']:
+        tractogram = nib.streamlines.load(in_tractogram_path,
+                                          lazy_load=True).tractogram
+        # Lazy-loaded streamlines are moved to rasmm one by one, in float64.
+        # A fully loaded .trk is moved at once, in float32: doing the same,
+        # to get the same points.
+        to_rasmm = tractogram._affine_to_apply.astype(np.float32)
+        tractogram._affine_to_apply = np.eye(4)
+        for chunk in ichunk(tractogram.streamlines, chunk_size):
+            streamlines = ArraySequence(chunk)
+            streamlines._data = streamlines._data.astype(np.float32)
+            if not np.array_equal(to_rasmm, np.eye(4)):
+                apply_affine(to_rasmm, streamlines._data, inplace=True)
+            yield streamlines
+    elif ext == '.trx':
+        trx = tmm.load(in_tractogram_path)
+        data = trx.streamlines._data
+        offsets = trx.streamlines._offsets
+        lengths = trx.streamlines._lengths
+        for start in range(0, len(lengths), chunk_size):
+            end = start + chunk_size
+            streamlines = reconstruct_streamlines(data, offsets[start:end],
+                                                  lengths[start:end])
+            streamlines._data = streamlines._data.astype(np.float32)
+            yield streamlines
+        trx.close()
+    elif ext == '.h5':
+        with h5py.File(in_tractogram_path, 'r') as hdf5_file:
+            # Saved in voxel space, corner: as StatefulTractogram.to_rasmm().
+            affine = hdf5_file.attrs['affine']
+            for key in _get_hdf5_streamlines_groups(hdf5_file):
+                group = hdf5_file[key]
+                for start in range(0, len(group['lengths']), chunk_size):
+                    streamlines = reconstruct_streamlines_from_hdf5(
+                        group, slice(start, start + chunk_size))
+                    streamlines._data = apply_affine(
+                        affine, streamlines._data - 0.5).astype(np.float32)
+                    yield streamlines
+    elif ext in FULLY_LOADED_FORMATS:
+        logging.warning('{} cannot be lazy-loaded. Loading it fully.'
+                        .format(in_tractogram_path))
+        streamlines = _load_full_streamlines(in_tractogram_path)
+        streamlines._data = streamlines._data.astype(np.float32)
+        for start in range(0, len(streamlines), chunk_size):
+            yield streamlines[start:start + chunk_size]
+    else:
+        raise IOError('{} is not supported for lazy loading'.format(ext))
 
 
 def lazy_concatenate(in_tractograms, out_ext):
@@ -82,3 +290,225 @@ def lazy_concatenate(in_tractograms, out_ext):
     out_tractogram = LazyTractogram(lambda: generator,
                                     affine_to_rasmm=np.eye(4))
     return out_tractogram, header
+
+
+def _chunk_density_map(args):
+    """
+    Density map of a chunk of streamlines (in voxel space, corner), returned
+    as the flat indices of the non-zero voxels and their int32 counts.
+    """
+    streamlines, dimensions, endpoints_only = args
+    if endpoints_only:
+        # As in get_endpoints_density_map: casting to int.
+        data = streamlines._data
+        heads = data[streamlines._offsets].astype(np.int16)
+        tails = data[streamlines._offsets +
+                     streamlines._lengths - 1].astype(np.int16)
+        flat = np.ravel_multi_index(
+            np.concatenate([heads, tails]).T.astype(np.intp), dimensions)
+        density = np.bincount(flat, minlength=np.prod(dimensions))
+    else:
+        density = compute_tract_counts_map(streamlines, dimensions).ravel()
+
+    voxels = np.flatnonzero(density)
+    return voxels, density[voxels].astype(np.int32)
+
+
+def _lazy_vox_corner_chunks(in_tractogram_path, space_attributes,
+                            chunk_size):
+    """
+    Yields the streamlines of a tractogram by chunks, in voxel space, aligned
+    to corner. Each chunk goes through the same (float32) conversions as a
+    fully loaded tractogram: load_tractogram's bounding box check, then
+    to_vox() and to_corner().
+    """
+    dimensions = space_attributes[1]
+    for streamlines in lazy_streamlines_chunks(in_tractogram_path,
+                                               chunk_size):
+        sft = StatefulTractogram(streamlines, space_attributes, Space.RASMM)
+        if not sft.is_bbox_in_vox_valid():
+            raise ValueError('{} contains streamlines out of the bounding box '
+                             'of the reference.'.format(in_tractogram_path))
+        sft.to_vox()
+        sft.to_corner()
+        # Points on the upper faces of the bounding box are accepted by
+        # is_bbox_in_vox_valid, but are out of the volume.
+        if np.any(sft.streamlines._data >= dimensions):
+            raise ValueError('{} contains streamlines out of the bounding box '
+                             'of the reference.'.format(in_tractogram_path))
+        yield sft.streamlines
+
+
+def lazy_compute_density_map(in_tractogram_path, reference, chunk_size,
+                             endpoints_only=False, nbr_processes=1):
+    """
+    Computes the density map of a tractogram (as compute_tract_counts_map, or
+    as get_endpoints_density_map), without loading it fully. The tractogram
+    is lazy-loaded and processed by chunks of streamlines, in parallel, and
+    the density maps of the chunks are summed.
+
+    Parameters
+    ----------
+    in_tractogram_path: str
+        Tractogram filepath, must be .trk or .tck.
+    reference: str
+        Reference of the tractogram (ex, the .trk itself or a nifti file).
+    chunk_size: int
+        Number of streamlines loaded at once (by process).
+    endpoints_only: bool
+        If true, only counts the endpoints.
+    nbr_processes: int
+        Number of processes.
+
+    Returns
+    -------
+    density_map: np.ndarray
+        The map (int32) of the dimensions of the reference.
+    """
+    _, ext = os.path.splitext(in_tractogram_path)
+    if ext not in ['.trk', '.tck']:
+        raise IOError('{} is not supported for lazy loading'.format(ext))
+
+    space_attributes = get_reference_info(reference)
+    dimensions = np.asarray(space_attributes[1], dtype=int)
+
+    chunks = _lazy_vox_corner_chunks(in_tractogram_path, space_attributes,
+                                     chunk_size)
+    args = zip(chunks, itertools.repeat(dimensions),
+               itertools.repeat(endpoints_only))
+
+    density_map = np.zeros(np.prod(dimensions), dtype=np.int32)
+    if nbr_processes > 1:
+        # Pool.imap would read the whole tractogram in advance: at most two
+        # chunks per process are read and waiting to be processed.
+        with multiprocessing.Pool(nbr_processes) as pool:
+            pending = collections.deque()
+            for chunk_args in args:
+                pending.append(pool.apply_async(_chunk_density_map,
+                                                (chunk_args,)))
+                if len(pending) == 2 * nbr_processes:
+                    voxels, counts = pending.popleft().get()
+                    density_map[voxels] += counts
+            for result in pending:
+                voxels, counts = result.get()
+                density_map[voxels] += counts
+    else:
+        for chunk_args in args:
+            voxels, counts = _chunk_density_map(chunk_args)
+            density_map[voxels] += counts
+
+    return density_map.reshape(dimensions)
+
+
+class _RunningStatistics(object):
+    """
+    Min, max, mean and (population) std of values received by chunks, in
+    constant memory. Chunks are merged with Chan et al.'s parallel algorithm.
+    """
+    def __init__(self):
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.
+        self._m2 = 0.
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        count = self.count + len(values)
+        mean = np.mean(values)
+        delta = mean - self.mean
+        self._m2 += np.sum((values - mean) ** 2) + \
+            delta ** 2 * self.count * len(values) / count
+        self.mean += delta * len(values) / count
+        self.count = count
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / self.count) if self.count else np.nan
+
+
+def lazy_tractogram_statistics(in_tractogram_path, reference=None,
+                               chunk_size=10000, bin_size=10.):
+    """
+    Computes statistics on a tractogram without loading it fully (see
+    lazy_streamlines_chunks for the supported formats): number of
+    streamlines, length in number of points, length in mm (and its
+    histogram), step size and bounding box.
+
+    Parameters
+    ----------
+    in_tractogram_path: str
+        Tractogram filepath.
+    reference: str, optional
+        Reference of the tractogram. Required for formats without a header
+        (.tck, .vtk, .vtp, .fib, .dpy). Ignored for the other formats.
+    chunk_size: int
+        Number of streamlines loaded at once.
+    bin_size: float
+        Width (in mm) of the bins of the histogram of lengths, starting at 0.
+
+    Returns
+    -------
+    stats: dict
+        number_streamlines: the number of streamlines.
+        length_nb_points, length_mm, step_size: dict with the min, mean, max
+        and std (None for an empty tractogram). Step sizes are computed in
+        voxmm space (as in StatefulTractogram.to_voxmm()).
+        length_mm_histogram: the number of streamlines of each bin.
+        bounding_box_rasmm: the min and max coordinates (in rasmm) of all
+        points.
+    """
+    affine, _, voxel_sizes = get_lazy_reference_info(in_tractogram_path,
+                                                     reference)
+    # Step vectors in voxmm: rasmm -> vox (without translation) -> voxmm.
+    to_voxmm = np.linalg.inv(affine)[:3, :3].T * voxel_sizes
+
+    nb_points = _RunningStatistics()
+    lengths_mm = _RunningStatistics()
+    steps = _RunningStatistics()
+    histogram = np.zeros(0, dtype=np.int64)
+    bbox_min = np.full(3, np.inf)
+    bbox_max = np.full(3, -np.inf)
+    for streamlines in lazy_streamlines_chunks(in_tractogram_path,
+                                               chunk_size):
+        if len(streamlines) == 0:
+            continue
+        streamlines_lengths = np.asarray(streamlines._lengths)
+        nb_points.update(streamlines_lengths)
+
+        chunk_lengths_mm = length(streamlines)
+        lengths_mm.update(chunk_lengths_mm)
+        bins = np.bincount((chunk_lengths_mm // bin_size).astype(np.intp))
+        if len(bins) > len(histogram):
+            histogram = np.pad(histogram, (0, len(bins) - len(histogram)))
+        histogram[:len(bins)] += bins
+
+        # Contiguous copy: the segments between streamlines are removed.
+        data = streamlines.get_data()
+        bbox_min = np.minimum(bbox_min, np.min(data, axis=0))
+        bbox_max = np.maximum(bbox_max, np.max(data, axis=0))
+        is_step = np.ones(max(len(data) - 1, 0), dtype=bool)
+        is_step[np.cumsum(streamlines_lengths)[:-1] - 1] = False
+        steps.update(np.linalg.norm(
+            np.diff(data, axis=0)[is_step] @ to_voxmm, axis=1))
+
+    def _summary(running_stats):
+        if running_stats.count == 0:
+            return {'min': None, 'mean': None, 'max': None, 'std': None}
+        return {'min': float(running_stats.min),
+                'mean': float(running_stats.mean),
+                'max': float(running_stats.max),
+                'std': float(running_stats.std)}
+
+    return {'number_streamlines': nb_points.count,
+            'length_nb_points': _summary(nb_points),
+            'length_mm': _summary(lengths_mm),
+            'step_size': _summary(steps),
+            'length_mm_histogram': histogram.tolist(),
+            'bounding_box_rasmm': (
+                [bbox_min.tolist(), bbox_max.tolist()]
+                if nb_points.count else None)}
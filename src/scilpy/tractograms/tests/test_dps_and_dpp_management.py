@@ -127,6 +127,12 @@ def test_project_map_to_streamlines():
     assert np.array_equal(dpp[0], [[1, 1]] * 3)
     assert np.array_equal(dpp[1], [[2, 2]] * 4)
 
+    # Test 3. Empty tractogram.
+    empty_sft = fake_sft.from_sft([], fake_sft)
+    assert project_map_to_streamlines(empty_sft, map_volume) == []
+    assert project_map_to_streamlines(empty_sft, map_volume,
+                                      endpoints_only=True) == []
+
 
 def test_project_dpp_to_map():
     fake_sft = _get_small_sft()
@@ -1,10 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
+import tempfile
+
+from dipy.io.streamline import load_tractogram, save_tractogram
+from dipy.tracking.streamlinespeed import length
+import h5py
+import nibabel as nib
+import numpy as np
+import pytest
 
 from scilpy import SCILPY_HOME
 from scilpy.io.fetcher import fetch_data, get_testing_files_dict
-from scilpy.tractograms.lazy_tractogram_operations import \
-    lazy_streamlines_count, lazy_concatenate
+from scilpy.io.hdf5 import construct_hdf5_from_sft
+from scilpy.tests.streamlines import get_random_walk_sft
+from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
+from scilpy.tractograms.lazy_tractogram_operations import (
+    lazy_compute_density_map, lazy_concatenate, lazy_data_keys,
+    lazy_streamlines_count, lazy_tractogram_statistics)
+from scilpy.tractograms.streamline_and_mask_operations import \
+    get_endpoints_density_map
 
 # If they already exist, this only takes 5 seconds (check md5sum)
 fetch_data(get_testing_files_dict(), keys=['tractograms.zip'])
@@ -23,3 +37,110 @@ def test_lazy_concatenate():
 
     out_trk, out_header = lazy_concatenate([in_file1, in_file2], '.tck')
     assert len(out_trk) == 20
+
+
+def test_lazy_compute_density_map():
+    # Oblique voxels of 1.25mm, points up to the borders of the volume: the
+    # conversions to voxel space must round as in the default mode (with
+    # enough streamlines for a few segments to change voxels otherwise).
+    affine = np.array([[-1.25, 0.05, 0., 90.3],
+                       [0.02, 1.25, 0.1, -126.7],
+                       [0., -0.1, 1.25, -72.1],
+                       [0., 0., 0., 1.]])
+    sft = get_random_walk_sft(10000, affine=affine, clip_range=(-0.49, 19.49))
+    reference = nib.Nifti1Image(np.zeros((20, 20, 20), dtype=np.uint8),
+                                affine)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_ref = os.path.join(tmp_dir, 'reference.nii.gz')
+        nib.save(reference, in_ref)
+        for ext in ['.trk', '.tck']:
+            in_file = os.path.join(tmp_dir, 'tractogram' + ext)
+            save_tractogram(sft, in_file)
+
+            loaded_sft = load_tractogram(in_file, in_ref)
+            loaded_sft.to_vox()
+            loaded_sft.to_corner()
+            expected = compute_tract_counts_map(loaded_sft.streamlines,
+                                                loaded_sft.dimensions)
+            expected_endpoints = get_endpoints_density_map(loaded_sft)
+
+            # Chunks of 3000 streamlines: the last one is incomplete.
+            for nbr_processes in [1, 2]:
+                density_map = lazy_compute_density_map(
+                    in_file, in_ref, 3000, nbr_processes=nbr_processes)
+                assert np.array_equal(density_map, expected)
+
+                density_map = lazy_compute_density_map(
+                    in_file, in_ref, 3000, endpoints_only=True,
+                    nbr_processes=nbr_processes)
+                assert np.array_equal(density_map, expected_endpoints)
+
+        # A point on the upper face of the volume: not in any voxel.
+        out_sft = get_random_walk_sft(nb_streamlines=1, clip_range=(0, 19.5))
+        out_sft.streamlines._data[-1] = 19.5
+        in_file = os.path.join(tmp_dir, 'out_of_volume.tck')
+        save_tractogram(out_sft, in_file)
+        in_ref = os.path.join(tmp_dir, 'reference_2mm.nii.gz')
+        nib.save(nib.Nifti1Image(np.zeros((20, 20, 20), dtype=np.uint8),
+                                 np.diag([2., 2., 2., 1.])), in_ref)
+        with pytest.raises(ValueError):
+            lazy_compute_density_map(in_file, in_ref, 30)
+
+
+def test_lazy_tractogram_statistics():
+    affine = np.diag([2., 1.5, 1., 1.])
+    affine[:3, 3] = [-10., -12., 4.]
+    sft = get_random_walk_sft(affine=affine, min_nb_points=1)
+    reference = nib.Nifti1Image(np.zeros((20, 20, 20), dtype=np.uint8),
+                                affine)
+    sft.data_per_streamline['weight'] = \
+        np.random.default_rng(1).uniform(size=(100, 1))
+
+    # Expected values, computed on the whole tractogram.
+    sft.to_rasmm()
+    lengths_mm = length(sft.streamlines)
+    nb_points = sft.streamlines._lengths
+    data = sft.streamlines.get_data()
+    sft.to_voxmm()
+    steps = np.hstack([np.linalg.norm(np.diff(s, axis=0), axis=1)
+                       for s in sft.streamlines])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_ref = os.path.join(tmp_dir, 'reference.nii.gz')
+        nib.save(reference, in_ref)
+        in_files = []
+        for ext in ['.trk', '.tck', '.trx']:
+            in_files.append(os.path.join(tmp_dir, 'tractogram' + ext))
+            save_tractogram(sft, in_files[-1])
+        in_files.append(os.path.join(tmp_dir, 'tractogram.h5'))
+        with h5py.File(in_files[-1], 'w') as hdf5_file:
+            construct_hdf5_from_sft(hdf5_file, [sft[0:40], sft[40:]],
+                                    ['a', 'b'], save_dps=True)
+
+        for in_file in in_files:
+            assert lazy_streamlines_count(in_file) == 100
+
+            # Chunks of 30 streamlines: the last one is incomplete.
+            stats = lazy_tractogram_statistics(in_file, in_ref, 30,
+                                               bin_size=5.)
+            assert stats['number_streamlines'] == 100
+            for key, values in [('length_nb_points', nb_points),
+                                ('length_mm', lengths_mm),
+                                ('step_size', steps)]:
+                assert np.allclose([stats[key]['min'], stats[key]['mean'],
+                                    stats[key]['max'], stats[key]['std']],
+                                   [np.min(values), np.mean(values),
+                                    np.max(values), np.std(values)],
+                                   atol=1e-4)
+            assert np.sum(stats['length_mm_histogram']) == 100
+            assert np.array_equal(
+                stats['length_mm_histogram'][0:3],
+                np.bincount(lengths_mm.astype(int) // 5, minlength=3)[0:3])
+            assert np.allclose(stats['bounding_box_rasmm'],
+                               [np.min(data, axis=0), np.max(data, axis=0)],
+                               atol=1e-4)
+
+        assert lazy_data_keys(in_files[0]) == ([], ['weight'])
+        assert lazy_data_keys(in_files[1]) == ([], [])
+        assert lazy_data_keys(in_files[3]) == ([], ['weight'])
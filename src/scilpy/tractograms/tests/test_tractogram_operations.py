@@ -141,6 +141,28 @@ def test_robust_operations():
     assert (indices == [0, 2]).all()
 
 
+def test_robust_operations_duplicates():
+    same = sft.streamlines[0]
+    different = np.asarray([[1., 0., 0.],
+                            [1., 0., 0.],
+                            [1., 0., 0.]])
+    duplicates = [same, same + 0.0001, different, same]
+
+    # Only the first instance of identical streamlines is kept.
+    for operation in [intersection_robust, difference_robust, union_robust]:
+        output, indices = perform_tractogram_operation_on_lines(
+            operation, [duplicates])
+        assert np.array_equal(indices, [0, 2])
+
+    output, indices = perform_tractogram_operation_on_lines(
+        intersection_robust, [duplicates, [different, same]])
+    assert np.array_equal(indices, [0, 2])
+
+    output, indices = perform_tractogram_operation_on_lines(
+        difference_robust, [duplicates, [different]])
+    assert np.array_equal(indices, [0])
+
+
 def test_concatenate_sft():
     # Testing with different metadata
     sft2 = StatefulTractogram.from_sft(sft.streamlines, sft)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import numpy as np
+from dipy.io.stateful_tractogram import Space, StatefulTractogram
+import pytest
+
+from scilpy.segment.streamlines import streamlines_in_mask
+from scilpy.tests.streamlines import get_random_walk_sft
+from scilpy.tractograms.voxel_traversal_index import (
+    VoxelTraversalIndex, load_or_compute_voxel_traversal_index)
+from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
+
+
+def _get_sft():
+    # Kept inside the volume (and not on the voxels' faces).
+    return get_random_walk_sft(space=Space.RASMM, clip_range=(0.2, 18.7))
+
+
+def _get_face_aligned_sft():
+    # Points rounded to half voxels: most of them lie on the voxels' faces,
+    # edges or corners, up to the volume's borders.
+    sft = get_random_walk_sft(clip_range=(-0.5, 19))
+    return StatefulTractogram.from_sft(
+        [np.round(s * 2) / 2 for s in sft.streamlines], sft)
+
+
+def _get_mask():
+    mask = np.zeros((20, 20, 20), dtype=np.uint8)
+    mask[4:16, 4:16, 6:14] = 1
+    return mask
+
+
+def test_voxel_traversal_index():
+    sft = _get_sft()
+    voxel_index = VoxelTraversalIndex.from_sft(sft)
+    assert sft.space == Space.RASMM
+    assert len(voxel_index) == len(sft)
+
+    sft.to_vox()
+    sft.to_corner()
+    indices, points_to_idx = streamlines_to_voxel_coordinates(
+        sft.streamlines, return_mapping=True)
+    new_indices, new_points_to_idx = voxel_index.get_voxel_coordinates()
+    assert np.array_equal(new_indices.get_data(), indices.get_data())
+    assert np.array_equal(new_points_to_idx.get_data(),
+                          points_to_idx.get_data())
+
+    mask = _get_mask()
+    for all_in in [False, True]:
+        ids = streamlines_in_mask(sft, mask, all_in=all_in)
+        assert np.array_equal(
+            np.flatnonzero(voxel_index.streamlines_in_mask(mask, all_in)),
+            ids)
+        assert streamlines_in_mask(sft, mask, all_in=all_in,
+                                   voxel_index=voxel_index) == ids
+
+    subset = voxel_index.select([8, 3, 3])
+    subset_indices, subset_points_to_idx = subset.get_voxel_coordinates()
+    for i, j in enumerate([8, 3, 3]):
+        assert np.array_equal(subset_indices[i], indices[j])
+        assert np.array_equal(subset_points_to_idx[i], points_to_idx[j])
+
+
+def test_voxel_traversal_index_face_aligned():
+    sft = _get_face_aligned_sft()
+    voxel_index = VoxelTraversalIndex.from_sft(sft)
+
+    sft.to_vox()
+    sft.to_corner()
+    on_face = np.mod(sft.streamlines.get_data(), 1) == 0
+    assert np.mean(np.any(on_face, axis=1)) > 0.8
+    indices, points_to_idx = streamlines_to_voxel_coordinates(
+        sft.streamlines, return_mapping=True)
+    new_indices, new_points_to_idx = voxel_index.get_voxel_coordinates()
+    assert np.array_equal(new_indices.get_data(), indices.get_data())
+    assert np.array_equal(new_points_to_idx.get_data(),
+                          points_to_idx.get_data())
+
+    matrix = voxel_index.to_csr().toarray()
+    mask = _get_mask().astype(bool)
+    for i, streamline_indices in enumerate(indices):
+        voxels = np.zeros((20, 20, 20), dtype=bool)
+        voxels[tuple(streamline_indices.T)] = True
+        assert np.array_equal(matrix[i], voxels.ravel())
+
+        in_mask = mask[tuple(streamline_indices.T)]
+        assert voxel_index.streamlines_in_mask(mask)[i] == np.any(in_mask)
+        assert voxel_index.streamlines_in_mask(mask, all_in=True)[i] == \
+            np.all(in_mask)
+
+
+def test_voxel_traversal_index_differs_on_faces():
+    # Integer coordinates (vox space, corner origin), inside the volume: all
+    # points lie on the voxels' faces.
+    sft = get_random_walk_sft(clip_range=(1, 18))
+    sft.to_corner()
+    sft = StatefulTractogram.from_sft(
+        [np.round(s) for s in sft.streamlines], sft)
+    voxel_index = VoxelTraversalIndex.from_sft(sft)
+
+    # The index's traversal (streamlines_to_voxel_coordinates) and dipy's do
+    # not select the same streamlines.
+    mask = _get_mask()
+    ids = streamlines_in_mask(sft, mask)
+    index_ids = streamlines_in_mask(sft, mask, voxel_index=voxel_index)
+    assert index_ids != ids
+    assert index_ids == np.flatnonzero(
+        voxel_index.streamlines_in_mask(mask)).tolist()
+
+    # Off the faces, they are the same (see test_voxel_traversal_index).
+    sft.streamlines._data += 0.25
+    voxel_index = VoxelTraversalIndex.from_sft(sft)
+    assert streamlines_in_mask(sft, mask, voxel_index=voxel_index) == \
+        streamlines_in_mask(sft, mask)
+
+
+def test_load_or_compute_voxel_traversal_index():
+    sft = _get_sft()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'voxel_index.npz')
+        voxel_index = load_or_compute_voxel_traversal_index(sft, filename)
+        assert os.path.isfile(filename)
+
+        loaded = load_or_compute_voxel_traversal_index(sft, filename)
+        assert loaded.signature == voxel_index.signature
+        assert np.array_equal(loaded.voxels, voxel_index.voxels)
+        assert loaded.matches(sft)
+
+        # Another tractogram: only computed again with overwrite.
+        other_sft = sft[0:50]
+        assert not loaded.matches(other_sft)
+        with pytest.raises(ValueError):
+            load_or_compute_voxel_traversal_index(other_sft, filename)
+        assert VoxelTraversalIndex.load(filename).matches(sft)
+
+        other = load_or_compute_voxel_traversal_index(other_sft, filename,
+                                                      overwrite=True)
+        assert len(other) == 50
+        assert VoxelTraversalIndex.load(filename).matches(other_sft)
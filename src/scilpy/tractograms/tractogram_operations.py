@@ -8,7 +8,6 @@ individually. See scilpy.tractograms.streamline_operations.py for the latter.
 """
 
 from functools import reduce
-import itertools
 import logging
 import random
 
@@ -25,6 +24,7 @@ from numpy.polynomial.polynomial import Polynomial
 from scipy.ndimage import map_coordinates
 from scipy.spatial import cKDTree
 
+from scilpy.io.streamlines import reconstruct_streamlines
 from scilpy.tractanalysis.bundle_operations import uniformize_bundle_sft
 from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
 from scilpy.tractograms.streamline_operations import smooth_line_gaussian, \
@@ -37,6 +37,7 @@ from scilpy.utils.spatial import generate_rotation_matrix
 
 MIN_NB_POINTS = 10
 KEY_INDEX = np.concatenate((range(5), range(-1, -6, -1)))
+MATCHING_CHUNK_SIZE = 100000
 
 
 def shuffle_streamlines(sft, rng_seed=None):
@@ -187,34 +188,88 @@ def flip_sft(sft, flip_axes):
     return new_sft
 
 
-def _get_streamline_key(streamline, precision=None):
-    # Use just a few data points as hash key. I could use all the data of
-    # the streamlines, but then the complexity grows with the number of
-    # points.
-    if len(streamline) < MIN_NB_POINTS:
-        key = streamline.copy()
-    else:
-        key = streamline[KEY_INDEX].copy()
+def _concatenate_streamlines(streamlines_list):
+    """
+    Concatenates lists of streamlines into a single (compact) ArraySequence,
+    without looping on the streamlines when the inputs are ArraySequences.
+    """
+    streamlines_list = [s if isinstance(s, ArraySequence) else
+                        ArraySequence(s) for s in streamlines_list]
+    streamlines_list = [s for s in streamlines_list if len(s) > 0]
 
-    if precision is not None:
-        key = np.round(key, precision)
+    streamlines = ArraySequence()
+    if len(streamlines_list) == 0:
+        return streamlines
 
-    key.flags.writeable = False
+    streamlines._data = np.concatenate(
+        [reconstruct_streamlines(s._data, s._offsets, s._lengths)._data
+         for s in streamlines_list])
+    streamlines._lengths = np.concatenate([s._lengths
+                                           for s in streamlines_list])
+    streamlines._offsets = np.concatenate(
+        ([0], np.cumsum(streamlines._lengths)[:-1]))
+    return streamlines
 
-    return key.data.tobytes()
 
+def _get_streamlines_keys(streamlines, precision=None):
+    """
+    Computes a key for each streamline, from a few of its points.
 
-def _hash_streamlines(streamlines, start_index=0, precision=None):
+    Use just a few data points as hash key. We could use all the data of the
+    streamlines, but then the complexity grows with the number of points.
+    Streamlines with less than MIN_NB_POINTS points use all their points.
+
+    Parameters
+    ----------
+    streamlines: ArraySequence
+        The streamlines.
+    precision: int, optional
+        The number of decimals to keep when hashing the points of the
+        streamlines. Points are then quantized to fixed-point integers. If
+        None, the exact bits of the points are used.
+
+    Returns
+    -------
+    keys: np.ndarray
+        Integer array of shape (nb_streamlines, 1 + 3 * len(KEY_INDEX)). Each
+        row is a streamline's key: its number of key points, then the
+        quantized key points (0-padded).
     """
-    Produces a dict from streamlines by using the points as keys and the
-    indices of the streamlines as values.
+    lengths = streamlines._lengths
+    nb_key_points = np.minimum(lengths, len(KEY_INDEX))
+    is_short = (lengths < MIN_NB_POINTS)[:, None]
+    valid = np.arange(len(KEY_INDEX)) < nb_key_points[:, None]
+
+    key_index = np.where(is_short, np.arange(len(KEY_INDEX)),
+                         KEY_INDEX % np.maximum(lengths, 1)[:, None])
+    key_index = np.where(valid, key_index, 0) + \
+        streamlines._offsets[:, None]
+    points = streamlines._data[np.minimum(key_index,
+                                          len(streamlines._data) - 1)]
+
+    if precision is None:
+        points = np.ascontiguousarray(points)
+        points = points.view('i{}'.format(points.dtype.itemsize))
+    else:
+        points = np.rint(points * 10.0 ** precision).astype(np.int64)
+    points[~valid] = 0
+
+    return np.concatenate((nb_key_points[:, None].astype(points.dtype),
+                           points.reshape((len(points), -1))), axis=1)
+
+
+def _hash_streamlines(streamlines, nb_streamlines, precision=None):
+    """
+    Produces a hash for each list of streamlines: the keys of its
+    streamlines, and for each key the index of the (last) streamline having
+    that key.
 
     Parameters
     ----------
-    streamlines: list of ndarray
-        The list of streamlines used to produce the dict.
-    start_index: int, optional
-        The index of the first streamline. 0 by default.
+    streamlines: ArraySequence
+        The concatenated lists of streamlines.
+    nb_streamlines: list[int]
+        The number of streamlines in each list.
     precision: int, optional
         The number of decimals to keep when hashing the points of the
         streamlines. Allows a soft comparison of streamlines. If None, no
@@ -222,27 +277,50 @@ def _hash_streamlines(streamlines, start_index=0, precision=None):
 
     Returns
     -------
-    A dict where the keys are streamline points and the values are indices
-    starting at start_index.
+    hashes: list[tuple]
+        For each list, a tuple (keys, indices) of np.ndarrays, with keys
+        sorted and unique. Keys are integers, comparable between lists.
+        Indices are in the concatenated streamlines.
     """
-    keys = [_get_streamline_key(s, precision) for s in streamlines]
-
-    return {k: i for i, k in enumerate(keys, start_index)}
+    if len(streamlines) == 0:
+        return [(np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+                for _ in nb_streamlines]
+
+    # Each key is viewed as a single void element (bytes of the row).
+    keys = _get_streamlines_keys(streamlines, precision)
+    keys = keys.view(np.dtype((np.void, keys.shape[1] * keys.dtype.itemsize)))
+    _, all_keys = np.unique(keys[:, 0], return_inverse=True)
+    hashes = []
+    start = 0
+    for nb in nb_streamlines:
+        # Searching in reverse: the last streamline with a given key is kept.
+        keys, last = np.unique(all_keys[start:start + nb][::-1],
+                               return_index=True)
+        hashes.append((keys, start + nb - 1 - last))
+        start += nb
+    return hashes
 
 
 def intersection(left, right):
-    """Intersection of two streamlines dict (see hash_streamlines)"""
-    return {k: v for k, v in left.items() if k in right}
+    """Intersection of two streamlines hashes (see _hash_streamlines)"""
+    keys, indices = left
+    in_right = np.isin(keys, right[0], assume_unique=True)
+    return keys[in_right], indices[in_right]
 
 
 def difference(left, right):
-    """Difference of two streamlines dict (see hash_streamlines)"""
-    return {k: v for k, v in left.items() if k not in right}
+    """Difference of two streamlines hashes (see _hash_streamlines)"""
+    keys, indices = left
+    in_right = np.isin(keys, right[0], assume_unique=True)
+    return keys[~in_right], indices[~in_right]
 
 
 def union(left, right):
-    """Union of two streamlines dict (see hash_streamlines)"""
-    return {**left, **right}
+    """Union of two streamlines hashes (see _hash_streamlines)"""
+    # For keys in both, np.unique returns the first occurrence: from right.
+    keys, first = np.unique(np.concatenate((right[0], left[0])),
+                            return_index=True)
+    return keys, np.concatenate((right[1], left[1]))[first]
 
 
 def perform_tractogram_operation_on_sft(op_name, sft_list, precision,
@@ -252,8 +330,8 @@ def perform_tractogram_operation_on_sft(op_name, sft_list, precision,
     Parameters
     ----------
     op_name: str
-        A callable that takes two streamlines dicts as inputs and preduces a
-        new streamline dict.
+        A callable that takes two streamlines hashes as inputs and preduces a
+        new streamline hash.
     sft_list: list[StatefulTractogram]
         The tractograms used in the operation.
     precision: int, optional
@@ -290,9 +368,9 @@ def perform_tractogram_operation_on_sft(op_name, sft_list, precision,
     start = 0
     for nb in streamlines_len_cumsum:
         end = start + nb
-        # Switch to int32 for json
-        indices_per_sft.append([int(i - start)
-                                for i in indices if start <= i < end])
+        # Switch to int for json
+        indices_per_sft.append(
+            (indices[(start <= indices) & (indices < end)] - start).tolist())
         start = end
 
     sft_list = [sft[indices_per_sft[i]] for i, sft in enumerate(sft_list)
@@ -310,15 +388,15 @@ def perform_tractogram_operation_on_lines(operation, streamlines,
     to the first two lists of streamlines. The result in then used recursively
     with the third, fourth, etc. lists of streamlines.
 
-    A valid operation is any function that takes two streamlines dict as input
-    and produces a new streamlines dict (see hash_streamlines). Union,
+    A valid operation is any function that takes two streamlines hashes as
+    input and produces a new streamlines hash (see _hash_streamlines). Union,
     difference, and intersection are valid examples of operations.
 
     Parameters
     ----------
     operation: callable
-        A callable that takes two streamlines dicts as inputs and preduces a
-        new streamline dict.
+        A callable that takes two streamlines hashes as inputs and preduces a
+        new streamline hash.
     streamlines: list of list of streamlines
         The streamlines used in the operation.
     precision: int, optional
@@ -328,7 +406,7 @@ def perform_tractogram_operation_on_lines(operation, streamlines,
 
     Returns
     -------
-    streamlines: list of `nib.streamline.Streamlines`
+    streamlines: ArraySequence
         The streamlines obtained after performing the operation on all the
         input streamlines.
     indices: np.ndarray
@@ -340,15 +418,14 @@ def perform_tractogram_operation_on_lines(operation, streamlines,
         return operation(streamlines, precision)
     else:
         # Hash the streamlines using the desired precision.
-        indices = np.cumsum([0] + [len(s) for s in streamlines[:-1]])
-        hashes = [_hash_streamlines(s, i, precision) for
-                  s, i in zip(streamlines, indices)]
+        all_streamlines = _concatenate_streamlines(streamlines)
+        hashes = _hash_streamlines(all_streamlines,
+                                   [len(s) for s in streamlines], precision)
 
         # Perform the operation on the hashes and get the output streamlines.
-        to_keep = reduce(operation, hashes)
-        all_streamlines = list(itertools.chain(*streamlines))
-        indices = np.array(sorted(to_keep.values())).astype(np.uint32)
-        streamlines = [all_streamlines[i] for i in indices]
+        _, indices = reduce(operation, hashes)
+        indices = np.sort(indices).astype(np.uint32)
+        streamlines = all_streamlines[indices]
     return streamlines, indices
 
 
@@ -380,11 +457,129 @@ def union_robust(streamlines_list, precision=3):
     return streamlines_fused[indices], indices
 
 
+def _find_matching_streamlines(streamlines, epsilon, nb_query):
+    """
+    Finds all pairs of 'identical' streamlines: streamlines with the same
+    number of points, with all their points closer than 2*epsilon.
+
+    Candidates are first found by comparing the first points, with a cKDTree
+    per number of points. The query is done by chunks of MATCHING_CHUNK_SIZE
+    streamlines, and candidates are verified by chunks of pairs, to limit
+    the memory usage.
+
+    Parameters
+    ----------
+    streamlines: ArraySequence
+        The streamlines (compact, see _concatenate_streamlines).
+    epsilon: float
+        Maximum allowed distance.
+    nb_query: int
+        Only pairs involving at least one of the first nb_query streamlines
+        are searched.
+
+    Returns
+    -------
+    pairs: np.ndarray
+        Array of shape (nb_pairs, 2), with pairs[:, 0] < pairs[:, 1].
+    average_match_distance: np.ndarray or None
+        The average difference between matched streamlines, or None if no
+        match was found.
+    """
+    data = streamlines._data
+    offsets = streamlines._offsets
+    lengths = streamlines._lengths
+    first_points = data[offsets[lengths > 0]]
+    first_points_ind = np.where(lengths > 0)[0]
+
+    all_pairs = []
+    sum_match_distance = np.zeros(3)
+    # Uses the number of point to speed up the search in the ckdtree
+    for point_count in np.unique(lengths[lengths > 0]):
+        same_length = lengths[first_points_ind] == point_count
+        same_length_ind = first_points_ind[same_length]
+        same_length_points = first_points[same_length]
+        tree = cKDTree(same_length_points)
+        nb_query_in_group = np.searchsorted(same_length_ind, nb_query)
+
+        for start in range(0, nb_query_in_group, MATCHING_CHUNK_SIZE):
+            end = min(start + MATCHING_CHUNK_SIZE, nb_query_in_group)
+            query_tree = cKDTree(same_length_points[start:end])
+            candidates = query_tree.sparse_distance_matrix(
+                tree, 2 * epsilon, output_type='ndarray')
+            i = same_length_ind[start + candidates['i']]
+            j = same_length_ind[candidates['j']]
+            i, j = i[i < j], j[i < j]
+
+            # Actual check of the whole streamlines
+            pairs_chunk_size = max(1, MATCHING_CHUNK_SIZE // point_count)
+            points_ind = np.arange(point_count)
+            for k in range(0, len(i), pairs_chunk_size):
+                sub_i = i[k:k + pairs_chunk_size]
+                sub_j = j[k:k + pairs_chunk_size]
+                sub_vector = data[offsets[sub_i, None] + points_ind] - \
+                    data[offsets[sub_j, None] + points_ind]
+                norm = np.linalg.norm(sub_vector, axis=-1)
+                is_match = np.all(norm < 2 * epsilon, axis=1)
+
+                all_pairs.append(np.stack((sub_i[is_match],
+                                           sub_j[is_match]), axis=1))
+                sum_match_distance += np.sum(
+                    np.average(sub_vector[is_match], axis=1), axis=0)
+
+    if len(all_pairs) == 0:
+        return np.zeros((0, 2), dtype=int), None
+
+    pairs = np.concatenate(all_pairs)
+    if len(pairs) == 0:
+        return pairs, None
+    return pairs, sum_match_distance / len(pairs)
+
+
+def _keep_first_of_matches(candidates, pairs):
+    """
+    Selects, in the order of the streamlines, each candidate for which no
+    previous candidate was selected amongst its matches. Keeps the first
+    instance of groups of identical streamlines.
+
+    Processed by rounds: a candidate is selected once all its previous
+    matching candidates are rejected, and rejected as soon as one of them is
+    selected.
+
+    Parameters
+    ----------
+    candidates: np.ndarray
+        Boolean array of shape (nb_streamlines,).
+    pairs: np.ndarray
+        Matching pairs of streamlines (see _find_matching_streamlines).
+
+    Returns
+    -------
+    selected: np.ndarray
+        Boolean array of shape (nb_streamlines,).
+    """
+    pairs = pairs[candidates[pairs[:, 0]] & candidates[pairs[:, 1]]]
+    undecided = candidates.copy()
+    selected = np.zeros(len(candidates), dtype=bool)
+    while np.any(undecided):
+        pairs = pairs[undecided[pairs[:, 1]]]
+        waiting = np.zeros(len(candidates), dtype=bool)
+        waiting[pairs[undecided[pairs[:, 0]], 1]] = True
+        new_selected = undecided & ~waiting
+        selected |= new_selected
+        undecided &= ~new_selected
+        undecided[pairs[new_selected[pairs[:, 0]], 1]] = False
+
+    return selected
+
+
 def _find_identical_streamlines(streamlines_list, epsilon=0.001,
                                 union_mode=False, difference_mode=False):
     """ Return the intersection/union/difference from a list of list of
     streamlines. Allows for a maximum distance for matching.
 
+    Identical streamlines inside the resulting set are only kept once (the
+    first instance).
+
     Parameters
     -----------
     streamlines_list: list
@@ -400,115 +595,49 @@ def _find_identical_streamlines(streamlines_list, epsilon=0.001,
     Tuple, ArraySequence, np.ndarray
         Returns the concatenated streamlines and the indices to pick from it
     """
-    streamlines = ArraySequence(itertools.chain(*streamlines_list))
-    nb_streamlines = np.cumsum([len(sft) for sft in streamlines_list])
-    nb_streamlines = np.insert(nb_streamlines, 0, 0)
+    streamlines = _concatenate_streamlines(streamlines_list)
+    nb_streamlines = [len(s) for s in streamlines_list]
+    nb_first = nb_streamlines[0]
 
     if union_mode and difference_mode:
         raise ValueError('Cannot use union_mode and difference_mode at the '
                          'same time.')
-    intersect_mode = (not union_mode and not difference_mode)
-
-    all_tree = {}
-    all_tree_mapping = {}
-    first_points = np.array(streamlines.get_data()[streamlines._offsets])
 
-    # Uses the number of point to speed up the search in the ckdtree
-    for point_count in np.unique(streamlines._lengths):
-        same_length_ind = np.where(streamlines._lengths == point_count)[0]
-        all_tree[point_count] = cKDTree(first_points[same_length_ind])
-        all_tree_mapping[point_count] = same_length_ind
-
-    inversion_val = 1 if union_mode or difference_mode else 0
-    streamlines_to_keep = np.ones((len(streamlines),)) * inversion_val
-    average_match_distance = []
-
-    # Difference by design will never select streamlines that are not from the
-    # first set
-    if difference_mode:
-        streamlines_to_keep[nb_streamlines[1]:] = 0
-    for i, streamline in enumerate(streamlines):
-        # Unless we do a union, there is no point looking past the first set
-        if not union_mode and i >= nb_streamlines[1]:
-            break
-
-        # Find the closest (first) points
-        distance_ind = all_tree[len(streamline)].query_ball_point(
-            streamline[0], r=2*epsilon)
-        actual_ind = np.sort(all_tree_mapping[len(streamline)][distance_ind])
-
-        # Intersection requires finding matches in all sets
-        if intersect_mode:
-            intersect_test = np.zeros((len(nb_streamlines)-1,))
-
-            # The streamline's set itself is obviously already ok.
-            set_i = np.max(np.where(nb_streamlines <= i)[0])
-            intersect_test[set_i] = True
-
-        # Looking at similar streamlines only:
-        for j in actual_ind:
-            # 1) Yourself is never a match.
-            #    (For union : always kept)
-            #    (For difference: if another is found, we will remove i)
-            #    (For intersection: will be kept lower if others are found).
-            if i == j:
-                continue
-
-            # Actual check of the whole streamline
-            sub_vector = streamline-streamlines[j]
-            norm = np.linalg.norm(sub_vector, axis=1)
-            average_match_distance.append(np.average(sub_vector, axis=0))
-
-            if union_mode:
-                # 1) Yourself is not a match
-                # 2) If the streamline hasn't been selected (by another match)
-                # 3) The streamline is 'identical'
-                if streamlines_to_keep[i] == 1 and (norm < 2*epsilon).all():
-                    streamlines_to_keep[j] = 0
-
-            elif difference_mode:
-                # 1) Yourself is not a match
-                # 2) The streamline is 'identical'
-                if (norm < 2*epsilon).all():
-                    set_j = np.max(np.where(nb_streamlines <= j)[0])
-
-                    # If it is an identical streamline, but from the first set,
-                    # it needs to be removed, otherwise remove all instances
-                    if set_j == 0:
-                        # If it is the first 'encounter', keep it.
-                        # Else, remove it.
-                        if streamlines_to_keep[actual_ind].all():
-                            streamlines_to_keep[j] = 0
-                    else:
-                        streamlines_to_keep[actual_ind] = 0
-            else:  # intersect_mode
-                # 1) Yourself is not a match
-                # 2) An equivalent streamline has not been selected by another
-                #    match.
-                # 3) The streamline is 'identical'
-                if (not np.any(streamlines_to_keep[actual_ind])
-                        and (norm < 2*epsilon).all()):
-                    set_j = np.max(np.where(nb_streamlines <= j)[0])
-                    # If it is an identical streamline, but from the same set
-                    # it needs to be removed (keeping streamlines_to_keep at 0)
-
-                    # Else: will be added only if it is found in all sets
-                    if set_i != set_j:
-                        intersect_test[set_j] = True
-
-        # Verify that you actually found a match in each set
-        if intersect_mode and intersect_test.all():
-            # Keeping only the first one; i.
-            streamlines_to_keep[i] = 1
+    # Unless we do a union, there is no point looking for pairs that do not
+    # involve the first set
+    pairs, average_match_distance = _find_matching_streamlines(
+        streamlines, epsilon, len(streamlines) if union_mode else nb_first)
+    with_other_set = pairs[:, 1] >= nb_first
+
+    candidates = np.zeros(len(streamlines), dtype=bool)
+    if union_mode:
+        candidates[:] = True
+    elif difference_mode:
+        # Difference by design will never select streamlines that are not
+        # from the first set, nor streamlines found in another set.
+        candidates[:nb_first] = True
+        candidates[pairs[with_other_set, 0]] = False
+    else:
+        # Intersection requires finding matches in all sets.
+        # The streamline's set itself is obviously already ok.
+        set_ids = np.repeat(np.arange(len(nb_streamlines)), nb_streamlines)
+        intersect_test = np.zeros((nb_first, len(nb_streamlines)),
+                                  dtype=bool)
+        intersect_test[:, 0] = True
+        intersect_test[pairs[with_other_set, 0],
+                       set_ids[pairs[with_other_set, 1]]] = True
+        candidates[:nb_first] = np.all(intersect_test, axis=1)
+
+    streamlines_to_keep = _keep_first_of_matches(candidates, pairs)
 
     # To facilitate debugging and discovering shifts in data
-    if average_match_distance:
+    if average_match_distance is not None:
         logging.info('Average matches distance: {}mm'.format(
-            np.round(np.average(average_match_distance, axis=0), 5)))
+            np.round(average_match_distance, 5)))
     else:
         logging.info('No matches found.')
 
-    return streamlines, np.where(streamlines_to_keep > 0)[0].astype(np.uint32)
+    return streamlines, np.where(streamlines_to_keep)[0].astype(np.uint32)
 
 
 def concatenate_sft(sft_list, erase_metadata=False, metadata_fake_init=False):
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+
+import numpy as np
+from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
+from nibabel.streamlines.array_sequence import ArraySequence
+from scipy.sparse import csr_matrix
+
+from scilpy.io.streamlines import reconstruct_streamlines
+from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
+
+
+def _get_vox_corner_streamlines(sft):
+    """
+    Returns the streamlines in voxel space, aligned to corner (as float32, as
+    expected by streamlines_to_voxel_coordinates). If the sft is in another
+    space, a copy is converted: the sft is not modified.
+    """
+    if sft.space == Space.VOX and sft.origin == Origin.TRACKVIS and \
+            sft.streamlines._data.dtype == np.float32:
+        return sft.streamlines
+
+    sft = StatefulTractogram.from_sft(reconstruct_streamlines(
+        sft.streamlines._data, sft.streamlines._offsets,
+        sft.streamlines._lengths), sft)
+    sft.to_vox()
+    sft.to_corner()
+    streamlines = sft.streamlines
+    if streamlines._data.dtype != np.float32:
+        streamlines = reconstruct_streamlines(
+            streamlines._data.astype(np.float32), streamlines._offsets,
+            streamlines._lengths)
+    return streamlines
+
+
+def _get_signature(streamlines, dimensions, affine):
+    """
+    Hash of the streamlines (in voxel space, corner), of the dimensions and of
+    the affine of a tractogram, used to verify that a saved index belongs to
+    a tractogram.
+    """
+    signature = hashlib.blake2b(digest_size=16)
+    for array in [np.asarray(dimensions, dtype=np.int64),
+                  np.asarray(affine, dtype=np.float64),
+                  np.asarray(streamlines._lengths, dtype=np.int64),
+                  np.asarray(streamlines._data, dtype=np.float32)]:
+        signature.update(np.ascontiguousarray(array).data)
+    return signature.hexdigest()
+
+
+def _gather(data, lengths, indices):
+    """
+    Gathers the rows of the given sequences (as data and lengths), in the
+    order of indices. Returns the new data and lengths.
+    """
+    offsets = np.zeros(len(lengths), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+
+    new_lengths = lengths[indices]
+    new_offsets = np.zeros(len(new_lengths), dtype=np.intp)
+    np.cumsum(new_lengths[:-1], out=new_offsets[1:])
+    positions = np.arange(np.sum(new_lengths), dtype=np.intp) + np.repeat(
+        offsets[indices] - new_offsets, new_lengths)
+    return data[positions], new_lengths
+
+
+class VoxelTraversalIndex(object):
+    """
+    Sparse streamline x voxel index of the voxels traversed by each streamline
+    of a tractogram, as computed by streamlines_to_voxel_coordinates.
+
+    This traversal is the costly part of most streamlines / mask operations
+    (filtering, connectivity). The index can be saved next to the tractogram
+    (see load_or_compute_voxel_traversal_index) and shared by all the scripts
+    of a pipeline.
+
+    Note. For points lying exactly on voxel faces, the traversal of
+    streamlines_to_voxel_coordinates does not always find the same voxels as
+    compute_tract_counts_map or as dipy's traversal (used by
+    streamlines_in_mask without an index). Density maps are thus not
+    computed from the index, and streamlines selected with the index may
+    differ on faces. Elsewhere, the voxels are the same.
+    """
+    def __init__(self, voxels, lengths, points_to_index, dimensions,
+                 signature=None):
+        """
+        Parameters
+        ----------
+        voxels: np.ndarray
+            The [i, j, k] indices (uint16) of the voxels traversed by all
+            streamlines, one streamline after the other.
+        lengths: np.ndarray
+            The number of voxels of each streamline.
+        points_to_index: ArraySequence
+            For each streamline point, the associated voxel in voxels.
+        dimensions: np.ndarray
+            The dimensions of the volume.
+        signature: str, optional
+            Signature of the tractogram from which the index was computed.
+        """
+        self.voxels = voxels
+        self.lengths = np.asarray(lengths, dtype=np.intp)
+        self.points_to_index = points_to_index
+        self.dimensions = np.asarray(dimensions, dtype=int)
+        self.signature = signature
+
+        self.offsets = np.zeros(len(self.lengths), dtype=np.intp)
+        np.cumsum(self.lengths[:-1], out=self.offsets[1:])
+
+        self._flat_voxels = None
+        self._unique = None
+
+    @classmethod
+    def from_sft(cls, sft):
+        """
+        Computes the index of a tractogram.
+
+        Parameters
+        ----------
+        sft: StatefulTractogram
+            The tractogram. It is not modified.
+
+        Returns
+        -------
+        voxel_index: VoxelTraversalIndex
+        """
+        streamlines = _get_vox_corner_streamlines(sft)
+        return cls._from_vox_corner_streamlines(
+            streamlines, sft.dimensions,
+            _get_signature(streamlines, sft.dimensions, sft.affine))
+
+    @classmethod
+    def _from_vox_corner_streamlines(cls, streamlines, dimensions,
+                                     signature=None):
+        if len(streamlines) == 0:
+            return cls(np.zeros((0, 3), dtype=np.uint16), [], ArraySequence(),
+                       dimensions, signature)
+
+        voxels, points_to_index = streamlines_to_voxel_coordinates(
+            streamlines, return_mapping=True)
+        return cls(voxels._data, voxels._lengths, points_to_index,
+                   dimensions, signature)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads an index saved with save().
+
+        Parameters
+        ----------
+        filename: str
+            The .npz file.
+
+        Returns
+        -------
+        voxel_index: VoxelTraversalIndex
+        """
+        with np.load(filename) as data:
+            points_to_index = ArraySequence()
+            points_to_index._data = data['points_to_index']
+            points_to_index._lengths = data['nb_points']
+            points_to_index._offsets = np.zeros(
+                len(points_to_index._lengths), dtype=np.intp)
+            np.cumsum(points_to_index._lengths[:-1],
+                      out=points_to_index._offsets[1:])
+            return cls(data['voxels'], data['lengths'], points_to_index,
+                       data['dimensions'], str(data['signature']))
+
+    def save(self, filename):
+        """
+        Saves the index as an (uncompressed) .npz file.
+
+        Parameters
+        ----------
+        filename: str
+            The .npz file.
+        """
+        # Opening the file ourselves: np.savez would add the .npz extension.
+        with open(filename, 'wb') as f:
+            np.savez(f, voxels=self.voxels, lengths=self.lengths,
+                     points_to_index=self.points_to_index._data,
+                     nb_points=self.points_to_index._lengths,
+                     dimensions=self.dimensions,
+                     signature=str(self.signature))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def matches(self, sft):
+        """
+        Verifies that the index was computed from this tractogram.
+
+        Parameters
+        ----------
+        sft: StatefulTractogram
+            The tractogram. It is not modified.
+
+        Returns
+        -------
+        matches: bool
+        """
+        return self.signature == _get_signature(
+            _get_vox_corner_streamlines(sft), sft.dimensions, sft.affine)
+
+    @property
+    def flat_voxels(self):
+        """Flat (C-order) indices of the traversed voxels."""
+        if self._flat_voxels is None:
+            self._flat_voxels = np.ravel_multi_index(
+                self.voxels.T.astype(np.intp), self.dimensions, mode='clip')
+        return self._flat_voxels
+
+    @property
+    def streamline_ids(self):
+        """Streamline of each traversed voxel."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def _get_unique(self):
+        # A streamline can traverse the same voxel more than once, (only
+        # consecutive voxels are unique). Sorting (streamline, voxel) pairs.
+        if self._unique is None:
+            nb_voxels = np.prod(self.dimensions)
+            keys = np.unique(self.streamline_ids.astype(np.int64) * nb_voxels
+                             + self.flat_voxels)
+            self._unique = (keys // nb_voxels, keys % nb_voxels)
+        return self._unique
+
+    def get_voxel_coordinates(self):
+        """
+        Returns the voxels traversed by each streamline, as returned by
+        streamlines_to_voxel_coordinates.
+
+        Returns
+        -------
+        indices: ArraySequence
+            The [i, j, k] indices of the voxels of each streamline.
+        points_to_index: ArraySequence
+            For each streamline point, the associated voxel in indices.
+        """
+        indices = ArraySequence()
+        indices._data = self.voxels
+        indices._lengths = self.lengths
+        indices._offsets = self.offsets
+        return indices, self.points_to_index
+
+    def select(self, indices):
+        """
+        Returns the index of a subset of the streamlines, ex, of a bundle
+        extracted from the tractogram.
+
+        Parameters
+        ----------
+        indices: np.ndarray
+            Indices of the streamlines to keep.
+
+        Returns
+        -------
+        voxel_index: VoxelTraversalIndex
+            The index of the subset. Its signature is not set.
+        """
+        indices = np.asarray(indices, dtype=np.intp).reshape(-1)
+        voxels, lengths = _gather(self.voxels, self.lengths, indices)
+
+        points_to_index = ArraySequence()
+        points_to_index._data, points_to_index._lengths = _gather(
+            self.points_to_index._data, self.points_to_index._lengths,
+            indices)
+        points_to_index._offsets = np.zeros(len(indices), dtype=np.intp)
+        np.cumsum(points_to_index._lengths[:-1],
+                  out=points_to_index._offsets[1:])
+
+        return VoxelTraversalIndex(voxels, lengths, points_to_index,
+                                   self.dimensions)
+
+    def to_csr(self):
+        """
+        Returns the index as a binary sparse matrix.
+
+        Returns
+        -------
+        matrix: scipy.sparse.csr_matrix
+            Matrix of shape (nb_streamlines, nb_voxels in the volume), with
+            ones where a streamline traverses a voxel.
+        """
+        rows, columns = self._get_unique()
+        indptr = np.zeros(len(self) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(rows, minlength=len(self)), out=indptr[1:])
+        return csr_matrix((np.ones(len(columns), dtype=bool), columns, indptr),
+                          shape=(len(self), np.prod(self.dimensions)))
+
+    def streamlines_in_mask(self, mask, all_in=False):
+        """
+        Finds the streamlines traversing a mask. Same as
+        scilpy.segment.streamlines.streamlines_in_mask, except for
+        streamlines with points lying exactly on voxel faces (see the class
+        description).
+
+        Parameters
+        ----------
+        mask: np.ndarray
+            Binary mask of the dimensions of the volume.
+        all_in: bool
+            If true, streamlines must be entirely in the mask. Else, they must
+            traverse at least one voxel of the mask.
+
+        Returns
+        -------
+        in_mask: np.ndarray
+            Boolean array of shape (nb_streamlines,).
+        """
+        mask = np.asarray(mask).astype(bool)
+        nb_in_mask = np.bincount(self.streamline_ids,
+                                 weights=mask.ravel()[self.flat_voxels],
+                                 minlength=len(self))
+        if all_in:
+            return nb_in_mask == self.lengths
+        return nb_in_mask > 0
+
+
+def load_or_compute_voxel_traversal_index(sft, filename=None,
+                                          overwrite=False):
+    """
+    Gets the voxel traversal index of a tractogram. If filename exists and
+    was computed from this tractogram, the index is loaded. Else, it is
+    computed and, if filename is given, saved for the next uses.
+
+    Parameters
+    ----------
+    sft: StatefulTractogram
+        The tractogram. It is not modified.
+    filename: str, optional
+        The .npz file caching the index.
+    overwrite: bool, optional
+        If filename exists but was computed from another tractogram, it is
+        only replaced if overwrite is True. Else, a ValueError is raised.
+
+    Returns
+    -------
+    voxel_index: VoxelTraversalIndex
+    """
+    streamlines = _get_vox_corner_streamlines(sft)
+    if filename is None:
+        return VoxelTraversalIndex._from_vox_corner_streamlines(
+            streamlines, sft.dimensions)
+
+    signature = _get_signature(streamlines, sft.dimensions, sft.affine)
+    if os.path.isfile(filename):
+        voxel_index = VoxelTraversalIndex.load(filename)
+        if voxel_index.signature == signature:
+            logging.info('Using the voxel traversal index {}.'
+                         .format(filename))
+            return voxel_index
+        if not overwrite:
+            raise ValueError('The voxel traversal index {} was not computed '
+                             'from this tractogram. Use overwrite to compute '
+                             'it again.'.format(filename))
+        logging.warning('The voxel traversal index {} was not computed from '
+                        'this tractogram. Computing it again.'
+                        .format(filename))
+
+    voxel_index = VoxelTraversalIndex._from_vox_corner_streamlines(
+        streamlines, sft.dimensions, signature)
+    voxel_index.save(filename)
+    return voxel_index
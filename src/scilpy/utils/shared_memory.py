@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedMemoryArray(object):
+    """
+    Numpy array stored in a multiprocessing.shared_memory block, so that
+    sub-processes can access it without copying it through a file or
+    pickling it.
+
+    The process creating the array owns the memory block and must release it
+    with unlink() (or use the object as a context manager). Sub-processes
+    attach to it with SharedMemoryArray.attach(info), where info is given by
+    get_info(), and should only close() it. If the owner dies before
+    unlinking the block, it is released by the multiprocessing resource
+    tracker when the main program exits.
+    """
+    def __init__(self, shape, dtype, name=None):
+        """
+        Parameters
+        ----------
+        shape: tuple
+            Shape of the array.
+        dtype: np.dtype or str
+            Data type of the array.
+        name: str or None
+            Name of an existing memory block to attach to. If None, a new
+            memory block is created (and owned by this object).
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.is_owner = name is None
+
+        if self.is_owner:
+            # A memory block can't be empty.
+            nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        Create a new memory block and copy the array into it.
+
+        Parameters
+        ----------
+        array: np.ndarray
+            The data to share.
+
+        Returns
+        -------
+        shared: SharedMemoryArray
+        """
+        shared = cls(array.shape, array.dtype)
+        try:
+            shared.array[...] = array
+        except BaseException:
+            shared.unlink()
+            raise
+        return shared
+
+    @classmethod
+    def attach(cls, info):
+        """
+        Attach to a memory block created by another process.
+
+        Parameters
+        ----------
+        info: dict
+            The output of get_info() in the owner process.
+
+        Returns
+        -------
+        shared: SharedMemoryArray
+        """
+        return cls(info['shape'], info['dtype'], name=info['name'])
+
+    def get_info(self):
+        """
+        Returns the (picklable) information necessary to attach to this
+        memory block from another process.
+        """
+        return {'name': self.shm.name,
+                'shape': self.shape,
+                'dtype': self.dtype.str}
+
+    def close(self):
+        """
+        Close access to the memory block from this process. The array can't
+        be used afterwards.
+        """
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views of the array still exist elsewhere. The memory will be
+            # unmapped when they are garbage collected.
+            logging.debug("Shared memory block {} is still in use; not "
+                          "closing it.".format(self.shm.name))
+
+    def unlink(self):
+        """
+        Close and, if this process is the owner, release the memory block.
+        Other processes keep their access until they close it.
+        """
+        if self.is_owner:
+            self.shm.unlink()
+            self.is_owner = False
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from scilpy.utils.shared_memory import SharedMemoryArray
+
+
+def _sum_shared(info):
+    shared = SharedMemoryArray.attach(info)
+    total = float(np.sum(shared.array))
+    shared.close()
+    return total
+
+
+def test_from_array():
+    data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+    with SharedMemoryArray.from_array(data) as shared:
+        assert shared.array.dtype == np.float32
+        np.testing.assert_array_equal(shared.array, data)
+
+        # Not a copy of the attached block: modifications are shared.
+        attached = SharedMemoryArray.attach(shared.get_info())
+        attached.array[0, 0, 0] = 100
+        assert shared.array[0, 0, 0] == 100
+        attached.close()
+
+
+def test_attach_in_subprocess():
+    data = np.ones((10, 10))
+    with SharedMemoryArray.from_array(data) as shared:
+        with multiprocessing.Pool(2) as pool:
+            totals = pool.map(_sum_shared, [shared.get_info()] * 2)
+    assert totals == [100, 100]
+
+
+def test_unlink():
+    shared = SharedMemoryArray((5,), 'int32')
+    info = shared.get_info()
+    shared.unlink()
+    assert shared.array is None
+    with pytest.raises(FileNotFoundError):
+        SharedMemoryArray.attach(info)